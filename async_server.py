@@ -0,0 +1,479 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import io
+import logging
+import signal
+import sys
+import threading
+from urllib.parse import unquote_to_bytes
+
+# Threads that run the app's route functions. Only requests being handled
+# hold one; idle keep-alive connections are held by the event loop alone
+THREADS = 16
+# Seconds a keep-alive connection may wait for its next request
+KEEP_ALIVE_TIMEOUT = 300
+# Connections the listening socket queues before they are accepted
+BACKLOG = 1024
+# Request bodies with a Content-Length up to this size are read before the
+# app is called; longer and chunked ones are read as the app reads them
+BUFFERED_BODY = 65536
+# Response bodies with a Content-Length are written this many bytes at a
+# time once they are longer
+WRITE_CHUNK = 65536
+# The longest request line or header line accepted
+MAX_LINE = 65536
+# The most bytes of header lines accepted with one request
+MAX_HEADER_SIZE = 65536
+# Seconds a client may take to send the head of a request once it has sent
+# its request line, and to send each part of its body the app reads
+REQUEST_TIMEOUT = 60
+# Seconds the requests being handled are given to finish once the server
+# is asked to stop
+DRAIN_TIMEOUT = 30
+
+REASONS = {400: "Bad Request", 413: "Content Too Large",
+           431: "Request Header Fields Too Large",
+           500: "Internal Server Error",
+           505: "HTTP Version Not Supported"}
+VERSIONS = ("HTTP/1.0", "HTTP/1.1")
+
+
+class _Refused(Exception):
+    # A request refused before the app is called, with the status code
+    # to answer it with
+    def __init__(self, status_code):
+        super().__init__(status_code)
+        self.status_code = status_code
+
+
+class _Body(io.RawIOBase):
+    """ The body of a request, read from its connection as the app reads it
+
+    The app runs on a thread of the pool and the connection belongs to the
+    event loop, so every read is handed to the loop and waited for.
+    """
+
+    def __init__(self, reader, loop, length=None):
+        """ Read a body from a connection
+
+        :param reader: the connection's asyncio.StreamReader
+        :param loop: the event loop that serves the connection
+        :param length: the Content-Length of the body, or None for a body
+        sent with chunked transfer encoding
+        """
+        self.reader = reader
+        self.loop = loop
+        self.chunked = length is None
+        self.remaining = None if self.chunked else length
+        self.done = length == 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            data = asyncio.run_coroutine_threadsafe(asyncio.wait_for(
+                self._read(len(buffer)), REQUEST_TIMEOUT), self.loop).result()
+        except asyncio.TimeoutError:
+            raise ConnectionError("The client stopped sending the body")
+        buffer[:len(data)] = data
+        return len(data)
+
+    async def _read(self, size):
+        if self.done:
+            return b""
+        if self.chunked and not self.remaining:
+            if self.remaining == 0:
+                await self.reader.readexactly(2)
+            line = await self.reader.readline()
+            digits = line.split(b";")[0].strip()
+            if not digits or digits.strip(b"0123456789abcdefABCDEF"):
+                raise ValueError("Not a chunk size: {!r}".format(line))
+            self.remaining = int(digits, 16)
+            if self.remaining == 0:
+                while (await self.reader.readline()).strip():
+                    pass
+                self.done = True
+                return b""
+        data = await self.reader.read(min(size, self.remaining))
+        if not data:
+            raise ConnectionError("The client closed the connection")
+        self.remaining -= len(data)
+        if not self.chunked and self.remaining == 0:
+            self.done = True
+        return data
+
+
+def _path(target):
+    # The path and query of a request's target, which may be sent in
+    # absolute form, e.g. "http://127.0.0.1:5000/api?q=1"
+    if target.startswith("/"):
+        return target
+    for scheme in ("http://", "https://"):
+        if target.lower().startswith(scheme):
+            rest = target[len(scheme):]
+            slash = rest.find("/")
+            return "/" if slash < 0 else rest[slash:]
+    raise ValueError("Not a request target: " + target)
+
+
+class AsyncServer:
+    """ Serves a WSGI app, such as the Flask app of heart_rate_sentinel.py,
+    from an asyncio event loop
+
+    The development server that app.run starts gives every connection a
+    thread of its own, for as long as the connection is open, so thousands
+    of bedside devices keeping their connections open need thousands of
+    threads. Here the event loop reads every connection's requests and
+    writes their responses, and only the route functions run on a pool of
+    threads, one thread per request being handled. The route functions
+    wait for the log to reach the disk on those threads without holding up
+    the event loop; e-mails are sent by the app's own background thread.
+    Once stop is called, the server stops accepting connections, closes
+    the ones waiting for their next request and gives the requests being
+    handled drain_timeout seconds to finish before serve returns; their
+    responses close their connections.
+    """
+
+    def __init__(self, app, threads=THREADS,
+                 keep_alive_timeout=KEEP_ALIVE_TIMEOUT, max_body_size=None,
+                 max_header_size=MAX_HEADER_SIZE,
+                 drain_timeout=DRAIN_TIMEOUT):
+        """ Create a server for an app
+
+        :param app: the WSGI app
+        :param threads: the number of threads that run the app
+        :param keep_alive_timeout: seconds a connection may stay idle
+        between two requests before it is closed
+        :param max_body_size: the longest Content-Length accepted, or None
+        to accept any. Longer requests are answered with 413 without being
+        read; chunked bodies are left for the app to limit, e.g. with
+        Flask's MAX_CONTENT_LENGTH
+        :param max_header_size: the most bytes of header lines accepted;
+        requests with more are answered with 431
+        :param drain_timeout: seconds the requests being handled are given
+        to finish once stop is called
+        """
+        self.app = app
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_body_size = max_body_size
+        self.max_header_size = max_header_size
+        self.drain_timeout = drain_timeout
+        self.executor = ThreadPoolExecutor(threads,
+                                           thread_name_prefix="async-app")
+        self.connections = 0
+        # The number of requests being handled
+        self.requests = 0
+        self.draining = False
+        self.loop = None
+        # Set by stop; the event that wakes serve is made by serve itself,
+        # as before Python 3.10 an asyncio.Event belongs to the event loop
+        # current when it is made
+        self._stop_asked = False
+        self._stopping = None
+        # The tasks of every open connection, and of those waiting for
+        # their next request
+        self._tasks = set()
+        self._idle = set()
+        # The address and port connections are accepted on, once serving
+        self.address = ("127.0.0.1", 5000)
+
+    async def serve(self, host="127.0.0.1", port=5000, sock=None,
+                    backlog=BACKLOG, started=None):
+        """ Accept and serve connections until cancelled
+
+        :param host: the address to listen on
+        :param port: the port to listen on
+        :param sock: a listening socket to accept connections from instead,
+        e.g. one shared by several worker processes
+        :param backlog: the length of the listening socket's queue
+        :param started: an optional threading.Event set once connections
+        are accepted
+        """
+        self._stopping = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        if self._stop_asked:
+            self._stopping.set()
+        if sock is None:
+            server = await asyncio.start_server(
+                self._connection, host, port, backlog=backlog,
+                limit=MAX_LINE)
+        else:
+            server = await asyncio.start_server(
+                self._connection, sock=sock, backlog=backlog,
+                limit=MAX_LINE)
+        self.address = server.sockets[0].getsockname()[:2]
+        async with server:
+            if started is not None:
+                started.set()
+            await self._stopping.wait()
+            await self._drain(server)
+
+    def stop(self):
+        """ Ask the server to stop, letting the requests being handled
+        finish first. May be called from any thread.
+        """
+        self._stop_asked = True
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._stopping.set)
+
+    async def _drain(self, server):
+        server.close()
+        self.draining = True
+        for task in list(self._idle):
+            task.cancel()
+        deadline = self.loop.time() + self.drain_timeout
+        while self.requests and self.loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if self.requests:
+            logging.warning("Stopped with {} requests still being handled"
+                            .format(self.requests))
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self.connections += 1
+        try:
+            while not self.draining:
+                self._idle.add(task)
+                try:
+                    request_line = await asyncio.wait_for(
+                        reader.readline(), self.keep_alive_timeout)
+                except asyncio.TimeoutError:
+                    break
+                finally:
+                    self._idle.discard(task)
+                if not request_line:
+                    break
+                if not request_line.strip():
+                    continue
+                self.requests += 1
+                try:
+                    if not await self._request(request_line, reader, writer):
+                        break
+                finally:
+                    self.requests -= 1
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._tasks.discard(task)
+            self.connections -= 1
+            writer.close()
+
+    async def _request(self, request_line, reader, writer):
+        # Serves one request and returns True if the connection is kept
+        # open for the next one
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+            if version not in VERSIONS:
+                raise _Refused(505 if version.startswith("HTTP/") else 400)
+            path = _path(target)
+            headers = await asyncio.wait_for(self._headers(reader),
+                                             REQUEST_TIMEOUT)
+            length = headers.get("CONTENT_LENGTH")
+            encoding = headers.get("HTTP_TRANSFER_ENCODING")
+            if encoding is not None:
+                # Only chunked bodies are understood, and a body with both
+                # headers could be read differently by a proxy in front
+                if encoding.strip().lower() != "chunked" or \
+                        length is not None:
+                    raise ValueError("Unsupported Transfer-Encoding")
+                length = None
+            elif length is None:
+                length = 0
+            elif length.isdigit():
+                length = int(length)
+            else:
+                raise ValueError("Not a Content-Length: " + length)
+            if length is not None and self.max_body_size is not None and \
+                    length > self.max_body_size:
+                raise _Refused(413)
+        except asyncio.TimeoutError:
+            return False
+        except ValueError:
+            await self._write_error(writer, 400)
+            return False
+        except _Refused as refused:
+            await self._write_error(writer, refused.status_code)
+            return False
+        connection = headers.get("HTTP_CONNECTION", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = "close" not in connection
+        else:
+            keep_alive = "keep-alive" in connection
+        if headers.get("HTTP_EXPECT", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        if length is not None and length <= BUFFERED_BODY:
+            body = None
+            try:
+                stream = io.BytesIO(await asyncio.wait_for(
+                    reader.readexactly(length), REQUEST_TIMEOUT))
+            except asyncio.TimeoutError:
+                return False
+        else:
+            body = _Body(reader, self.loop, length)
+            stream = io.BufferedReader(body, WRITE_CHUNK)
+        path, _, query = path.partition("?")
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote_to_bytes(path).decode("latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": str(self.address[0]),
+            "SERVER_PORT": str(self.address[1]),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": str(
+                (writer.get_extra_info("peername") or ("", 0))[0]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": stream,
+            "wsgi.input_terminated": True,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False}
+        environ.update(headers)
+        head, chunks = await self.loop.run_in_executor(
+            self.executor, self._run_app, environ, writer, keep_alive)
+        if body is not None and not body.done or self.draining:
+            # The app left part of the body unread, so the next request
+            # cannot be found; or the server is stopping
+            keep_alive = False
+        if head is not None:
+            writer.write(head)
+        writer.writelines(chunks)
+        await writer.drain()
+        return keep_alive
+
+    async def _headers(self, reader):
+        headers = {}
+        size = 0
+        while True:
+            line = await reader.readline()
+            if not line.strip():
+                return headers
+            size += len(line)
+            if size > self.max_header_size:
+                raise _Refused(431)
+            name, value = line.decode("latin-1").split(":", 1)
+            if not name or any(char.isspace() for char in name):
+                # Includes lines folded onto the one before, which
+                # HTTP/1.1 no longer allows
+                raise ValueError("Not a header name: " + name)
+            key = name.strip().upper().replace("-", "_")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = "HTTP_" + key
+            value = value.strip()
+            if key in headers:
+                value = headers[key] + "," + value
+            headers[key] = value
+
+    def _run_app(self, environ, writer, keep_alive):
+        # Runs on a thread of the pool. Returns the head of the response
+        # and its body chunks for the event loop to write, or None and the
+        # rest of the body once a long body's start has been written
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+
+        try:
+            result = self.app(environ, start_response)
+        except Exception:
+            logging.exception("The app failed to handle a request")
+            return self._error_head(500, keep_alive), []
+        try:
+            chunks = []
+            size = 0
+            head = None
+            lengths = [value for name, value in response[1]
+                       if name.lower() == "content-length"]
+            for chunk in result:
+                chunks.append(chunk)
+                size += len(chunk)
+                if lengths and size >= WRITE_CHUNK:
+                    if head is None:
+                        head = self._head(response, keep_alive)
+                        chunks.insert(0, head)
+                    self._write_now(writer, chunks)
+                    chunks = []
+                    size = 0
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        if head is not None:
+            return None, chunks
+        if not lengths and environ["REQUEST_METHOD"] != "HEAD":
+            response[1].append(("Content-Length", str(size)))
+        return self._head(response, keep_alive), chunks
+
+    def _write_now(self, writer, chunks):
+        async def write():
+            writer.writelines(chunks)
+            await writer.drain()
+        asyncio.run_coroutine_threadsafe(write(), self.loop).result()
+
+    def _head(self, response, keep_alive):
+        status, headers = response
+        lines = ["HTTP/1.1 " + status]
+        lines.extend("{}: {}".format(name, value) for name, value in headers)
+        keep_alive = keep_alive and not self.draining
+        lines.append("Connection: " + ("keep-alive" if keep_alive else
+                                       "close"))
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    def _error_head(self, status_code, keep_alive):
+        return self._head(["{} {}".format(status_code,
+                                          REASONS[status_code]),
+                           [("Content-Length", "0")]], keep_alive)
+
+    async def _write_error(self, writer, status_code):
+        writer.write(self._error_head(status_code, False))
+        await writer.drain()
+
+
+def run(app, host="127.0.0.1", port=5000, sock=None, threads=THREADS,
+        keep_alive_timeout=KEEP_ALIVE_TIMEOUT, backlog=BACKLOG,
+        max_body_size=None, max_header_size=MAX_HEADER_SIZE,
+        drain_timeout=DRAIN_TIMEOUT):
+    """ Serve a WSGI app from an asyncio event loop until interrupted
+
+    SIGINT (Ctrl+C) and SIGTERM stop the server once the requests being
+    handled have finished, unless the process ignores them or run is
+    called from another thread than the main one.
+
+    :param app: the WSGI app
+    :param host: the address to listen on
+    :param port: the port to listen on
+    :param sock: a listening socket to accept connections from instead
+    :param threads: the number of threads that run the app
+    :param keep_alive_timeout: seconds a connection may stay idle between
+    two requests
+    :param backlog: the length of the listening socket's queue
+    :param max_body_size: the longest Content-Length accepted, or None
+    :param max_header_size: the most bytes of header lines accepted
+    :param drain_timeout: seconds the requests being handled are given to
+    finish once the server is stopped
+    """
+    server = AsyncServer(app, threads, keep_alive_timeout, max_body_size,
+                         max_header_size, drain_timeout)
+
+    async def serve():
+        loop = asyncio.get_running_loop()
+        # Signal handlers can only be set from the main thread
+        if threading.current_thread() is threading.main_thread():
+            for signal_number in (signal.SIGINT, signal.SIGTERM):
+                if signal.getsignal(signal_number) is not signal.SIG_IGN:
+                    loop.add_signal_handler(signal_number, server.stop)
+        await server.serve(host, port, sock, backlog)
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.executor.shutdown(wait=False)
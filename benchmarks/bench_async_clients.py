@@ -0,0 +1,149 @@
+"""Hold CLIENTS keep-alive connections open to the server, as bedside
+devices do, and have each post a heart rate every INTERVAL seconds for
+ROUNDS rounds. The server is run as app.run starts it, with a thread per
+connection, and with --asyncio, where an event loop holds the connections
+and only the requests being handled run on threads. The clients connect
+over the first INTERVAL seconds and share one asyncio event loop in this
+process; a client whose connection the server closes after answering
+(as the development server does after every request) connects again for
+its next request, and the time to connect counts towards the request's
+latency. Shown are the requests answered per second, their latency, the
+clients that failed and the most threads and memory the server used.
+Every reading is logged to disk with fsync.
+
+Run from the repository root with:  python benchmarks/bench_async_clients.py
+"""
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import requests
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), "heart_rate_sentinel.py")
+PORT = 5341
+CLIENTS = 5000
+ROUNDS = 3
+INTERVAL = 5.0
+PATIENTS = 500
+# Seconds a client waits for a connection or an answer before it fails
+TIMEOUT = 30.0
+
+
+def start_server(directory, *args):
+    server = subprocess.Popen([sys.executable, SERVER, "--port", str(PORT)] +
+                              list(args), cwd=directory,
+                              stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            requests.get("http://127.0.0.1:{}/api".format(PORT))
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise AssertionError("the server did not start")
+
+
+def server_usage(pid):
+    usage = {}
+    with open("/proc/{}/status".format(pid)) as status:
+        for line in status:
+            key, _, value = line.partition(":")
+            if key in ("Threads", "VmRSS"):
+                usage[key] = int(value.split()[0])
+    return usage
+
+
+async def device(number, latencies, failures):
+    # Reconnects whenever the server closed the connection after answering
+    await asyncio.sleep(random.uniform(0, INTERVAL))
+    writer = None
+    try:
+        for count in range(ROUNDS):
+            body = json.dumps({"patient_id": number % PATIENTS,
+                               "heart_rate": 60 + count}).encode()
+            began = time.perf_counter()
+            if writer is None:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection("127.0.0.1", PORT), TIMEOUT)
+            writer.write(b"POST /api/heart_rate HTTP/1.1\r\n"
+                         b"Host: 127.0.0.1\r\n"
+                         b"Content-Type: application/json\r\n"
+                         b"Content-Length: " + str(len(body)).encode() +
+                         b"\r\n\r\n" + body)
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"),
+                                          TIMEOUT)
+            length = int(head.lower().split(b"content-length:")[1]
+                         .split(b"\r\n")[0])
+            await reader.readexactly(length)
+            if not head.startswith(b"HTTP/1.1 200"):
+                raise ConnectionError(head)
+            latencies.append(time.perf_counter() - began)
+            if b"connection: close" in head.lower():
+                writer.close()
+                writer = None
+            await asyncio.sleep(INTERVAL - (time.perf_counter() - began) %
+                                INTERVAL)
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        failures.append(number)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def run_devices(pid):
+    latencies = []
+    failures = []
+    peak = {"Threads": 0, "VmRSS": 0}
+
+    async def sample():
+        while True:
+            for key, value in server_usage(pid).items():
+                peak[key] = max(peak[key], value)
+            await asyncio.sleep(0.2)
+
+    sampler = asyncio.ensure_future(sample())
+    began = time.perf_counter()
+    await asyncio.gather(*[device(number, latencies, failures)
+                           for number in range(CLIENTS)])
+    seconds = time.perf_counter() - began
+    sampler.cancel()
+    return latencies, failures, seconds, peak
+
+
+def run(*args):
+    directory = tempfile.mkdtemp()
+    server = start_server(directory, *args)
+    try:
+        requests.post("http://127.0.0.1:{}/api/bulk_import".format(PORT),
+                      data="".join(json.dumps({
+                          "patient_id": patient_id,
+                          "attending_username": "Smith.J",
+                          "patient_age": 50}) + "\n"
+                          for patient_id in range(PATIENTS)))
+        latencies, failures, seconds, peak = asyncio.run(
+            run_devices(server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(directory)
+    latencies.sort()
+    return (len(latencies) / seconds,
+            1000 * latencies[len(latencies) // 2] if latencies else 0,
+            1000 * latencies[int(0.99 * len(latencies))] if latencies else 0,
+            len(failures), peak["Threads"], peak["VmRSS"] / 1024)
+
+
+if __name__ == "__main__":
+    print("{} clients posting a heart rate every {} s, {} times each"
+          .format(CLIENTS, INTERVAL, ROUNDS))
+    print("  server                  requests/s  p50 (ms)  p99 (ms)  "
+          "failed  threads  RSS (MB)")
+    for name, args in (("thread per connection", ()),
+                       ("asyncio", ("--asyncio",))):
+        print("  {:22}  {:10.0f}  {:8.1f}  {:8.1f}  {:6d}  {:7d}  {:8.1f}"
+              .format(name, *run(*args)))
@@ -0,0 +1,63 @@
+"""Compare heart rate ingestion throughput of one /api/heart_rate POST per
+reading against /api/heart_rate/batch, using the Flask test client.
+
+Run from the repository root with:  python benchmarks/bench_batch_ingest.py
+"""
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import heart_rate_sentinel  # noqa: E402
+
+PATIENTS = 200
+READINGS = 20000
+BATCH_SIZE = 1000
+
+
+def readings():
+    rng = random.Random(547)
+    # Heart rates below 100 so that no tachycardia e-mails are queued
+    return [{"patient_id": rng.randrange(PATIENTS),
+             "heart_rate": rng.randint(50, 99)} for _ in range(READINGS)]
+
+
+def reset():
+    heart_rate_sentinel.storage.clear()
+    for patient_id in range(PATIENTS):
+        heart_rate_sentinel.add_new_patient(patient_id, "Smith.J", 50)
+
+
+def single(client, data):
+    for reading in data:
+        client.post("/api/heart_rate", json=reading)
+
+
+def batch(client, data):
+    for start in range(0, len(data), BATCH_SIZE):
+        body = "\n".join(json.dumps(reading)
+                         for reading in data[start:start + BATCH_SIZE])
+        client.post("/api/heart_rate/batch", data=body,
+                    content_type="application/x-ndjson")
+
+
+def run(send, client, data):
+    reset()
+    start = time.perf_counter()
+    send(client, data)
+    return len(data) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    client = heart_rate_sentinel.app.test_client()
+    data = readings()
+    single_rate = run(single, client, data)
+    batch_rate = run(batch, client, data)
+    print("{} readings for {} patients".format(READINGS, PATIENTS))
+    print("single POSTs:         {:>9.0f} readings/s".format(single_rate))
+    print("batches of {:<5}      {:>9.0f} readings/s"
+          .format(BATCH_SIZE, batch_rate))
+    print("speedup:              {:>9.1f}x".format(batch_rate / single_rate))
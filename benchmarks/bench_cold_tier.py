@@ -0,0 +1,72 @@
+"""Measure the memory held by heart rate series as their history grows, with
+every reading in memory and with older readings moved to the cold tier, and
+the time of an interval average that reaches into the cold tier.
+
+Run from the repository root with:  python benchmarks/bench_cold_tier.py
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cold_tier import ColdTier  # noqa: E402
+from hr_series import HeartRateSeries  # noqa: E402
+
+PATIENTS = 100
+HISTORIES = (10000, 50000, 200000)
+BATCH_SIZE = 100
+HOT_READINGS = 4096
+QUERIES = 1000
+
+
+def build(readings, tier):
+    rng = random.Random(547)
+    heart_rates = [rng.randint(50, 150) for _ in range(BATCH_SIZE)]
+    all_series = []
+    for patient_id in range(PATIENTS):
+        cold = None if tier is None else tier.history(patient_id)
+        series = HeartRateSeries(cold)
+        for epoch in range(0, readings, BATCH_SIZE):
+            series.extend_at(heart_rates, epoch)
+        all_series.append(series)
+    return all_series
+
+
+def megabytes(readings, tier):
+    tracemalloc.start()
+    kept = build(readings, tier)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current / 1e6, kept
+
+
+def microseconds_per_query(all_series, readings):
+    began = time.perf_counter()
+    for query in range(QUERIES):
+        all_series[query % PATIENTS].sum_after(readings // 2)
+    return (time.perf_counter() - began) / QUERIES * 1e6
+
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    try:
+        print("{} patients, {} readings per patient kept in memory by the "
+              "cold tier".format(PATIENTS, HOT_READINGS))
+        for readings in HISTORIES:
+            tier = ColdTier(directory, HOT_READINGS)
+            tier.open()
+            memory, kept = megabytes(readings, None)
+            del kept
+            tiered, kept = megabytes(readings, tier)
+            print("{:7d} readings per patient: {:7.1f} MB in memory, "
+                  "{:5.1f} MB with the cold tier, interval average "
+                  "{:.0f} us".format(readings, memory, tiered,
+                                     microseconds_per_query(kept, readings)))
+            del kept
+    finally:
+        shutil.rmtree(directory)
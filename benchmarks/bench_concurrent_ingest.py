@@ -0,0 +1,93 @@
+"""Add heart rates from several threads at once, as Flask's threaded
+server does, and check that no reading is lost. Readings per second are
+shown for 1 to 16 threads, adding readings straight to the storage and
+posting them to /api/heart_rate with the Flask test client, with the
+patients sharing 64 lock stripes and with a single lock for all of them
+(one stripe). Every reading is logged to disk with fsync.
+
+Run from the repository root with:
+    python benchmarks/bench_concurrent_ingest.py
+"""
+from datetime import datetime
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import heart_rate_sentinel  # noqa: E402
+from storage import MemoryStorage  # noqa: E402
+
+PATIENTS = 64
+# Readings posted by each thread; every patient gets readings from several
+# threads, so updates to the same patient race
+READINGS_PER_THREAD = 2000
+THREADS = (1, 2, 4, 8, 16)
+
+
+def add_readings(storage, thread_number, errors):
+    timestamp = datetime.now()
+    for count in range(READINGS_PER_THREAD):
+        if not storage.add_readings((thread_number + count) % PATIENTS,
+                                    [60 + count % 40], timestamp):
+            errors.append(400)
+
+
+def post_readings(storage, thread_number, errors):
+    client = heart_rate_sentinel.app.test_client()
+    for count in range(READINGS_PER_THREAD):
+        # Heart rates below 100 so that no tachycardia e-mails are queued
+        response = client.post("/api/heart_rate", json={
+            "patient_id": (thread_number + count) % PATIENTS,
+            "heart_rate": 60 + count % 40})
+        if response.status_code != 200:
+            errors.append(response.status_code)
+
+
+def run(send, stripes, threads):
+    directory = tempfile.mkdtemp()
+    try:
+        storage = MemoryStorage(directory, stripes=stripes)
+        storage.open()
+        heart_rate_sentinel.storage = storage
+        storage.add_patients([{"patient_id": patient_id,
+                               "attending_username": "Smith.J",
+                               "patient_age": 50}
+                              for patient_id in range(PATIENTS)])
+        errors = []
+        workers = [threading.Thread(target=send,
+                                    args=(storage, number, errors))
+                   for number in range(threads)]
+        began = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - began
+        stored = sum(storage.reading_stats(patient_id)["count"]
+                     for patient_id in range(PATIENTS))
+        storage.close()
+        posted = threads * READINGS_PER_THREAD
+        if errors or stored != posted:
+            raise AssertionError("{} readings posted, {} stored, {} errors"
+                                 .format(posted, stored, len(errors)))
+        return posted / seconds
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    print("{} patients, {} readings per thread, no reading lost in any run"
+          .format(PATIENTS, READINGS_PER_THREAD))
+    for name, send in (("storage.add_readings", add_readings),
+                       ("POST /api/heart_rate", post_readings)):
+        print(name)
+        print("  threads  64 stripes (readings/s)  1 lock (readings/s)")
+        for threads in THREADS:
+            striped = run(send, 64, threads)
+            single = run(send, 1, threads)
+            print("  {:7d}  {:24.0f}  {:19.0f}".format(threads, striped,
+                                                       single))
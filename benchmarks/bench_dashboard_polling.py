@@ -0,0 +1,108 @@
+"""Measure how long adding a heart rate takes while dashboard threads keep
+reading the full histories of the same patients every POLL_INTERVAL
+seconds, as GET /api/heart_rate/<patient_id> does. Readers take the
+immutable snapshot of a patient's readings without a lock; for
+comparison, the same reads are also made while holding the patient's
+stripe, as before snapshots, so a long read holds up the readings added to
+that patient meanwhile. The readers still share the interpreter lock with
+the writer, so some of the added time remains with snapshots.
+Every reading is logged to disk with fsync.
+
+Run from the repository root with:
+    python benchmarks/bench_dashboard_polling.py
+"""
+from datetime import datetime, timedelta
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import MemoryStorage  # noqa: E402
+
+PATIENTS = 8
+# Readings of each patient before the run, so every read copies and
+# formats a long history
+HISTORY = 5000
+READINGS = 20000
+POLLERS = 4
+# Seconds each poller waits between two reads, like a dashboard refreshing
+POLL_INTERVAL = 0.05
+
+
+class LockedReads(MemoryStorage):
+    """ Reads a patient's readings while holding the patient's stripe
+    """
+
+    def readings(self, patient_id):
+        with self.stripes.stripe(patient_id):
+            return super().readings(patient_id)
+
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+def run(storage_type, pollers):
+    directory = tempfile.mkdtemp()
+    try:
+        storage = storage_type(directory)
+        storage.open()
+        storage.add_patients([{"patient_id": patient_id,
+                               "attending_username": "Smith.J",
+                               "patient_age": 50}
+                              for patient_id in range(PATIENTS)])
+        start = datetime(2018, 3, 9, 11, 0, 0)
+        with storage.transaction():
+            for second in range(HISTORY):
+                timestamp = start + timedelta(seconds=second)
+                for patient_id in range(PATIENTS):
+                    storage.add_readings(patient_id, [60 + second % 40],
+                                         timestamp)
+        done = threading.Event()
+        polls = []
+
+        def poll(number):
+            count = 0
+            while not done.wait(POLL_INTERVAL):
+                storage.readings((number + count) % PATIENTS)
+                count += 1
+            polls.append(count)
+
+        threads = [threading.Thread(target=poll, args=(number,))
+                   for number in range(pollers)]
+        for thread in threads:
+            thread.start()
+        latencies = []
+        for count in range(READINGS):
+            timestamp = start + timedelta(seconds=HISTORY + count)
+            began = time.perf_counter()
+            storage.add_readings(count % PATIENTS, [60 + count % 40],
+                                 timestamp)
+            latencies.append(time.perf_counter() - began)
+        done.set()
+        for thread in threads:
+            thread.join()
+        storage.close()
+        latencies.sort()
+        return (1000 * percentile(latencies, 0.5),
+                1000 * percentile(latencies, 0.99),
+                1000 * latencies[-1], sum(polls))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    print("{} patients with {} readings each, {} readings added, {} "
+          "pollers".format(PATIENTS, HISTORY, READINGS, POLLERS))
+    print("  reads                     p50 (ms)  p99 (ms)  max (ms)  polls")
+    for name, storage_type, pollers in (
+            ("no polling", MemoryStorage, 0),
+            ("snapshots, no lock", MemoryStorage, POLLERS),
+            ("holding the stripe", LockedReads, POLLERS)):
+        p50, p99, slowest, polls = run(storage_type, pollers)
+        print("  {:24}  {:8.2f}  {:8.2f}  {:8.2f}  {:5d}".format(
+            name, p50, p99, slowest, polls))
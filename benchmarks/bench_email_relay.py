@@ -0,0 +1,87 @@
+"""Count the relay requests and connections used for a sustained
+tachycardia episode, sending each alert inline with requests.post (the old
+behaviour) and through the EmailDispatcher with a digest window.
+
+One hour of alerts at one per second is replayed 1000 times faster than
+real time, so the dispatcher's 60 second digest window becomes 60 ms.
+
+Run from the repository root with:  python benchmarks/bench_email_relay.py
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+from email_outbox import Outbox, EmailDispatcher  # noqa: E402
+
+ALERTS = 3600
+SPEEDUP = 1000.0
+DIGEST_WINDOW = 60
+
+
+def start_relay(stats):
+    class Relay(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            stats["requests"] += 1
+            stats["connections"].add(self.client_address)
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Relay)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}/send".format(server.server_port)
+
+
+def alert():
+    return {"from_email": "server@domain.com",
+            "to_email": "dr_user_id@ourdomain.com",
+            "subject": "Tachycardic!",
+            "content": "Patient 1 has a tachycardic heart rate!"}
+
+
+def inline(url):
+    for second in range(ALERTS):
+        requests.post(url, json=alert())
+        time.sleep(1 / SPEEDUP)
+
+
+def dispatched(url):
+    outbox = Outbox()
+    dispatcher = EmailDispatcher(outbox, url,
+                                 coalesce_window=DIGEST_WINDOW / SPEEDUP)
+    dispatcher.start()
+    for second in range(ALERTS):
+        outbox.put(alert())
+        time.sleep(1 / SPEEDUP)
+    while len(outbox):
+        time.sleep(0.01)
+    dispatcher.stop()
+
+
+def run(name, send):
+    stats = {"requests": 0, "connections": set()}
+    server, url = start_relay(stats)
+    start = time.perf_counter()
+    send(url)
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    print("{:<22} {:>6} requests {:>6} connections {:>7.2f} s".format(
+        name, stats["requests"], len(stats["connections"]), elapsed))
+
+
+if __name__ == "__main__":
+    print("{} alerts for one physician".format(ALERTS))
+    run("inline requests.post", inline)
+    run("dispatcher + digest", dispatched)
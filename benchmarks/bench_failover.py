@@ -0,0 +1,83 @@
+"""Start a primary server and a standby that promotes itself one second
+after the primary stops answering (--promote-after 1). Measure how long a
+heart rate posted to the primary takes to be readable on the standby, then
+stop the primary and measure how long it takes until the standby accepts
+heart rates instead. Every reading is logged to disk with fsync on both.
+
+Run from the repository root with:  python benchmarks/bench_failover.py
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import requests
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), "heart_rate_sentinel.py")
+PRIMARY_PORT = 5331
+STANDBY_PORT = 5332
+PROMOTE_AFTER = 1
+READINGS = 500
+
+
+def start(directory, port, *args):
+    os.mkdir(directory)
+    server = subprocess.Popen([sys.executable, SERVER, "--port", str(port)] +
+                              list(args), cwd=directory)
+    url = "http://127.0.0.1:{}".format(port)
+    for _ in range(100):
+        try:
+            requests.get(url + "/api")
+            return server, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise AssertionError("the server did not start")
+
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    primary, primary_url = start(os.path.join(directory, "primary"),
+                                 PRIMARY_PORT)
+    standby, standby_url = start(os.path.join(directory, "standby"),
+                                 STANDBY_PORT, "--standby-of", primary_url,
+                                 "--promote-after", str(PROMOTE_AFTER))
+    try:
+        session = requests.Session()
+        session.post(primary_url + "/api/new_patient", json={
+            "patient_id": 1, "attending_username": "Smith.J",
+            "patient_age": 50})
+        latencies = []
+        for count in range(1, READINGS + 1):
+            began = time.perf_counter()
+            session.post(primary_url + "/api/heart_rate",
+                         json={"patient_id": 1, "heart_rate": 60 + count % 40})
+            while (session.get(standby_url + "/api/heart_rate/stats/1")
+                   .json() or {}).get("count") != count:
+                pass
+            latencies.append(time.perf_counter() - began)
+        latencies.sort()
+        print("{} heart rates posted to the primary".format(READINGS))
+        print("  time until readable on the standby (ms): p50 {:.1f}, "
+              "p99 {:.1f}, max {:.1f}".format(
+                  1000 * percentile(latencies, 0.5),
+                  1000 * percentile(latencies, 0.99), 1000 * latencies[-1]))
+        primary.terminate()
+        primary.wait()
+        stopped = time.perf_counter()
+        while session.post(standby_url + "/api/heart_rate", json={
+                "patient_id": 1, "heart_rate": 70}).status_code != 200:
+            time.sleep(0.01)
+        print("  failover with --promote-after {}: the standby accepted "
+              "heart rates {:.2f} s after the primary stopped".format(
+                  PROMOTE_AFTER, time.perf_counter() - stopped))
+    finally:
+        for server in (primary, standby):
+            server.terminate()
+            server.wait()
+        shutil.rmtree(directory)
@@ -0,0 +1,69 @@
+"""Measure the time the /api/metrics instrumentation adds to requests and to
+the instrumented helper functions, by running the same work with metrics
+enabled and disabled.
+
+Run from the repository root with:  python benchmarks/bench_metrics_overhead.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import heart_rate_sentinel  # noqa: E402
+from metrics import metrics  # noqa: E402
+
+PATIENTS = 100
+REQUESTS = 20000
+CALLS = 200000
+ROUNDS = 3
+
+
+def reset(client):
+    heart_rate_sentinel.storage.clear()
+    for patient_id in range(PATIENTS):
+        heart_rate_sentinel.add_new_patient(patient_id, "Smith.J", 50)
+        client.post("/api/heart_rate",
+                    json={"patient_id": patient_id, "heart_rate": 80})
+
+
+def per_request(client, enabled):
+    metrics.enabled = enabled
+    start = time.perf_counter()
+    for index in range(REQUESTS):
+        client.get("/api/status/{}".format(index % PATIENTS))
+    return (time.perf_counter() - start) / REQUESTS
+
+
+def per_call(enabled):
+    metrics.enabled = enabled
+    find_patient = heart_rate_sentinel.find_patient
+    storage = heart_rate_sentinel.storage
+    start = time.perf_counter()
+    for index in range(CALLS):
+        find_patient(index % PATIENTS, storage)
+    return (time.perf_counter() - start) / CALLS
+
+
+if __name__ == "__main__":
+    client = heart_rate_sentinel.app.test_client()
+    reset(client)
+    per_request(client, True)
+    # Alternate between off and on and keep the best of each, so that
+    # warm-up and background noise do not count as overhead
+    request_off = request_on = call_off = call_on = float("inf")
+    for _ in range(ROUNDS):
+        request_off = min(request_off, per_request(client, False))
+        request_on = min(request_on, per_request(client, True))
+        call_off = min(call_off, per_call(False))
+        call_on = min(call_on, per_call(True))
+    print("GET /api/status/<patient_id>, best of {} x {} requests"
+          .format(ROUNDS, REQUESTS))
+    print("  metrics off: {:>8.1f} us/request".format(request_off * 1e6))
+    print("  metrics on:  {:>8.1f} us/request  ({:+.1f} us, {:+.1%})"
+          .format(request_on * 1e6, (request_on - request_off) * 1e6,
+                  request_on / request_off - 1))
+    print("find_patient, best of {} x {} calls".format(ROUNDS, CALLS))
+    print("  metrics off: {:>8.2f} us/call".format(call_off * 1e6))
+    print("  metrics on:  {:>8.2f} us/call     ({:+.2f} us)"
+          .format(call_on * 1e6, (call_on - call_off) * 1e6))
@@ -0,0 +1,120 @@
+"""Post heart rates as fast as CONCURRENCY clients can, each waiting for
+its answer before sending the next, for SECONDS seconds, to the development
+server that app.run starts and to production.py. The clients keep their
+connections alive where the server allows it; the development server
+closes every connection after answering, so its clients connect again for
+every request. The clients share one asyncio event loop in this process.
+Every reading is logged to disk with fsync.
+
+Run from the repository root with:
+    python benchmarks/bench_production_server.py
+"""
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PORT = 5351
+CONCURRENCY = (1, 16, 64)
+SECONDS = 5.0
+PATIENTS = 500
+
+
+def start_server(directory, script, *args):
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, script),
+                               "--port", str(PORT)] + list(args),
+                              cwd=directory, stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            requests.get("http://127.0.0.1:{}/api".format(PORT))
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise AssertionError("the server did not start")
+
+
+async def client(number, deadline, latencies, counts):
+    writer = None
+    count = 0
+    try:
+        while time.perf_counter() < deadline:
+            body = json.dumps({"patient_id": (number + count) % PATIENTS,
+                               "heart_rate": 70}).encode()
+            began = time.perf_counter()
+            if writer is None:
+                reader, writer = await asyncio.open_connection("127.0.0.1",
+                                                               PORT)
+                counts["connections"] += 1
+            writer.write(b"POST /api/heart_rate HTTP/1.1\r\n"
+                         b"Host: 127.0.0.1\r\n"
+                         b"Content-Type: application/json\r\n"
+                         b"Content-Length: " + str(len(body)).encode() +
+                         b"\r\n\r\n" + body)
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = int(head.lower().split(b"content-length:")[1]
+                         .split(b"\r\n")[0])
+            await reader.readexactly(length)
+            if not head.startswith(b"HTTP/1.1 200"):
+                raise ConnectionError(head)
+            latencies.append(time.perf_counter() - began)
+            if b"connection: close" in head.lower():
+                writer.close()
+                writer = None
+            count += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def run_clients(concurrency):
+    latencies = []
+    counts = {"connections": 0}
+    began = time.perf_counter()
+    await asyncio.gather(*[client(number, began + SECONDS, latencies, counts)
+                           for number in range(concurrency)])
+    return latencies, time.perf_counter() - began, counts["connections"]
+
+
+def run(script, *args):
+    directory = tempfile.mkdtemp()
+    server = start_server(directory, script, *args)
+    results = []
+    try:
+        requests.post("http://127.0.0.1:{}/api/bulk_import".format(PORT),
+                      data="".join(json.dumps({
+                          "patient_id": patient_id,
+                          "attending_username": "Smith.J",
+                          "patient_age": 50}) + "\n"
+                          for patient_id in range(PATIENTS)))
+        for concurrency in CONCURRENCY:
+            latencies, seconds, connections = asyncio.run(
+                run_clients(concurrency))
+            latencies.sort()
+            results.append((concurrency, len(latencies) / seconds,
+                            1000 * latencies[len(latencies) // 2],
+                            1000 * latencies[int(0.99 * len(latencies))],
+                            connections))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(directory)
+    return results
+
+
+if __name__ == "__main__":
+    print("Heart rates posted for {} s by each number of clients"
+          .format(SECONDS))
+    print("  server                     clients  requests/s  p50 (ms)  "
+          "p99 (ms)  connections")
+    for name, script, args in (
+            ("development (app.run)", "heart_rate_sentinel.py", ()),
+            ("production.py", "production.py", ())):
+        for row in run(script, *args):
+            print("  {:25}  {:7d}  {:10.0f}  {:8.1f}  {:8.1f}  {:11d}"
+                  .format(name, *row))
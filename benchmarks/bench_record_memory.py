@@ -0,0 +1,68 @@
+"""Compare the memory held by 100,000 patients and 1,000 attending
+physicians stored as dictionaries, as before, and as PatientRecord and
+AttendingRecord objects, first without heart rates and then with one
+reading per patient (whose HeartRateSeries is the same in both layouts).
+
+Run from the repository root with:  python benchmarks/bench_record_memory.py
+"""
+from datetime import datetime
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hr_series import HeartRateSeries, new_series_keys  # noqa: E402
+from records import AttendingRecord, PatientRecord  # noqa: E402
+from registry import Registry  # noqa: E402
+
+PATIENTS = 100000
+ATTENDINGS = 1000
+
+
+def fill(record_types, readings):
+    patients = Registry("patient_id", group_by="attending_username",
+                        record_type=record_types[0])
+    attendings = Registry("attending_username", record_type=record_types[1])
+    timestamp = datetime(2018, 3, 9, 11, 0, 0)
+    for number in range(ATTENDINGS):
+        attendings.append({"attending_username": "Doctor.{}".format(number),
+                           "attending_email": "doctor{}@hospital.org".format(
+                               number),
+                           "attending_phone": "919-867-{:04d}".format(
+                               number)})
+    for patient_id in range(PATIENTS):
+        patient = patients.append(
+            {"patient_id": patient_id,
+             "attending_username": "Doctor.{}".format(patient_id %
+                                                      ATTENDINGS),
+             "patient_age": 20 + patient_id % 70})
+        if not readings:
+            continue
+        # The dictionary layout added the readings as two extra keys
+        series = HeartRateSeries()
+        patient.update(new_series_keys(series))
+        series.append(60 + patient_id % 40, timestamp)
+    return patients, attendings
+
+
+def measure(record_types, readings):
+    tracemalloc.start()
+    databases = fill(record_types, readings)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del databases
+    return memory
+
+
+if __name__ == "__main__":
+    print("{} patients, {} attending physicians".format(PATIENTS,
+                                                        ATTENDINGS))
+    for readings in (False, True):
+        print("  with one reading each:" if readings else "  no readings:")
+        for name, record_types in (("dictionaries", (None, None)),
+                                   ("records", (PatientRecord,
+                                                AttendingRecord))):
+            memory = measure(record_types, readings)
+            print("    {:13} {:7.1f} MB, {:5.0f} bytes per patient".format(
+                name, memory / 1e6, memory / PATIENTS))
@@ -0,0 +1,56 @@
+"""Compare a patient's series without retention against a RingSeries that
+keeps only the latest readings: memory held, and the time to add a reading
+once the ring is full (every reading then expires the oldest one).
+
+Run from the repository root with:  python benchmarks/bench_retention.py
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hr_series import HeartRateSeries  # noqa: E402
+from ring_series import RingSeries  # noqa: E402
+
+READINGS = 500000
+RETENTION = 10000
+
+
+def fill(new_series, rates, rollups):
+    series = new_series()
+    if rollups:
+        series.get_rollups()
+    for epoch, heart_rate in enumerate(rates):
+        series.append_at(heart_rate, epoch)
+    return series
+
+
+def measure(new_series, rates, rollups):
+    # Timed without tracemalloc, which slows every allocation down
+    began = time.perf_counter()
+    series = fill(new_series, rates, rollups)
+    seconds = time.perf_counter() - began
+    del series
+    tracemalloc.start()
+    series = fill(new_series, rates, rollups)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return memory, seconds / len(rates) * 1e6, len(series)
+
+
+if __name__ == "__main__":
+    rng = random.Random(547)
+    rates = [rng.randint(50, 150) for _ in range(READINGS)]
+    print("{} readings, retention of the latest {}".format(
+        READINGS, RETENTION))
+    for name, new_series in (("no retention", HeartRateSeries),
+                             ("ring buffer",
+                              lambda: RingSeries(RETENTION))):
+        for rollups in (False, True):
+            memory, microseconds, kept = measure(new_series, rates, rollups)
+            label = name + (" with rollups" if rollups else "")
+            print("  {:30} {:8.2f} MB, {:5.2f} us per reading, "
+                  "{} kept".format(label, memory / 1e6, microseconds, kept))
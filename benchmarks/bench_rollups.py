@@ -0,0 +1,75 @@
+"""Compare the history and average routes over a 30-day window read from the
+raw readings and from the rollups picked by resolution=auto, for both
+storage backends, using the Flask test client.
+
+Run from the repository root with:  python benchmarks/bench_rollups.py
+"""
+from datetime import datetime, timedelta
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import heart_rate_sentinel  # noqa: E402
+from storage import make_storage  # noqa: E402
+
+DAYS = 30
+# Seconds between two readings of the patient
+SPACING = 4
+BATCH_SIZE = 10000
+ROUNDS = 5
+
+
+def fill(storage):
+    storage.add_patients([{"patient_id": 1, "attending_username": "Smith.J",
+                           "patient_age": 50}])
+    rng = random.Random(547)
+    start = datetime.now() - timedelta(days=DAYS)
+    readings = DAYS * 86400 // SPACING
+    for first in range(0, readings, BATCH_SIZE):
+        with storage.transaction():
+            for count in range(first, min(first + BATCH_SIZE, readings)):
+                storage.add_readings(1, [rng.randint(50, 150)],
+                                     start + timedelta(seconds=SPACING *
+                                                       count))
+    return start, readings
+
+
+def best_milliseconds(client, url):
+    best = None
+    for _ in range(ROUNDS):
+        began = time.perf_counter()
+        response = client.get(url)
+        seconds = time.perf_counter() - began
+        if best is None or seconds < best:
+            best = seconds
+    return best * 1000, len(response.data)
+
+
+if __name__ == "__main__":
+    client = heart_rate_sentinel.app.test_client()
+    for backend in ("memory", "sqlite"):
+        directory = tempfile.mkdtemp()
+        try:
+            storage = make_storage(backend, directory)
+            storage.open()
+            start, readings = fill(storage)
+            heart_rate_sentinel.storage = storage
+            since = (start + timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S")
+            print("{}: {} readings over {} days".format(backend, readings,
+                                                        DAYS))
+            for route in ("/api/heart_rate/1",
+                          "/api/heart_rate/average/1"):
+                for resolution in ("raw", "auto"):
+                    milliseconds, size = best_milliseconds(
+                        client, "{}?since={}&resolution={}".format(
+                            route, since, resolution))
+                    print("    {:26} {:4}: {:8.2f} ms, {:8d} bytes".format(
+                        route, resolution, milliseconds, size))
+            storage.close()
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,56 @@
+"""Compare the memory used per heart rate reading by the old list layout
+and by HeartRateSeries.
+
+Run from the repository root with:  python benchmarks/bench_series_memory.py
+"""
+import os
+import random
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hr_series import HeartRateSeries, TIMESTAMP_FORMAT  # noqa: E402
+
+SAMPLES = 1000000
+
+
+def readings():
+    start = datetime(2021, 10, 29)
+    rng = random.Random(547)
+    for second in range(SAMPLES):
+        yield rng.randint(50, 180), start + timedelta(seconds=second)
+
+
+def list_layout():
+    patient = {"heart_rate": [], "timestamp": []}
+    for heart_rate, timestamp in readings():
+        patient["heart_rate"].append(heart_rate)
+        patient["timestamp"].append(timestamp.strftime(TIMESTAMP_FORMAT))
+    return patient
+
+
+def series_layout():
+    series = HeartRateSeries()
+    for heart_rate, timestamp in readings():
+        series.append(heart_rate, timestamp)
+    return series
+
+
+def bytes_per_sample(build):
+    tracemalloc.start()
+    kept = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return current / SAMPLES
+
+
+if __name__ == "__main__":
+    old = bytes_per_sample(list_layout)
+    new = bytes_per_sample(series_layout)
+    print("{} samples".format(SAMPLES))
+    print("list layout:     {:6.1f} bytes/sample".format(old))
+    print("HeartRateSeries: {:6.1f} bytes/sample".format(new))
+    print("reduction:       {:6.1f}x".format(old / new))
@@ -0,0 +1,81 @@
+"""Compare the in-memory and SQLite storage backends: heart rate readings
+written per second, and the time of an interval average computed by the
+backend (an SQL aggregate for SQLite) against pulling every reading into
+Python and averaging there.
+
+Run from the repository root with:  python benchmarks/bench_storage_backends.py
+"""
+from datetime import datetime, timedelta
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hr_series import to_epoch  # noqa: E402
+from storage import make_storage  # noqa: E402
+
+PATIENTS = 100
+READINGS = 200000
+BATCH_SIZE = 1000
+QUERIES = 200
+# Seconds between two readings, so the readings span 30 days
+SPACING = 13
+
+
+def fill(storage):
+    storage.add_patients([{"patient_id": patient_id,
+                           "attending_username": "Smith.J",
+                           "patient_age": 50}
+                          for patient_id in range(PATIENTS)])
+    rng = random.Random(547)
+    start = datetime(2018, 3, 9, 11, 0, 0)
+    began = time.perf_counter()
+    for first in range(0, READINGS, BATCH_SIZE):
+        with storage.transaction():
+            for count in range(first, first + BATCH_SIZE):
+                storage.add_readings(count % PATIENTS, [rng.randint(50, 150)],
+                                     start + timedelta(seconds=SPACING *
+                                                       count))
+    return READINGS / (time.perf_counter() - began), start
+
+
+def average_in_python(storage, patient_id, since):
+    heart_rates, timestamps = storage.readings(patient_id)
+    since = since.strftime("%Y-%m-%d %H:%M:%S")
+    selected = [heart_rate for heart_rate, timestamp
+                in zip(heart_rates, timestamps) if timestamp >= since]
+    return sum(selected) / len(selected)
+
+
+def average_in_backend(storage, patient_id, since):
+    count, total = storage.sum_after(patient_id, to_epoch(since))
+    return total / count
+
+
+def time_queries(storage, average, since):
+    began = time.perf_counter()
+    for query in range(QUERIES):
+        average(storage, query % PATIENTS, since)
+    return (time.perf_counter() - began) / QUERIES * 1e6
+
+
+if __name__ == "__main__":
+    for backend in ("memory", "sqlite"):
+        directory = tempfile.mkdtemp()
+        try:
+            storage = make_storage(backend, directory)
+            storage.open()
+            rate, start = fill(storage)
+            since = start + timedelta(seconds=SPACING * READINGS // 4)
+            print("{}: {:.0f} readings/s written".format(backend, rate))
+            print("    interval average in the backend: {:.0f} us".format(
+                time_queries(storage, average_in_backend, since)))
+            print("    interval average in Python:      {:.0f} us".format(
+                time_queries(storage, average_in_python, since)))
+            storage.close()
+        finally:
+            shutil.rmtree(directory)
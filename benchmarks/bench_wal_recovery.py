@@ -0,0 +1,92 @@
+"""Measure how long the server takes to recover 10 million heart rate
+readings from its write-ahead log and snapshot at startup.
+
+The worst case is timed: a snapshot holding most of the readings plus a log
+tail of single-reading records just short of the next snapshot.
+
+Run from the repository root with:  python benchmarks/bench_wal_recovery.py
+"""
+from datetime import datetime, timedelta
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hr_series import append_readings, new_series_keys  # noqa: E402
+from registry import Registry  # noqa: E402
+from wal import WriteAheadLog  # noqa: E402
+
+PATIENTS = 1000
+READINGS = 10000000
+BATCH_SIZE = 100
+SNAPSHOT_EVERY = 500000
+
+
+def make_databases():
+    return (Registry("patient_id", group_by="attending_username"),
+            Registry("attending_username"))
+
+
+def log_readings(wal, patients_db, patient_id, heart_rates, timestamp):
+    with wal.lock:
+        wal.log_readings(patient_id, heart_rates, timestamp)
+        append_readings(patients_db[patient_id], heart_rates, timestamp)
+
+
+def write(directory):
+    patients_db, attending_db = make_databases()
+    wal = WriteAheadLog(directory, patients_db, attending_db,
+                        snapshot_every=SNAPSHOT_EVERY, fsync=False)
+    wal.open()
+    rng = random.Random(547)
+    with wal.lock:
+        for patient_id in range(PATIENTS):
+            patient = {"patient_id": patient_id,
+                       "attending_username": "Doctor.{}".format(
+                           patient_id % 50),
+                       "patient_age": 50}
+            wal.log_patient(patient)
+            patient.update(new_series_keys())
+            patients_db.append(patient)
+    timestamp = datetime(2018, 3, 9, 11, 0, 0)
+    tail = SNAPSHOT_EVERY - 1000
+    for count in range(0, READINGS - tail, BATCH_SIZE):
+        heart_rates = [rng.randint(50, 150) for _ in range(BATCH_SIZE)]
+        log_readings(wal, patients_db, rng.randrange(PATIENTS), heart_rates,
+                     timestamp + timedelta(seconds=count // BATCH_SIZE))
+    wal.snapshot()
+    timestamp += timedelta(days=1)
+    for count in range(tail):
+        log_readings(wal, patients_db, count % PATIENTS,
+                     [rng.randint(50, 150)],
+                     timestamp + timedelta(seconds=count))
+        if count % 1000 == 0:
+            wal.commit()
+    wal.close()
+    return tail
+
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    try:
+        tail = write(directory)
+        patients_db, attending_db = make_databases()
+        wal = WriteAheadLog(directory, patients_db, attending_db)
+        start = time.perf_counter()
+        replayed = wal.open()
+        seconds = time.perf_counter() - start
+        wal.close()
+        recovered = sum(len(patient["heart_rate"]) for patient in patients_db)
+        size = sum(os.path.getsize(os.path.join(directory, name))
+                   for name in os.listdir(directory))
+        print("{} readings for {} patients, {:.0f} MB on disk"
+              .format(recovered, len(patients_db), size / 1e6))
+        print("snapshot plus {} log records replayed ({} in the tail)"
+              .format(replayed, tail))
+        print("recovery time: {:.2f} s".format(seconds))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,94 @@
+"""Post heart rates to a server started with 1, 2, 4 and 8 worker
+processes and show the requests served per second. With one worker the
+server keeps its data in its own process; with more, the workers share
+one store process (see shared_store.py). Requests are sent over HTTP from
+several client processes with keep-alive connections, and every reading is
+logged to disk with fsync.
+The number of CPU cores is shown too: the workers can only run in parallel
+on as many cores as there are.
+
+Run from the repository root with:  python benchmarks/bench_worker_scaling.py
+"""
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import requests
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), "heart_rate_sentinel.py")
+PORT = 5321
+URL = "http://127.0.0.1:{}".format(PORT)
+PATIENTS = 64
+CLIENTS = 8
+REQUESTS_PER_CLIENT = 500
+WORKERS = (1, 2, 4, 8)
+
+
+def post_readings(client_number, done):
+    session = requests.Session()
+    for count in range(REQUESTS_PER_CLIENT):
+        response = session.post(URL + "/api/heart_rate", json={
+            "patient_id": (client_number + count) % PATIENTS,
+            "heart_rate": 60 + count % 40})
+        if response.status_code != 200:
+            raise AssertionError(response.text)
+    done.put(client_number)
+
+
+def wait_until_up():
+    for _ in range(100):
+        try:
+            requests.get(URL + "/api")
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise AssertionError("the server did not start")
+
+
+def run(workers):
+    directory = tempfile.mkdtemp()
+    server = subprocess.Popen(
+        [sys.executable, SERVER, "--workers", str(workers), "--port",
+         str(PORT), "--data", os.path.join(directory, "data")],
+        cwd=directory)
+    try:
+        wait_until_up()
+        for patient_id in range(PATIENTS):
+            requests.post(URL + "/api/new_patient", json={
+                "patient_id": patient_id, "attending_username": "Smith.J",
+                "patient_age": 50})
+        done = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=post_readings,
+                                           args=(number, done))
+                   for number in range(CLIENTS)]
+        began = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            done.get()
+        seconds = time.perf_counter() - began
+        for client in clients:
+            client.join()
+        stored = sum(requests.get(
+            URL + "/api/heart_rate/stats/{}".format(patient_id)).json()[
+                "count"] for patient_id in range(PATIENTS))
+        if stored != CLIENTS * REQUESTS_PER_CLIENT:
+            raise AssertionError("{} readings stored".format(stored))
+        return CLIENTS * REQUESTS_PER_CLIENT / seconds
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    print("{} CPU cores, {} client processes, {} requests each".format(
+        os.cpu_count(), CLIENTS, REQUESTS_PER_CLIENT))
+    print("  workers  requests/s")
+    for workers in WORKERS:
+        print("  {:7d}  {:10.0f}".format(workers, run(workers)))
@@ -0,0 +1,71 @@
+import argparse
+import sys
+import requests
+
+hostname = "http://127.0.0.1:5000/"
+
+
+def stream_file(in_file, chunk_size=65536):
+    """ Read a file in fixed-size chunks
+
+    :param in_file: an open binary file
+    :param chunk_size: the number of bytes in each chunk
+
+    :returns: a generator of byte strings, so the file is sent to the
+    server as it is read instead of being loaded into memory first
+    """
+    while True:
+        chunk = in_file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def bulk_import(in_file, server=hostname):
+    """ Send an NDJSON file of patients and attendings to the server
+
+    :param in_file: an open binary file with one patient or attending
+    physician per line
+    :param server: the server's base URL
+
+    :returns: the import summary returned by the /api/bulk_import route
+    """
+    r = requests.post(server + "api/bulk_import", data=stream_file(in_file),
+                      headers={"Content-Type": "application/x-ndjson"})
+    r.raise_for_status()
+    return r.json()
+
+
+def main(argv=None):
+    """ Command line entry point
+
+    Usage: python bulk_import_client.py records.ndjson [--server URL]
+    Use "-" as the file name to read from standard input.
+
+    :returns: 0 if every line was imported, otherwise 1
+    """
+    parser = argparse.ArgumentParser(
+        description="Import patients and attending physicians from an "
+                    "NDJSON file into a running heart rate sentinel server")
+    parser.add_argument("file", help="NDJSON file, or - for standard input")
+    parser.add_argument("--server", default=hostname,
+                        help="server base URL (default: %(default)s)")
+    args = parser.parse_args(argv)
+    if args.file == "-":
+        summary = bulk_import(sys.stdin.buffer, args.server)
+    else:
+        with open(args.file, "rb") as in_file:
+            summary = bulk_import(in_file, args.server)
+    print("Added {} patients and {} attending physicians, rejected {} lines"
+          .format(summary["patients_added"], summary["attendings_added"],
+                  summary["rejected"]))
+    for reject in summary["rejects"]:
+        print("line {}: {}".format(reject["line"], reject["error"]))
+    if summary["rejected"] > len(summary["rejects"]):
+        print("... and {} more".format(summary["rejected"] -
+                                       len(summary["rejects"])))
+    return 0 if summary["rejected"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
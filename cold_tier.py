@@ -0,0 +1,342 @@
+from array import array
+from bisect import bisect_right
+from contextlib import contextmanager
+import mmap
+import os
+import shutil
+
+COLD_FILE = "{}.hrs"
+# Records are copied out of a cold file this many at a time when a whole
+# history is read, so no query holds more than one chunk in memory
+CHUNK_RECORDS = 65536
+
+
+class ColdTier:
+    """ Folder of files holding the older heart rate readings of each patient
+
+    A patient's HeartRateSeries keeps only its latest hot_readings readings
+    in memory. Whenever twice that many have piled up, the older half is
+    moved to the end of the patient's file in this folder, so the memory
+    used by a patient is bounded however long the patient stays.
+    The files only hold readings that are also in the write-ahead log and
+    snapshot, so they are not made durable, and they are deleted and
+    rebuilt when the server starts.
+    """
+
+    def __init__(self, directory, hot_readings=4096):
+        """ Create a cold tier in a folder
+
+        :param directory: the folder for the patients' files
+        :param hot_readings: the number of latest readings of each patient
+        that are always kept in memory
+        """
+        if hot_readings < 1:
+            raise ValueError("hot_readings must be at least 1")
+        self.directory = directory
+        self.hot_readings = hot_readings
+
+    def open(self):
+        """ Start with an empty folder, deleting files left by an earlier run
+        """
+        self.clear()
+
+    def clear(self):
+        """ Delete every patient's file
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+
+    def history(self, patient_id):
+        """ Create an empty cold history for a patient
+
+        A file left by an earlier series of the same patient is unlinked
+        rather than truncated, so a snapshot still reading it is not
+        affected.
+
+        :param patient_id: the patient_id as an integer
+
+        :returns: a ColdHistory to attach to the patient's HeartRateSeries
+        """
+        self.remove(patient_id)
+        return ColdHistory(self._path(patient_id), self.hot_readings)
+
+    def remove(self, patient_id):
+        """ Delete a patient's file, if there is one
+
+        :param patient_id: the patient_id as an integer
+        """
+        path = self._path(patient_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _path(self, patient_id):
+        return os.path.join(self.directory, COLD_FILE.format(patient_id))
+
+
+@contextmanager
+def _mapped(file, count):
+    # The first count records of an open file, memory-mapped as a
+    # memoryview of 64-bit integers
+    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    with mapped, memoryview(mapped) as view:
+        records = view[:16 * count].cast("q")
+        try:
+            yield records
+        finally:
+            records.release()
+
+
+def _epochs(chunks):
+    for chunk in chunks:
+        yield from chunk[0::2]
+
+
+def _rates(chunks):
+    before = 0
+    for chunk in chunks:
+        prefix = chunk[1::2]
+        for total in prefix:
+            yield total - before
+            before = total
+
+
+class ColdHistory:
+    """ The older readings of one patient, in a file of fixed-width records
+
+    Record i is two native 64-bit integers: the epoch seconds of reading i
+    and the sum of the heart rates of readings 0 to i. The file continues
+    where the prefix sums of the HeartRateSeries in memory start, so window
+    sums across both tiers are still a binary search and a subtraction.
+    Queries memory-map the file and read the records in place. Records are
+    only appended, except when a reading arrives that is older than the
+    readings already in the file; the file is then rewritten into a new
+    file that replaces it, so readers that opened the old file keep a
+    consistent copy. Every rewrite, and retiring the history when its
+    patient is replaced, counts as a new generation, so a reader that noted
+    the generation can tell whether the file still holds the records it
+    expects.
+    """
+
+    __slots__ = ("path", "hot_readings", "spill_at", "count", "last_epoch",
+                 "total", "generation")
+
+    def __init__(self, path, hot_readings):
+        """ Create an empty cold history
+
+        :param path: the path of the patient's file
+        :param hot_readings: the number of readings the series keeps in
+        memory after moving older ones here
+        """
+        self.path = path
+        self.hot_readings = hot_readings
+        self.spill_at = 2 * hot_readings
+        self.count = 0
+        self.last_epoch = None
+        self.total = 0
+        self.generation = 0
+
+    def append(self, epochs, prefix):
+        """ Add the oldest readings of a series to the end of the file
+
+        :param epochs: an array("q") of epoch seconds, no older than the
+        readings already in the file
+        :param prefix: an array("q") of the prefix sums through each of
+        those readings
+        """
+        records = array("q", bytes(16 * len(epochs)))
+        records[0::2] = epochs
+        records[1::2] = prefix
+        with open(self.path, "ab") as file:
+            records.tofile(file)
+        self.count += len(epochs)
+        self.last_epoch = epochs[-1]
+        self.total = prefix[-1]
+
+    @contextmanager
+    def _records(self):
+        with open(self.path, "rb") as file, \
+                _mapped(file, self.count) as records:
+            yield records
+
+    def _chunks(self):
+        if self.count == 0:
+            return
+        with self._records() as records:
+            for start in range(0, len(records), 2 * CHUNK_RECORDS):
+                chunk = array("q")
+                chunk.frombytes(
+                    records[start:start + 2 * CHUNK_RECORDS].cast("B"))
+                yield chunk
+
+    def epoch_at(self, index):
+        """ Read the epoch seconds of one reading
+
+        :param index: the position of the reading in the file
+        """
+        with self._records() as records:
+            return records[2 * index]
+
+    def rate_at(self, index):
+        """ Read one heart rate
+
+        :param index: the position of the reading in the file
+        """
+        with self._records() as records:
+            before = records[2 * index - 1] if index > 0 else 0
+            return records[2 * index + 1] - before
+
+    def position_after(self, epoch):
+        """ Find the first reading taken after a given time
+
+        :param epoch: the time in seconds since 1970-01-01
+
+        :returns: a tuple of the position of the first reading after the
+        time, which is count if there is none, and the sum of the heart rates
+        before that position
+        """
+        with self.frozen() as frozen:
+            return frozen.position_after(epoch)
+
+    def iter_epochs(self):
+        """ Iterate over the epoch seconds of the readings in time order
+        """
+        return _epochs(self._chunks())
+
+    def iter_rates(self):
+        """ Iterate over the heart rates in time order
+        """
+        return _rates(self._chunks())
+
+    def insert(self, epoch, heart_rate):
+        """ Insert a reading older than the latest reading in the file
+
+        The file is copied a chunk at a time into a new file with the reading
+        in its sorted position and the prefix sums after it increased, which
+        then replaces the old file. This takes time proportional to the
+        length of the history, but only happens when a reading arrives older
+        than every reading kept in memory.
+
+        :param epoch: the time of the reading in seconds since 1970-01-01
+        :param heart_rate: the heart rate as an integer
+        """
+        position, before = self.position_after(epoch)
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as file:
+            offset = 0
+            for chunk in self._chunks():
+                split = 2 * (position - offset)
+                offset += len(chunk) // 2
+                if split < len(chunk):
+                    start = 1
+                    if split >= 0:
+                        chunk[split:split] = array(
+                            "q", [epoch, before + heart_rate])
+                        start = split + 3
+                    for index in range(start, len(chunk), 2):
+                        chunk[index] += heart_rate
+                chunk.tofile(file)
+        # The generation changes before the file does, so a reader that
+        # opens the new file also sees the new generation
+        self.generation += 1
+        os.replace(temporary, self.path)
+        self.count += 1
+        self.total += heart_rate
+
+    def frozen(self):
+        """ Open the records as they are now, for writing a snapshot
+
+        Later appends go after these records and a rewrite goes to a new
+        file, so the frozen records can be read after the caller releases
+        its locks.
+
+        :returns: a FrozenHistory, which must be closed
+        """
+        return FrozenHistory(open(self.path, "rb"), self.count)
+
+    def frozen_at(self, generation, count):
+        """ Open the records as they were earlier, without holding a lock
+
+        :param generation: the generation noted with the count
+        :param count: the number of records there were then
+
+        :returns: a FrozenHistory of the first count records, which must be
+        closed, or None if the file has been rewritten or retired since
+        """
+        try:
+            file = open(self.path, "rb")
+        except FileNotFoundError:
+            return None
+        if self.generation != generation:
+            file.close()
+            return None
+        return FrozenHistory(file, count)
+
+    def retire(self):
+        """ Mark the history as no longer in use, before its patient's file
+        is deleted or replaced by a new series' file
+        """
+        self.generation += 1
+
+
+class FrozenHistory:
+    """ The records of a ColdHistory at one moment, read from an open file
+
+    It can be used in a with statement, which closes it at the end.
+    """
+
+    def __init__(self, file, count):
+        self.file = file
+        self.count = count
+
+    def _chunks(self):
+        self.file.seek(0)
+        left = self.count
+        while left > 0:
+            chunk = array("q")
+            chunk.fromfile(self.file, 2 * min(left, CHUNK_RECORDS))
+            yield chunk
+            left -= CHUNK_RECORDS
+
+    def write_column(self, output, column):
+        """ Copy the epochs or the prefix sums of the records to a file
+
+        :param output: a binary file to write the column to
+        :param column: 0 for the epochs, 1 for the prefix sums
+        """
+        for chunk in self._chunks():
+            chunk[column::2].tofile(output)
+
+    def iter_epochs(self):
+        """ Iterate over the epoch seconds of the readings in time order
+        """
+        return _epochs(self._chunks())
+
+    def iter_rates(self):
+        """ Iterate over the heart rates in time order
+        """
+        return _rates(self._chunks())
+
+    def position_after(self, epoch):
+        """ Find the first reading taken after a given time
+
+        :param epoch: the time in seconds since 1970-01-01
+
+        :returns: a tuple of the position of the first reading after the
+        time, which is count if there is none, and the sum of the heart rates
+        before that position
+        """
+        with _mapped(self.file, self.count) as records:
+            epochs = records[0::2]
+            position = bisect_right(epochs, epoch)
+            epochs.release()
+            before = records[2 * position - 1] if position > 0 else 0
+        return position, before
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,461 @@
+from collections import OrderedDict
+import json
+import logging
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class Outbox:
+    """ A bounded queue of e-mails waiting to be sent, kept on disk
+
+    Every e-mail put in the outbox is written to a JSON lines journal and
+    fsynced before put returns, and every delivered e-mail is marked as
+    done in the same journal. When the server restarts, reopening the
+    journal brings back the e-mails that had not been delivered yet. The
+    journal is rewritten with only the pending e-mails once enough
+    delivered ones have piled up. An e-mail that failed to send can be put
+    off with retry; peek passes it over until its next attempt is due, and
+    the time and number of attempts are kept in the journal too. An e-mail
+    that cannot be delivered is moved to a dead-letter file next to the
+    journal rather than dropped.
+    The outbox holds at most max_size pending e-mails; put refuses new ones
+    while it is full, so a relay outage cannot use up memory or disk.
+    """
+
+    def __init__(self, path=None, max_size=10000):
+        """ Create an outbox
+
+        The journal file is only opened when the outbox is first used.
+
+        :param path: the path of the journal file, or None to keep the
+        outbox in memory only; the dead-letter file is the same path with
+        ".dead" added
+        :param max_size: the largest number of pending e-mails
+        """
+        self.path = path
+        self.dead_letter_path = None if path is None else path + ".dead"
+        self.max_size = max_size
+        self._pending = OrderedDict()
+        self._next_id = 0
+        self._done_since_compact = 0
+        self._file = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+
+    def _load(self):
+        self._loaded = True
+        if self.path is None:
+            return
+        if os.path.exists(self.path):
+            with open(self.path) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash while it was written
+                        continue
+                    if entry["op"] == "put":
+                        self._pending[entry["id"]] = [
+                            entry["time"], entry["email"],
+                            entry.get("attempts", 0), entry.get("next_at", 0)]
+                    elif entry["op"] == "retry":
+                        if entry["id"] in self._pending:
+                            self._pending[entry["id"]][2:] = [
+                                entry["attempts"], entry["next_at"]]
+                    else:
+                        self._pending.pop(entry["id"], None)
+                    self._next_id = max(self._next_id, entry["id"] + 1)
+        self._rewrite()
+
+    def _rewrite(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as journal:
+            for entry_id, (queued_at, email, attempts, next_at) in \
+                    self._pending.items():
+                journal.write(json.dumps({"op": "put", "id": entry_id,
+                                          "time": queued_at, "email": email,
+                                          "attempts": attempts,
+                                          "next_at": next_at}) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(tmp_path, self.path)
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, "a")
+        self._done_since_compact = 0
+
+    def _write(self, entry, sync=False):
+        # Only puts are fsynced: an ack lost in a crash sends an e-mail
+        # twice, and a lost retry tries it again early, but a lost put would
+        # never send it
+        if self._file is not None:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def put(self, email):
+        """ Add an e-mail to the outbox
+
+        :param email: a dictionary with the e-mail to send to the relay
+
+        :returns: True if the e-mail was queued, or False if the outbox is
+        full
+        """
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if len(self._pending) >= self.max_size:
+                return False
+            entry_id = self._next_id
+            self._next_id += 1
+            queued_at = time.time()
+            self._write({"op": "put", "id": entry_id, "time": queued_at,
+                         "email": email}, sync=True)
+            self._pending[entry_id] = [queued_at, email, 0, 0]
+            self._ready.notify()
+            return True
+
+    def peek(self, timeout=None, ready=None):
+        """ Wait for the oldest pending e-mail without removing it
+
+        E-mails put off by retry are passed over until their next attempt
+        is due.
+
+        :param timeout: the longest time to wait in seconds, or None to wait
+        until an e-mail is available
+        :param ready: a function called with an e-mail dictionary that
+        returns False for e-mails to pass over, or None to take any e-mail
+
+        :returns: a tuple of the e-mail's id, the e-mail dictionary, the
+        time it was queued (as from time.time) and the number of failed
+        attempts to send it, or None if the timeout ran out first
+        """
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            now = time.time()
+            item = self._oldest(ready, now)
+            if item is None:
+                # Woken early if a put-off e-mail becomes due first
+                due = [next_at - now for _, _, _, next_at
+                       in self._pending.values() if next_at > now]
+                if due and (timeout is None or min(due) < timeout):
+                    timeout = min(due)
+                self._ready.wait(timeout)
+                item = self._oldest(ready, time.time())
+            return item
+
+    def _oldest(self, ready, now):
+        for entry_id, (queued_at, email, attempts, next_at) in \
+                self._pending.items():
+            if next_at <= now and (ready is None or ready(email)):
+                return entry_id, email, queued_at, attempts
+        return None
+
+    def matching(self, key, value):
+        """ List the pending e-mails that have a given value for a key
+
+        :param key: the e-mail dictionary key to compare, e.g. "to_email"
+        :param value: the value to look for
+
+        :returns: a list of (id, e-mail dictionary) tuples, oldest first
+        """
+        with self._lock:
+            return [(entry_id, entry[1])
+                    for entry_id, entry in self._pending.items()
+                    if entry[1].get(key) == value]
+
+    def retry(self, entry_id, attempts, next_at):
+        """ Keep an e-mail that failed to send for another attempt later
+
+        :param entry_id: the id returned by peek
+        :param attempts: the number of failed attempts to send it so far
+        :param next_at: the time of the next attempt, as from time.time;
+        peek passes the e-mail over until then
+        """
+        with self._lock:
+            entry = self._pending.get(entry_id)
+            if entry is None:
+                return
+            entry[2:] = [attempts, next_at]
+            self._write({"op": "retry", "id": entry_id,
+                         "attempts": attempts, "next_at": next_at})
+
+    def ack(self, entry_id):
+        """ Remove an e-mail from the outbox once it has been handled
+
+        :param entry_id: the id returned by peek
+        """
+        with self._lock:
+            if self._pending.pop(entry_id, None) is None:
+                return
+            self._write({"op": "ack", "id": entry_id})
+            self._done_since_compact += 1
+            if self._file is not None and \
+                    self._done_since_compact > max(1000, len(self._pending)):
+                self._rewrite()
+
+    def dead_letter(self, entry_id):
+        """ Move an e-mail that could not be delivered out of the outbox
+
+        The e-mail is appended to the dead-letter file, and fsynced, before
+        it is removed from the outbox, so it is kept for someone to look
+        at and send again. An outbox kept in memory only logs it.
+
+        :param entry_id: the id returned by peek
+        """
+        with self._lock:
+            if entry_id not in self._pending:
+                return
+            queued_at, email, attempts, _ = self._pending[entry_id]
+            logging.error("Moved undelivered e-mail to {} to the dead "
+                          "letters".format(email.get("to_email")))
+            if self.dead_letter_path is not None:
+                with open(self.dead_letter_path, "a") as dead_letters:
+                    dead_letters.write(json.dumps({
+                        "id": entry_id, "time": queued_at,
+                        "failed_at": time.time(), "attempts": attempts,
+                        "email": email}) + "\n")
+                    dead_letters.flush()
+                    os.fsync(dead_letters.fileno())
+        self.ack(entry_id)
+
+    def close(self):
+        """ Close the journal file
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._loaded = False
+            self._pending.clear()
+
+    def __len__(self):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            return len(self._pending)
+
+
+def make_relay_session(pool_size=4):
+    """ Create a requests session that keeps relay connections open
+
+    :param pool_size: the number of connections to keep open per host
+
+    :returns: a requests.Session whose connections are reused between
+    e-mails instead of being opened for each one
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def post_email(relay_url, email, timeout, session=requests):
+    """ Send one e-mail through the e-mail relay server
+
+    :param relay_url: the URL of the relay's send_email route
+    :param email: a dictionary with "from_email", "to_email", "subject" and
+    "content" keys
+    :param timeout: the longest time to wait for the relay in seconds
+    :param session: the requests.Session to send through, so its open
+    connection can be reused (the requests module itself by default)
+
+    :returns: the relay's response text and status code. An exception is
+    raised if the relay could not be reached or returned an error code.
+    """
+    r = session.post(relay_url, json=email, timeout=timeout)
+    r.raise_for_status()
+    return r.text, r.status_code
+
+
+def make_digest(emails):
+    """ Merge several e-mails to the same physician into one
+
+    Identical messages are listed once with the number of times they were
+    sent, e.g. "Patient 1 has a tachycardic heart rate! (x60)".
+
+    :param emails: a list of e-mail dictionaries with the same "to_email"
+
+    :returns: a single e-mail dictionary. A list of one e-mail returns that
+    e-mail unchanged.
+    """
+    if len(emails) == 1:
+        return emails[0]
+    counts = OrderedDict()
+    for email in emails:
+        counts[email["content"]] = counts.get(email["content"], 0) + 1
+    lines = []
+    for content, count in counts.items():
+        if count > 1:
+            content = "{} (x{})".format(content, count)
+        lines.append(content)
+    digest = dict(emails[0])
+    digest["subject"] = "{} ({} alerts)".format(emails[0]["subject"],
+                                                len(emails))
+    digest["content"] = "\n".join(lines)
+    return digest
+
+
+class EmailDispatcher:
+    """ Background thread that delivers the e-mails in an Outbox
+
+    The dispatcher takes the oldest e-mail that is due from the outbox and
+    posts it to the relay. If that fails the e-mail stays in the outbox
+    with a time for its next attempt (see Outbox.retry), doubling the wait
+    after each failure up to max_delay, and the dispatcher goes on with the
+    e-mails behind it. Once an e-mail has been queued for max_age seconds,
+    or tried max_attempts times, it is moved to the outbox's dead-letter
+    file (see Outbox.dead_letter) so it is not lost. An e-mail without a
+    "to_email" is moved there at once. An e-mail only leaves the outbox
+    once it has been delivered or moved there, so e-mails that were in
+    flight or waiting to be tried again when the server stopped are sent
+    after it restarts.
+    With a coalesce_window, the first e-mail to an address is sent at once,
+    and the ones that follow within that many seconds of it are held until
+    the window ends, then sent together with every other pending e-mail to
+    the same address as one digest (see make_digest). While an address is
+    held, e-mails to other addresses are sent as usual, so a first alert is
+    never delayed, and a patient who stays tachycardic produces one e-mail
+    per window instead of one per reading. All e-mails go through one
+    pooled session, so the connection to the relay is kept alive between
+    them.
+    """
+
+    def __init__(self, outbox, relay_url, timeout=5, max_attempts=None,
+                 max_age=86400, base_delay=0.5, max_delay=300,
+                 coalesce_window=0, post=None):
+        """ Create a dispatcher for an outbox
+
+        :param outbox: the Outbox to deliver e-mails from
+        :param relay_url: the URL of the relay's send_email route
+        :param timeout: the longest time to wait for the relay in seconds
+        :param max_attempts: how many times to try each e-mail, or None to
+        try it until max_age
+        :param max_age: the longest time in seconds to keep trying an e-mail
+        after it was queued, or None to try it until max_attempts
+        :param base_delay: the wait in seconds after the first failure
+        :param max_delay: the longest wait in seconds between two tries
+        :param coalesce_window: how long in seconds to collect e-mails to
+        the same address into one digest, or 0 to send each one
+        :param post: the function used to send one e-mail, called as
+        post(relay_url, email, timeout). By default e-mails are posted
+        through the dispatcher's pooled session.
+        """
+        self.outbox = outbox
+        self.relay_url = relay_url
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.max_age = max_age
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.coalesce_window = coalesce_window
+        self.session = make_relay_session()
+        self.post = post or self._post_pooled
+        self._stopping = threading.Event()
+        self._thread = None
+        # The time each address was last sent an e-mail, as from time.time
+        self._last_sent = {}
+
+    def start(self):
+        """ Start the background thread if it is not already running
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="email-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Ask the background thread to stop and wait for it
+
+        :param timeout: the longest time to wait in seconds
+        """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.session.close()
+
+    def _forget_before(self, moment):
+        # An address not sent to since moment gets its next e-mail at once
+        # anyway, so it is dropped to keep the dictionary small
+        for address, last_sent in list(self._last_sent.items()):
+            if last_sent < moment:
+                del self._last_sent[address]
+
+    def _post_pooled(self, relay_url, email, timeout):
+        return post_email(relay_url, email, timeout, session=self.session)
+
+    def deliver(self, email, attempt=1):
+        """ Try once to send one e-mail
+
+        :param email: the e-mail dictionary to send
+        :param attempt: the number of this attempt, for the log
+
+        :returns: True if the e-mail was sent, or False if it failed
+        """
+        try:
+            self.post(self.relay_url, email, self.timeout)
+            return True
+        except Exception as error:
+            logging.warning("E-mail to {} failed (attempt {}): {}"
+                            .format(email.get("to_email"), attempt, error))
+            return False
+
+    def _gives_up(self, queued_at, attempts, now):
+        return (self.max_attempts is not None and
+                attempts >= self.max_attempts) or \
+            (self.max_age is not None and now - queued_at >= self.max_age)
+
+    def _is_due(self, email):
+        return email.get("to_email") not in self._last_sent
+
+    def _run(self):
+        while not self._stopping.is_set():
+            if self.coalesce_window > 0:
+                # Only addresses still inside their window are left, so the
+                # earliest of them is the next one to become due
+                now = time.time()
+                self._forget_before(now - self.coalesce_window)
+                wait = min([0.5] + [last_sent + self.coalesce_window - now
+                                    for last_sent in self._last_sent.values()])
+                item = self.outbox.peek(timeout=wait, ready=self._is_due)
+            else:
+                item = self.outbox.peek(timeout=0.5)
+            if item is None:
+                continue
+            entry_id, email, queued_at, attempts = item
+            if email.get("to_email") is None:
+                # No relay can deliver it, e.g. the patient's attending
+                # physician is not registered, so it is not retried
+                self.outbox.dead_letter(entry_id)
+                continue
+            if self.coalesce_window > 0:
+                batch = self.outbox.matching("to_email", email["to_email"])
+            else:
+                batch = [(entry_id, email)]
+            attempts += 1
+            if self.deliver(make_digest([e for _, e in batch]), attempts):
+                if self.coalesce_window > 0:
+                    self._last_sent[email["to_email"]] = time.time()
+                for batch_id, _ in batch:
+                    self.outbox.ack(batch_id)
+                continue
+            now = time.time()
+            if self._gives_up(queued_at, attempts, now):
+                for batch_id, _ in batch:
+                    self.outbox.dead_letter(batch_id)
+                continue
+            # The exponent is capped so a long outage cannot overflow it
+            delay = min(self.base_delay * 2 ** min(attempts - 1, 32),
+                        self.max_delay)
+            for batch_id, _ in batch:
+                self.outbox.retry(batch_id, attempts, now + delay)
@@ -0,0 +1,885 @@
+from flask import Flask, Response, request, jsonify
+from collections import Counter
+from contextlib import contextmanager
+import argparse
+import json
+import logging
+import os
+import threading
+import requests
+from hash_ring import HashRing
+from heart_rate_sentinel import CLUSTER_TOKEN_HEADER, CLUSTER_TOKEN_VARIABLE, \
+    has_cluster_token, parse_heart_rate_batch
+from metrics import metrics, instrument_app
+
+app = Flask(__name__)
+
+# Count and time every request; the results are served at /api/metrics
+instrument_app(app)
+
+# Seconds to wait for a server of the cluster to answer
+NODE_TIMEOUT = 30
+
+# Only the first MAX_REPORTED_REJECTS rejected lines of a bulk import are
+# listed in its summary, as by each server
+MAX_REPORTED_REJECTS = 100
+
+logging.basicConfig(filename="logfile.log", level=logging.INFO)
+log = logging.getLogger('werkzeug')
+log.setLevel(logging.ERROR)
+
+
+class PatientMove:
+    """ The patients being moved from one ring of servers to another
+
+    A patient still waiting to move is routed by the old ring, and one that
+    has moved, or was not on its old server when the move began, by the new
+    ring. The patients routed by the requests in progress are counted, so a
+    patient only moves once the requests forwarded to its old server are
+    done, and the requests for the patient being moved wait until it has.
+    """
+
+    def __init__(self, old, new):
+        """ Start a move between two rings
+
+        :param old: the HashRing the patients are routed by before the move
+        :param new: the HashRing they are routed by once they have moved
+        """
+        self.old = old
+        self.new = new
+        # The keys of the patients still on their old server
+        self.pending = set()
+        # The key of the patient being moved, or None
+        self.current = None
+        # The number of requests in progress that routed each key
+        self.busy = Counter()
+
+    def node_for(self, key):
+        """ Find the server a patient is on
+
+        :param key: the patient's key, as from patient_key
+
+        :returns: the URL of the server
+        """
+        if key in self.pending:
+            return self.old.node_for(key)
+        return self.new.node_for(key)
+
+    @property
+    def nodes(self):
+        """ The servers of both rings, those of the old ring first
+        """
+        return self.old.nodes + [node for node in self.new.nodes
+                                 if node not in self.old]
+
+
+class MovingRing:
+    """ Routes one request while patients are moved (see PatientMove)
+
+    It stands in for the HashRing of the cluster, and is released once the
+    request has been forwarded.
+    """
+
+    def __init__(self, move, condition):
+        """ Route a request during a move
+
+        :param move: the PatientMove in progress
+        :param condition: the threading.Condition guarding the move
+        """
+        self.move = move
+        self.condition = condition
+        self.keys = set()
+
+    def node_for(self, key):
+        """ Find the server of a patient, waiting while it is being moved
+
+        :param key: the patient's key as a string
+
+        :returns: the URL of the server
+        """
+        with self.condition:
+            while self.move.current == key:
+                self.condition.wait()
+            if key not in self.keys:
+                self.keys.add(key)
+                self.move.busy[key] += 1
+            return self.move.node_for(key)
+
+    def release(self):
+        """ Stop counting the patients of the request; called holding the
+        condition
+        """
+        for key in self.keys:
+            self.move.busy[key] -= 1
+            if not self.move.busy[key]:
+                del self.move.busy[key]
+        self.keys.clear()
+
+    @property
+    def nodes(self):
+        return self.move.nodes
+
+    def __len__(self):
+        return len(self.move.nodes)
+
+    def __contains__(self, node):
+        return node in self.move.nodes
+
+
+class Cluster:
+    """ The heart rate sentinel servers behind the gateway
+
+    Each patient, with all of its heart rates, is kept by one server, chosen
+    by consistent hashing of its patient_id (see hash_ring.py). Every server
+    keeps every attending physician. When a server joins or leaves, the
+    patients whose server changes are moved to their new server one at a
+    time: each is exported from its old server, imported into the new one
+    and only then removed from the old one. Requests only wait for the
+    patient they route to while it is being moved, and requests for the
+    other patients go to the server that holds them at that moment (see
+    PatientMove). Requests are only held up all at once while the patients
+    to move are listed, and while they are moved back if a server fails.
+    The servers answer the /api/cluster/ routes that move patients only to
+    requests carrying the cluster token they share with the gateway.
+    """
+
+    def __init__(self, nodes=(), token=None):
+        """ Create a cluster of running servers
+
+        :param nodes: an iterable of server URLs, e.g.
+        "http://127.0.0.1:5001"; they are expected to hold their patients
+        already, e.g. because they were started empty
+        :param token: the cluster token of the servers, or None
+        """
+        self.ring = HashRing(node.rstrip("/") for node in nodes)
+        self.token = token
+        self._local = threading.local()
+        self._condition = threading.Condition()
+        self._active = 0
+        self._paused = False
+        # The PatientMove in progress, or None
+        self._move = None
+        # Held while servers are added or removed, one at a time
+        self._changing = threading.Lock()
+
+    def session(self):
+        """ The requests Session of the calling thread
+
+        :returns: a requests.Session, kept for the thread's later requests
+        so its connections to the servers are reused
+        """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    @contextmanager
+    def routing(self):
+        """ Route a request, waiting while every request is held up
+
+        :returns: a context manager giving the HashRing to route with, or a
+        MovingRing while patients are moved
+        """
+        with self._condition:
+            while self._paused:
+                self._condition.wait()
+            self._active += 1
+            if self._move is None:
+                ring = self.ring
+            else:
+                ring = MovingRing(self._move, self._condition)
+        try:
+            yield ring
+        finally:
+            with self._condition:
+                if isinstance(ring, MovingRing):
+                    ring.release()
+                self._active -= 1
+                self._condition.notify_all()
+
+    @contextmanager
+    def _pausing(self):
+        with self._condition:
+            while self._paused:
+                self._condition.wait()
+            self._paused = True
+            while self._active:
+                self._condition.wait()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._paused = False
+                self._condition.notify_all()
+
+    def call(self, method, node, path, **kwargs):
+        """ Send a request to a server
+
+        Requests to the /api/cluster/ routes carry the cluster token.
+
+        :param method: the HTTP method, e.g. "GET"
+        :param node: the URL of the server
+        :param path: the path of the route, e.g. "/api/cluster/patients"
+        :param kwargs: more arguments of requests.Session.request
+
+        :returns: the requests.Response
+
+        :raises requests.RequestException: if the server cannot be reached
+        """
+        if path.startswith("/api/cluster/") and self.token is not None:
+            kwargs["headers"] = dict(kwargs.get("headers") or {},
+                                     **{CLUSTER_TOKEN_HEADER: self.token})
+        return self.session().request(method, node + path,
+                                      timeout=NODE_TIMEOUT, **kwargs)
+
+    def add_node(self, node):
+        """ Add a running, empty server to the cluster
+
+        The server is given every attending physician, then the patients
+        it now owns are moved to it from the other servers. If a server
+        fails meanwhile, the patients already moved are moved back and the
+        cluster is left as it was.
+
+        :param node: the URL of the server
+
+        :returns: the number of patients moved
+
+        :raises requests.RequestException: if a server could not be
+        reached, answered with an error, or rejected an attending physician
+        """
+        node = node.rstrip("/")
+        with self._changing:
+            with self._pausing():
+                if node in self.ring:
+                    return 0
+                if len(self.ring):
+                    attendings = self.call("GET", self.ring.nodes[0],
+                                           "/api/cluster/attendings").json()
+                    lines = "".join(json.dumps(attending) + "\n"
+                                    for attending in attendings)
+                    imported = self.call("POST", node, "/api/bulk_import",
+                                         data=lines.encode())
+                    imported.raise_for_status()
+                    if imported.json()["rejected"]:
+                        raise requests.HTTPError(
+                            "{} rejected {} attending physicians".format(
+                                node, imported.json()["rejected"]),
+                            response=imported)
+                ring = self.ring.copy()
+                ring.add(node)
+                moves = self._start_move(self.ring.nodes, ring)
+            self._rebalance(moves)
+        logging.info("Added server {} to the cluster, moving {} patients"
+                     .format(node, len(moves)))
+        return len(moves)
+
+    def remove_node(self, node):
+        """ Remove a server from the cluster, once its patients are moved
+        to the other servers
+
+        :param node: the URL of the server
+
+        :returns: the number of patients moved
+
+        :raises KeyError: if the server is not in the cluster
+        :raises ValueError: if it is the only server of the cluster
+        :raises requests.RequestException: if a server failed while the
+        patients were moved; they are moved back and the server stays
+        """
+        node = node.rstrip("/")
+        with self._changing:
+            with self._pausing():
+                if node not in self.ring:
+                    raise KeyError(node)
+                if len(self.ring) == 1:
+                    raise ValueError("the cluster needs at least one server")
+                ring = self.ring.copy()
+                ring.remove(node)
+                moves = self._start_move([node], ring)
+            self._rebalance(moves)
+        logging.info("Removed server {} from the cluster, moving {} "
+                     "patients".format(node, len(moves)))
+        return len(moves)
+
+    def _start_move(self, sources, ring):
+        # Called while every request is held up, so no patient is added to
+        # a source after it is listed and before the move begins
+        moves = []
+        for source in sources:
+            listed = self.call("GET", source, "/api/cluster/patients")
+            listed.raise_for_status()
+            for patient_id in listed.json():
+                target = ring.node_for(str(patient_id))
+                if target != source:
+                    moves.append((patient_id, source, target))
+        self._move = PatientMove(self.ring, ring)
+        self._move.pending.update(str(patient_id)
+                                  for patient_id, _, _ in moves)
+        return moves
+
+    def _rebalance(self, moves):
+        move = self._move
+        try:
+            for patient_id, source, target in moves:
+                key = str(patient_id)
+                with self._condition:
+                    move.current = key
+                    while move.busy[key]:
+                        self._condition.wait()
+                try:
+                    self._move_patient(patient_id, source, target)
+                    with self._condition:
+                        move.pending.discard(key)
+                finally:
+                    with self._condition:
+                        move.current = None
+                        self._condition.notify_all()
+        except requests.RequestException:
+            self._move_back(move)
+            raise
+        with self._condition:
+            self.ring = move.new
+            self._move = None
+
+    def _move_back(self, move):
+        # Patients added during the move are on their new server too, so
+        # every server of the new ring is searched for patients the old
+        # ring routes elsewhere
+        with self._pausing():
+            try:
+                for node in move.new.nodes:
+                    try:
+                        listed = self.call("GET", node,
+                                           "/api/cluster/patients")
+                        listed.raise_for_status()
+                    except requests.RequestException as error:
+                        logging.error("Could not list the patients of {}: "
+                                      "{}".format(node, error))
+                        continue
+                    for patient_id in listed.json():
+                        source = move.old.node_for(str(patient_id))
+                        if source == node:
+                            continue
+                        try:
+                            self._move_patient(patient_id, node, source)
+                        except requests.RequestException as error:
+                            logging.error("Could not move patient {} back "
+                                          "to {}: {}".format(patient_id,
+                                                             source, error))
+            finally:
+                self._move = None
+
+    def _move_patient(self, patient_id, source, target):
+        path = "/api/cluster/patients/{}".format(patient_id)
+        exported = self.call("GET", source, path)
+        exported.raise_for_status()
+        self.call("POST", target, "/api/cluster/patients",
+                  json=exported.json()).raise_for_status()
+        try:
+            self.call("DELETE", source, path).raise_for_status()
+        except requests.RequestException:
+            # The source still has the patient, so the copy is dropped
+            self.call("DELETE", target, path)
+            raise
+
+
+cluster = Cluster()
+
+
+def patient_key(patient_id):
+    """ The key a patient_id is routed by
+
+    The servers accept patient_ids as integers or as strings of one, so
+    both are routed to the same server.
+
+    :param patient_id: the patient_id of a request
+
+    :returns: the patient_id as a string of an integer, or None if it is
+    not one
+    """
+    try:
+        return str(int(patient_id))
+    except (TypeError, ValueError):
+        return None
+
+
+def every_node(ring):
+    """ List the servers a request for every server is sent to
+
+    :param ring: the HashRing of the cluster
+
+    :returns: the list of server URLs
+
+    :raises LookupError: if the ring has no nodes, which is answered with
+    503
+    """
+    if not len(ring):
+        raise LookupError("the ring has no nodes")
+    return ring.nodes
+
+
+def node_for(ring, patient_id):
+    """ Find the server of a patient
+
+    Requests whose patient_id is not valid go to the first server, which
+    rejects them the same way a lone server would.
+
+    :param ring: the HashRing of the cluster
+    :param patient_id: the patient_id of a request
+
+    :returns: the URL of the server
+
+    :raises LookupError: if the ring has no nodes
+    """
+    key = patient_key(patient_id)
+    if key is None:
+        return every_node(ring)[0]
+    return ring.node_for(key)
+
+
+def forward(node, data=None):
+    """ Send the current request on to a server
+
+    :param node: the URL of the server
+    :param data: the body to send instead of the request's own
+
+    :returns: the server's response as a Flask Response
+    """
+    path = request.path
+    if request.query_string:
+        path += "?" + request.query_string.decode()
+    response = cluster.call(
+        request.method, node, path,
+        data=request.get_data() if data is None else data,
+        headers={"Content-Type": request.content_type or "text/plain"})
+    return Response(response.content, response.status_code,
+                    content_type=response.headers.get("Content-Type"))
+
+
+def forward_or_fail(node, data=None):
+    """ Send the current request on to a server that may not answer
+
+    :param node: the URL of the server
+    :param data: the body to send instead of the request's own
+
+    :returns: the server's response as a Flask Response, or an error
+    string, 503 as a Flask Response if the server could not be reached
+    """
+    try:
+        return forward(node, data)
+    except requests.RequestException as error:
+        logging.error("A server of the cluster failed: {}".format(error))
+        return Response("A server of the cluster is not available", 503,
+                        content_type="text/plain")
+
+
+def body_patient_id():
+    """ The patient_id in the JSON body of the current request
+
+    :returns: the patient_id, or None if the body has none
+    """
+    in_data = request.get_json(silent=True)
+    if type(in_data) is not dict:
+        return None
+    return in_data.get("patient_id")
+
+
+@app.errorhandler(requests.RequestException)
+def node_unavailable(error):
+    """ Answer a request that a server of the cluster did not answer
+    """
+    logging.error("A server of the cluster failed: {}".format(error))
+    return "A server of the cluster is not available", 503
+
+
+@app.errorhandler(LookupError)
+def no_nodes(error):
+    """ Answer a request made while the cluster has no servers
+    """
+    return "The cluster has no servers", 503
+
+
+@app.route("/", methods=["GET"])
+def status():
+    """Used to indicate that the gateway is running
+    """
+    return "Gateway is on"
+
+
+@app.route("/api", methods=["GET"])
+def status_api():
+    """Used to indicate that the gateway/api is running
+    """
+    return "Gateway is on"
+
+
+@app.route("/api/metrics", methods=["GET"])
+def get_metrics():
+    """Report the gateway's request metrics for Prometheus
+
+    Each server of the cluster serves its own metrics too.
+    """
+    return app.response_class(metrics.render(),
+                              mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/status/<patient_id>", methods=["GET"])
+@app.route("/api/heart_rate/<patient_id>", methods=["GET"])
+@app.route("/api/heart_rate/average/<patient_id>", methods=["GET"])
+@app.route("/api/heart_rate/stats/<patient_id>", methods=["GET"])
+def patient_route(patient_id):
+    """ Forward a request for one patient to the patient's server
+
+    :param patient_id: The id of the patient
+
+    :returns: the server's response
+    """
+    with cluster.routing() as ring:
+        return forward(node_for(ring, patient_id))
+
+
+@app.route("/api/new_patient", methods=["POST"])
+@app.route("/api/heart_rate", methods=["POST"])
+@app.route("/api/heart_rate/interval_average", methods=["POST"])
+def patient_body_route():
+    """ Forward a request with a "patient_id" in its JSON body to the
+    patient's server
+
+    :returns: the server's response
+    """
+    with cluster.routing() as ring:
+        return forward(node_for(ring, body_patient_id()))
+
+
+@app.route("/api/new_attending", methods=["POST"])
+def new_attending():
+    """ Add an attending physician to every server
+
+    A server that already has the physician replaces it, so a request that
+    failed on some servers can be sent again.
+
+    :returns: the response of the first server if none failed, the first
+    error response if every server rejected the input, or a JSON
+    dictionary listing the servers that failed, 503, in the format:
+        {"message": "The attending physician was not added to every
+                     server",
+         "failed": [{"node": "http://127.0.0.1:5001", "status": 503,
+                     "message": "A server of the cluster is not
+                                 available"}, ...]}
+    """
+    with cluster.routing() as ring:
+        responses = [(node, forward_or_fail(node))
+                     for node in every_node(ring)]
+    failed = [(node, response) for node, response in responses
+              if response.status_code != 200]
+    if not failed:
+        return responses[0][1]
+    if len(failed) == len(responses) and \
+            all(response.status_code < 500 for _, response in failed):
+        return failed[0][1]
+    return jsonify({
+        "message": "The attending physician was not added to every server",
+        "failed": [{"node": node, "status": response.status_code,
+                    "message": response.get_data(as_text=True)}
+                   for node, response in failed]}), 503
+
+
+@app.route("/api/patients/<attending_username>", methods=["GET"])
+def attendings_patients(attending_username):
+    """ List the patients of an attending physician from every server
+
+    :param attending_username: the attending physician's username
+
+    :returns: the lists of every server merged and sorted by patient_id, or
+    the first error response of a server, e.g. if there is no such
+    attending physician. A patient being moved is on two servers for a
+    moment, and is listed once.
+    """
+    with cluster.routing() as ring:
+        responses = [forward(node) for node in every_node(ring)]
+    patients = {}
+    for response in responses:
+        if response.status_code != 200:
+            return response
+        for patient in response.get_json():
+            patients[patient["patient_id"]] = patient
+    return jsonify([patients[patient_id]
+                    for patient_id in sorted(patients)]), 200
+
+
+@app.route("/api/heart_rate/batch", methods=["POST"])
+def heart_rate_batch():
+    """ Split a batch of heart rates between the servers of its patients
+
+    Each server is sent its patients' readings as one batch, and their
+    results are put back in the order the readings were sent. Readings
+    without a valid patient_id go to the first server, which rejects them.
+    The readings of a server that fails get its error response as their
+    result, e.g. status 503 if it could not be reached, so the readings the
+    other servers stored are still reported as added.
+
+    :returns: A JSON dictionary in the format of the servers' own
+    /api/heart_rate/batch route, or the first server's response if the body
+    holds no readings
+    """
+    in_batch = parse_heart_rate_batch(request.get_data(as_text=True))
+    with cluster.routing() as ring:
+        if not in_batch:
+            return forward(node_for(ring, None))
+        groups = {}
+        for position, in_heart_rate in enumerate(in_batch):
+            patient_id = None
+            if type(in_heart_rate) is dict:
+                patient_id = in_heart_rate.get("patient_id")
+            groups.setdefault(node_for(ring, patient_id), []).append(position)
+        results = [None] * len(in_batch)
+        for node, positions in groups.items():
+            response = forward_or_fail(node, json.dumps(
+                [in_batch[position] for position in positions]).encode())
+            if response.status_code != 200:
+                failure = {"message": response.get_data(as_text=True),
+                           "status": response.status_code}
+                for position in positions:
+                    results[position] = dict(failure)
+                continue
+            for position, result in zip(positions,
+                                        response.get_json()["results"]):
+                results[position] = result
+    added = sum(1 for result in results if result["status"] == 200)
+    return jsonify({"results": results,
+                    "added": added,
+                    "rejected": len(results) - added}), 200
+
+
+@app.route("/api/bulk_import", methods=["POST"])
+def bulk_import():
+    """ Import NDJSON patients and attending physicians into the cluster
+
+    Every line that is not a patient (a JSON dictionary with a
+    "patient_id") is sent to every server first, then each server is sent
+    its own patients. Lines sent to a server keep their line numbers, with
+    blank lines in place of the others, so rejected lines are reported with
+    the numbers of the whole input. Unlike a lone server, the gateway
+    reads the whole input before importing it. A server that fails is
+    reported in the summary, and is not sent its patients if it failed to
+    import the attending physicians. The input can be sent again once the
+    server is back: the patients already added are then rejected as
+    existing, and the rest are added.
+
+    :returns: A JSON summary in the format of the servers' own
+    /api/bulk_import route, counting the lines sent to every server once,
+    with the summary of each server added, 200, or 503 if a server failed:
+        {"patients_added": 2, "attendings_added": 1, "rejected": 1,
+         "rejects": [{"line": 3, "error": "The key ... is missing"}],
+         "servers": [{"node": "http://127.0.0.1:5001", "status": 200,
+                      "patients_added": 1, "attendings_added": 1,
+                      "rejected": 1, "rejects": [...]},
+                     {"node": "http://127.0.0.1:5002", "status": 503,
+                      "message": "A server of the cluster is not
+                                  available", "patients_added": 0,
+                      "attendings_added": 0, "rejected": 0,
+                      "rejects": []}, ...]}
+    """
+    lines = request.get_data(as_text=True).splitlines()
+    with cluster.routing() as ring:
+        shared = []
+        patients = {}
+        for line_number, line in enumerate(lines):
+            try:
+                in_data = json.loads(line) if line.strip() else None
+            except ValueError:
+                in_data = None
+            if type(in_data) is dict and "patient_id" in in_data:
+                node = node_for(ring, in_data["patient_id"])
+                patients.setdefault(node, []).append(line_number)
+            elif line.strip():
+                shared.append(line_number)
+        servers = [dict(import_lines(node, lines, shared), node=node)
+                   for node in every_node(ring)]
+        summary = {"patients_added": 0, "attendings_added": 0,
+                   "rejected": 0, "rejects": []}
+        # Every server is sent the shared lines, so they are counted once
+        for server in servers:
+            if server["status"] == 200:
+                add_summary(summary, server)
+                break
+        for server in servers:
+            line_numbers = patients.get(server["node"])
+            if server["status"] != 200 or not line_numbers:
+                continue
+            node_summary = import_lines(server["node"], lines, line_numbers)
+            if node_summary["status"] != 200:
+                server["status"] = node_summary["status"]
+                server["message"] = node_summary["message"]
+                continue
+            add_summary(server, node_summary)
+            add_summary(summary, node_summary)
+    for counted in servers + [summary]:
+        counted["rejects"].sort(key=lambda reject: reject["line"])
+        del counted["rejects"][MAX_REPORTED_REJECTS:]
+    summary["servers"] = servers
+    if any(server["status"] != 200 for server in servers):
+        return jsonify(summary), 503
+    return jsonify(summary), 200
+
+
+def import_lines(node, lines, line_numbers):
+    """ Send some lines of a bulk import to one server
+
+    :param node: the URL of the server
+    :param lines: the list of lines of the input
+    :param line_numbers: the sorted positions of the lines to send
+
+    :returns: the server's summary with "status": 200 added, or a summary
+    with nothing imported and the "status" and "message" of the server's
+    error response
+    """
+    response = forward_or_fail(node, select_lines(lines,
+                                                  line_numbers).encode())
+    if response.status_code != 200:
+        return {"status": response.status_code,
+                "message": response.get_data(as_text=True),
+                "patients_added": 0, "attendings_added": 0, "rejected": 0,
+                "rejects": []}
+    return dict(response.get_json(), status=200)
+
+
+def add_summary(summary, other):
+    """ Add the counts and rejected lines of a bulk import summary to another
+
+    :param summary: the summary dictionary to add to
+    :param other: the summary dictionary to add
+    """
+    for key in ("patients_added", "attendings_added", "rejected", "rejects"):
+        summary[key] += other[key]
+
+
+def select_lines(lines, line_numbers):
+    """ Keep some lines of an NDJSON input, blanking the others
+
+    :param lines: the list of lines of the input
+    :param line_numbers: the sorted positions of the lines to keep
+
+    :returns: the NDJSON input, with the other lines blank
+    """
+    selected = [""] * len(lines)
+    for line_number in line_numbers:
+        selected[line_number] = lines[line_number]
+    return "\n".join(selected) + "\n"
+
+
+@app.before_request
+def refuse_cluster_requests_without_token():
+    """ Refuse the requests to the gateway's /api/cluster/ routes that do not
+    carry the cluster token
+
+    Adding a server hands it the cluster token and patients, and removing
+    one moves its patients away, so only the holders of the token may.
+
+    :returns: an error string, 403 for a request to a cluster route without
+    the cluster token in its CLUSTER_TOKEN_HEADER header, or None to handle
+    the request
+    """
+    if not request.path.startswith("/api/cluster/"):
+        return None
+    if not has_cluster_token(cluster.token):
+        return "The cluster routes need the cluster token", 403
+    return None
+
+
+@app.route("/api/cluster/nodes", methods=["GET"])
+def list_nodes():
+    """ List the servers of the cluster
+
+    :returns: a JSON list of server URLs, 200
+    """
+    return jsonify(cluster.ring.nodes), 200
+
+
+@app.route("/api/cluster/nodes", methods=["POST"])
+def add_node():
+    """ Add a running, empty server to the cluster and move its patients to
+    it
+
+    Input json format: {"node": "http://127.0.0.1:5003"}
+
+    :returns: {"node": "http://127.0.0.1:5003", "moved": 120}, 200, or an
+    error string, 400 if the input has no "node" string, or 502 if a server
+    failed and the cluster was left as it was
+    """
+    in_data = request.get_json(silent=True)
+    if type(in_data) is not dict or type(in_data.get("node")) is not str:
+        return "The input has no node URL", 400
+    try:
+        moved = cluster.add_node(in_data["node"])
+    except requests.RequestException as error:
+        return move_failed(error)
+    return jsonify({"node": in_data["node"], "moved": moved}), 200
+
+
+@app.route("/api/cluster/nodes", methods=["DELETE"])
+def remove_node():
+    """ Move the patients of a server to the other servers and remove it
+    from the cluster
+
+    Input json format: {"node": "http://127.0.0.1:5003"}
+
+    :returns: {"node": "http://127.0.0.1:5003", "moved": 120}, 200, or an
+    error string, 400 if the server is not in the cluster or is the last
+    one, or 502 if a server failed and the cluster was left as it was
+    """
+    in_data = request.get_json(silent=True)
+    if type(in_data) is not dict or type(in_data.get("node")) is not str:
+        return "The input has no node URL", 400
+    try:
+        moved = cluster.remove_node(in_data["node"])
+    except KeyError:
+        return "{} is not in the cluster".format(in_data["node"]), 400
+    except ValueError as error:
+        return str(error), 400
+    except requests.RequestException as error:
+        return move_failed(error)
+    return jsonify({"node": in_data["node"], "moved": moved}), 200
+
+
+def move_failed(error):
+    """ Answer a request to add or remove a server that failed while the
+    patients were moved
+
+    :param error: the requests.RequestException raised
+
+    :returns: an error string, 502
+    """
+    logging.error("Moving patients failed: {}".format(error))
+    return "A server of the cluster failed while the patients were " \
+           "moved; the cluster is unchanged", 502
+
+
+def main(argv=None):
+    """ Command line entry point that starts the gateway
+
+    Usage: python gateway.py --node URL [--node URL ...] [--port PORT]
+    [--cluster-token TOKEN]
+    """
+    parser = argparse.ArgumentParser(
+        description="Run a gateway to a cluster of heart rate sentinel "
+                    "servers")
+    parser.add_argument("--node", action="append", default=[],
+                        help="URL of a server of the cluster, e.g. "
+                             "http://127.0.0.1:5001; repeat for each server")
+    parser.add_argument("--port", type=int, default=5000,
+                        help="port to serve on (default: %(default)s)")
+    parser.add_argument("--cluster-token",
+                        default=os.environ.get(CLUSTER_TOKEN_VARIABLE),
+                        help="token the servers of the cluster were started "
+                             "with (default: the {} environment "
+                             "variable)".format(CLUSTER_TOKEN_VARIABLE))
+    args = parser.parse_args(argv)
+    cluster.token = args.cluster_token
+    for node in args.node:
+        cluster.ring.add(node.rstrip("/"))
+    app.run(port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
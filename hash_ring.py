@@ -0,0 +1,96 @@
+from bisect import bisect
+import hashlib
+
+# Points each node has on the ring; more points spread the keys more evenly
+VIRTUAL_NODES = 128
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """ Assigns keys to nodes by consistent hashing
+
+    Every node is hashed to VIRTUAL_NODES points on a ring of 64-bit
+    integers, and a key belongs to the node of the first point at or after
+    the key's own hash, wrapping around at the end. When a node joins it
+    only takes over the keys that fall just before its points, and when one
+    leaves only its own keys move, to the nodes after it; every other key
+    stays where it was.
+    """
+
+    def __init__(self, nodes=(), virtual_nodes=VIRTUAL_NODES):
+        """ Create a ring of the given nodes
+
+        :param nodes: an iterable of node names, e.g. server URLs
+        :param virtual_nodes: the number of points of each node on the ring
+        """
+        self.virtual_nodes = virtual_nodes
+        self._nodes = []
+        self._points = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        """ Add a node to the ring
+
+        :param node: the name of the node; adding a node twice does nothing
+        """
+        if node in self._nodes:
+            return
+        self._nodes.append(node)
+        self._rebuild()
+
+    def remove(self, node):
+        """ Remove a node from the ring
+
+        :param node: the name of the node
+
+        :raises KeyError: if the node is not on the ring
+        """
+        if node not in self._nodes:
+            raise KeyError(node)
+        self._nodes.remove(node)
+        self._rebuild()
+
+    def _rebuild(self):
+        points = sorted((_hash("{}#{}".format(node, number)), node)
+                        for node in self._nodes
+                        for number in range(self.virtual_nodes))
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key):
+        """ Find the node a key belongs to
+
+        :param key: the key as a string, e.g. a patient_id
+
+        :returns: the name of the node
+
+        :raises LookupError: if the ring has no nodes
+        """
+        if not self._points:
+            raise LookupError("the ring has no nodes")
+        position = bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[position]
+
+    @property
+    def nodes(self):
+        """ The nodes on the ring, in the order they were added
+        """
+        return list(self._nodes)
+
+    def copy(self):
+        """ Make a ring with the same nodes
+
+        :returns: a new HashRing
+        """
+        return HashRing(self._nodes, self.virtual_nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, node):
+        return node in self._nodes
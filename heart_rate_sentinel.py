@@ -1,19 +1,94 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_file
 from datetime import datetime
+import argparse
+from collections import Counter
+import hmac
+from itertools import groupby
+import json
 import logging
-import requests
+import multiprocessing
+from operator import itemgetter
+import os
+import signal
+import socket
+import threading
+import time
+from werkzeug.serving import make_server
+from hr_series import to_epoch, format_epoch
+from email_outbox import Outbox, EmailDispatcher
+from metrics import Metrics, metrics, timed, instrument_app, \
+    instrument_storage
+from storage import RETENTION_KEYS, make_storage
+from rollups import RESOLUTIONS, choose_resolution
+from shared_store import connect_metrics, connect_store, new_authkey, \
+    serve, start_store
+from replication import Standby
+import async_server
 
 app = Flask(__name__)
 
-# Empty database to add new patients
-patients_db = []
+# Count and time every request; the results are served at /api/metrics
+instrument_app(app)
+
+# A worker of the multi-process mode sends its metrics to the store
+# process every METRICS_REPORT_SECONDS and serves those of every worker;
+# worker_metrics is the store's WorkerMetrics, or None in one process
+METRICS_REPORT_SECONDS = 5
+worker_metrics = None
+
+# Patients, attending physicians and heart rates are kept by a storage
+# backend (see storage.py): "memory" keeps them in memory and logs every
+# change to DATA_DIRECTORY, "sqlite" keeps them in a database file in
+# DATA_DIRECTORY. The data is recovered when the server starts.
+STORAGE_BACKEND = "memory"
+DATA_DIRECTORY = "data"
+storage = instrument_storage(make_storage(STORAGE_BACKEND, DATA_DIRECTORY))
+
+# Bulk imports add records this many at a time, and list at most this many
+# rejected lines in their summary
+IMPORT_CHUNK_SIZE = 1000
+MAX_REPORTED_REJECTS = 100
+
+# Heart rates are stored with their patient_id as signed 64-bit integers,
+# and added up with their squares into 64-bit running sums, so readings are
+# only accepted with a patient_id in the 64-bit range and a heart rate in
+# beats per minute a human heart can reach, which no sum can overflow
+MIN_STORED_INTEGER = -2 ** 63
+MAX_STORED_INTEGER = 2 ** 63 - 1
+MIN_HEART_RATE = 0
+MAX_HEART_RATE = 600
+READING_RANGES = {"patient_id": (MIN_STORED_INTEGER, MAX_STORED_INTEGER),
+                  "heart_rate": (MIN_HEART_RATE, MAX_HEART_RATE)}
 
-# Empty database to add attending physicians
-attending_db = []
 logging.basicConfig(filename="logfile.log", level=logging.INFO)
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 
+# Tachycardia e-mails are queued in a file-backed outbox and sent to the
+# relay by a background thread; both are made by create_app, with these
+# defaults, and until then e-mails are only queued in memory.
+# E-mails to the same physician within EMAIL_DIGEST_WINDOW seconds are sent
+# as one digest.
+EMAIL_OUTBOX_PATH = "email_outbox.jsonl"
+EMAIL_RELAY_URL = "http://vcm-7631.vm.duke.edu:5007/hrss/send_email"
+EMAIL_DIGEST_WINDOW = 60
+email_outbox = Outbox()
+email_dispatcher = None
+
+# A server started with --standby-of applies the changes of its primary
+# server (see replication.py) and refuses changes of its own until it is
+# promoted
+standby = None
+
+# The /api/cluster/ routes move patients between the servers of a cluster
+# and are only answered to the gateway, which sends the token shared by the
+# servers in the CLUSTER_TOKEN_HEADER header. The replication routes that
+# ship the data to a standby or promote it need the same token. The token
+# is given with --cluster-token or the CLUSTER_TOKEN_VARIABLE environment
+# variable; a server without one refuses all of those requests.
+CLUSTER_TOKEN_HEADER = "X-Cluster-Token"
+CLUSTER_TOKEN_VARIABLE = "HEART_RATE_CLUSTER_TOKEN"
+
 
 @app.route("/", methods=["GET"])
 def status():
@@ -29,12 +104,36 @@ def status_api():
     return "Server is on"
 
 
+@app.route("/api/metrics", methods=["GET"])
+def get_metrics():
+    """Report request and helper function metrics for Prometheus
+
+    Returns the count, error count and latency histogram of every route,
+    of the find_patient, queue_email and window_average functions and of
+    the storage calls in metrics.STORAGE_CALLS (as "storage.<name>"), in
+    the Prometheus text exposition format. p50, p95 and p99 latencies are
+    included as summaries. A worker of the multi-process mode reports the
+    metrics of every worker added together, as last sent to the store
+    process (see shared_store.WorkerMetrics).
+    """
+    registry = metrics
+    if worker_metrics is not None:
+        registry = Metrics()
+        for exported in worker_metrics.report(os.getpid(),
+                                              metrics.export()):
+            registry.add(exported)
+    return app.response_class(registry.render(),
+                              mimetype="text/plain; version=0.0.4")
+
+
 def parse_new_patient(in_data):
     """To change the input data from string to integer
 
     This function will take the input data with keys "patient id"
     and "patient age" and change them from string to integer.
     If it contains more than integer it will show an error message.
+    The optional "retention_readings" and "retention_seconds" keys are
+    changed to integers too, and must be at least 1.
 
     :param in_data: JSON contains keys "patient id" and "patient age"
     :return: the changed data format (to int) or error message
@@ -59,6 +158,16 @@ def parse_new_patient(in_data):
     else:
         return "No such key: patient_age"
 
+    for key in RETENTION_KEYS:
+        if in_data.get(key) is not None:
+            try:
+                in_data[key] = int(in_data[key])
+            except (TypeError, ValueError):
+                return "{} is not a number or can't convert to " \
+                       "integer".format(key)
+            if in_data[key] < 1:
+                return "{} must be at least 1".format(key)
+
     return in_data
 
 
@@ -73,13 +182,18 @@ def new_patient():
     The /new_patient route is a POST request that should receive a JSON-encoded
     string with the following format:
     {"patient_id": int, "attending_username": str, "patient_age": int}
+    It can also have "retention_readings" and "retention_seconds" integers,
+    which limit the readings kept for the patient to the latest ones and to
+    those taken at most that many seconds before the latest one.
     The function first calls parse_new_patient to try to change id and age
     to full integer. The function then calls validation functions to ensure
     that the needed keys and data types exist in the received JSON, then
     calls a function to add the patient data to the database.
     The function then returns to the caller either a status code of 200
     and the patient info if it was successfully added, or a status code of
-    400 and an error message if there was a validation problem.
+    400 and an error message if there was a validation problem or a patient
+    with the same patient_id already exists; that patient and its readings
+    are left as they were.
 
     :returns: If the json is in the correct format and data types:
     {"patient_id": int, "attending_username": str, "patient_age": int}
@@ -96,7 +210,11 @@ def new_patient():
         return error_string, status_code
     added_patient = add_new_patient(in_data["patient_id"],
                                     in_data["attending_username"],
-                                    in_data["patient_age"])
+                                    in_data["patient_age"],
+                                    in_data.get("retention_readings"),
+                                    in_data.get("retention_seconds"))
+    if added_patient is None:
+        return "Patient {} already exists".format(in_data["patient_id"]), 400
     log_if_new_patient(in_data["patient_id"])
     return "Added patient {}".format(added_patient), 200
 
@@ -136,7 +254,8 @@ def validate_new_patient(in_data, expected_keys):
     return True, 200
 
 
-def add_new_patient(patient_id, attending_username, patient_age):
+def add_new_patient(patient_id, attending_username, patient_age,
+                    retention_readings=None, retention_seconds=None):
     """Creates new patient database entry
     This function receives information about the patient,
     creates a dictionary, and appends that dictionary to the database list.
@@ -144,8 +263,7 @@ def add_new_patient(patient_id, attending_username, patient_age):
     {"patient_id": str, "attending_username": int, "patient_age": str,
      "tests": list}
     The "tests" list is initialized as an empty list while the values for the
-    other keys are taken from the input parameters.  After the new patient
-    is added, the database is printed to the console for debugging purposes.
+    other keys are taken from the input parameters.
     The created dictionary is returned to enable this function to be tested.
     This function takes the information from each of the expected_keys and
     adds it to the attending physician database as a dictionary.
@@ -154,15 +272,26 @@ def add_new_patient(patient_id, attending_username, patient_age):
     :param attending_username: A string of the new attending physician's
     username
     :param patient_age: A string of the new patient age
+    :param retention_readings: the number of latest readings to keep for
+    the patient, or None for the server's default
+    :param retention_seconds: drop the patient's readings taken more than
+    this many seconds before its latest one, or None for the server's
+    default
 
     :returns: Returns the four parameters in a dictionary format under the
-    keys: "patient_id", "attending_username", "patient_age", and "tests"
+    keys: "patient_id", "attending_username", "patient_age", and "tests",
+    or None if a patient with the same patient_id already exists; that
+    patient and its readings are kept
     """
     patient_to_add = {"patient_id": patient_id,
                       "attending_username": attending_username,
                       "patient_age": patient_age}
-    patients_db.append(patient_to_add)
-    print(patients_db)
+    if retention_readings is not None:
+        patient_to_add["retention_readings"] = retention_readings
+    if retention_seconds is not None:
+        patient_to_add["retention_seconds"] = retention_seconds
+    if storage.add_patients([patient_to_add]):
+        return None
     return patient_to_add
 
 
@@ -253,41 +382,187 @@ def add_new_attending(username, email, phone):
     attending_to_add = {"attending_username": username,
                         "attending_email": email,
                         "attending_phone": phone}
-    attending_db.append(attending_to_add)
-    print(attending_db)
+    storage.add_attendings([attending_to_add])
     return attending_to_add
 
 
+@app.route("/api/bulk_import", methods=["POST"])
+def bulk_import():
+    """ Implements /api/bulk_import route for onboarding many records
+
+    The body is newline-delimited JSON (NDJSON) with one patient or
+    attending physician per line, in the same formats as the
+    /api/new_patient and /api/new_attending inputs. The body is read line by
+    line as it arrives, so a file of any size can be imported with constant
+    memory. See import_records for how each line is handled.
+
+    :returns: A JSON summary of the import in the format:
+        {"patients_added": 2, "attendings_added": 1, "rejected": 1,
+         "rejects": [{"line": 3, "error": "The key ... is missing"}]}
+    """
+    summary = import_records(read_lines(request.stream))
+    return jsonify(summary), 200
+
+
+def read_lines(stream, chunk_size=65536):
+    """ Split a binary stream into lines, reading it in large chunks
+
+    Iterating a raw request stream directly can read it one byte at a time,
+    which makes large uploads very slow. This reads chunk_size bytes at a
+    time and only keeps the current chunk and any unfinished line in
+    memory.
+
+    :param stream: a binary file-like object with a read method
+    :param chunk_size: the number of bytes to read at a time
+
+    :returns: a generator of the lines in the stream as bytes
+    """
+    rest = b""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        yield from lines
+    if rest:
+        yield rest
+
+
+def import_records(lines):
+    """ Validate and add patients and attending physicians from NDJSON
+
+    A line containing a "patient_id" key is a patient and goes through
+    parse_new_patient and validate_new_patient, and is rejected with
+    parse_new_patient's error message if it cannot be parsed. Any other line
+    is an attending physician and goes through validate_new_attending. Valid
+    records are collected and added to the databases IMPORT_CHUNK_SIZE at a
+    time. Blank lines are skipped, and a patient whose patient_id already
+    exists is rejected and the existing patient kept. Only the first
+    MAX_REPORTED_REJECTS
+    rejected lines are listed in the summary, so memory use does not grow
+    with the size of the input.
+
+    :param lines: an iterable of NDJSON lines as strings or bytes, e.g. an
+    open file or the request stream
+
+    :returns: a summary dictionary with the number of patients and attending
+    physicians added, the number of rejected lines, and a list of
+    {"line": int, "error": str} dictionaries for the first rejected lines
+    """
+    patient_keys = {"patient_id": int,
+                    "attending_username": str,
+                    "patient_age": int}
+    attending_keys = {"attending_username": str, "attending_email": str,
+                      "attending_phone": str}
+    summary = {"patients_added": 0, "attendings_added": 0, "rejected": 0,
+               "rejects": []}
+    patients = []
+    patient_lines = []
+    attendings = []
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            in_data = json.loads(line)
+        except ValueError:
+            in_data = None
+        if type(in_data) is dict and "patient_id" in in_data:
+            in_data = parse_new_patient(in_data)
+            if type(in_data) is str:
+                error_string = in_data
+            else:
+                error_string, status_code = validate_new_patient(in_data,
+                                                                 patient_keys)
+                patient_lines.append(line_number)
+            records = patients
+        else:
+            error_string, status_code = validate_new_attending(in_data,
+                                                               attending_keys)
+            records = attendings
+        if error_string is not True:
+            if records is patients:
+                patient_lines.pop()
+            add_reject(summary, line_number, error_string)
+            continue
+        records.append(in_data)
+        if len(records) >= IMPORT_CHUNK_SIZE:
+            add_imported_records(patients, attendings, summary,
+                                 patient_lines)
+    add_imported_records(patients, attendings, summary, patient_lines)
+    logging.info("Bulk import added {} patients and {} attending physicians, "
+                 "rejected {} lines".format(summary["patients_added"],
+                                            summary["attendings_added"],
+                                            summary["rejected"]))
+    return summary
+
+
+def add_reject(summary, line_number, error_string):
+    """ Count a rejected import line, and list it if there is room
+
+    :param summary: the import summary
+    :param line_number: the number of the rejected line, starting at 1
+    :param error_string: why the line was rejected
+    """
+    summary["rejected"] += 1
+    if len(summary["rejects"]) < MAX_REPORTED_REJECTS:
+        summary["rejects"].append({"line": line_number,
+                                   "error": error_string})
+
+
+def add_imported_records(patients, attendings, summary, patient_lines):
+    """ Add a chunk of validated import records to the databases
+
+    A patient that already exists is not added, and its line is rejected.
+    The lists are emptied once their records have been added.
+
+    :param patients: a list of validated patient dictionaries
+    :param attendings: a list of validated attending physician dictionaries
+    :param summary: the import summary, whose "patients_added" and
+    "attendings_added" counts are increased
+    :param patient_lines: the line number of each patient in patients
+    """
+    with storage.transaction():
+        existing = Counter(storage.add_patients(patients))
+        storage.add_attendings(attendings)
+    # Of the patients sharing a patient_id only the first can have been
+    # added, so the rejected ones are the last ones
+    rejected = []
+    for patient, line_number in zip(reversed(patients),
+                                    reversed(patient_lines)):
+        if existing[patient["patient_id"]] > 0:
+            existing[patient["patient_id"]] -= 1
+            rejected.append((line_number, patient["patient_id"]))
+    for line_number, patient_id in reversed(rejected):
+        add_reject(summary, line_number,
+                   "Patient {} already exists".format(patient_id))
+    summary["patients_added"] += len(patients) - len(rejected)
+    summary["attendings_added"] += len(attendings)
+    patients.clear()
+    patient_lines.clear()
+    attendings.clear()
+
+
 @app.route("/api/heart_rate", methods=["POST"])
 def heart_rate_timestamp():
     """ Implements /api/heart_rate route
 
-    This function is a driver for the validate_heart_rate, find_patient,
-    add_heart_rate_timestamp_keys, add_heart_rate_timestamp_info, and
-    add_hr_to_db functions.
     It first reads in a json file in the correct format that contains a
     patient_id and a heart_rate reading.
     The inputted data is validated and can return True, 200 if no errors
     occurred or it can return an error string and a 400 error code. The error
     string describes the error that occurred with the inputted json file.
-    The find_patient will then run the find_patient function and return the
-    patient information, an indexing location ("enum"), and a status. The
-    status can be False, True, or []. If False, the patient was not found in
-    the database and an appropriate error message will be returned.
-    If True, this means that the patient is receiving their first heart_rate
-    and timestamp entry. This will then run the add_heart_rate_timestamp
-    function.
-    If status = [], then the program will skip to the
-    add_heart_rate_timestamp_info function and append the new information.
-    Finally, the new information and created patient dictionary will be added
-    to the patients_db using the add_hr_to_db function.
+    The reading is then added to the patient in the storage backend with the
+    current time as its timestamp, and is durable before the route returns.
+    If the patient is not in the storage, an error message is returned.
+    If the new heart rate is tachycardic, an e-mail to the attending
+    physician is queued with send_email. The e-mail is delivered in the
+    background, so the request does not wait for the e-mail relay.
 
     :returns: If the status_code from validate_heart_rate_timestamp is 400, an
     error string and the error code will be returned describing the error.
     If the entered patient ID is not found in the database, a 400 error code
     and error string will be returned.
-    If status from find_patient is False, an error message will be returned
-    indicating the missing Patient ID.
     If the patient ID is found and there are no validation errors, the function
     will return "Added test to patient id <patient_id>", 200
     """
@@ -297,54 +572,16 @@ def heart_rate_timestamp():
         validate_heart_rate_timestamp(in_heart_rate, heart_rate_expected_keys)
     if error_string is not True:
         return error_string, status_code
-    patient, enum, status = find_patient(in_heart_rate["patient_id"],
-                                         patients_db)
-    if status is False:
-        return "Patient ID {} not found in database" \
-                   .format(in_heart_rate["patient_id"]), 400
-    if status is True:
-        patient = add_heart_rate_timestamp_keys(patient)
-    new_entry = add_heart_rate_timestamp_info(patient, in_heart_rate)
-    send_email(new_entry["patient_id"], new_entry["heart_rate"][-1])
-    add_hr_to_db(patients_db, enum, new_entry)
-    print("here is the dbdbdbdb")
-    print(patients_db)
+    patient_id = in_heart_rate["patient_id"]
+    heart_rate = in_heart_rate["heart_rate"]
+    if not storage.add_readings(patient_id, [heart_rate], datetime.now()):
+        return "Patient ID {} not found in database".format(patient_id), 400
+    if is_tachy({"heart_rate": [heart_rate]}) == "tachycardic":
+        send_email(patient_id, heart_rate)
     return "Added test to patient id " \
            "{}".format(in_heart_rate["patient_id"]), 200
 
 
-def add_hr_to_db(patients_db, enum, new_entry):
-    """ Replace old patient information with new information
-
-    This function is responsible for taking the old patient dictionary and
-    replacing it with a new patient dictionary. This new dictionary contains
-    any new heart rate and timestamp information that has been added on the
-    /api/heart_rate route.
-
-    :param patients_db: a list of dictionaries. Each dictionary contains
-    information for each patient. Format:
-        {'patient_id': 1,
-         'attending_username': 'Smith.J',
-         'patient_age': 50,
-         'heart_rate': [],
-         'timestamp': []}
-    :param enum: an integer that is used to index the location of the new
-    patient dictionary in the patients_db
-    :param new_entry: the new patient dictionary that will replace the old
-    dictionary in the patients_db. Format:
-        {'patient_id': 1,
-         'attending_username': 'Smith.J',
-         'patient_age': 50,
-         'heart_rate': [100,...],
-         'timestamp': ["2018-11-02 11:00:00,..."]}
-
-    :returns: the new patients_db with the updated patient dictionary (shown
-    above)
-    """
-    patients_db[enum] = new_entry
-    return patients_db
-
-
 def validate_heart_rate_timestamp(in_heart_rate, heart_rate_expected_keys):
     """Validate inputted json data
 
@@ -353,7 +590,8 @@ def validate_heart_rate_timestamp(in_heart_rate, heart_rate_expected_keys):
     2. It must contain all of the expected_keys: "patient_id" and
     "heart_rate"
     3. It must contain the correct data types for each key. All values must be
-       integers or integers in a string format.
+       integers or integers in a string format, within their
+       READING_RANGES.
    The appropriate error message will be returned based on what the json file
    is missing or has incorrect.
    If the json file has the correct format and data types, the function will
@@ -377,11 +615,15 @@ def validate_heart_rate_timestamp(in_heart_rate, heart_rate_expected_keys):
         if type(in_heart_rate[key]) is not heart_rate_expected_keys[key]:
             try:
                 in_heart_rate[key] = int(in_heart_rate[key])
-            except ValueError:
+            except (TypeError, ValueError):
                 return "The key {} has the wrong data type".format(key), 400
+        low, high = READING_RANGES[key]
+        if not low <= in_heart_rate[key] <= high:
+            return "The key {} is out of range".format(key), 400
     return True, 200
 
 
+@timed("find_patient")
 def find_patient(patient_id, patients_db):
     """Find patient dictionary from database
 
@@ -389,94 +631,150 @@ def find_patient(patient_id, patients_db):
     in the json file. If the entered patient_id is not found in the patient
     database, then a False "status" boolean is returned. This output is used in
     the heart_rate_timestamp function.
-    This function also returns the patient dictionary, if found, and the enum
-    variable. "Enum" is used to count the number of iterations through the
-    for loop in the function. This allows us to locate the index for the
-    specified patient in the patients database.
+    The patient is looked up directly by its id, and the returned dictionary
+    does not hold the readings.
 
     :param patient_id: The patient_id number from the inputted json as an
     integer
-    :param patients_db: The master database containing dictionaries for each
-    entered patient
+    :param patients_db: the Storage backend holding the patients
 
     :returns: This function will return "patient" which is a dictionary
-    corresponding to the entered patient_id number.
-    It can return False as a boolean if the entered patient_id number is not
-    found in the database.
-    Enum is an integer returned as an indexing tool in later functions.
-    The third return is a "status" that can be [], True, or False.
-    """
-    for enum, patient in enumerate(patients_db):
-        if patient["patient_id"] == patient_id:
-            for key in {"timestamp": [], "heart_rate": []}:
-                if key in patient:
-                    return patient, enum, []
-                else:
-                    return patient, enum, True
-    return patient, enum, False
-
-
-def add_heart_rate_timestamp_keys(patient):
-    """ Add empty keys for heart_rate and timestamps
-
-    This function adds an empty list to the patient's dictionary information.
-    This is a preliminary step so that heart_rate and timestamp information can
-    later be added to the server in the heart_rate_timestamp function.
-    Note: this function only runs if there are no heart_rate and timestamp
-    entries in the past.
-
-    :param patient: A dictionary conataining information in the format:
-        {"patient_id": patient_id,
-         "attending_username": attending_username,
-         "patient_age": patient_age}
-add
-    :returns: A dictionary with added empty lists for the "heart_rate" and
-    "timestamp" keys. The first three keys are "patient_id",
-    "attending_username", and "patient_age".
+    corresponding to the entered patient_id number, or None if the entered
+    patient_id number is not found in the database.
+    The second return is the patient_id.
+    The third return is a "status" that can be [] if the patient has
+    readings, True if it has none, or False if it was not found.
     """
-    patient_id = patient["patient_id"]
-    attending_username = patient["attending_username"]
-    patient_age = patient["patient_age"]
-    patient_new_keys = {"patient_id": patient_id,
-                        "attending_username": attending_username,
-                        "patient_age": patient_age,
-                        "heart_rate": [],
-                        "timestamp": []}
-    return patient_new_keys
-
-
-def add_heart_rate_timestamp_info(patient_new_keys, in_heart_rate):
-    """ Add heart_rate and timestamp to patient dictionary
-
-    This function appends the information to the dictionary of an entered
-    patient. The information being added is the "heart_rate" and "timestamp"
-    for the heart_rate reading. This function is used within the
-    heart_rate_timestamp function to add the heart_rate and timestamp
-    information to the patient database and server.
-
-    :param patient: A dictionary in the format:
-        {"patient_id": patient_id,
-         "attending_username": attending_username,
-         "patient_age": patient_age,
-         "heart_rate": [],
-         "timestamp": []}
-    :param in_heart_rate: A dictionary that contains "patient_id" and
-    "heart_rate" values as integers.
-
-    :returns: An updated dictionary for the entered patient ID with their
-    heart rate reading and a timestamp for the reading. Ex:
-        {"patient_id": patient_id,
-         "attending_username": attending_username,
-         "patient_age": patient_age,
-         "heart_rate": 100,
-         "timestamp": "2018-03-09 11:00:36"}
-    """
-    heart_rate_to_add = in_heart_rate["heart_rate"]
-    patient_new_keys["heart_rate"].append(heart_rate_to_add)
-    timestamp_to_add = datetime.now()
-    timestamp_to_add = datetime.strftime(timestamp_to_add, "%Y-%m-%d %H:%M:%S")
-    patient_new_keys["timestamp"].append(timestamp_to_add)
-    return patient_new_keys
+    patient = patients_db.get_patient(patient_id)
+    if patient is None:
+        return None, patient_id, False
+    if patients_db.last_reading(patient_id) is not None:
+        return patient, patient_id, []
+    return patient, patient_id, True
+
+
+@app.route("/api/heart_rate/batch", methods=["POST"])
+def heart_rate_batch():
+    """ Implements /api/heart_rate/batch route
+
+    This route lets a bedside gateway send many buffered heart rate readings,
+    for any number of patients, in one request. The body is either a JSON
+    list of readings or newline-delimited JSON (one reading per line). Each
+    reading has the same format as the /api/heart_rate input:
+        {"patient_id": 1, "heart_rate": 100}
+    All readings are validated in one pass with validate_heart_rate_timestamp
+    and grouped by patient with group_heart_rate_batch. Each patient is then
+    looked up once and all of their readings are added in one operation by
+    add_heart_rate_group. Every reading in the request gets the same
+    timestamp.
+
+    :returns: A JSON dictionary with one result per reading, in the order
+    they were sent, and the number of readings added and rejected:
+        {"results": [{"message": "Added test to patient id 1",
+                      "status": 200}, ...],
+         "added": 1, "rejected": 0}
+    or "No heart rate readings in the input", 400 if the body is empty.
+    """
+    in_batch = parse_heart_rate_batch(request.get_data(as_text=True))
+    if len(in_batch) == 0:
+        return "No heart rate readings in the input", 400
+    results, groups = group_heart_rate_batch(in_batch)
+    timestamp = datetime.now()
+    with storage.transaction():
+        for patient_id, positions in groups.items():
+            heart_rates = [in_batch[position]["heart_rate"]
+                           for position in positions]
+            message, status_code = add_heart_rate_group(patient_id,
+                                                        heart_rates,
+                                                        timestamp)
+            for position in positions:
+                results[position] = {"message": message,
+                                     "status": status_code}
+    added = sum(1 for result in results if result["status"] == 200)
+    return jsonify({"results": results,
+                    "added": added,
+                    "rejected": len(results) - added}), 200
+
+
+def parse_heart_rate_batch(body):
+    """ Read the readings from the body of a batch request
+
+    The body can be a JSON list of readings, a single JSON reading, or
+    newline-delimited JSON with one reading per line. Blank lines are
+    skipped. A line that is not valid JSON is kept as None so that it gets
+    its own error result.
+
+    :param body: the request body as a string
+
+    :returns: a list of the readings in the order they were sent
+    """
+    try:
+        in_batch = json.loads(body)
+    except ValueError:
+        in_batch = None
+    if type(in_batch) is list:
+        return in_batch
+    if type(in_batch) is dict:
+        return [in_batch]
+    readings = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            readings.append(json.loads(line))
+        except ValueError:
+            readings.append(None)
+    return readings
+
+
+def group_heart_rate_batch(in_batch):
+    """ Validate the readings of a batch and group them by patient
+
+    :param in_batch: a list of readings, each expected to be a dictionary
+    with "patient_id" and "heart_rate" keys
+
+    :returns: a list with one result per reading, where readings that failed
+    validation already hold their error {"message": str, "status": 400} and
+    the others hold None, and a dictionary mapping each patient_id to the
+    positions of that patient's valid readings in the batch
+    """
+    heart_rate_expected_keys = {"patient_id": int, "heart_rate": int}
+    results = []
+    groups = {}
+    for position, in_heart_rate in enumerate(in_batch):
+        error_string, status_code = \
+            validate_heart_rate_timestamp(in_heart_rate,
+                                          heart_rate_expected_keys)
+        if error_string is not True:
+            results.append({"message": error_string, "status": status_code})
+            continue
+        results.append(None)
+        groups.setdefault(in_heart_rate["patient_id"], []).append(position)
+    return results, groups
+
+
+def add_heart_rate_group(patient_id, heart_rates, timestamp):
+    """ Add several heart rate readings to one patient
+
+    All readings are added to the patient in the storage backend in one
+    operation, and a single e-mail is queued if any of the readings is
+    tachycardic. The caller can wrap several calls in a
+    storage.transaction() so that they reach the disk together.
+
+    :param patient_id: the patient_id of the readings as an integer
+    :param heart_rates: a list of heart rates as integers
+    :param timestamp: the time of the readings as a datetime
+
+    :returns: the result message and status code for these readings, the
+    same ones /api/heart_rate would return for each of them
+    """
+    if not storage.add_readings(patient_id, heart_rates, timestamp):
+        return "Patient ID {} not found in database".format(patient_id), 400
+    tachycardic = [heart_rate for heart_rate in heart_rates
+                   if is_tachy({"heart_rate": [heart_rate]}) == "tachycardic"]
+    if tachycardic:
+        send_email(patient_id, tachycardic[-1])
+    return "Added test to patient id {}".format(patient_id), 200
 
 
 def find_patient_all(patient_id, patients_db):
@@ -489,20 +787,20 @@ def find_patient_all(patient_id, patients_db):
 
     :param patient_id: The patient_id number from the inputted json as an
     integer
-    :param patients_db: The master database containing dictionaries for each
-    entered patient
+    :param patients_db: the Storage backend holding the patients
 
     :returns: This function will return a list of all data from one specific
     patient id corresponding to the entered patient_id number.
     """
-    find_all_list = []
-    for patient in patients_db:
-        if patient["patient_id"] == patient_id:
-            for key in {"timestamp": [], "heart_rate": []}:
-                if key in patient:
-                    find_all_list.append(patient)
-                    break
-    return find_all_list
+    patient = patients_db.get_patient(patient_id)
+    if patient is None:
+        return []
+    heart_rates, timestamps = patients_db.readings(patient_id)
+    if len(heart_rates) == 0:
+        return []
+    patient["heart_rate"] = heart_rates
+    patient["timestamp"] = timestamps
+    return [patient]
 
 
 def is_tachy(patient):
@@ -523,25 +821,6 @@ def is_tachy(patient):
         return "not tachycardic"
 
 
-def cal_avg_hr(find_all_list):
-    """Calculate the average heart rate given multiple of data
-    registered from client
-
-    It wil collect multiple data from different time stamp and
-    return the average value.
-
-    :param find_all_list: The list of data of a patient in JSON
-
-    :returns: The average heart beat value of a list: find_all_list
-    """
-    avg_hr = 0
-    count = 0
-    for patient in find_all_list:
-        avg_hr += patient["heart_rate"][-1]
-        count += 1
-    return avg_hr / count
-
-
 @app.route("/api/status/<patient_id>", methods=["GET"])
 def check_status_by_id(patient_id):
     """Create a JSON file containing the most recent time stamp,
@@ -559,21 +838,15 @@ def check_status_by_id(patient_id):
     return "No patient's information" or "No timestamp or
     heart_Rate data available for this patient id"
     """
-    patient = find_patient_all(int(patient_id), patients_db)
-    print("find find patient all:")
-    print(patients_db)
-    # return jsonify(patient)
+    patient = find_patient_all(int(patient_id), storage)
     try:
         patient = patient[-1]
-        print("look here")
-        print(patient)
         status = is_tachy(patient)
-        print(status)
         timestamp = patient["timestamp"]
         heart_Rate = patient["heart_rate"]
-        status_json = {"heart_rate": heart_Rate,
+        status_json = {"heart_rate": list(heart_Rate),
                        "status": status,
-                       "timestamp": timestamp}
+                       "timestamp": list(timestamp)}
         if status == "tachycardic":
             if not get_doc_email(patient_id, heart_Rate):
                 return "No such doctor's email", 400
@@ -605,14 +878,13 @@ def get_doc_email(patient_id, heart_Rate):
     patient id.
     """
     try:
-        for patient in patients_db:
-            if int(patient_id) == patient["patient_id"]:
-                doc_name = patient["attending_username"]
-                for doc in attending_db:
-                    if doc["attending_username"] == doc_name:
-                        doc_email = doc["attending_email"]
-
-                        return doc_email
+        patient = storage.get_patient(int(patient_id))
+        if patient is not None:
+            doc = storage.get_attending(patient["attending_username"])
+            if doc is not None:
+                doc_email = doc["attending_email"]
+
+                return doc_email
     except KeyError:
         log_if_no_doc_email()
         return False
@@ -624,19 +896,26 @@ def log_if_send_email(patient_id, heart_Rate, doc_email):
                  .format(patient_id, heart_Rate, doc_email))
 
 
+@timed("queue_email")
 def send_email(patient_id, heart_Rate):
-    """Send the email through server:
+    """Queue the email to send through server:
      "http://vcm-7631.vm.duke.edu:5007/hrss/send_email"
 
     If the patient has tachycardic based on his/her recent record
     of heart rate, it will send a email to the doctor's email.
+    The email is written to the email_outbox and this function
+    returns straight away; the email_dispatcher thread posts it
+    to the relay given to create_app (EMAIL_RELAY_URL by default) and
+    retries if that fails.
+    Emails to the same doctor within EMAIL_DIGEST_WINDOW seconds
+    are merged into one digest email.
 
     :param patient_id: The id of the patient
     :param heart_Rate: The heart rate array of the patient
 
     :returns: The text string showing that
-    "E-mail sent to dr_user_id@ourdomain.com from server@domain.com"
-    with code returned. 200 if pass. 400 if not pass.
+    "E-mail to dr_user_id@ourdomain.com queued"
+    with code returned. 200 if queued. 503 if the outbox is full.
 
     """
     doc_email = get_doc_email(patient_id, heart_Rate)
@@ -648,11 +927,11 @@ def send_email(patient_id, heart_Rate):
         .format(patient_id)
     }
     log_if_send_email(patient_id, heart_Rate, doc_email)
-    r = requests.post("http://vcm-7631.vm.duke.edu:5007/hrss/send_email",
-                      json=email)
-    print(r.status_code)
-    print(r.text)
-    return r.text, r.status_code
+    if not email_outbox.put(email):
+        logging.error("E-mail outbox is full, dropped e-mail to {}"
+                      .format(doc_email))
+        return "E-mail outbox is full", 503
+    return "E-mail to {} queued".format(doc_email), 200
 
 
 @app.route("/api/heart_rate/<patient_id>", methods=["GET"])
@@ -662,19 +941,39 @@ def check_hr_by_id(patient_id):
 
     It will get all data from this particular patient's id and
     get all dictionary with heart rate. Finally, return all
-    heart rate in the list
+    heart rate in the list. The list is only built here, when
+    the response is serialized.
+    The optional "since" and "resolution" query arguments (see
+    window_args) limit the list to readings after a date, and
+    return one summary per minute, hour or day instead of every
+    reading, e.g.
+    /api/heart_rate/1?since=2018-03-09 11:00:00&resolution=hour
 
     :param patient_id: The id of the patient
 
     :returns: List of all heart rate recorded for this patient id
     or "No heart rate data available" is there is no "heart_rate"
-    for the patient id
+    for the patient id. With a resolution other than "raw", a list
+    of dictionaries in the format:
+        {"timestamp": "2018-03-09 11:00:00", "count": 3600,
+         "average": 72.5, "min": 60, "max": 101}
+    where timestamp is the start of the minute, hour or day
     """
-    patient = find_patient_all(int(patient_id), patients_db)
+    if "since" in request.args or "resolution" in request.args:
+        try:
+            since, resolution = window_args(request.args)
+        except ValueError as error:
+            return str(error), 400
+        history = window_history(int(patient_id), since, resolution,
+                                 storage)
+        if len(history) == 0:
+            return "No heart rate data available", 400
+        return jsonify(history), 200
+    patient = find_patient_all(int(patient_id), storage)
     list_hr = []
     try:
         for record in patient:
-            list_hr.append(record["heart_rate"][-1])
+            list_hr.extend(record["heart_rate"])
         return jsonify(list_hr), 200
     except KeyError:
         return "No heart rate data available", 400
@@ -685,21 +984,154 @@ def check_avghr_by_id(patient_id):
     """Return the average heart rate based on the list of heart
     rate available
 
-    It will receive the full data of a patient and use function
-    cal_avg_hr to calculate the average value
+    The average comes from the storage backend's reading_stats,
+    which reads it from running aggregates or computes it with an
+    SQL aggregate, without loading the readings
+    With a "since" query argument, only the readings after that
+    date are averaged, from the raw readings or from the rollups
+    chosen by the "resolution" query argument (see window_args), e.g.
+    /api/heart_rate/average/1?since=2018-03-09 11:00:00&resolution=auto
 
     :param patient_id: The id of the patient
 
     :returns: The average heart rate from the patient id, or
     "No average heart rate data available" if there is no heart rate
-    key in the dictionary
+    key in the dictionary. A "resolution" without a "since", or a
+    query argument that is not valid, is answered with an error
+    string, 400.
     """
-    find_all_list = find_patient_all(int(patient_id), patients_db)
-    avg_hr = cal_avg_hr(find_all_list)
-    try:
-        return jsonify(avg_hr), 200
-    except KeyError:
+    if "resolution" in request.args and "since" not in request.args:
+        return "resolution needs a since date", 400
+    if "since" in request.args:
+        try:
+            since, resolution = window_args(request.args)
+        except ValueError as error:
+            return str(error), 400
+        average = window_average(int(patient_id), since, resolution,
+                                 storage)
+        if average is None:
+            return "No average heart rate data available", 400
+        return jsonify(average), 200
+    stats = storage.reading_stats(int(patient_id))
+    if stats is None:
         return "No average heart rate data available", 400
+    return jsonify(stats["average"]), 200
+
+
+def window_args(args):
+    """ Read the query arguments that select a window of heart rates
+
+    "since" is a date in the "%Y-%m-%d %H:%M:%S" format; only
+    readings after it are used. "resolution" is "raw" (the
+    default) for the readings themselves, "minute", "hour" or "day"
+    for the rollups of that resolution, or "auto" for the coarsest
+    rollups that still split the window from "since" until now into
+    rollups.BUCKETS_PER_WINDOW buckets, so long windows read a few
+    hundred buckets instead of every reading.
+
+    :param args: the query arguments of the request
+
+    :returns: a tuple of the start of the window in epoch seconds,
+    or None if there is no "since", and the resolution, which is
+    never "auto"
+
+    :raises ValueError: if "since" or "resolution" is not valid
+    """
+    since = args.get("since")
+    if since is not None:
+        try:
+            since = to_epoch(since)
+        except ValueError:
+            raise ValueError("since must be a date in the "
+                             "%Y-%m-%d %H:%M:%S format")
+    resolution = args.get("resolution", "raw")
+    if resolution == "auto":
+        if since is None:
+            raise ValueError("resolution auto needs a since date")
+        resolution = choose_resolution(to_epoch(datetime.now()) - since)
+    if resolution != "raw" and resolution not in RESOLUTIONS:
+        raise ValueError("Unknown resolution {}".format(resolution))
+    return since, resolution
+
+
+@timed("window_average")
+def window_average(patient_id, since, resolution, patients_db):
+    """ Average a patient's heart rates after a date
+
+    :param patient_id: the patient_id as an integer
+    :param since: the start of the window in epoch seconds
+    :param resolution: "raw" to average the readings exactly, or
+    "minute", "hour" or "day" to add up the rollups of that
+    resolution. The rollup holding the start of the window is
+    counted whole.
+    :param patients_db: the Storage backend
+
+    :returns: the average heart rate, or None if there are no readings
+    in the window
+    """
+    if resolution == "raw":
+        count, total = patients_db.sum_after(patient_id, since)
+    else:
+        buckets = patients_db.rollups(patient_id, resolution, since)
+        count = sum(bucket[1] for bucket in buckets)
+        total = sum(bucket[2] for bucket in buckets)
+    if count == 0:
+        return None
+    return total / count
+
+
+def window_history(patient_id, since, resolution, patients_db):
+    """ List a patient's heart rates, or their rollups, after a date
+
+    :param patient_id: the patient_id as an integer
+    :param since: the start of the window in epoch seconds, or None for
+    the whole history
+    :param resolution: "raw", "minute", "hour" or "day"
+    :param patients_db: the Storage backend
+
+    :returns: a list of heart rates for "raw", otherwise a list of
+    dictionaries with the "timestamp", "count", "average", "min" and
+    "max" of each bucket that ends after the start of the window
+    """
+    if resolution == "raw":
+        heart_rates, timestamps = patients_db.readings(patient_id)
+        if since is None:
+            return heart_rates
+        # Timestamps in this format sort like the times they stand for
+        since = format_epoch(since)
+        return [heart_rate for heart_rate, timestamp
+                in zip(heart_rates, timestamps) if timestamp > since]
+    if since is None:
+        since = -2 ** 62
+    return [{"timestamp": format_epoch(start),
+             "count": count,
+             "average": total / count,
+             "min": minimum,
+             "max": maximum}
+            for start, count, total, minimum, maximum
+            in patients_db.rollups(patient_id, resolution, since)]
+
+
+@app.route("/api/heart_rate/stats/<patient_id>", methods=["GET"])
+def check_hr_stats_by_id(patient_id):
+    """Return summary statistics of the heart rates of this patient
+
+    The statistics come from the storage backend's reading_stats:
+    running aggregates in memory, or SQL aggregates over the
+    readings index with the SQLite backend.
+
+    :param patient_id: The id of the patient
+
+    :returns: A JSON dictionary in the format:
+        {"count": 3, "average": 110.0, "min": 100, "max": 120,
+         "stddev": 8.16}
+    or "No heart rate data available" if the patient has no
+    readings
+    """
+    stats_json = storage.reading_stats(int(patient_id))
+    if stats_json is None:
+        return "No heart rate data available", 400
+    return jsonify(stats_json), 200
 
 
 @app.route("/api/heart_rate/interval_average", methods=["POST"])
@@ -710,9 +1142,8 @@ def interval_average():
         {"patient_id": 1,
          "heart_rate_average_since": "2018-03-09 11:00:36"}
 
-    It is the driver code for the validate_interval_average,
-    get_patient_hr_entries, get_patient_timestamp_entries, calculate_hrs_after,
-    and calulate_average_since functions. Each of these functions are explained
+    It is the driver code for the validate_interval_average and
+    calculate_interval_average functions. Each of these functions are explained
     in later docstrings.
     interval_average will return error strings and status codes based on
     errors within the program. Each error string describes the error and a 400
@@ -737,21 +1168,17 @@ def interval_average():
     if error_string is not True:
         return error_string, status_code
 
-    patient, enum, status = find_patient(in_int_avg["patient_id"], patients_db)
+    patient, enum, status = find_patient(in_int_avg["patient_id"], storage)
     if status is False:
         return "Patient ID {} not found in database" \
                    .format(in_int_avg["patient_id"]), 400
     if status is True:
         return "Patient does not have heart_rate information", 400
-    all_hr_entries = get_patient_hr_entries(patient)
-    all_timestamps = get_patient_timestamp_entries(patient)
-    hrs_after_time = \
-        calculate_hrs_after(all_hr_entries, all_timestamps,
-                            in_int_avg["heart_rate_average_since"])
-    if len(hrs_after_time) == 0:
+    average_since = calculate_interval_average(
+        patient, in_int_avg["heart_rate_average_since"], storage)
+    if average_since is None:
         return "{} is a future date, no data found" \
                    .format(in_int_avg["heart_rate_average_since"]), 400
-    average_since = calculate_average_since(hrs_after_time)
     return "Average heart rate since {} is {}".format(
         in_int_avg["heart_rate_average_since"],
         int(average_since)), 200
@@ -795,81 +1222,28 @@ def validate_interval_average(in_int_avg, expected_keys):
     return True, 200
 
 
-def get_patient_hr_entries(patient):
-    """ Get heart rate information from patient database
+def calculate_interval_average(patient, heart_rate_average_since,
+                               patients_db):
+    """ Calculate a patient's average heart rate after a specified date
 
-    This function indexes the patient database dictionary and pulls all heart
-    rate entries. The entries are then saved in the "all_hr_entries" variable.
+    The count and sum of the readings after the date come from the storage
+    backend's sum_after: the memory backend finds them with a binary search
+    on the sorted timestamps and the series' prefix sums, and the SQLite
+    backend computes them as an SQL aggregate.
 
     :param patient: A dictionary containing all of a patient's information
+    :param heart_rate_average_since: a string containing the desired date in
+    the "%Y-%m-%d %H:%M:%S" format
+    :param patients_db: the Storage backend holding the patient's readings
 
-    :returns: a list of all of the indicated patient's heart rate entries
+    :returns: the average heart rate after the date, or None if there are no
+    readings after it (e.g. the date is in the future)
     """
-    all_hr_entries = patient["heart_rate"]
-    return all_hr_entries
-
-
-def get_patient_timestamp_entries(patient):
-    """ Get timestamp information from patient database
-
-    This function indexes the patient database dictionary and pulls each
-    timestamp for each heart rate entry. The entries are then saved in the
-    "all_timestampes" variable.
-
-    :param patient: A dictionary containing all of a patient's information
-
-    :returns: a list of all of the indicated patient's heart rate entry
-    timestamps
-    """
-    all_timestamps = patient["timestamp"]
-    return all_timestamps
-
-
-def calculate_hrs_after(all_hr_entries, all_timestamps,
-                        heart_rate_average_since):
-    """ Find heart rate entries after indicated time
-
-    This function uses a for loop and if/else statement to index and make a
-    list of all the heart rate entries that occur after the
-    "heart_rate_average_since" date (from inputted json).
-    If the date is a future date, an empty list will be returned.
-
-    :param all_hr_entries: a list of all the indicated patient's heart rate
-    entries
-    :param all_timestamps: a list of all the indicated patient's heart rate
-    entry timestamps
-    :param heart_rate_average_since: a string containing the desired date. All
-    heart rates entered after this date will be averaged.
-
-    :returns: A list of heart rate values that were entered after the indicated
-    date. An empty list will be returned if the date is in the future.
-    """
-    average_since = datetime.strptime(heart_rate_average_since,
-                                      "%Y-%m-%d %H:%M:%S")
-    hrs_after_time = []
-    for entry in range(0, len(all_hr_entries)):
-        if datetime.strptime(all_timestamps[entry], "%Y-%m-%d %H:%M:%S") \
-                > average_since:
-            hrs_after_time.append(all_hr_entries[entry])
-    return hrs_after_time
-
-
-def calculate_average_since(hrs_after_time):
-    """ Calculate average heart rate after specified date
-
-    This function first sums all of the heart rates after the specified date.
-    It then divides the summed heart rates by the total number of heart rate
-    entries. The result is the sum of the heart rates after the entered time.
-
-    :param hrs_after_time: a list of heart rate values that were entered after
-    the specified time ("heart_rate_average_since")
-
-    :returns: an integer indicating the average heart rate of the patient after
-    a certain date
-    """
-    total_entries = len(hrs_after_time)
-    average_since = sum(hrs_after_time) / total_entries
-    return average_since
+    count, total = patients_db.sum_after(
+        patient["patient_id"], to_epoch(heart_rate_average_since))
+    if count == 0:
+        return None
+    return total / count
 
 
 @app.route("/api/patients/<attending_username>", methods=["GET"])
@@ -897,26 +1271,20 @@ def attendings_patients(attending_username):
         not exist in the database. True, 200 will be returned if no errors
         occur.
     """
-    print("Searching for {}...".format(attending_username))
     error_string, error_code = validate_attendings_patients(attending_username,
-                                                            attending_db)
-    print("Attending DB:")
-    print(attending_db)
+                                                            storage)
     if error_string is not True:
         return error_string, error_code
-    all_patients_list = find_patients(attending_username, patients_db)
-    print("{}'s patients:".format(attending_username))
-    print(all_patients_list)
+    all_patients_list = find_patients(attending_username, storage)
     return jsonify(all_patients_list), 200
 
 
 def find_patients(attending_username, patients_db):
     """ Find all patients for a single physician
 
-    This function searches the patient database for all patients that are being
-    treated by a single physician. If a patient's attending physician matches
-    the "attending_username" parameter, their dictionary will be added to a
-    list of that physicians patients. Each dictionary is in the format:
+    This function finds all patients that are being treated by a single
+    physician, and makes a dictionary of each with its latest reading. Each
+    dictionary is in the format:
     Example:   {"patient_id": 1,
                 "last_heart_rate": 100,
                 "last_time": "2018-03-09 11:00:00",
@@ -924,29 +1292,26 @@ def find_patients(attending_username, patients_db):
 
     :param attending_username: a string containing the attending physician's
     username (from URL)
-    :param patients_db: a list of patient dictionaries containing the
-    information from each patient entered in the database
+    :param patients_db: the Storage backend holding the patients; only the
+    physician's own patients are visited and their latest readings are
+    looked up with last_reading.
 
     :returns: a list of dictionaries for patients that are being treated by
     the specified attending physician. This may also return an empty list ([])
     if the physician is not treating any patients currently.
     """
     all_patients_list = []
-    for patient in patients_db:
-        if patient["attending_username"] == attending_username:
-            for key in {"timestamp": [], "heart_rate": []}:
-                if key in patient:
-                    dictionary = {"patient_id": patient["patient_id"],
-                                  "last_heart_rate":
-                                      int(patient["heart_rate"][-1]),
-                                  "last_time": patient["timestamp"][-1],
-                                  "status": is_tachy(patient)}
-                else:
-                    dictionary = {"patient_id": patient["patient_id"],
-                                  "last_heart_rate": "No entries",
-                                  "last_time": "No entries",
-                                  "status": "No entries"}
-            all_patients_list.append(dictionary)
+    for patient in patients_db.patients_of(attending_username):
+        last = patients_db.last_reading(patient["patient_id"])
+        if last is None:
+            last_heart_rate = last_time = status = "No entries"
+        else:
+            last_heart_rate, last_time = last
+            status = is_tachy({"heart_rate": [last_heart_rate]})
+        all_patients_list.append({"patient_id": patient["patient_id"],
+                                  "last_heart_rate": last_heart_rate,
+                                  "last_time": last_time,
+                                  "status": status})
     return all_patients_list
 
 
@@ -964,8 +1329,8 @@ def validate_attendings_patients(attending_username, attending_db):
 
     :param attending_username: a string containing the attending physician's
     username (from URL)
-    :param attending_db: a list of attending physician dictionaries containing
-    the information from each attending physician entered in the database.
+    :param attending_db: the Storage backend holding the attending
+    physicians, in which the username is looked up directly.
 
     :returns: An error string and error code in the format:
     error_string, error_code
@@ -978,11 +1343,545 @@ def validate_attendings_patients(attending_username, attending_db):
     """
     if type(attending_username) is not str:
         return "The input was not a string", 400
-    for physician in attending_db:
-        if physician["attending_username"] == attending_username:
-            return True, 200
+    if attending_db.get_attending(attending_username) is not None:
+        return True, 200
     return "Attending physician {} not found".format(attending_username), 400
 
 
+@app.route("/api/cluster/patients", methods=["GET"])
+def cluster_patient_ids():
+    """ Implements the /api/cluster/patients route of a cluster node
+
+    The cluster gateway (see gateway.py) lists the patients of each server
+    to find the ones it has to move when a server joins or leaves.
+
+    :returns: a JSON list of the patient_id of every patient, 200
+    """
+    return jsonify(storage.patient_ids()), 200
+
+
+@app.route("/api/cluster/attendings", methods=["GET"])
+def cluster_attendings():
+    """ Implements the /api/cluster/attendings route of a cluster node
+
+    Every server of a cluster holds every attending physician; the gateway
+    copies them to a server that joins.
+
+    :returns: a JSON list of attending physician dictionaries, 200
+    """
+    return jsonify(storage.all_attendings()), 200
+
+
+@app.route("/api/cluster/patients/<patient_id>", methods=["GET"])
+def export_patient(patient_id):
+    """ Implements the GET /api/cluster/patients/<patient_id> route
+
+    Reads one patient and all of its readings, to be moved to another
+    server with POST /api/cluster/patients.
+
+    :param patient_id: The id of the patient
+
+    :returns: A JSON dictionary in the format:
+        {"patient": {"patient_id": 1, "attending_username": "Smith.J",
+                     "patient_age": 50},
+         "heart_rate": [100, 80], "timestamp": ["2018-03-09 11:00:00",
+                                                "2018-03-09 11:30:00"]}
+    or an error string, 400 if there is no such patient
+    """
+    patient = storage.get_patient(int(patient_id))
+    if patient is None:
+        return "Patient ID {} not found in database".format(patient_id), 400
+    heart_rates, timestamps = storage.readings(int(patient_id))
+    return jsonify({"patient": patient, "heart_rate": heart_rates,
+                    "timestamp": timestamps}), 200
+
+
+@app.route("/api/cluster/patients", methods=["POST"])
+def import_patient():
+    """ Implements the POST /api/cluster/patients route
+
+    Adds a patient read from another server with GET
+    /api/cluster/patients/<patient_id>, and its readings with their
+    original timestamps, in one transaction. No e-mails are sent for the
+    readings.
+
+    The patient is validated as by the /api/new_patient route.
+
+    :returns: "Imported patient id <patient_id>", 200, or an error string,
+    400 if the input is not in that format, the patient is not valid, or a
+    patient with the same patient_id already exists; that patient and its
+    readings are kept
+    """
+    in_data = request.get_json()
+    expected_keys = {"patient_id": int,
+                     "attending_username": str,
+                     "patient_age": int}
+    try:
+        patient = parse_new_patient(in_data["patient"])
+        readings = [(datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S"),
+                     int(heart_rate))
+                    for timestamp, heart_rate in zip(in_data["timestamp"],
+                                                     in_data["heart_rate"])]
+    except (KeyError, TypeError, ValueError):
+        return "The input is not an exported patient", 400
+    if not all(MIN_HEART_RATE <= heart_rate <= MAX_HEART_RATE
+               for _, heart_rate in readings):
+        return "The key heart_rate is out of range", 400
+    error_string, status_code = validate_new_patient(patient, expected_keys)
+    if error_string is not True:
+        return error_string, status_code
+    patient = {key: value for key, value in patient.items()
+               if key in expected_keys or key in RETENTION_KEYS}
+    patient_id = patient["patient_id"]
+    with storage.transaction():
+        if storage.add_patients([patient]):
+            return "Patient {} already exists".format(patient_id), 400
+        for timestamp, group in groupby(readings, key=itemgetter(0)):
+            storage.add_readings(patient_id,
+                                 [heart_rate for _, heart_rate in group],
+                                 timestamp)
+    return "Imported patient id {}".format(patient_id), 200
+
+
+@app.route("/api/cluster/patients/<patient_id>", methods=["DELETE"])
+def remove_patient(patient_id):
+    """ Implements the DELETE /api/cluster/patients/<patient_id> route
+
+    Removes a patient and its readings once the gateway has moved them to
+    another server.
+
+    :param patient_id: The id of the patient
+
+    :returns: "Removed patient id <patient_id>", 200
+    """
+    storage.remove_patients([int(patient_id)])
+    return "Removed patient id {}".format(patient_id), 200
+
+
+@app.before_request
+def refuse_cluster_requests_without_token():
+    """ Refuse the requests to the /api/cluster/ routes that do not come from
+    the gateway
+
+    :returns: an error string, 403 for a request to a cluster route without
+    the server's cluster token in its CLUSTER_TOKEN_HEADER header, or None
+    to handle the request
+    """
+    if not request.path.startswith("/api/cluster/"):
+        return None
+    if not has_cluster_token(app.config.get("CLUSTER_TOKEN")):
+        return "The cluster routes are only answered to the gateway", 403
+    return None
+
+
+def has_cluster_token(token):
+    """ Check that the current request carries the cluster token
+
+    :param token: the cluster token, or None if there is none
+
+    :returns: True if there is a token and the request's
+    CLUSTER_TOKEN_HEADER header holds it, otherwise False
+    """
+    given = request.headers.get(CLUSTER_TOKEN_HEADER, "")
+    return bool(token) and hmac.compare_digest(given.encode(),
+                                               token.encode())
+
+
+@app.before_request
+def refuse_replication_requests_without_token():
+    """ Refuse the requests to the replication routes, except the status,
+    that do not come from a standby or an operator with the cluster token
+
+    :returns: an error string, 403 for a request to /api/replication/log,
+    /api/replication/snapshot or /api/replication/promote without the
+    server's cluster token in its CLUSTER_TOKEN_HEADER header, or None to
+    handle the request
+    """
+    if request.endpoint not in ("replication_log", "replication_snapshot",
+                                "promote"):
+        return None
+    if not has_cluster_token(app.config.get("CLUSTER_TOKEN")):
+        return "The replication routes need the cluster token", 403
+    return None
+
+
+@app.before_request
+def refuse_changes_on_standby():
+    """ Refuse the requests that make changes while the server is a standby
+
+    :returns: an error string, 503 for a POST or DELETE request to a
+    standby that has not been promoted, or None to handle the request
+    """
+    if standby is None or standby.promoted.is_set():
+        return None
+    if request.method != "GET" and request.endpoint != "promote":
+        return "This server is a standby of {}; send changes to the " \
+               "primary".format(standby.primary), 503
+    return None
+
+
+@app.route("/api/replication/log", methods=["GET"])
+def replication_log():
+    """ Implements the /api/replication/log route of a primary server
+
+    A standby server (see replication.py) asks for the part of the change
+    log written after the position it has reached, with the query
+    arguments 'generation' and 'offset', and 'wait', the seconds to wait
+    for a change when there is none yet.
+
+    :returns: the bytes of the log, 200, with the headers
+    "Replication-Generation" (the generation the bytes are from),
+    "Replication-Complete" ("true" if they end that generation's log) and
+    "Replication-Behind" (the bytes logged after them), or an error string,
+    410 if the standby has to load the snapshot instead, 409 if the
+    position is past the end of the log, or 400 if the arguments are not
+    numbers
+    """
+    try:
+        generation = int(request.args["generation"])
+        offset = int(request.args["offset"])
+        wait = min(float(request.args.get("wait", 0)), 10.0)
+    except (KeyError, ValueError):
+        return "The generation, offset and wait must be numbers", 400
+    try:
+        data, complete, behind = storage.shipped_log(generation, offset, wait)
+    except LookupError as error:
+        return str(error), 410
+    except ValueError as error:
+        return str(error), 409
+    except NotImplementedError as error:
+        return str(error), 501
+    return app.response_class(data, mimetype="application/octet-stream",
+                              headers={"Replication-Generation":
+                                       str(generation),
+                                       "Replication-Complete":
+                                       str(complete).lower(),
+                                       "Replication-Behind": str(behind)})
+
+
+@app.route("/api/replication/snapshot", methods=["GET"])
+def replication_snapshot():
+    """ Implements the /api/replication/snapshot route of a primary server
+
+    :returns: the latest snapshot file, which a standby loads before
+    applying the log that follows it
+    """
+    try:
+        path = storage.snapshot_file()
+    except NotImplementedError as error:
+        return str(error), 501
+    return send_file(open(path, "rb"), mimetype="application/octet-stream")
+
+
+@app.route("/api/replication/status", methods=["GET"])
+def replication_status():
+    """ Implements the /api/replication/status route
+
+    :returns: A JSON dictionary in the format:
+        {"role": "primary" | "standby", "primary": "http://127.0.0.1:5000",
+         "lag_seconds": 0.0, "lag_bytes": 0, "error": None}
+    where "primary", "lag_seconds", "lag_bytes" and "error" are None on a
+    primary, and "error" is why a standby last failed to follow its
+    primary, or None once it follows it again
+    """
+    if standby is None or standby.promoted.is_set():
+        return jsonify({"role": "primary", "primary": None,
+                        "lag_seconds": None, "lag_bytes": None,
+                        "error": None}), 200
+    return jsonify({"role": "standby", "primary": standby.primary,
+                    "lag_seconds": standby.lag(),
+                    "lag_bytes": standby.behind,
+                    "error": standby.error}), 200
+
+
+@app.route("/api/replication/promote", methods=["POST"])
+def promote():
+    """ Implements the /api/replication/promote route of a standby server
+
+    The standby stops applying the changes of its primary, once the ones
+    it is applying are applied, and makes changes of its own from then on.
+
+    :returns: "Promoted to primary", 200, or an error string, 400 if the
+    server is not a standby
+    """
+    if standby is None:
+        return "This server is not a standby", 400
+    standby.promote()
+    return "Promoted to primary", 200
+
+
+def open_storage(backend, directory, retention_readings=None,
+                 retention_seconds=None):
+    """ Create and open the storage the server keeps its data in
+
+    :param backend: "memory" or "sqlite"
+    :param directory: the folder for the stored data
+    :param retention_readings: the default number of latest readings kept
+    for each patient, or None to keep them all
+    :param retention_seconds: by default drop the readings taken more than
+    this many seconds before a patient's latest reading, or None
+    """
+    global storage
+    storage = instrument_storage(make_storage(
+        backend, directory, retention_readings=retention_readings,
+        retention_seconds=retention_seconds))
+    replayed = storage.open()
+    logging.info("Opened {} storage in {}, replaying {} log records"
+                 .format(backend, directory, replayed))
+
+
+def create_app(storage_backend=STORAGE_BACKEND, data_directory=DATA_DIRECTORY,
+               retention_readings=None, retention_seconds=None,
+               standby_of=None, promote_after=None, max_content_length=None,
+               cluster_token=None, outbox_path=EMAIL_OUTBOX_PATH,
+               relay_url=EMAIL_RELAY_URL):
+    """ Open the storage, start sending e-mails and return the app to serve
+
+    Nothing is opened when this module is imported, so the configuration
+    is chosen by whoever serves the app: main, production.py, or a WSGI
+    server given "heart_rate_sentinel:create_app()". The routes belong to
+    the module's app, so it is configured and returned rather than a new
+    one created; call create_app once per process, and close_app once the
+    app has stopped serving.
+
+    :param storage_backend: "memory" or "sqlite"
+    :param data_directory: the folder for the stored data
+    :param retention_readings: the default number of latest readings kept
+    for each patient, or None to keep them all
+    :param retention_seconds: by default drop the readings taken more than
+    this many seconds before a patient's latest reading, or None
+    :param standby_of: the URL of a primary server to follow as a standby
+    (see replication.py), or None
+    :param promote_after: seconds without an answer from the primary after
+    which the standby promotes itself, or None
+    :param max_content_length: the longest request body in bytes, or None
+    for no limit; longer bodies are answered with 413
+    :param cluster_token: the token the gateway of a cluster sends to the
+    /api/cluster/ routes, and a standby to the replication routes, or None
+    to refuse them; a standby sends it to its primary
+    :param outbox_path: the journal file of the e-mail outbox
+    :param relay_url: the URL of the e-mail relay's send_email route
+
+    :returns: the Flask app
+
+    :raises ValueError: if a standby is asked for without the memory
+    storage
+    """
+    global standby
+    if standby_of is not None and storage_backend != "memory":
+        raise ValueError("A standby needs the memory storage")
+    app.config["MAX_CONTENT_LENGTH"] = max_content_length
+    app.config["CLUSTER_TOKEN"] = cluster_token
+    open_storage(storage_backend, data_directory, retention_readings,
+                 retention_seconds)
+    if standby_of is not None:
+        standby = Standby(storage, standby_of, promote_after=promote_after,
+                          headers={CLUSTER_TOKEN_HEADER: cluster_token or ""})
+        standby.start()
+    open_email(outbox_path, relay_url)
+    return app
+
+
+def open_email(outbox_path, relay_url):
+    """ Open the e-mail outbox and start sending its e-mails to the relay
+
+    :param outbox_path: the journal file of the e-mail outbox
+    :param relay_url: the URL of the e-mail relay's send_email route
+    """
+    global email_outbox, email_dispatcher
+    email_outbox = Outbox(outbox_path)
+    email_dispatcher = EmailDispatcher(email_outbox, relay_url,
+                                       coalesce_window=EMAIL_DIGEST_WINDOW)
+    email_dispatcher.start()
+
+
+def close_app():
+    """ Stop following the primary and sending e-mails, and close the
+    storage and the e-mail outbox
+
+    The e-mails not sent yet stay in the outbox for the next start.
+    """
+    if standby is not None:
+        standby.stop()
+    if email_dispatcher is not None:
+        email_dispatcher.stop()
+    email_outbox.close()
+    storage.close()
+
+
+def open_store(args):
+    """ Open the storage in the store process of the multi-process mode,
+    start sending its e-mails and serve both to the workers
+
+    :param args: the parsed command line arguments
+    """
+    open_storage(args.storage, args.data, args.retention_readings,
+                 args.retention_seconds)
+    open_email(args.outbox, args.email_relay)
+    serve(storage, email_outbox)
+
+
+def serve_worker(address, authkey, listener, use_asyncio=False,
+                 cluster_token=None):
+    """ Serve requests in a worker process of the multi-process mode
+
+    The worker uses the storage and e-mail outbox of the store process, and
+    accepts connections on a listening socket shared by every worker.
+
+    :param address: the address of the store process
+    :param authkey: the authentication key of the store process
+    :param listener: the listening socket
+    :param use_asyncio: True to serve from an asyncio event loop (see
+    async_server.py) instead of a thread per connection
+    :param cluster_token: the token the gateway sends to the /api/cluster/
+    routes, or None to refuse them
+    """
+    global storage, email_outbox, worker_metrics
+    app.config["CLUSTER_TOKEN"] = cluster_token
+    # Only the parent process stops on Ctrl+C; it then terminates the
+    # workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    storage, email_outbox = connect_store(address, authkey)
+    instrument_storage(storage)
+    worker_metrics = connect_metrics(address, authkey)
+    threading.Thread(target=report_metrics, name="metrics-report",
+                     daemon=True).start()
+    if use_asyncio:
+        async_server.run(app, sock=listener)
+        return
+    server = make_server(listener.getsockname()[0], 0, app, threaded=True,
+                         fd=listener.fileno())
+    server.serve_forever()
+
+
+def report_metrics():
+    """ Send the worker's metrics to the store process every
+    METRICS_REPORT_SECONDS, so the other workers serve them up to date
+    """
+    while True:
+        time.sleep(METRICS_REPORT_SECONDS)
+        try:
+            worker_metrics.report(os.getpid(), metrics.export())
+        except Exception as error:
+            logging.warning("Could not report the worker's metrics: {}"
+                            .format(error))
+
+
+def run_workers(args):
+    """ Serve requests from several worker processes
+
+    The patients, attending physicians and readings are kept by one store
+    process (see shared_store.py), so every worker sees the same data.
+    Each worker records its own metrics and sends them to the store
+    process, and /api/metrics reports those of every worker.
+
+    :param args: the parsed command line arguments
+    """
+    authkey = new_authkey()
+    manager = start_store(authkey, open_store, (args,))
+    listener = socket.create_server(("127.0.0.1", args.port),
+                                    backlog=async_server.BACKLOG)
+    workers = [multiprocessing.Process(target=serve_worker,
+                                       args=(manager.address, authkey,
+                                             listener, args.asyncio,
+                                             args.cluster_token))
+               for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    logging.info("Serving on port {} with {} workers"
+                 .format(args.port, args.workers))
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        connect_store(manager.address, authkey)[0].shared.close()
+        manager.shutdown()
+        listener.close()
+
+
+def add_app_arguments(parser):
+    """ Add the command line options that configure the app, the arguments
+    of create_app
+
+    :param parser: an argparse.ArgumentParser
+    """
+    parser.add_argument("--storage", choices=["memory", "sqlite"],
+                        default=STORAGE_BACKEND,
+                        help="storage backend (default: %(default)s)")
+    parser.add_argument("--data", default=DATA_DIRECTORY,
+                        help="folder for the stored data "
+                             "(default: %(default)s)")
+    parser.add_argument("--retention-readings", type=int,
+                        help="keep only this many latest readings of each "
+                             "patient without its own retention")
+    parser.add_argument("--retention-seconds", type=int,
+                        help="drop readings taken more than this many "
+                             "seconds before the patient's latest reading")
+    parser.add_argument("--standby-of", metavar="URL",
+                        help="run as a standby of the primary server at "
+                             "this URL, applying its changes")
+    parser.add_argument("--promote-after", type=float, metavar="SECONDS",
+                        help="promote the standby once the primary has not "
+                             "answered for this many seconds")
+    parser.add_argument("--cluster-token",
+                        default=os.environ.get(CLUSTER_TOKEN_VARIABLE),
+                        help="token the gateway of a cluster sends to the "
+                             "/api/cluster/ routes and a standby to the "
+                             "replication routes, which are refused "
+                             "without one (default: the {} environment "
+                             "variable)".format(CLUSTER_TOKEN_VARIABLE))
+    parser.add_argument("--outbox", default=EMAIL_OUTBOX_PATH, metavar="PATH",
+                        help="journal file of the e-mails waiting to be sent "
+                             "(default: %(default)s)")
+    parser.add_argument("--email-relay", default=EMAIL_RELAY_URL,
+                        metavar="URL",
+                        help="URL of the e-mail relay's send_email route "
+                             "(default: %(default)s)")
+
+
+def main(argv=None):
+    """ Command line entry point that starts the server
+
+    Usage: python heart_rate_sentinel.py [--storage memory|sqlite]
+    [--data FOLDER] [--retention-readings N] [--retention-seconds SECONDS]
+    [--workers N] [--port PORT] [--standby-of URL [--promote-after SECONDS]]
+    [--cluster-token TOKEN] [--outbox PATH] [--email-relay URL] [--asyncio]
+    """
+    parser = argparse.ArgumentParser(
+        description="Run the heart rate sentinel server")
+    add_app_arguments(parser)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes; with more than "
+                             "one, the data is kept by a separate store "
+                             "process (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=5000,
+                        help="port to serve on (default: %(default)s)")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="serve connections from an asyncio event loop, "
+                             "running only the requests being handled on "
+                             "threads, instead of a thread per connection")
+    args = parser.parse_args(argv)
+    if args.standby_of is not None and \
+            (args.storage != "memory" or args.workers > 1):
+        parser.error("--standby-of needs the memory storage and one worker")
+    if args.workers > 1:
+        run_workers(args)
+        return
+    create_app(args.storage, args.data, args.retention_readings,
+               args.retention_seconds, args.standby_of, args.promote_after,
+               cluster_token=args.cluster_token, outbox_path=args.outbox,
+               relay_url=args.email_relay)
+    if args.asyncio:
+        async_server.run(app, port=args.port)
+    else:
+        app.run(port=args.port)
+    close_app()
+
+
 if __name__ == "__main__":
-    app.run()
+    main()
@@ -1,3 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+import argparse
+import heapq
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import requests
 
 hostname = "http://127.0.0.1:5000/"
@@ -8,144 +20,413 @@ hostname = "http://vcm-23088.vm.duke.edu:5000/"
 hostname = "http://vcm-23099.vm.duke.edu:5000/"
 """
 
-""" New Attending """
-# Successfully add new attending
-attending1 = {"attending_username": "Smith.J",
-              "attending_email": "dr_user_id@ourdomain.com",
-              "attending_phone": "919-867-5309"}
-r = requests.post(hostname + "api/new_attending", json=attending1)
-print(r.status_code)
-print(r.text)
-
-attending = {"attending_username": "Ann.A",
-             "attending_email": "dr_user_id@ourdomain.com",
-             "attending_phone": "919-867-5309"}
-r = requests.post(hostname + "api/new_attending", json=attending)
-print(r.status_code)
-print(r.text)
-
-# Check for missing key
-attending2 = {"attending_username": "Smith.J",
-              "attending_email": "dr_user_id@ourdomain.com"}
-r = requests.post(hostname + "api/new_attending", json=attending2)
-print(r.status_code)
-print(r.text)
-
-# Check for bad data type
-attending3 = {"attending_username": 3,
-              "attending_email": "dr_user_id@ourdomain.com",
-              "attending_phone": "919-867-5309"}
-r = requests.post(hostname + "api/new_attending", json=attending3)
-print(r.status_code)
-print(r.text)
-
-""" New Patient """
-patient1 = {"patient_id": 1,
-            "attending_username": "Smith.J",
-            "patient_age": 50}
-r = requests.post(hostname + "api/new_patient", json=patient1)
-print(r.status_code)
-print(r.text)
-
-patient2 = {"patient_id": 2,
-            "attending_username": "Ann.A",
-            "patient_age": 40}
-r = requests.post(hostname + "api/new_patient", json=patient2)
-print(r.status_code)
-print(r.text)
-
-patient3 = {"patient_id": 3,
-            "attending_username": "Ann.A"}
-r = requests.post(hostname + "api/new_patient", json=patient3)
-print(r.status_code)
-print(r.text)
-
-patient4 = {"patient_id": "4",
-            "attending_username": "Ann.A",
-            "patient_age": 40}
-r = requests.post(hostname + "api/new_patient", json=patient4)
-print(r.status_code)
-print(r.text)
-
-patient5 = {"patient_id": "5a",
-            "attending_username": "Ann.A",
-            "patient_age": "a40"}
-r = requests.post(hostname + "api/new_patient", json=patient5)
-print(r.status_code)
-print(r.text)
-
-""" Add heart rate and timestamp """
-# Successfully add heart rate and timestamp to patient with strings
-hr0 = {"patient_id": "1", "heart_rate": "100"}
-r = requests.post(hostname + "api/heart_rate", json=hr0)
-print(r.status_code)
-print(r.text)
-
-# Check adding additional heart rate to same patient
-hr = {"patient_id": "1", "heart_rate": "120"}
-r = requests.post(hostname + "api/heart_rate", json=hr)
-print(r.status_code)
-print(r.text)
-
-# Successfully add heart rate and timestamp to patient with ints
-hr1 = {"patient_id": 2, "heart_rate": 110}
-r = requests.post(hostname + "api/heart_rate", json=hr1)
-print(r.status_code)
-print(r.text)
-
-# Check for heart_rate not a dictionary
-hr2 = "hello"
-r = requests.post(hostname + "api/heart_rate", json=hr2)
-print(r.status_code)
-print(r.text)
-
-# Check for missing key
-hr3 = {"patient_id": "1"}
-r = requests.post(hostname + "api/heart_rate", json=hr3)
-print(r.status_code)
-print(r.text)
-
-# Check for wrong data type
-hr4 = {"patient_id": "hello", "heart_rate": 100}
-r = requests.post(hostname + "api/heart_rate", json=hr4)
-print(r.status_code)
-print(r.text)
-
-# Check for missing id
-hr5 = {"patient_id": 3, "heart_rate": 130}
-r = requests.post(hostname + "api/heart_rate", json=hr5)
-print(r.status_code)
-print(r.text)
-
-""" Interval Average """
-# Check for successful interval average calculation
-int_avg1 = {"patient_id": 1, "heart_rate_average_since": "2000-03-09 11:00:36"}
-r = requests.post(hostname + "api/heart_rate/interval_average",
-                  json=int_avg1)
-print(r.status_code)
-print(r.text)
-
-# Check for missing id
-int_avg2 = {"patient_id": 50,
-            "heart_rate_average_since": "2018-03-09 11:00:36"}
-r = requests.post(hostname + "api/heart_rate/interval_average",
-                  json=int_avg2)
-print(r.status_code)
-print(r.text)
-
-# Check for future date
-int_avg3 = {"patient_id": 1, "heart_rate_average_since": "2100-03-09 11:00:36"}
-r = requests.post(hostname + "api/heart_rate/interval_average",
-                  json=int_avg3)
-print(r.status_code)
-print(r.text)
-
-""" All Attending's Patients """
-# Check for successful finding of attending's patients
-r = requests.get(hostname + "api/patients/Smith.J")
-print(r.status_code)
-print(r.text)
-
-r = requests.get(hostname + "api/patients/Ann.A")
-print(r.status_code)
-print(r.text)
+# Threads that send requests at once
+THREADS = 16
+# Heart rates each simulated patient posts per second, and times per second
+# each simulated attending physician reads the list of their patients
+READING_RATE = 1.0
+POLL_RATE = 0.2
+# The fractions of the requests of a route answered within the latencies
+# reported
+PERCENTILES = (0.5, 0.95, 0.99)
+
+
+def simulate(attendings, patients, seconds, reading_rate=READING_RATE,
+             poll_rate=POLL_RATE, seed=None):
+    """ Make the traffic of virtual attending physicians and patients
+
+    The attending physicians and the patients, shared out between them, are
+    added first. Then for the given number of seconds every patient posts
+    heart rates to /api/heart_rate at reading_rate per second, and every
+    attending physician reads /api/patients/<attending_username> at
+    poll_rate per second, each starting at a random moment of its first
+    period.
+
+    Each request is a dictionary with its "method", "path", the "route" it
+    is reported under, its "json" body if any, and for the timed requests
+    the "time" in seconds from the start of the traffic at which it is
+    sent. The requests adding attending physicians and patients have no
+    time (see run_load).
+
+    :param attendings: the number of attending physicians
+    :param patients: the number of patients
+    :param seconds: how long the patients and physicians are active
+    :param reading_rate: heart rates posted per second by each patient
+    :param poll_rate: reads per second by each attending physician
+    :param seed: the seed of the random numbers, to make the same traffic
+    again
+
+    :returns: a generator of requests, in the order they are sent
+    """
+    rand = random.Random(seed)
+    usernames = ["Attending.{}".format(number)
+                 for number in range(1, attendings + 1)]
+    for username in usernames:
+        yield {"method": "POST", "path": "/api/new_attending",
+               "route": "/api/new_attending",
+               "json": {"attending_username": username,
+                        "attending_email": username + "@hospital.org",
+                        "attending_phone": "919-867-5309"}}
+    for patient_id in range(1, patients + 1):
+        yield {"method": "POST", "path": "/api/new_patient",
+               "route": "/api/new_patient",
+               "json": {"patient_id": patient_id,
+                        "attending_username":
+                            usernames[patient_id % attendings],
+                        "patient_age": rand.randint(20, 80)}}
+    # The next request of every patient and physician, earliest first
+    upcoming = []
+    if reading_rate > 0:
+        upcoming.extend((rand.uniform(0, 1 / reading_rate), "patient",
+                         patient_id)
+                        for patient_id in range(1, patients + 1))
+    if poll_rate > 0:
+        upcoming.extend((rand.uniform(0, 1 / poll_rate), "attending",
+                         username) for username in usernames)
+    heapq.heapify(upcoming)
+    while upcoming and upcoming[0][0] < seconds:
+        at, kind, who = heapq.heappop(upcoming)
+        if kind == "patient":
+            yield {"time": round(at, 6), "method": "POST",
+                   "path": "/api/heart_rate", "route": "/api/heart_rate",
+                   "json": {"patient_id": who,
+                            "heart_rate": rand.randint(60, 95)}}
+            heapq.heappush(upcoming, (at + 1 / reading_rate, kind, who))
+        else:
+            yield {"time": round(at, 6), "method": "GET",
+                   "path": "/api/patients/" + who,
+                   "route": "/api/patients/<attending_username>"}
+            heapq.heappush(upcoming, (at + 1 / poll_rate, kind, who))
+
+
+def read_traffic(in_file):
+    """ Read recorded requests from an NDJSON file
+
+    :param in_file: an open text file with one request per line, as made
+    by simulate and written by write_traffic
+
+    :returns: a generator of request dictionaries
+    """
+    for line in in_file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def write_traffic(requests_made, out_file):
+    """ Write requests to an NDJSON file as they are passed on
+
+    :param requests_made: an iterable of request dictionaries
+    :param out_file: an open text file to write one request per line to
+
+    :returns: a generator of the same requests, so the traffic can be
+    recorded while it is sent
+    """
+    for made in requests_made:
+        out_file.write(json.dumps(made) + "\n")
+        yield made
+
+
+def http_sender(server=hostname):
+    """ Make a function that sends requests to a running server
+
+    :param server: the server's base URL
+
+    :returns: a function that sends one request dictionary and returns the
+    status code of the answer. Each thread keeps its connection alive in a
+    session of its own.
+    """
+    local = threading.local()
+
+    def send(made):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session.request(made["method"],
+                                     server.rstrip("/") + made["path"],
+                                     json=made.get("json")).status_code
+    return send
+
+
+def app_sender(app):
+    """ Make a function that sends requests to a Flask app in this process
+
+    :param app: the Flask app, e.g. the one returned by
+    heart_rate_sentinel.create_app
+
+    :returns: a function that sends one request dictionary and returns the
+    status code of the answer, through a test client of each thread's own
+    """
+    local = threading.local()
+
+    def send(made):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        return local.client.open(made["path"], method=made["method"],
+                                 json=made.get("json")).status_code
+    return send
+
+
+class LoadReport:
+    """ The requests sent to each route, their errors and latencies
+    """
+
+    def __init__(self):
+        self.requests = {}
+        self.errors = {}
+        self.latencies = {}
+        # The requests sent before the clock started, and how many of them
+        # failed
+        self.setup_requests = 0
+        self.setup_errors = 0
+        # Seconds from the first request sent until the last was answered
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, route, latency, error):
+        """ Count one request
+
+        :param route: the route the request is reported under, e.g.
+        "POST /api/heart_rate"
+        :param latency: the seconds until it was answered, or None if it
+        was not
+        :param error: True if it failed or was answered with a status code
+        of 400 or more
+        """
+        with self._lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+            self.errors[route] = self.errors.get(route, 0) + bool(error)
+            latencies = self.latencies.setdefault(route, [])
+            if latency is not None:
+                latencies.append(latency)
+
+    def add_setup(self, error):
+        """ Count one request sent before the clock started
+
+        :param error: True if it failed or was answered with a status code
+        of 400 or more
+        """
+        with self._lock:
+            self.setup_requests += 1
+            self.setup_errors += bool(error)
+
+    def summary(self):
+        """ Summarize the requests of every route, and of all of them
+
+        :returns: a list of dictionaries with the "route", the number of
+        "requests" and "errors", the "throughput" in requests per second
+        and the latency in seconds at each of PERCENTILES, e.g. "p95", or
+        None if no request was answered. The last one is for all routes.
+        """
+        rows = [self._row(route, self.requests[route], self.errors[route],
+                          self.latencies[route])
+                for route in sorted(self.requests)]
+        rows.append(self._row("all", sum(self.requests.values()),
+                              sum(self.errors.values()),
+                              [latency for latencies in
+                               self.latencies.values()
+                               for latency in latencies]))
+        return rows
+
+    def _row(self, route, count, errors, latencies):
+        latencies = sorted(latencies)
+        row = {"route": route, "requests": count, "errors": errors,
+               "throughput": count / self.seconds if self.seconds else 0.0}
+        for fraction in PERCENTILES:
+            row[percentile_key(fraction)] = latencies[min(
+                len(latencies) - 1, int(fraction * len(latencies)))] \
+                if latencies else None
+        return row
+
+    def format(self):
+        """ Format the summary as a table, with latencies in milliseconds
+
+        :returns: the table as a string
+        """
+        lines = ["{:45}  {:>8}  {:>6}  {:>8}".format(
+            "route", "requests", "errors", "req/s") +
+            "".join("  {:>9}".format(percentile_key(fraction) + " (ms)")
+                    for fraction in PERCENTILES)]
+        for row in self.summary():
+            line = "{:45}  {:8d}  {:6d}  {:8.1f}".format(
+                row["route"], row["requests"], row["errors"],
+                row["throughput"])
+            for fraction in PERCENTILES:
+                latency = row[percentile_key(fraction)]
+                line += "  {:>9}".format("-" if latency is None else
+                                         "{:.1f}".format(1000 * latency))
+            lines.append(line)
+        if self.setup_requests:
+            lines.append("setup: {} requests, {} errors".format(
+                self.setup_requests, self.setup_errors))
+        return "\n".join(lines)
+
+
+def percentile_key(fraction):
+    """ Name a percentile of the latencies in a LoadReport summary
+
+    :param fraction: a fraction of the requests, e.g. 0.95
+
+    :returns: the name, e.g. "p95"
+    """
+    return "p{:g}".format(100 * fraction)
+
+
+def run_load(requests_made, send, threads=THREADS, speed=1.0):
+    """ Send requests at their times and measure how long they take
+
+    Requests without a time, such as the attending physicians and patients
+    a simulation adds first, are sent one after another as they are
+    reached, each once the one before has been answered; they are only
+    counted, with their errors, as setup requests. The clock starts at the
+    first request with a time; each is then sent by one of the threads at
+    its time divided by speed. Once every thread is busy, the next requests
+    wait for one, and are sent late. Each request is timed from its time
+    until it is answered, so the time spent waiting for a thread counts
+    too, as it would for a device that sent it on time; with a speed of 0
+    there is no such time, and each is timed from when it is sent.
+
+    :param requests_made: an iterable of request dictionaries, as made by
+    simulate or read_traffic
+    :param send: a function that sends one request and returns the status
+    code of the answer, e.g. one made by http_sender or app_sender
+    :param threads: the number of requests sent at once
+    :param speed: how many times faster than recorded to send the
+    requests, or 0 to send them as fast as possible
+
+    :returns: a LoadReport of the requests with a time, and of the setup
+    requests
+    """
+    report = LoadReport()
+    free = threading.BoundedSemaphore(threads)
+
+    def send_timed(made, route, began):
+        if began is None:
+            began = time.perf_counter()
+        try:
+            status_code = send(made)
+        except requests.RequestException:
+            report.add(route, None, True)
+        else:
+            report.add(route, time.perf_counter() - began,
+                       status_code >= 400)
+        finally:
+            free.release()
+
+    started = None
+    with ThreadPoolExecutor(threads) as executor:
+        for made in requests_made:
+            if "time" not in made:
+                try:
+                    report.add_setup(send(made) >= 400)
+                except requests.RequestException:
+                    report.add_setup(True)
+                continue
+            if started is None:
+                started = time.perf_counter()
+            due = None
+            if speed > 0:
+                due = started + made["time"] / speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            free.acquire()
+            executor.submit(send_timed, made, "{} {}".format(
+                made["method"], made.get("route", made["path"])), due)
+    if started is not None:
+        report.seconds = time.perf_counter() - started
+    return report
+
+
+def main(argv=None):
+    """ Command line entry point
+
+    Usage: python heart_rate_sentinel_client.py [--server URL | --in-process]
+    [--attendings N] [--patients M] [--seconds S] [--reading-rate R]
+    [--poll-rate R] [--seed N] [--replay FILE] [--record FILE]
+    [--threads N] [--speed X]
+
+    Simulates attending physicians and patients, or replays the requests
+    recorded in an NDJSON file, and prints the throughput and latency of
+    each route.
+
+    :returns: 0 if no request failed, otherwise 1
+    """
+    parser = argparse.ArgumentParser(
+        description="Send simulated or recorded traffic to a heart rate "
+                    "sentinel server and report its throughput and latency")
+    parser.add_argument("--server", default=hostname,
+                        help="server base URL (default: %(default)s)")
+    parser.add_argument("--in-process", action="store_true",
+                        help="send the requests to the app in this process, "
+                             "through Flask's test client, with its data in "
+                             "a temporary folder")
+    parser.add_argument("--attendings", type=int, default=10,
+                        help="simulated attending physicians "
+                             "(default: %(default)s)")
+    parser.add_argument("--patients", type=int, default=100,
+                        help="simulated patients (default: %(default)s)")
+    parser.add_argument("--seconds", type=float, default=10.0,
+                        help="length of the simulation "
+                             "(default: %(default)s)")
+    parser.add_argument("--reading-rate", type=float, default=READING_RATE,
+                        help="heart rates posted per second by each patient "
+                             "(default: %(default)s)")
+    parser.add_argument("--poll-rate", type=float, default=POLL_RATE,
+                        help="reads of its patients per second by each "
+                             "attending physician (default: %(default)s)")
+    parser.add_argument("--seed", type=int,
+                        help="seed of the simulation's random numbers")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="send the requests recorded in this NDJSON file "
+                             "instead of simulating")
+    parser.add_argument("--record", metavar="FILE",
+                        help="also write the requests sent to this NDJSON "
+                             "file")
+    parser.add_argument("--threads", type=int, default=THREADS,
+                        help="requests sent at once (default: %(default)s)")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="how many times faster than their times to "
+                             "send the requests, or 0 for as fast as "
+                             "possible (default: %(default)s)")
+    args = parser.parse_args(argv)
+    if args.attendings < 1 and args.replay is None:
+        parser.error("--attendings must be at least 1")
+    directory = None
+    if args.in_process:
+        import heart_rate_sentinel
+        directory = tempfile.mkdtemp()
+        send = app_sender(heart_rate_sentinel.create_app(
+            data_directory=directory))
+    else:
+        send = http_sender(args.server)
+    in_file = out_file = None
+    try:
+        if args.replay is not None:
+            in_file = open(args.replay)
+            requests_made = read_traffic(in_file)
+        else:
+            requests_made = simulate(args.attendings, args.patients,
+                                     args.seconds, args.reading_rate,
+                                     args.poll_rate, args.seed)
+        if args.record is not None:
+            out_file = open(args.record, "w")
+            requests_made = write_traffic(requests_made, out_file)
+        with open(os.devnull, "w") as devnull:
+            # What the app prints in this process is not shown
+            with redirect_stdout(devnull if args.in_process
+                                 else sys.stdout):
+                report = run_load(requests_made, send, args.threads,
+                                  args.speed)
+    finally:
+        for open_file in (in_file, out_file):
+            if open_file is not None:
+                open_file.close()
+        if directory is not None:
+            heart_rate_sentinel.close_app()
+            shutil.rmtree(directory)
+    print(report.format())
+    failed = report.summary()[-1]["errors"] + report.setup_errors
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,563 @@
+from array import array
+from bisect import bisect_right
+from collections.abc import Sequence
+from datetime import datetime, timedelta
+from itertools import accumulate, chain, islice
+from operator import sub
+from time import gmtime, strftime
+from rollups import Rollups
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch(timestamp):
+    """ Convert a timestamp into whole seconds since 1970-01-01
+
+    The server's timestamps are naive local times, so they are counted from
+    a naive epoch rather than through the time zone. This keeps the
+    conversion exact in both directions, including across daylight saving
+    changes.
+
+    :param timestamp: a datetime, or a string in the "%Y-%m-%d %H:%M:%S"
+    format
+
+    :returns: an integer number of seconds since 1970-01-01 00:00:00
+    """
+    if type(timestamp) is str:
+        timestamp = datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+    return (timestamp - EPOCH) // timedelta(seconds=1)
+
+
+def format_epoch(seconds):
+    """ Convert seconds since 1970-01-01 back to a timestamp string
+
+    :param seconds: an integer number of seconds since 1970-01-01 00:00:00
+
+    :returns: the timestamp as a string in the "%Y-%m-%d %H:%M:%S" format
+    """
+    # gmtime counts from the same naive epoch as to_epoch, without building
+    # a datetime
+    return strftime(TIMESTAMP_FORMAT, gmtime(seconds))
+
+
+class HeartRateSeries:
+    """ Compact storage for one patient's heart rate readings
+
+    Timestamps are kept sorted in a typed array of 64-bit epoch seconds.
+    Heart rates are kept as a running prefix sum in a parallel 64-bit array,
+    where prefix[i] is the sum of the first i heart rates; each heart rate is
+    the difference of two neighbouring entries. That is 16 bytes per reading
+    instead of a boxed int plus a formatted string in two Python lists, and
+    the average over any time window costs a binary search and two lookups
+    however long the history is.
+    The "heart_rate" and "timestamp" attributes are read-only list-like
+    views, so a patient dictionary can hold them where it used to hold the
+    lists. Timestamp strings are only built when a view is read, e.g. when a
+    response is serialized.
+    The minimum, maximum and sum of squares of the heart rates are updated
+    with every reading, so together with the count and the last prefix sum
+    the summary statistics (see storage.summarize) are available in
+    constant time.
+    A series can be given a ColdHistory (see cold_tier.py), which then holds
+    its older readings on disk: epochs and prefix only hold the latest
+    readings, prefix[0] is the sum of the heart rates in the cold history,
+    and positions passed to the methods below count from the first reading
+    in the cold history.
+    Minute, hour and day rollups (see rollups.py) are kept up to date with
+    every reading, and only keep recent buckets, so they are never built
+    from the whole history.
+    After every change the series publishes a new SeriesSnapshot in its
+    "snapshot" attribute, which other threads can read without a lock. For
+    that, readings already in the arrays are never changed in place: new
+    readings are appended, and a reading that arrives out of order is
+    inserted into new copies of the arrays.
+    """
+
+    __slots__ = ("epochs", "prefix", "minimum", "maximum", "sum_squares",
+                 "cold", "rollups", "heart_rate", "timestamp", "snapshot")
+
+    def __init__(self, cold=None):
+        """ Create an empty series
+
+        :param cold: an empty ColdHistory to move older readings to, or None
+        to keep every reading in memory
+        """
+        self.epochs = array("q")
+        self.prefix = array("q", [0])
+        self.cold = cold
+        self.rollups = Rollups()
+        self.minimum = None
+        self.maximum = None
+        self.sum_squares = 0
+        self.heart_rate = HeartRateView(self)
+        self.timestamp = TimestampView(self)
+        self.snapshot = None
+        self._publish()
+
+    def extend_arrays(self, epochs, prefix):
+        """ Add readings in time order together with their prefix sums
+
+        This is how a series is loaded back from a snapshot a chunk at a
+        time. The minimum, maximum, sum of squares and rollups are not
+        updated; see restore_aggregates and restore_rollups.
+
+        :param epochs: an array("q") of sorted epoch seconds, none older than
+        the readings already in the series
+        :param prefix: an array("q") of the prefix sums through each of those
+        readings, continuing the prefix sums of the series
+        """
+        self.epochs.extend(epochs)
+        self.prefix.extend(prefix)
+        self._spill()
+        self._publish()
+
+    def restore_aggregates(self, minimum, maximum, sum_squares):
+        """ Set the running aggregates of a series loaded with extend_arrays
+
+        :param minimum: the smallest heart rate, or None if empty
+        :param maximum: the largest heart rate, or None if empty
+        :param sum_squares: the sum of the squared heart rates
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.sum_squares = sum_squares
+        self._publish()
+
+    def restore_rollups(self, frozen):
+        """ Set the rollups of a series loaded with extend_arrays
+
+        :param frozen: the rollups as copied by Rollups.frozen, or None to
+        build them from the readings, e.g. for a snapshot written before
+        rollups were saved
+        """
+        if frozen is None:
+            self.rollups = Rollups.build(self.iter_epochs(),
+                                         self.iter_rates())
+        else:
+            self.rollups.restore(frozen)
+        self._publish()
+
+    def append(self, heart_rate, timestamp):
+        """ Add one reading to the series
+
+        Readings normally arrive in time order and are appended in O(1). A
+        reading older than the latest one (e.g. after the clock was turned
+        back) is inserted in its sorted position instead.
+
+        :param heart_rate: the heart rate as an integer
+        :param timestamp: the time of the reading as a datetime
+        """
+        self.append_at(heart_rate, to_epoch(timestamp))
+
+    def append_at(self, heart_rate, epoch):
+        """ Add one reading whose time is already in epoch seconds
+
+        :param heart_rate: the heart rate as an integer
+        :param epoch: the time of the reading in seconds since 1970-01-01
+        """
+        if self.minimum is None or heart_rate < self.minimum:
+            self.minimum = heart_rate
+        if self.maximum is None or heart_rate > self.maximum:
+            self.maximum = heart_rate
+        self.sum_squares += heart_rate * heart_rate
+        self.rollups.add(1, heart_rate, heart_rate, heart_rate, epoch)
+        if self.epochs and epoch < self.epochs[-1]:
+            self._insert(heart_rate, epoch)
+        else:
+            self.epochs.append(epoch)
+            self.prefix.append(self.prefix[-1] + heart_rate)
+            if self.cold is not None and \
+                    len(self.epochs) >= self.cold.spill_at:
+                self._spill()
+        self._publish()
+
+    def _insert(self, heart_rate, epoch):
+        # Builds new arrays rather than shifting the old ones, which
+        # snapshots may still be reading
+        cold = self.cold
+        if cold is not None and cold.count and epoch < cold.last_epoch:
+            cold.insert(epoch, heart_rate)
+            self.prefix = array("q", (total + heart_rate
+                                      for total in self.prefix))
+            return
+        position = bisect_right(self.epochs, epoch)
+        epochs = self.epochs[:position]
+        epochs.append(epoch)
+        epochs.extend(self.epochs[position:])
+        prefix = self.prefix[:position + 1]
+        prefix.extend(total + heart_rate
+                      for total in self.prefix[position:])
+        self.epochs = epochs
+        self.prefix = prefix
+
+    def extend(self, heart_rates, timestamp):
+        """ Add several readings taken at the same time to the series
+
+        The readings are added with one extend of each array instead of one
+        append per reading.
+
+        :param heart_rates: a list of heart rates as integers
+        :param timestamp: the time of the readings as a datetime
+        """
+        if len(heart_rates) == 0:
+            return
+        self.extend_at(heart_rates, to_epoch(timestamp))
+
+    def extend_at(self, heart_rates, epoch):
+        """ Add several readings whose time is already in epoch seconds
+
+        :param heart_rates: a list of heart rates as integers
+        :param epoch: the time of the readings in seconds since 1970-01-01
+        """
+        if len(heart_rates) == 0:
+            return
+        if self.epochs and epoch < self.epochs[-1]:
+            for heart_rate in heart_rates:
+                self.append_at(heart_rate, epoch)
+            return
+        low = min(heart_rates)
+        high = max(heart_rates)
+        if self.minimum is None or low < self.minimum:
+            self.minimum = low
+        if self.maximum is None or high > self.maximum:
+            self.maximum = high
+        self.sum_squares += sum(rate * rate for rate in heart_rates)
+        self.rollups.add(len(heart_rates), sum(heart_rates), low, high, epoch)
+        self.epochs.extend(array("q", [epoch]) * len(heart_rates))
+        self.prefix.extend(islice(accumulate(heart_rates,
+                                             initial=self.prefix[-1]),
+                                  1, None))
+        self._spill()
+        self._publish()
+
+    def _spill(self):
+        # Move all but the latest hot_readings readings to the cold history
+        # once spill_at have piled up in memory
+        cold = self.cold
+        if cold is None or len(self.epochs) < cold.spill_at:
+            return
+        moved = len(self.epochs) - cold.hot_readings
+        cold.append(self.epochs[:moved], self.prefix[1:moved + 1])
+        self.epochs = self.epochs[moved:]
+        self.prefix = self.prefix[moved:]
+
+    def _publish(self):
+        # Readers pick up the snapshot attribute without a lock, so the new
+        # snapshot is built first and then swapped in with one assignment
+        cold = self.cold
+        cold_count = 0 if cold is None else cold.count
+        version = 0 if self.snapshot is None else self.snapshot.version + 1
+        self.snapshot = SeriesSnapshot(
+            version, self.epochs, self.prefix, len(self.epochs), cold,
+            cold_count, 0 if cold is None else cold.generation,
+            self.minimum, self.maximum, self.sum_squares)
+
+    def _cold_count(self):
+        return 0 if self.cold is None else self.cold.count
+
+    def rate_at(self, index):
+        """ Read one heart rate from the series
+
+        :param index: the position of the reading; negative positions count
+        from the end like a list
+
+        :returns: the heart rate as an integer
+        """
+        cold_count = self._cold_count()
+        if index < 0:
+            index += cold_count + len(self.epochs)
+        if not 0 <= index < cold_count + len(self.epochs):
+            raise IndexError("heart rate index out of range")
+        if index < cold_count:
+            return self.cold.rate_at(index)
+        index -= cold_count
+        return self.prefix[index + 1] - self.prefix[index]
+
+    def epoch_at(self, index):
+        """ Read the time of one reading
+
+        :param index: the position of the reading; negative positions count
+        from the end like a list
+
+        :returns: the time of the reading in seconds since 1970-01-01
+        """
+        cold_count = self._cold_count()
+        if index < 0:
+            index += cold_count + len(self.epochs)
+        if not 0 <= index < cold_count + len(self.epochs):
+            raise IndexError("timestamp index out of range")
+        if index < cold_count:
+            return self.cold.epoch_at(index)
+        return self.epochs[index - cold_count]
+
+    def iter_rates(self):
+        """ Iterate over the heart rates in time order
+        """
+        rates = map(sub, islice(self.prefix, 1, None), self.prefix)
+        if self._cold_count() == 0:
+            return rates
+        return chain(self.cold.iter_rates(), rates)
+
+    def iter_epochs(self):
+        """ Iterate over the times of the readings in epoch seconds
+        """
+        if self._cold_count() == 0:
+            return iter(self.epochs)
+        return chain(self.cold.iter_epochs(), self.epochs)
+
+    def sum_after(self, epoch):
+        """ Count and sum the heart rates recorded after a given time
+
+        :param epoch: the start of the window in seconds since 1970-01-01.
+        Readings taken exactly at this time are not included.
+
+        :returns: a tuple of the number of readings after the time and the
+        sum of their heart rates
+        """
+        if self._cold_count() and epoch < self.epochs[0]:
+            position, before = self.cold.position_after(epoch)
+            return len(self) - position, self.prefix[-1] - before
+        position = bisect_right(self.epochs, epoch)
+        count = len(self.epochs) - position
+        return count, self.prefix[-1] - self.prefix[position]
+
+    def total(self):
+        """ Sum of all the heart rates in the series
+        """
+        return self.prefix[-1]
+
+    def frozen(self):
+        """ Copy the series for writing a snapshot
+
+        :returns: a tuple of a FrozenHistory of the cold history, or None
+        if there is none, and copies of epochs and prefix
+        """
+        cold = None
+        if self._cold_count():
+            cold = self.cold.frozen()
+        return cold, self.epochs[:], self.prefix[:]
+
+    def get_rollups(self):
+        """ Minute, hour and day rollups of the series
+
+        :returns: the series' Rollups
+        """
+        return self.rollups
+
+    def __len__(self):
+        if self.cold is None:
+            return len(self.epochs)
+        return self.cold.count + len(self.epochs)
+
+
+class SeriesSnapshot:
+    """ An immutable view of a HeartRateSeries at one version
+
+    A snapshot holds the series' arrays together with how many readings
+    they held when it was taken, and copies of the running aggregates. The
+    series only appends to those arrays, and swaps in new arrays for any
+    other change, so the readings counted by a snapshot stay the same while
+    the series goes on changing, and a snapshot can be read without the
+    lock its writers hold. The cold readings are read back from the
+    ColdHistory's file; if the file has been rewritten since the snapshot
+    was taken, readings and sum_after return None and the caller takes a
+    newer snapshot.
+    """
+
+    __slots__ = ("version", "epochs", "prefix", "hot", "cold", "cold_count",
+                 "cold_generation", "minimum", "maximum", "sum_squares")
+
+    def __init__(self, version, epochs, prefix, hot, cold, cold_count,
+                 cold_generation, minimum, maximum, sum_squares):
+        self.version = version
+        self.epochs = epochs
+        self.prefix = prefix
+        self.hot = hot
+        self.cold = cold
+        self.cold_count = cold_count
+        self.cold_generation = cold_generation
+        self.minimum = minimum
+        self.maximum = maximum
+        self.sum_squares = sum_squares
+
+    def total(self):
+        """ Sum of the heart rates in the snapshot
+        """
+        return self.prefix[self.hot]
+
+    def latest(self):
+        """ The latest reading in the snapshot
+
+        :returns: a tuple of the heart rate and its time in epoch seconds,
+        or None if the snapshot is empty
+        """
+        hot = self.hot
+        if hot == 0:
+            return None
+        return self.prefix[hot] - self.prefix[hot - 1], self.epochs[hot - 1]
+
+    def _frozen_cold(self):
+        return self.cold.frozen_at(self.cold_generation, self.cold_count)
+
+    def readings(self):
+        """ Copy every reading in the snapshot
+
+        :returns: a tuple of a list of the heart rates and a list of their
+        times in epoch seconds, or None if the cold readings were rewritten
+        """
+        hot = self.hot
+        prefix = self.prefix[:hot + 1]
+        rates = list(map(sub, islice(prefix, 1, None), prefix))
+        epochs = list(self.epochs[:hot])
+        if self.cold_count == 0:
+            return rates, epochs
+        frozen = self._frozen_cold()
+        if frozen is None:
+            return None
+        with frozen:
+            return (list(chain(frozen.iter_rates(), rates)),
+                    list(chain(frozen.iter_epochs(), epochs)))
+
+    def sum_after(self, epoch):
+        """ Count and sum the heart rates recorded after a given time
+
+        :param epoch: the start of the window in seconds since 1970-01-01.
+        Readings taken exactly at this time are not included.
+
+        :returns: a tuple of the number of readings after the time and the
+        sum of their heart rates, or None if the cold readings were
+        rewritten
+        """
+        hot = self.hot
+        total = self.prefix[hot]
+        if self.cold_count and epoch < self.epochs[0]:
+            frozen = self._frozen_cold()
+            if frozen is None:
+                return None
+            with frozen:
+                position, before = frozen.position_after(epoch)
+            return len(self) - position, total - before
+        position = bisect_right(self.epochs, epoch, 0, hot)
+        return hot - position, total - self.prefix[position]
+
+    def __len__(self):
+        return self.cold_count + self.hot
+
+
+class _SeriesView(Sequence):
+    """ Read-only list-like view of one column of a HeartRateSeries
+    """
+
+    __slots__ = ("series",)
+
+    def __init__(self, series):
+        self.series = series
+
+    def __len__(self):
+        return len(self.series)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            indices = range(*index.indices(len(self)))
+            return [self._item(position) for position in indices]
+        return self._item(index)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, _SeriesView)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class HeartRateView(_SeriesView):
+    """ The heart rates of a HeartRateSeries, read as integers
+    """
+
+    __slots__ = ()
+
+    def _item(self, index):
+        return self.series.rate_at(index)
+
+    def __iter__(self):
+        return self.series.iter_rates()
+
+
+class TimestampView(_SeriesView):
+    """ The timestamps of a HeartRateSeries, read as formatted strings
+    """
+
+    __slots__ = ()
+
+    def _item(self, index):
+        return format_epoch(self.series.epoch_at(index))
+
+    def __iter__(self):
+        return map(format_epoch, self.series.iter_epochs())
+
+
+def new_series_keys(series=None):
+    """ Create the "heart_rate" and "timestamp" entries of a patient
+
+    :param series: the HeartRateSeries to view, or None for a new, empty one
+
+    :returns: a dictionary with "heart_rate" and "timestamp" views over the
+    series
+    """
+    if series is None:
+        series = HeartRateSeries()
+    return {"heart_rate": series.heart_rate, "timestamp": series.timestamp}
+
+
+def get_series(patient):
+    """ Find the HeartRateSeries behind a patient dictionary
+
+    :param patient: a patient dictionary
+
+    :returns: the patient's HeartRateSeries, or None if the patient has no
+    readings yet or still stores them as plain lists
+    """
+    heart_rate = patient.get("heart_rate")
+    if isinstance(heart_rate, _SeriesView):
+        return heart_rate.series
+    return None
+
+
+def append_reading(patient, heart_rate, timestamp):
+    """ Add one reading to a patient dictionary
+
+    Readings go straight into the patient's HeartRateSeries when it has one.
+    Patients whose "heart_rate" and "timestamp" entries are plain lists get
+    the heart rate and the formatted timestamp string appended instead.
+
+    :param patient: a patient dictionary with "heart_rate" and "timestamp"
+    keys
+    :param heart_rate: the heart rate as an integer
+    :param timestamp: the time of the reading as a datetime
+    """
+    series = get_series(patient)
+    if series is not None:
+        series.append(heart_rate, timestamp)
+    else:
+        patient["heart_rate"].append(heart_rate)
+        patient["timestamp"].append(timestamp.strftime(TIMESTAMP_FORMAT))
+
+
+def append_readings(patient, heart_rates, timestamp):
+    """ Add several readings taken at the same time to a patient dictionary
+
+    :param patient: a patient dictionary with "heart_rate" and "timestamp"
+    keys
+    :param heart_rates: a list of heart rates as integers
+    :param timestamp: the time of the readings as a datetime
+    """
+    series = get_series(patient)
+    if series is not None:
+        series.extend(heart_rates, timestamp)
+    else:
+        for heart_rate in heart_rates:
+            append_reading(patient, heart_rate, timestamp)
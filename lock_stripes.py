@@ -0,0 +1,58 @@
+from contextlib import contextmanager
+import threading
+
+# Number of locks shared by the patients; two patients whose ids fall on
+# the same stripe wait for each other, so this should be well above the
+# number of threads serving requests
+STRIPES = 64
+
+
+class LockStripes:
+    """ A fixed set of locks shared out between keys by their hash
+
+    Changes to one key (for example one patient's readings) are made while
+    holding that key's stripe, so they are serialized, while changes to
+    keys on other stripes go ahead in parallel. One lock per key would also
+    work but would grow with the number of keys and need its own lock to
+    create them; a fixed number of stripes needs neither.
+    Using the object itself in a with statement holds every stripe, which
+    excludes all keyed changes, e.g. while a snapshot is copied or records
+    are added or removed. The stripes are reentrant, so a thread that holds
+    every stripe can still take a single one.
+    """
+
+    def __init__(self, count=STRIPES):
+        """ Create the locks
+
+        :param count: the number of stripes
+        """
+        self._locks = [threading.RLock() for _ in range(count)]
+
+    def lock_for(self, key):
+        """ Find the lock of a key
+
+        :param key: a hashable key, e.g. a patient_id
+
+        :returns: the RLock of the key's stripe
+        """
+        return self._locks[hash(key) % len(self._locks)]
+
+    @contextmanager
+    def stripe(self, key):
+        """ Hold the lock of one key for the body of a with statement
+
+        :param key: a hashable key, e.g. a patient_id
+        """
+        with self.lock_for(key):
+            yield
+
+    def __enter__(self):
+        # Always taken in the same order, so two threads holding every
+        # stripe cannot deadlock
+        for lock in self._locks:
+            lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        for lock in reversed(self._locks):
+            lock.release()
@@ -0,0 +1,378 @@
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+import threading
+
+# Upper bounds of the latency histogram buckets in seconds, from 50
+# microseconds to 10 seconds
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# The storage methods the routes call on every reading or query, timed by
+# instrument_storage
+STORAGE_CALLS = ("add_readings", "readings", "last_reading", "reading_stats",
+                 "sum_after", "rollups", "get_patient")
+
+
+class Histogram:
+    """ Counts of observed values in fixed buckets
+
+    Recording a value costs one binary search over the bucket bounds and a
+    few additions, and the memory used does not grow with the number of
+    values. Quantiles are estimated from the buckets by linear
+    interpolation, the same way Prometheus' histogram_quantile does.
+    """
+
+    __slots__ = ("bounds", "counts", "total", "count")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        """ Create an empty histogram
+
+        :param bounds: the sorted upper bounds of the buckets. Values above
+        the last bound go into an extra +Inf bucket.
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """ Record one value
+
+        The histogram does not lock; callers that share it between threads
+        hold their own lock around observe.
+
+        :param value: the value to record, e.g. a latency in seconds
+        """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def merge(self, counts, total, count):
+        """ Add the values recorded by another histogram with the same
+        bounds
+
+        :param counts: the other histogram's counts
+        :param total: the other histogram's total
+        :param count: the other histogram's count
+        """
+        for index, bucket_count in enumerate(counts):
+            self.counts[index] += bucket_count
+        self.total += total
+        self.count += count
+
+    def quantile(self, q):
+        """ Estimate a quantile of the recorded values
+
+        :param q: the quantile between 0 and 1, e.g. 0.95
+
+        :returns: the estimated value, or None if nothing was recorded.
+        Values in the +Inf bucket are reported as the largest bound.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                if index == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[index - 1] if index > 0 else 0.0
+                upper = self.bounds[index]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.bounds[-1]
+
+
+class Metrics:
+    """ Request and function call metrics for the server
+
+    For each route and method this keeps a request count, an error count
+    (responses with a status code of 400 or more) and a latency histogram.
+    For each instrumented function it keeps a call count, an error count
+    (calls that raised) and a latency histogram. Setting enabled to False
+    stops recording, which is used to measure the overhead.
+    Gauges report a current value, e.g. a standby server's replication lag,
+    which is read when the metrics are rendered.
+    The metrics of several processes are combined by adding what export
+    copies from each of them to one Metrics.
+    """
+
+    def __init__(self, prefix="hrs"):
+        """ Create an empty set of metrics
+
+        :param prefix: the prefix of every metric name in render's output
+        """
+        self.prefix = prefix
+        self.enabled = True
+        self.requests = {}
+        self.request_errors = {}
+        self.request_latency = {}
+        self.calls = {}
+        self.call_errors = {}
+        self.call_latency = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def record_request(self, route, method, status_code, seconds):
+        """ Record one handled request
+
+        :param route: the route's URL rule, e.g. "/api/status/<patient_id>"
+        :param method: the HTTP method, e.g. "GET"
+        :param status_code: the status code of the response
+        :param seconds: how long the request took
+        """
+        key = (route, method)
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if status_code >= 400:
+                self.request_errors[key] = \
+                    self.request_errors.get(key, 0) + 1
+            histogram = self.request_latency.get(key)
+            if histogram is None:
+                histogram = self.request_latency[key] = Histogram()
+            histogram.observe(seconds)
+
+    def record_call(self, name, seconds, failed=False):
+        """ Record one function call
+
+        :param name: the name of the function
+        :param seconds: how long the call took
+        :param failed: True if the call raised an exception
+        """
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if failed:
+                self.call_errors[name] = self.call_errors.get(name, 0) + 1
+            histogram = self.call_latency.get(name)
+            if histogram is None:
+                histogram = self.call_latency[name] = Histogram()
+            histogram.observe(seconds)
+
+    def set_gauge(self, name, help_text, read):
+        """ Report a current value
+
+        :param name: the name of the gauge, without the prefix
+        :param help_text: the description of the gauge
+        :param read: a function without arguments that returns the current
+        value, or None to leave the gauge out
+        """
+        with self._lock:
+            self.gauges[name] = (help_text, read)
+
+    def export(self):
+        """ Copy everything recorded so far, e.g. to send to another
+        process
+
+        :returns: a dictionary of plain values that add takes, in which
+        histograms are (counts, total, count) tuples and gauges are
+        (help text, current value) tuples
+        """
+        with self._lock:
+            exported = {name: dict(getattr(self, name))
+                        for name in ("requests", "request_errors", "calls",
+                                     "call_errors")}
+            for name in ("request_latency", "call_latency"):
+                exported[name] = {
+                    key: (list(histogram.counts), histogram.total,
+                          histogram.count)
+                    for key, histogram in getattr(self, name).items()}
+            exported["gauges"] = {
+                gauge: (help_text, read())
+                for gauge, (help_text, read) in self.gauges.items()}
+            return exported
+
+    def add(self, exported):
+        """ Add the metrics copied by export from another Metrics
+
+        Counts and histograms are added to these; a gauge reports the value
+        that was copied.
+
+        :param exported: a dictionary returned by export
+        """
+        with self._lock:
+            for name in ("requests", "request_errors", "calls",
+                         "call_errors"):
+                counters = getattr(self, name)
+                for key, value in exported[name].items():
+                    counters[key] = counters.get(key, 0) + value
+            for name in ("request_latency", "call_latency"):
+                histograms = getattr(self, name)
+                for key, copied in exported[name].items():
+                    histogram = histograms.get(key)
+                    if histogram is None:
+                        histogram = histograms[key] = Histogram()
+                    histogram.merge(*copied)
+            for gauge, (help_text, value) in exported["gauges"].items():
+                self.gauges[gauge] = (help_text, lambda value=value: value)
+
+    def reset(self):
+        """ Forget everything recorded so far, and every gauge
+        """
+        with self._lock:
+            for table in (self.requests, self.request_errors,
+                          self.request_latency, self.calls, self.call_errors,
+                          self.call_latency, self.gauges):
+                table.clear()
+
+    def render(self):
+        """ Write the metrics in the Prometheus text exposition format
+
+        :returns: the metrics as a string. Latencies are reported both as
+        histograms (the _duration_seconds metrics) and as p50/p95/p99
+        summaries estimated from them (the _latency_seconds metrics).
+        """
+        with self._lock:
+            return self._render()
+
+    def _render(self):
+        lines = []
+        request_labels = {key: 'route="{}",method="{}"'.format(
+            _escape(key[0]), key[1]) for key in self.requests}
+        call_labels = {name: 'function="{}"'.format(_escape(name))
+                       for name in self.calls}
+        self._render_counter(lines, "requests_total",
+                             "Requests handled, by route and method.",
+                             self.requests, request_labels)
+        self._render_counter(lines, "request_errors_total",
+                             "Responses with a status code of 400 or more.",
+                             self.request_errors, request_labels)
+        self._render_latency(lines, "request", "Request",
+                             self.request_latency, request_labels)
+        self._render_counter(lines, "function_calls_total",
+                             "Calls of instrumented functions.",
+                             self.calls, call_labels)
+        self._render_counter(lines, "function_errors_total",
+                             "Calls of instrumented functions that raised.",
+                             self.call_errors, call_labels)
+        self._render_latency(lines, "function", "Function",
+                             self.call_latency, call_labels)
+        for gauge, (help_text, read) in sorted(self.gauges.items()):
+            value = read()
+            if value is None:
+                continue
+            name = "{}_{}".format(self.prefix, gauge)
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} gauge".format(name))
+            lines.append("{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+    def _render_counter(self, lines, name, help_text, counters, labels):
+        name = "{}_{}".format(self.prefix, name)
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} counter".format(name))
+        for key, value in sorted(counters.items()):
+            lines.append("{}{{{}}} {}".format(name, labels[key], value))
+
+    def _render_latency(self, lines, kind, title, histograms, labels):
+        name = "{}_{}_duration_seconds".format(self.prefix, kind)
+        lines.append("# HELP {} {} latency in seconds.".format(name, title))
+        lines.append("# TYPE {} histogram".format(name))
+        for key, histogram in sorted(histograms.items()):
+            cumulative = 0
+            bounds = [repr(bound) for bound in histogram.bounds] + ["+Inf"]
+            for bound, bucket_count in zip(bounds, histogram.counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    name, labels[key], bound, cumulative))
+            lines.append("{}_sum{{{}}} {}".format(name, labels[key],
+                                                  histogram.total))
+            lines.append("{}_count{{{}}} {}".format(name, labels[key],
+                                                    histogram.count))
+        name = "{}_{}_latency_seconds".format(self.prefix, kind)
+        lines.append("# HELP {} {} latency quantiles in seconds, estimated "
+                     "from the histogram.".format(name, title))
+        lines.append("# TYPE {} summary".format(name))
+        for key, histogram in sorted(histograms.items()):
+            for q in QUANTILES:
+                lines.append('{}{{{},quantile="{}"}} {}'.format(
+                    name, labels[key], q, histogram.quantile(q)))
+            lines.append("{}_sum{{{}}} {}".format(name, labels[key],
+                                                  histogram.total))
+            lines.append("{}_count{{{}}} {}".format(name, labels[key],
+                                                    histogram.count))
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+metrics = Metrics()
+
+
+def timed(name, registry=metrics):
+    """ Decorator that records the latency of every call of a function
+
+    :param name: the name to report the function under
+    :param registry: the Metrics to record into
+
+    :returns: a decorator that wraps the function without changing its
+    arguments, return value or exceptions
+    """
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return function(*args, **kwargs)
+            start = perf_counter()
+            failed = True
+            try:
+                result = function(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                registry.record_call(name, perf_counter() - start, failed)
+        return wrapper
+    return decorate
+
+
+def instrument_storage(storage, names=STORAGE_CALLS, registry=metrics):
+    """ Record the latency of the calls the routes make to a storage backend
+
+    Each method is timed under its name prefixed with "storage.", e.g.
+    "storage.add_readings". Only the instance is changed, not its class.
+
+    :param storage: the Storage backend
+    :param names: the names of the methods to time
+    :param registry: the Metrics to record into
+
+    :returns: the storage
+    """
+    for name in names:
+        setattr(storage, name,
+                timed("storage." + name, registry)(getattr(storage, name)))
+    return storage
+
+
+def instrument_app(app, registry=metrics):
+    """ Record the count, errors and latency of every request to a Flask app
+
+    Requests are labelled with their URL rule (e.g.
+    "/api/status/<patient_id>") rather than the URL, so the number of
+    metrics does not grow with the number of patients. Requests that match
+    no route are labelled "unmatched".
+
+    :param app: the Flask app
+    :param registry: the Metrics to record into
+    """
+    from flask import g, request
+
+    @app.before_request
+    def start_request_timer():
+        if registry.enabled:
+            g.metrics_start = perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            if request.url_rule is not None:
+                route = request.url_rule.rule
+            else:
+                route = "unmatched"
+            registry.record_request(route, request.method,
+                                    response.status_code,
+                                    perf_counter() - start)
+        return response
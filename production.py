@@ -0,0 +1,89 @@
+import argparse
+import logging
+import async_server
+import heart_rate_sentinel
+
+# The longest request body accepted, in bytes; bulk imports are the longest
+# requests
+MAX_BODY_SIZE = 100 * 1024 * 1024
+
+
+def main(argv=None):
+    """ Command line entry point that serves the app for production
+
+    app.run starts Werkzeug's development server, which gives every
+    connection a thread of its own and closes it after one request. Here
+    the app made by heart_rate_sentinel.create_app is served by the
+    AsyncServer of async_server.py instead: connections are kept alive
+    between requests, the requests are run on a fixed pool of threads,
+    over-long requests are refused before they are read, and on SIGTERM or
+    Ctrl+C the server stops accepting connections and lets the requests
+    being handled finish before the storage is closed.
+
+    Usage: python production.py [--host HOST] [--port PORT]
+    [--threads N] [--backlog N] [--keep-alive SECONDS]
+    [--max-body-size BYTES] [--max-header-size BYTES]
+    [--drain-timeout SECONDS] [--storage memory|sqlite] [--data FOLDER]
+    [--retention-readings N] [--retention-seconds SECONDS]
+    [--standby-of URL [--promote-after SECONDS]] [--cluster-token TOKEN]
+    [--outbox PATH] [--email-relay URL]
+    """
+    parser = argparse.ArgumentParser(
+        description="Serve the heart rate sentinel server for production")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=5000,
+                        help="port to serve on (default: %(default)s)")
+    parser.add_argument("--threads", type=int,
+                        default=async_server.THREADS,
+                        help="threads that handle requests "
+                             "(default: %(default)s)")
+    parser.add_argument("--backlog", type=int,
+                        default=async_server.BACKLOG,
+                        help="connections queued before they are accepted "
+                             "(default: %(default)s)")
+    parser.add_argument("--keep-alive", type=float,
+                        default=async_server.KEEP_ALIVE_TIMEOUT,
+                        metavar="SECONDS",
+                        help="seconds a connection may stay idle between "
+                             "two requests (default: %(default)s)")
+    parser.add_argument("--max-body-size", type=int, default=MAX_BODY_SIZE,
+                        metavar="BYTES",
+                        help="longest request body accepted "
+                             "(default: %(default)s)")
+    parser.add_argument("--max-header-size", type=int,
+                        default=async_server.MAX_HEADER_SIZE,
+                        metavar="BYTES",
+                        help="most bytes of request headers accepted "
+                             "(default: %(default)s)")
+    parser.add_argument("--drain-timeout", type=float,
+                        default=async_server.DRAIN_TIMEOUT,
+                        metavar="SECONDS",
+                        help="seconds the requests being handled are given "
+                             "to finish when stopping (default: %(default)s)")
+    heart_rate_sentinel.add_app_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.standby_of is not None and args.storage != "memory":
+        parser.error("--standby-of needs the memory storage")
+    app = heart_rate_sentinel.create_app(
+        args.storage, args.data, args.retention_readings,
+        args.retention_seconds, args.standby_of, args.promote_after,
+        max_content_length=args.max_body_size,
+        cluster_token=args.cluster_token, outbox_path=args.outbox,
+        relay_url=args.email_relay)
+    logging.info("Serving on {}:{} with {} threads"
+                 .format(args.host, args.port, args.threads))
+    try:
+        async_server.run(app, args.host, args.port, threads=args.threads,
+                         keep_alive_timeout=args.keep_alive,
+                         backlog=args.backlog,
+                         max_body_size=args.max_body_size,
+                         max_header_size=args.max_header_size,
+                         drain_timeout=args.drain_timeout)
+    finally:
+        heart_rate_sentinel.close_app()
+    logging.info("Stopped serving")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+from hr_series import get_series
+
+PATIENT_KEYS = ("patient_id", "attending_username", "patient_age")
+# Optional patient keys that limit the readings kept for the patient: only
+# the latest retention_readings readings, and only those taken at most
+# retention_seconds before the patient's latest reading. A patient without
+# them uses the storage's default retention.
+RETENTION_KEYS = ("retention_readings", "retention_seconds")
+ATTENDING_KEYS = ("attending_username", "attending_email", "attending_phone")
+
+
+class _Record:
+    """ A fixed set of fields kept in slots rather than a dictionary
+
+    A dictionary with three or four short keys takes several hundred bytes
+    of hash table; a record keeps the same values in a fixed array of slots.
+    Records read like the dictionaries they replace (get, [], in, keys,
+    items and update with the same keys), so a Registry, the write-ahead log
+    and older helper functions handle either. to_dict turns a record back
+    into the JSON shape used by the routes, which is only done when a
+    response is built.
+    """
+
+    __slots__ = ()
+    FIELDS = ()
+    OPTIONAL = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Create a record from a dictionary
+
+        :param data: a dictionary with the record's keys; other keys are
+        ignored
+
+        :returns: a new record
+        """
+        return cls(**{name: data.get(name) for name in cls.FIELDS})
+
+    def to_dict(self):
+        """ Copy the record into a dictionary in the JSON shape
+
+        :returns: a dictionary with every key in FIELDS, except optional
+        keys that are None
+        """
+        record = {}
+        for name in self.FIELDS:
+            value = getattr(self, name)
+            if value is not None or name not in self.OPTIONAL:
+                record[name] = value
+        return record
+
+    def keys(self):
+        return [key for key, _ in self.items()]
+
+    def items(self):
+        return self.to_dict().items()
+
+    def get(self, key, default=None):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            if value is not None or key not in self.OPTIONAL:
+                return value
+        return default
+
+    def update(self, fields):
+        for key, value in fields.items():
+            setattr(self, key, value)
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __eq__(self, other):
+        if isinstance(other, _Record):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.to_dict())
+
+
+class PatientRecord(_Record):
+    """ A patient, and the series of its heart rate readings
+
+    The "heart_rate" and "timestamp" keys read the list-like views of the
+    patient's series, and are only present once the patient has one.
+    Setting them (e.g. with update(new_series_keys(series))) sets the
+    series, so readings are added to the record in place.
+    """
+
+    __slots__ = PATIENT_KEYS + RETENTION_KEYS + ("series",)
+    FIELDS = PATIENT_KEYS + RETENTION_KEYS
+    OPTIONAL = RETENTION_KEYS
+
+    @classmethod
+    def from_dict(cls, data):
+        record = super().from_dict(data)
+        record.series = get_series(data)
+        return record
+
+    def get(self, key, default=None):
+        if key in ("heart_rate", "timestamp"):
+            if self.series is None:
+                return default
+            return getattr(self.series, key)
+        return super().get(key, default)
+
+    def update(self, fields):
+        for key, value in fields.items():
+            if key in ("heart_rate", "timestamp"):
+                self.series = value.series
+            else:
+                setattr(self, key, value)
+
+    def items(self):
+        record = self.to_dict()
+        if self.series is not None:
+            record["heart_rate"] = self.series.heart_rate
+            record["timestamp"] = self.series.timestamp
+        return record.items()
+
+
+class AttendingRecord(_Record):
+    """ An attending physician
+    """
+
+    __slots__ = ATTENDING_KEYS
+    FIELDS = ATTENDING_KEYS
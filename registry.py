@@ -0,0 +1,148 @@
+class Registry:
+    """ A database of record dictionaries with a hash index on one key
+
+    The server used to keep its patients and attending physicians in plain
+    lists, so every lookup walked the whole list. A Registry keeps the same
+    records in a dictionary keyed by one of their fields (for example
+    "patient_id"), which makes lookup, insert and update O(1).
+    Iterating a Registry yields the records in insertion order, exactly like
+    iterating the old list, so code that loops over the database keeps
+    working unchanged.
+    A registry can also keep a secondary index on a non-unique field (for
+    example "attending_username"), so all records sharing a value can be
+    listed in time proportional to their number rather than the size of the
+    whole registry.
+    A registry can also be given a record type (see records.py), in which
+    case the dictionaries added to it are stored as records of that type.
+    """
+
+    def __init__(self, key, records=(), group_by=None, record_type=None):
+        """ Create a registry indexed on the given record field
+
+        :param key: the name of the record field used as the unique key,
+        e.g. "patient_id"
+        :param records: an optional iterable of record dictionaries to load
+        :param group_by: the name of an optional non-unique field to keep a
+        secondary index on, e.g. "attending_username"
+        :param record_type: a record class with a from_dict method to store
+        the records as, or None to store them as they are given
+        """
+        self.key = key
+        self.group_by = group_by
+        self.record_type = record_type
+        self._records = {}
+        self._groups = {}
+        for record in records:
+            self.append(record)
+
+    def append(self, record):
+        """ Add a record to the registry
+
+        If a record with the same key already exists it is replaced in
+        place, so it keeps its original position in iteration order.
+
+        :param record: a dictionary containing the registry's key field
+
+        :returns: the record that was added
+        """
+        self[record[self.key]] = record
+        return self._records[record[self.key]]
+
+    def extend(self, records):
+        """ Add several records to the registry
+
+        :param records: an iterable of record dictionaries
+        """
+        for record in records:
+            self[record[self.key]] = record
+
+    def get(self, key_value, default=None):
+        """ Look up a record by its key
+
+        :param key_value: the value of the key field to look for
+        :param default: what to return if no record has that key
+
+        :returns: the matching record, or default if it is not found
+        """
+        return self._records.get(key_value, default)
+
+    def group(self, group_value):
+        """ List the records whose group_by field has the given value
+
+        :param group_value: the value of the group_by field to look for,
+        e.g. an attending physician's username
+
+        :returns: a list of the matching records in the order they joined
+        the group. The list is empty if no record has that value.
+        """
+        # The keys are copied in one step, so a record added to or moved out
+        # of the group by another thread meanwhile cannot break the loop
+        members = list(self._groups.get(group_value, ()))
+        records = [self._records.get(key_value) for key_value in members]
+        return [record for record in records if record is not None]
+
+    def remove(self, key_value):
+        """ Remove a record by its key
+
+        :param key_value: the value of the key field of the record
+
+        :returns: the removed record, or None if there was none
+        """
+        record = self._records.pop(key_value, None)
+        if record is not None and self.group_by is not None:
+            self._ungroup(key_value, record)
+        return record
+
+    def keys(self):
+        """ List the keys of the records, in insertion order
+        """
+        return list(self._records)
+
+    def values(self):
+        """ List the records, in insertion order
+        """
+        return list(self._records.values())
+
+    def clear(self):
+        """ Remove every record from the registry
+        """
+        self._records.clear()
+        self._groups.clear()
+
+    def _ungroup(self, key_value, record):
+        group_value = record.get(self.group_by)
+        members = self._groups.get(group_value)
+        if members is not None:
+            members.pop(key_value, None)
+            if not members:
+                del self._groups[group_value]
+
+    def __getitem__(self, key_value):
+        return self._records[key_value]
+
+    def __setitem__(self, key_value, record):
+        record_type = self.record_type
+        if record_type is not None and type(record) is not record_type:
+            record = record_type.from_dict(record)
+        if self.group_by is not None:
+            group_value = record.get(self.group_by)
+            old_record = self._records.get(key_value)
+            if old_record is not None:
+                if old_record.get(self.group_by) == group_value:
+                    self._records[key_value] = record
+                    return
+                self._ungroup(key_value, old_record)
+            self._groups.setdefault(group_value, {})[key_value] = None
+        self._records[key_value] = record
+
+    def __contains__(self, key_value):
+        return key_value in self._records
+
+    def __iter__(self):
+        return iter(self._records.values())
+
+    def __len__(self):
+        return len(self._records)
+
+    def __repr__(self):
+        return repr(list(self._records.values()))
@@ -0,0 +1,199 @@
+import logging
+import threading
+from time import monotonic
+import requests
+from metrics import metrics
+
+# Seconds the primary holds a standby's request for the log when there is
+# nothing new, so changes are shipped as soon as they reach its disk
+LONG_POLL = 1.0
+# Seconds added to LONG_POLL before a request to the primary gives up
+PRIMARY_TIMEOUT = 5.0
+# Seconds between two tries to reach a primary that did not answer
+RETRY_INTERVAL = 0.2
+# The longest wait in seconds between two tries to apply a log that failed
+# for another reason, e.g. a malformed answer of the primary
+MAX_RETRY_INTERVAL = 5.0
+
+
+class Standby:
+    """ Keeps a MemoryStorage a warm copy of a primary server's
+
+    A thread asks the primary's /api/replication/log for the part of its
+    change log written since the last request, and applies it with
+    receive_log; when the primary has nothing new, it holds the request
+    for up to LONG_POLL seconds, so every change reaches the standby
+    about as soon as it reaches the primary's disk. A standby that is too
+    far behind, or just started, loads the primary's snapshot from
+    /api/replication/snapshot first.
+    The standby can be promoted to take over from its primary: it stops
+    applying the primary's log and makes changes of its own from then on.
+    Given promote_after, it promotes itself when the primary has not
+    answered for that many seconds.
+    Its replication lag is reported in the metrics as the seconds since it
+    last had every change of the primary, and the bytes of log it had not
+    received yet. Any other failure to follow the primary, e.g. an error
+    status or a log out of sequence, is logged, kept in error, and retried
+    with a growing wait; it does not promote the standby, since the
+    primary is up.
+    """
+
+    def __init__(self, storage, primary, promote_after=None, headers=None,
+                 registry=metrics):
+        """ Make a storage the standby of a primary server
+
+        :param storage: the open MemoryStorage to apply the changes to
+        :param primary: the URL of the primary, e.g.
+        "http://127.0.0.1:5000"
+        :param promote_after: seconds without an answer from the primary
+        after which the standby promotes itself, or None to wait for
+        promote to be called
+        :param headers: a dictionary of headers to send with every request
+        to the primary, e.g. its cluster token
+        :param registry: the Metrics to report the replication lag in
+        """
+        self.storage = storage
+        self.primary = primary.rstrip("/")
+        self.promote_after = promote_after
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        self.promoted = threading.Event()
+        self.behind = None
+        self.error = None
+        self._caught_up = None
+        self._waiting = False
+        self._failed_since = None
+        self._stopping = threading.Event()
+        self._thread = None
+        registry.set_gauge("replication_lag_seconds",
+                           "Seconds since the standby last had every change "
+                           "of its primary.", self.lag)
+        registry.set_gauge("replication_lag_bytes",
+                           "Bytes of the primary's log the standby had not "
+                           "received at its last request.",
+                           lambda: None if self.promoted.is_set()
+                           else self.behind)
+
+    def start(self):
+        """ Start applying the primary's changes in a background thread
+        """
+        self._thread = threading.Thread(target=self._run,
+                                        name="replication", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        delay = RETRY_INTERVAL
+        while not self._stopping.is_set():
+            try:
+                self.poll()
+                self._failed_since = None
+                self.error = None
+                delay = RETRY_INTERVAL
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if self._failed_since is None:
+                    self._failed_since = monotonic()
+                    logging.warning("The primary {} did not answer: {}"
+                                    .format(self.primary, error))
+                self.error = "The primary did not answer: {}".format(error)
+                if self.promote_after is not None and \
+                        monotonic() - self._failed_since >= \
+                        self.promote_after:
+                    self._promote()
+                    return
+                self._stopping.wait(RETRY_INTERVAL)
+            except Exception as error:
+                # The primary answered, so it is up
+                self._failed_since = None
+                if delay == RETRY_INTERVAL:
+                    logging.exception("Applying the log of the primary {} "
+                                      "failed".format(self.primary))
+                self.error = "Applying the primary's log failed: {!r}" \
+                    .format(error)
+                self._stopping.wait(delay)
+                delay = min(delay * 2, MAX_RETRY_INTERVAL)
+
+    def poll(self, wait=LONG_POLL):
+        """ Apply the changes the primary logged since the last poll
+
+        :param wait: seconds for the primary to wait for a change when it
+        has none
+
+        :returns: True if the standby has every change the primary had
+        logged when it answered
+
+        :raises requests.ConnectionError: if the primary cannot be reached
+        :raises requests.Timeout: if the primary did not answer in time
+        :raises requests.HTTPError: if the primary answered an error status
+        """
+        generation, offset = self.storage.log_position()
+        self._waiting = self.behind == 0
+        try:
+            response = self.session.get(
+                self.primary + "/api/replication/log",
+                params={"generation": generation, "offset": offset,
+                        "wait": wait},
+                timeout=wait + PRIMARY_TIMEOUT)
+        finally:
+            self._waiting = False
+        answered = monotonic()
+        if response.status_code in (409, 410):
+            self._restore()
+            return False
+        response.raise_for_status()
+        generation = int(response.headers["Replication-Generation"])
+        self.storage.receive_log(generation, response.content)
+        if response.headers["Replication-Complete"] == "true":
+            self.storage.receive_log(generation + 1, b"")
+        self.behind = int(response.headers["Replication-Behind"])
+        if self.behind == 0:
+            self._caught_up = answered
+        return self.behind == 0
+
+    def _restore(self):
+        response = self.session.get(self.primary + "/api/replication/snapshot",
+                                    stream=True, timeout=PRIMARY_TIMEOUT)
+        response.raise_for_status()
+        with response:
+            response.raw.decode_content = True
+            self.storage.restore_snapshot(response.raw)
+        logging.info("Loaded the snapshot of the primary {}"
+                     .format(self.primary))
+
+    def lag(self):
+        """ Seconds since the standby last had every change of the primary
+
+        While the primary holds a request of a standby that was up to date,
+        it has no change to ship, so the standby is still up to date.
+
+        :returns: the lag in seconds, or None if the standby was never up to
+        date or has been promoted
+        """
+        if self.promoted.is_set() or self._caught_up is None:
+            return None
+        if self._waiting:
+            return 0.0
+        return monotonic() - self._caught_up
+
+    def stop(self):
+        """ Stop applying the primary's changes, without promoting the
+        standby, e.g. before its storage is closed
+        """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def promote(self):
+        """ Stop applying the primary's changes and start making changes
+
+        Waits for the changes being applied to be applied first.
+        """
+        self.stop()
+        self._promote()
+
+    def _promote(self):
+        if self.promoted.is_set():
+            return
+        self.storage.end_replication()
+        self.promoted.set()
+        logging.info("Promoted the standby of {} to primary"
+                     .format(self.primary))
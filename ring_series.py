@@ -0,0 +1,440 @@
+from array import array
+from bisect import bisect_right
+from collections import deque
+from itertools import chain
+from operator import sub
+from hr_series import HeartRateView, TimestampView, to_epoch
+from rollups import Rollups
+
+# Capacity of the ring buffers of a series that is only limited by age;
+# they double whenever the readings within the age limit do not fit
+INITIAL_CAPACITY = 1024
+
+
+class _Ring:
+    # Reading the ring buffers, shared by RingSeries and RingSnapshot, which
+    # both have epochs, prefix, head, size and base attributes
+
+    __slots__ = ()
+
+    def _slot(self, index):
+        return (self.head + index) % len(self.epochs)
+
+    def _linear(self):
+        # The retained epochs and prefix sums as arrays in time order
+        end = self.head + self.size
+        if end <= len(self.epochs):
+            return self.epochs[self.head:end], self.prefix[self.head:end]
+        end -= len(self.epochs)
+        return (self.epochs[self.head:] + self.epochs[:end],
+                self.prefix[self.head:] + self.prefix[:end])
+
+    def _position_after(self, epoch):
+        # The logical position of the first retained reading after epoch
+        epochs = self.epochs
+        end = self.head + self.size
+        if end <= len(epochs):
+            return bisect_right(epochs, epoch, self.head, end) - self.head
+        end -= len(epochs)
+        if epoch < epochs[-1]:
+            return bisect_right(epochs, epoch, self.head) - self.head
+        return len(epochs) - self.head + bisect_right(epochs, epoch, 0, end)
+
+    def _prefix_before(self, position):
+        if position == 0:
+            return self.base
+        return self.prefix[self._slot(position - 1)]
+
+
+class RingSeries(_Ring):
+    """ The most recent heart rate readings of a patient with a retention
+    policy
+
+    A patient can keep only its latest max_readings readings, only the
+    readings taken less than max_age seconds before its latest reading, or
+    both. The readings are kept like in a HeartRateSeries, as epoch seconds
+    and running prefix sums in typed arrays, but the arrays are ring buffers
+    allocated up front: a new reading overwrites the oldest one once the
+    buffer is full, so expiring a reading is O(1) and never reallocates.
+    (A series limited only by age starts with INITIAL_CAPACITY readings and
+    doubles its buffers when more readings than that are within the limit.)
+    The count, sum and sum of squares of the retained readings are updated
+    as readings are added and expire. The minimum and maximum come from
+    monotonic queues of the readings that can still become the minimum or
+    maximum, which is amortized O(1) per reading.
+    A RingSeries has the same methods and "heart_rate" and "timestamp" views
+    as a HeartRateSeries, so the rest of the server reads it the same way.
+    It also publishes a RingSnapshot after every change, which can be read
+    without a lock as long as the readings it covers have not been
+    overwritten meanwhile.
+    """
+
+    __slots__ = ("max_readings", "max_age", "epochs", "prefix", "head",
+                 "size", "base", "last", "added", "sum_squares", "_lows",
+                 "_highs", "rollups", "cold", "heart_rate", "timestamp",
+                 "snapshot")
+
+    def __init__(self, max_readings=None, max_age=None):
+        """ Create an empty series with a retention policy
+
+        :param max_readings: the number of latest readings to keep, or None
+        :param max_age: keep only the readings taken less than this many
+        seconds before the latest reading, or None
+        """
+        if max_readings is None and max_age is None:
+            raise ValueError("A RingSeries needs max_readings or max_age")
+        if max_readings is not None and max_readings < 1:
+            raise ValueError("max_readings must be at least 1")
+        self.max_readings = max_readings
+        self.max_age = max_age
+        capacity = max_readings or INITIAL_CAPACITY
+        self.epochs = array("q", bytes(8 * capacity))
+        # prefix[slot] is the sum of every heart rate added up to and
+        # including the one in slot; base is the sum before the oldest
+        # retained reading and last the sum through the newest
+        self.prefix = array("q", bytes(8 * capacity))
+        self.head = 0
+        self.size = 0
+        self.base = 0
+        self.last = 0
+        # Every reading gets a sequence number, so the monotonic queues can
+        # tell when their front reading expires
+        self.added = 0
+        self.sum_squares = 0
+        self._lows = deque()
+        self._highs = deque()
+        self.rollups = Rollups()
+        self.cold = None
+        self.heart_rate = HeartRateView(self)
+        self.timestamp = TimestampView(self)
+        self.snapshot = None
+        self._publish()
+
+    @property
+    def minimum(self):
+        return self._lows[0][1] if self._lows else None
+
+    @property
+    def maximum(self):
+        return self._highs[0][1] if self._highs else None
+
+    def append(self, heart_rate, timestamp):
+        """ Add one reading, expiring readings outside the retention policy
+
+        :param heart_rate: the heart rate as an integer
+        :param timestamp: the time of the reading as a datetime
+        """
+        self.append_at(heart_rate, to_epoch(timestamp))
+
+    def append_at(self, heart_rate, epoch):
+        """ Add one reading whose time is already in epoch seconds
+
+        Readings in time order are added in O(1). A reading older than the
+        latest one rebuilds the buffers in sorted order, which is O(n).
+
+        :param heart_rate: the heart rate as an integer
+        :param epoch: the time of the reading in seconds since 1970-01-01
+        """
+        self._add(heart_rate, epoch)
+        self._publish()
+
+    def _add(self, heart_rate, epoch):
+        if self.size and epoch < self.epochs[self._slot(self.size - 1)]:
+            self._insert(heart_rate, epoch)
+            return
+        capacity = len(self.epochs)
+        if self.size == capacity:
+            if self.max_readings is not None:
+                self._drop_oldest()
+            else:
+                self._grow()
+                capacity = len(self.epochs)
+        slot = (self.head + self.size) % capacity
+        # Counted before the slot is written, so a snapshot being read can
+        # tell that the slot may have changed
+        sequence = self.added
+        self.added += 1
+        self.last += heart_rate
+        self.epochs[slot] = epoch
+        self.prefix[slot] = self.last
+        self.size += 1
+        self.sum_squares += heart_rate * heart_rate
+        lows = self._lows
+        while lows and lows[-1][1] >= heart_rate:
+            lows.pop()
+        lows.append((sequence, heart_rate))
+        highs = self._highs
+        while highs and highs[-1][1] <= heart_rate:
+            highs.pop()
+        highs.append((sequence, heart_rate))
+        self.rollups.add(1, heart_rate, heart_rate, heart_rate, epoch)
+        if self.max_age is not None:
+            cutoff = epoch - self.max_age
+            while self.size and self.epochs[self.head] < cutoff:
+                self._drop_oldest()
+
+    def extend(self, heart_rates, timestamp):
+        """ Add several readings taken at the same time
+
+        :param heart_rates: a list of heart rates as integers
+        :param timestamp: the time of the readings as a datetime
+        """
+        self.extend_at(heart_rates, to_epoch(timestamp))
+
+    def extend_at(self, heart_rates, epoch):
+        """ Add several readings whose time is already in epoch seconds
+
+        :param heart_rates: a list of heart rates as integers
+        :param epoch: the time of the readings in seconds since 1970-01-01
+        """
+        for heart_rate in heart_rates:
+            self._add(heart_rate, epoch)
+        self._publish()
+
+    def extend_arrays(self, epochs, prefix):
+        """ Add readings in time order together with their prefix sums
+
+        This is how a series is loaded back from a snapshot. The prefix sums
+        continue from the sum of the readings already in the series.
+
+        :param epochs: an array("q") of sorted epoch seconds
+        :param prefix: an array("q") of the prefix sums through each of those
+        readings
+        """
+        before = self.last - self.base
+        for epoch, total in zip(epochs, prefix):
+            self._add(total - before, epoch)
+            before = total
+        self._publish()
+
+    def restore_aggregates(self, minimum, maximum, sum_squares):
+        """ Ignored: a RingSeries works its aggregates out from its readings
+        """
+
+    def restore_rollups(self, frozen):
+        """ Ignored: a RingSeries works its rollups out from its readings
+        """
+
+    def _publish(self):
+        # Swapped in with one assignment, so readers without a lock always
+        # see a whole snapshot
+        version = 0 if self.snapshot is None else self.snapshot.version + 1
+        last = None
+        if self.size:
+            last = (self.rate_at(-1), self.epoch_at(-1))
+        self.snapshot = RingSnapshot(
+            self, version, self.epochs, self.prefix, self.head, self.size,
+            self.base, self.last, self.added, self.minimum, self.maximum,
+            self.sum_squares, last)
+
+    def _drop_oldest(self):
+        slot = self.head
+        heart_rate = self.prefix[slot] - self.base
+        epoch = self.epochs[slot]
+        self.base = self.prefix[slot]
+        self.sum_squares -= heart_rate * heart_rate
+        self.head = (slot + 1) % len(self.epochs)
+        self.size -= 1
+        sequence = self.added - self.size - 1
+        if self._lows[0][0] == sequence:
+            self._lows.popleft()
+        if self._highs[0][0] == sequence:
+            self._highs.popleft()
+        self.rollups.remove(heart_rate, epoch, self.rates_between)
+
+    def _grow(self):
+        epochs, prefix = self._linear()
+        capacity = 2 * len(self.epochs)
+        self.epochs = epochs + array("q", bytes(8 * (capacity - len(epochs))))
+        self.prefix = prefix + array("q", bytes(8 * (capacity - len(prefix))))
+        self.head = 0
+
+    def _insert(self, heart_rate, epoch):
+        epochs, prefix = self._linear()
+        rates = list(map(sub, prefix, chain((self.base,), prefix)))
+        position = bisect_right(epochs, epoch)
+        epochs.insert(position, epoch)
+        rates.insert(position, heart_rate)
+        # Rebuilt in new buffers, so snapshots of the old ones stay intact
+        rebuilt = RingSeries(self.max_readings, self.max_age)
+        for rate, reading_epoch in zip(rates, epochs):
+            rebuilt._add(rate, reading_epoch)
+        for name in ("epochs", "prefix", "head", "size", "base", "last",
+                     "added", "sum_squares", "_lows", "_highs"):
+            setattr(self, name, getattr(rebuilt, name))
+        # Only the retained readings are read, so this is as cheap as the
+        # rebuild above
+        self.rollups = Rollups.build(self.iter_epochs(), self.iter_rates())
+
+    def rate_at(self, index):
+        """ Read one retained heart rate
+
+        :param index: the position of the reading; negative positions count
+        from the end like a list
+
+        :returns: the heart rate as an integer
+        """
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("heart rate index out of range")
+        return self.prefix[self._slot(index)] - self._prefix_before(index)
+
+    def epoch_at(self, index):
+        """ Read the time of one retained reading
+
+        :param index: the position of the reading; negative positions count
+        from the end like a list
+
+        :returns: the time of the reading in seconds since 1970-01-01
+        """
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("timestamp index out of range")
+        return self.epochs[self._slot(index)]
+
+    def iter_rates(self):
+        """ Iterate over the retained heart rates in time order
+        """
+        prefix = self._linear()[1]
+        return map(sub, prefix, chain((self.base,), prefix))
+
+    def iter_epochs(self):
+        """ Iterate over the times of the retained readings in epoch seconds
+        """
+        return iter(self._linear()[0])
+
+    def rates_between(self, start, end):
+        """ Iterate over the retained heart rates taken in a time range
+
+        :param start: the first epoch second of the range
+        :param end: the epoch second after the range
+
+        :returns: an iterator of heart rates
+        """
+        first = self._position_after(start - 1)
+        prefix = self._linear()[1][first:self._position_after(end - 1)]
+        return map(sub, prefix, chain((self._prefix_before(first),), prefix))
+
+    def sum_after(self, epoch):
+        """ Count and sum the retained heart rates after a given time
+
+        :param epoch: the start of the window in seconds since 1970-01-01.
+        Readings taken exactly at this time are not included.
+
+        :returns: a tuple of the number of readings after the time and the
+        sum of their heart rates
+        """
+        position = self._position_after(epoch)
+        return self.size - position, self.last - self._prefix_before(position)
+
+    def total(self):
+        """ Sum of the retained heart rates
+        """
+        return self.last - self.base
+
+    def frozen(self):
+        """ Copy the retained readings for writing a snapshot
+
+        :returns: a tuple of None (a RingSeries has no cold history), the
+        epochs and the prefix sums counted from zero, with a leading zero
+        """
+        epochs, prefix = self._linear()
+        base = self.base
+        return None, epochs, array("q", chain((0,), (total - base
+                                                     for total in prefix)))
+
+    def get_rollups(self):
+        """ Minute, hour and day rollups of the retained readings
+
+        The rollups are kept up to date as readings are added and expire.
+
+        :returns: the series' Rollups
+        """
+        return self.rollups
+
+    def __len__(self):
+        return self.size
+
+
+class RingSnapshot(_Ring):
+    """ An immutable view of a RingSeries at one version
+
+    A snapshot holds the series' ring buffers together with where its
+    readings were in them and copies of the running aggregates. New
+    readings go into free slots first, so the readings counted by a
+    snapshot are only overwritten once the series has added as many
+    readings as the buffers have free slots, or has moved to new buffers.
+    readings and sum_after read the buffers without a lock and then check
+    that this has not happened; if it has, they return None and the caller
+    takes a newer snapshot.
+    """
+
+    __slots__ = ("series", "version", "epochs", "prefix", "head", "size",
+                 "base", "last", "added", "minimum", "maximum",
+                 "sum_squares", "reading")
+
+    def __init__(self, series, version, epochs, prefix, head, size, base,
+                 last, added, minimum, maximum, sum_squares, reading):
+        self.series = series
+        self.version = version
+        self.epochs = epochs
+        self.prefix = prefix
+        self.head = head
+        self.size = size
+        self.base = base
+        self.last = last
+        self.added = added
+        self.minimum = minimum
+        self.maximum = maximum
+        self.sum_squares = sum_squares
+        self.reading = reading
+
+    def _intact(self):
+        series = self.series
+        return (series.epochs is self.epochs and
+                series.added - self.added <= len(self.epochs) - self.size)
+
+    def total(self):
+        """ Sum of the heart rates in the snapshot
+        """
+        return self.last - self.base
+
+    def latest(self):
+        """ The latest reading in the snapshot
+
+        :returns: a tuple of the heart rate and its time in epoch seconds,
+        or None if the snapshot is empty
+        """
+        return self.reading
+
+    def readings(self):
+        """ Copy every reading in the snapshot
+
+        :returns: a tuple of a list of the heart rates and a list of their
+        times in epoch seconds, or None if some were overwritten
+        """
+        epochs, prefix = self._linear()
+        if not self._intact():
+            return None
+        return (list(map(sub, prefix, chain((self.base,), prefix))),
+                list(epochs))
+
+    def sum_after(self, epoch):
+        """ Count and sum the heart rates recorded after a given time
+
+        :param epoch: the start of the window in seconds since 1970-01-01.
+        Readings taken exactly at this time are not included.
+
+        :returns: a tuple of the number of readings after the time and the
+        sum of their heart rates, or None if some were overwritten
+        """
+        position = self._position_after(epoch)
+        before = self._prefix_before(position)
+        if not self._intact():
+            return None
+        return self.size - position, self.last - before
+
+    def __len__(self):
+        return self.size
@@ -0,0 +1,283 @@
+from array import array
+from bisect import bisect_left
+from itertools import islice
+
+# Seconds covered by one bucket of each rollup resolution
+RESOLUTIONS = {"minute": 60, "hour": 3600, "day": 86400}
+# "auto" picks the coarsest resolution that still splits the requested
+# window into at least this many buckets. An average then includes at most
+# one partial bucket, so the readings it wrongly counts or leaves out lie
+# within 1/BUCKETS_PER_WINDOW of the window.
+BUCKETS_PER_WINDOW = 100
+# Seconds of buckets each resolution keeps, counted back from its newest
+# bucket. Every window "auto" gives a resolution fits in what it keeps, and a
+# patient read every second keeps about 400 kB of rollups in all.
+KEEP_SECONDS = {"minute": RESOLUTIONS["hour"] * BUCKETS_PER_WINDOW,
+                "hour": RESOLUTIONS["day"] * BUCKETS_PER_WINDOW,
+                "day": 3650 * RESOLUTIONS["day"]}
+# Readings are read this many at a time when rollups are built
+BUILD_CHUNK = 65536
+
+
+def choose_resolution(window_seconds):
+    """ Pick the coarsest resolution that is still accurate for a window
+
+    :param window_seconds: the length of the requested window in seconds
+
+    :returns: "day", "hour" or "minute", or "raw" if even minutes are too
+    coarse for the window
+    """
+    for name in ("day", "hour", "minute"):
+        if RESOLUTIONS[name] * BUCKETS_PER_WINDOW <= window_seconds:
+            return name
+    return "raw"
+
+
+class Rollup:
+    """ Count, sum, minimum and maximum of heart rates per time bucket
+
+    Buckets are kept in columns of typed arrays sorted by their start time,
+    in epoch seconds. Readings normally arrive in time order and update or
+    append the last bucket in O(1). Given keep, buckets that start that many
+    seconds or more before the newest one are dropped, and readings that
+    would fall in them are not counted.
+    When a reading expires and was the minimum or maximum of its bucket,
+    the bucket is marked stale and its minimum and maximum are worked out
+    again the next time the buckets are read.
+    """
+
+    __slots__ = ("seconds", "keep", "starts", "counts", "totals", "minimums",
+                 "maximums", "stale", "rates_between")
+
+    def __init__(self, seconds, keep=None):
+        """ Create an empty rollup
+
+        :param seconds: the length of each bucket in seconds
+        :param keep: the seconds of buckets to keep before the newest one, or
+        None to keep every bucket
+        """
+        self.seconds = seconds
+        self.keep = keep
+        self.starts = array("q")
+        self.counts = array("q")
+        self.totals = array("q")
+        self.minimums = array("q")
+        self.maximums = array("q")
+        self.stale = set()
+        self.rates_between = None
+
+    def add(self, count, total, minimum, maximum, epoch):
+        """ Add the aggregates of readings that fall in one bucket
+
+        :param count: the number of readings
+        :param total: the sum of their heart rates
+        :param minimum: the smallest of their heart rates
+        :param maximum: the largest of their heart rates
+        :param epoch: a time in the bucket, in seconds since 1970-01-01
+        """
+        start = epoch - epoch % self.seconds
+        starts = self.starts
+        if starts and starts[-1] == start:
+            index = len(starts) - 1
+        elif not starts or start > starts[-1]:
+            starts.append(start)
+            self.counts.append(count)
+            self.totals.append(total)
+            self.minimums.append(minimum)
+            self.maximums.append(maximum)
+            if self.keep is not None:
+                self._drop_before(start - self.keep)
+            return
+        elif self.keep is not None and start <= starts[-1] - self.keep:
+            return
+        else:
+            index = bisect_left(starts, start)
+            if starts[index] != start:
+                starts.insert(index, start)
+                self.counts.insert(index, count)
+                self.totals.insert(index, total)
+                self.minimums.insert(index, minimum)
+                self.maximums.insert(index, maximum)
+                return
+        self.counts[index] += count
+        self.totals[index] += total
+        if minimum < self.minimums[index]:
+            self.minimums[index] = minimum
+        if maximum > self.maximums[index]:
+            self.maximums[index] = maximum
+
+    def _drop_before(self, cutoff):
+        dropped = bisect_left(self.starts, cutoff + 1)
+        if dropped == 0:
+            return
+        for start in self.starts[:dropped]:
+            self.stale.discard(start)
+        for column in self.columns():
+            del column[:dropped]
+
+    def columns(self):
+        """ The arrays of the buckets' starts, counts, totals, minimums and
+        maximums, in that order
+        """
+        if self.stale:
+            self._recount()
+        return (self.starts, self.counts, self.totals, self.minimums,
+                self.maximums)
+
+    def restore(self, columns):
+        """ Replace the buckets with ones saved from columns
+
+        :param columns: five arrays("q") as returned by columns
+        """
+        (self.starts, self.counts, self.totals, self.minimums,
+         self.maximums) = columns
+        self.stale.clear()
+
+    def remove(self, heart_rate, epoch, rates_between):
+        """ Take an expired reading out of its bucket
+
+        A bucket whose last reading expires is deleted. If the reading was
+        the bucket's minimum or maximum, the bucket is marked stale.
+
+        :param heart_rate: the expired heart rate
+        :param epoch: the time of the expired reading in epoch seconds
+        :param rates_between: a function of a start and end epoch that
+        returns the heart rates still kept in that range
+        """
+        start = epoch - epoch % self.seconds
+        index = bisect_left(self.starts, start)
+        if index == len(self.starts) or self.starts[index] != start:
+            return
+        if self.counts[index] == 1:
+            self.stale.discard(start)
+            del self.starts[index]
+            del self.counts[index]
+            del self.totals[index]
+            del self.minimums[index]
+            del self.maximums[index]
+            return
+        self.counts[index] -= 1
+        self.totals[index] -= heart_rate
+        if heart_rate in (self.minimums[index], self.maximums[index]):
+            self.stale.add(start)
+            self.rates_between = rates_between
+
+    def _recount(self):
+        # Work out the minimum and maximum of the stale buckets again
+        for start in self.stale:
+            index = bisect_left(self.starts, start)
+            rates = list(self.rates_between(start, start + self.seconds))
+            self.minimums[index] = min(rates)
+            self.maximums[index] = max(rates)
+        self.stale.clear()
+
+    def after(self, epoch):
+        """ List the buckets that end after a given time
+
+        :param epoch: the start of the window in seconds since 1970-01-01
+
+        :returns: a list of (start, count, total, minimum, maximum) tuples in
+        time order. The first bucket may start before the window.
+        """
+        if self.stale:
+            self._recount()
+        first = bisect_left(self.starts, epoch - self.seconds + 1)
+        return list(zip(self.starts[first:], self.counts[first:],
+                        self.totals[first:], self.minimums[first:],
+                        self.maximums[first:]))
+
+
+class Rollups:
+    """ Minute, hour and day rollups of one patient's heart rates
+
+    Each resolution keeps its buckets for KEEP_SECONDS, so the rollups of a
+    patient take a bounded amount of memory however long its history.
+    """
+
+    __slots__ = ("tiers",)
+
+    def __init__(self):
+        self.tiers = {name: Rollup(seconds, KEEP_SECONDS[name])
+                      for name, seconds in RESOLUTIONS.items()}
+
+    def add(self, count, total, minimum, maximum, epoch):
+        """ Add the aggregates of readings taken at the same time
+
+        See Rollup.add for the parameters.
+        """
+        for rollup in self.tiers.values():
+            rollup.add(count, total, minimum, maximum, epoch)
+
+    def remove(self, heart_rate, epoch, rates_between):
+        """ Take an expired reading out of every tier
+
+        See Rollup.remove for the parameters.
+        """
+        for rollup in self.tiers.values():
+            rollup.remove(heart_rate, epoch, rates_between)
+
+    def add_arrays(self, epochs, rates):
+        """ Add many readings in time order
+
+        The readings are grouped into minutes first, so each tier is updated
+        once per minute rather than once per reading.
+
+        :param epochs: an array("q") of sorted epoch seconds
+        :param rates: an array("q") of the heart rates at those times
+        """
+        seconds = RESOLUTIONS["minute"]
+        first = 0
+        while first < len(epochs):
+            epoch = epochs[first]
+            last = bisect_left(epochs, epoch - epoch % seconds + seconds,
+                               first)
+            minute = rates[first:last]
+            self.add(len(minute), sum(minute), min(minute), max(minute),
+                     epoch)
+            first = last
+
+    def frozen(self):
+        """ Copy the buckets for writing a snapshot
+
+        :returns: a list with the copied columns (see Rollup.columns) of
+        each resolution, in the order of RESOLUTIONS
+        """
+        return [tuple(column[:] for column in self.tiers[name].columns())
+                for name in RESOLUTIONS]
+
+    def restore(self, frozen):
+        """ Replace the buckets with ones copied by frozen
+
+        :param frozen: a list like the one frozen returns
+        """
+        for name, columns in zip(RESOLUTIONS, frozen):
+            self.tiers[name].restore(columns)
+
+    def after(self, resolution, epoch):
+        """ List the buckets of one resolution that end after a given time
+
+        :param resolution: "minute", "hour" or "day"
+        :param epoch: the start of the window in seconds since 1970-01-01
+
+        :returns: a list of (start, count, total, minimum, maximum) tuples
+        """
+        return self.tiers[resolution].after(epoch)
+
+    @classmethod
+    def build(cls, epochs, rates):
+        """ Build the rollups of a whole history
+
+        :param epochs: an iterable of sorted epoch seconds
+        :param rates: an iterable of the heart rates at those times
+
+        :returns: new Rollups
+        """
+        rollups = cls()
+        epochs = iter(epochs)
+        rates = iter(rates)
+        while True:
+            epoch_chunk = array("q", islice(epochs, BUILD_CHUNK))
+            if len(epoch_chunk) == 0:
+                return rollups
+            rollups.add_arrays(epoch_chunk,
+                               array("q", islice(rates, BUILD_CHUNK)))
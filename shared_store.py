@@ -0,0 +1,270 @@
+from contextlib import contextmanager
+from multiprocessing.managers import BaseManager
+import os
+import threading
+from metrics import metrics
+from storage import Storage
+
+# The storage methods that worker processes call in the store process
+STORAGE_METHODS = ("add_patients", "add_attendings", "get_patient",
+                   "get_attending", "patients_of", "patient_ids",
+                   "all_attendings", "remove_patients", "add_readings",
+                   "readings", "last_reading", "reading_stats", "sum_after",
+                   "rollups", "clear", "log_position", "shipped_log",
+                   "snapshot_file", "begin", "end", "close")
+
+# The storage, e-mail outbox and worker metrics served by the store
+# process; set by serve
+_served = {}
+
+
+class SharedStorage:
+    """ The storage backend of the store process, as its workers call it
+
+    The store process serves every worker connection on a thread of its
+    own, so a transaction a worker thread starts with begin is held open on
+    that thread until the worker calls end, like a transaction the worker
+    held itself.
+    """
+
+    def __init__(self, storage):
+        """ Wrap an open storage backend
+
+        :param storage: the Storage to serve
+        """
+        self.storage = storage
+        self._local = threading.local()
+
+    def begin(self):
+        """ Start a transaction, or a nested one
+        """
+        transactions = getattr(self._local, "transactions", None)
+        if transactions is None:
+            transactions = self._local.transactions = []
+        transaction = self.storage.transaction()
+        transaction.__enter__()
+        transactions.append(transaction)
+
+    def end(self, failed=False):
+        """ End the innermost transaction started with begin
+
+        :param failed: True to roll the transaction back, where the
+        backend can
+        """
+        transaction = self._local.transactions.pop()
+        if not failed:
+            transaction.__exit__(None, None, None)
+            return
+        error = RuntimeError("the transaction failed in a worker")
+        try:
+            transaction.__exit__(RuntimeError, error, None)
+        except RuntimeError as raised:
+            if raised is not error:
+                raise
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+
+class WorkerMetrics:
+    """ The metrics of every worker, kept by the store process
+
+    Each worker sends a copy of its metrics (see Metrics.export) now and
+    then and whenever it serves /api/metrics, and gets back the latest
+    copies of every worker's and the store process' own, so the metrics it
+    serves cover the whole server whichever worker answers. The copies of a
+    worker that has stopped are kept, so the counts never go down.
+    """
+
+    def __init__(self, registry=metrics):
+        """ Keep the metrics of the workers of a store process
+
+        :param registry: the store process' own Metrics, e.g. with the
+        replication lag of a standby
+        """
+        self.registry = registry
+        self._latest = {}
+        self._lock = threading.Lock()
+
+    def report(self, worker, exported):
+        """ Keep the latest metrics of a worker
+
+        :param worker: an id of the worker, e.g. its process id
+        :param exported: the worker's metrics, as from Metrics.export
+
+        :returns: a list of the latest metrics of every worker and of the
+        store process, as from Metrics.export
+        """
+        with self._lock:
+            self._latest[worker] = exported
+            latest = list(self._latest.values())
+        return latest + [self.registry.export()]
+
+
+def serve(storage, outbox):
+    """ Set what the store process serves to its workers
+
+    Called in the store process, e.g. by the initializer given to
+    start_store.
+
+    :param storage: the open Storage to serve
+    :param outbox: the email_outbox.Outbox the workers queue e-mails in
+    """
+    _served["storage"] = SharedStorage(storage)
+    _served["outbox"] = outbox
+    _served["metrics"] = WorkerMetrics()
+
+
+class StoreManager(BaseManager):
+    """ Connects worker processes to the storage, e-mail outbox and
+    worker metrics of one store process over a local socket
+
+    Only the store process holds the patients, attending physicians and
+    readings, so every worker sees the same data. The workers call it
+    through proxies; every call is a round trip over the socket.
+    """
+
+
+def _storage():
+    return _served["storage"]
+
+
+def _outbox():
+    return _served["outbox"]
+
+
+def _metrics():
+    return _served["metrics"]
+
+
+StoreManager.register("storage", callable=_storage, exposed=STORAGE_METHODS)
+StoreManager.register("outbox", callable=_outbox, exposed=("put",))
+StoreManager.register("metrics", callable=_metrics, exposed=("report",))
+
+
+def new_authkey():
+    """ Make a random key for workers to authenticate to a store process
+    """
+    return os.urandom(32)
+
+
+def start_store(authkey, initializer, initargs=()):
+    """ Start the store process
+
+    :param authkey: the key workers must present, e.g. from new_authkey
+    :param initializer: a function run in the store process before it
+    serves anything, which opens the storage and calls serve
+    :param initargs: the arguments of the initializer
+
+    :returns: the started StoreManager; workers connect to its address
+    """
+    manager = StoreManager(authkey=authkey)
+    manager.start(initializer, initargs)
+    return manager
+
+
+def connect_store(address, authkey):
+    """ Connect to a store process started with start_store
+
+    :param address: the address of the store process
+    :param authkey: the authentication key of the store process
+
+    :returns: a tuple of a RemoteStorage and a proxy of the store's
+    e-mail outbox, whose put method queues an e-mail
+    """
+    manager = StoreManager(address, authkey)
+    manager.connect()
+    return RemoteStorage(manager.storage()), manager.outbox()
+
+
+def connect_metrics(address, authkey):
+    """ Connect to the worker metrics of a store process started with
+    start_store
+
+    :param address: the address of the store process
+    :param authkey: the authentication key of the store process
+
+    :returns: a proxy of the store's WorkerMetrics
+    """
+    manager = StoreManager(address, authkey)
+    manager.connect()
+    return manager.metrics()
+
+
+class RemoteStorage(Storage):
+    """ The storage of a store process, used from a worker process
+
+    Every method is a call to the store process. open and close do nothing,
+    as the store process opens and closes the storage itself.
+    """
+
+    def __init__(self, shared):
+        """ Use a store process' storage
+
+        :param shared: a proxy of the store's SharedStorage
+        """
+        self.shared = shared
+
+    @contextmanager
+    def transaction(self):
+        self.shared.begin()
+        try:
+            yield
+        except BaseException:
+            self.shared.end(True)
+            raise
+        self.shared.end()
+
+    def add_patients(self, patients):
+        return self.shared.add_patients(patients)
+
+    def add_attendings(self, attendings):
+        self.shared.add_attendings(attendings)
+
+    def get_patient(self, patient_id):
+        return self.shared.get_patient(patient_id)
+
+    def get_attending(self, attending_username):
+        return self.shared.get_attending(attending_username)
+
+    def patients_of(self, attending_username):
+        return self.shared.patients_of(attending_username)
+
+    def patient_ids(self):
+        return self.shared.patient_ids()
+
+    def all_attendings(self):
+        return self.shared.all_attendings()
+
+    def remove_patients(self, patient_ids):
+        self.shared.remove_patients(patient_ids)
+
+    def add_readings(self, patient_id, heart_rates, timestamp):
+        return self.shared.add_readings(patient_id, heart_rates, timestamp)
+
+    def readings(self, patient_id):
+        return self.shared.readings(patient_id)
+
+    def last_reading(self, patient_id):
+        return self.shared.last_reading(patient_id)
+
+    def reading_stats(self, patient_id):
+        return self.shared.reading_stats(patient_id)
+
+    def sum_after(self, patient_id, epoch):
+        return self.shared.sum_after(patient_id, epoch)
+
+    def rollups(self, patient_id, resolution, epoch):
+        return self.shared.rollups(patient_id, resolution, epoch)
+
+    def clear(self):
+        self.shared.clear()
+
+    def log_position(self):
+        return self.shared.log_position()
+
+    def shipped_log(self, generation, offset, wait=0):
+        return self.shared.shipped_log(generation, offset, wait)
+
+    def snapshot_file(self):
+        return self.shared.snapshot_file()
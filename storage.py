@@ -0,0 +1,1068 @@
+from contextlib import contextmanager
+from math import sqrt
+import os
+import sqlite3
+import threading
+from registry import Registry
+from lock_stripes import STRIPES, LockStripes
+from cold_tier import ColdTier
+from ring_series import RingSeries
+from rollups import RESOLUTIONS
+from hr_series import HeartRateSeries, format_epoch, to_epoch
+from records import ATTENDING_KEYS, PATIENT_KEYS, RETENTION_KEYS, \
+    AttendingRecord, PatientRecord
+from wal import WriteAheadLog
+
+# Width of the time partitions of the SQLite backend's readings: one day
+PARTITION_SECONDS = 86400
+# Times the in-memory storage reads a newer snapshot of a patient's
+# readings, when the one it read was overwritten meanwhile, before it holds
+# the patient's stripe instead
+SNAPSHOT_ATTEMPTS = 3
+
+
+def patient_record(patient):
+    """ Copy the stored keys of a patient dictionary
+
+    :param patient: a patient dictionary
+
+    :returns: a dictionary with the keys in PATIENT_KEYS, and the keys in
+    RETENTION_KEYS that the patient has and are not None
+    """
+    record = {key: patient[key] for key in PATIENT_KEYS}
+    for key in RETENTION_KEYS:
+        if patient.get(key) is not None:
+            record[key] = patient[key]
+    return record
+
+
+def summarize(count, total, minimum, maximum, sum_squares):
+    """ Turn running aggregates of heart rates into summary statistics
+
+    The variance is worked out from the count, sum and sum of squares with
+    integer arithmetic, so it is exact before the square root.
+
+    :returns: a dictionary in the format
+        {"count": 3, "average": 110.0, "min": 100, "max": 120,
+         "stddev": 8.16}
+    or None if there are no readings
+    """
+    if count == 0:
+        return None
+    return {"count": count,
+            "average": total / count,
+            "min": minimum,
+            "max": maximum,
+            "stddev": sqrt(count * sum_squares - total * total) / count}
+
+
+class Storage:
+    """ Interface of the storage backends for patients, attending
+    physicians and heart rate readings
+
+    Patients and attending physicians are passed in and returned as plain
+    dictionaries with the keys in PATIENT_KEYS and ATTENDING_KEYS, and
+    patients also with any of the keys in RETENTION_KEYS. Adding an
+    attending physician with an existing key replaces it; adding a patient
+    with an existing patient_id does nothing, and the existing patient
+    keeps its readings (see add_patients).
+    Readings outside a patient's retention (or the storage's default
+    retention) are dropped as new readings are added, and no longer count
+    towards any statistic. Heart rates are returned
+    in time order, and timestamps as "%Y-%m-%d %H:%M:%S" strings.
+    Every change is durable once the method that made it returns, or once
+    the outermost transaction around it ends.
+    """
+
+    def open(self):
+        """ Open or recover the stored data
+
+        :returns: the number of log records replayed, or 0
+        """
+        return 0
+
+    def close(self):
+        """ Make every change durable and release files and connections
+        """
+
+    @contextmanager
+    def transaction(self):
+        """ Group several changes so they are made durable together
+        """
+        yield
+
+    def add_patients(self, patients):
+        """ Add new patients
+
+        A patient whose patient_id already exists, or comes earlier in the
+        list, is not added: the existing patient and its readings are kept
+        as they are.
+
+        :param patients: a list of patient dictionaries
+
+        :returns: the patient_id of every patient that was not added
+        """
+        raise NotImplementedError
+
+    def add_attendings(self, attendings):
+        """ Add or replace attending physicians
+
+        :param attendings: a list of attending physician dictionaries
+        """
+        raise NotImplementedError
+
+    def get_patient(self, patient_id):
+        """ Look up a patient
+
+        :returns: the patient dictionary, or None if there is no such patient
+        """
+        raise NotImplementedError
+
+    def get_attending(self, attending_username):
+        """ Look up an attending physician
+
+        :returns: the attending physician dictionary, or None
+        """
+        raise NotImplementedError
+
+    def patients_of(self, attending_username):
+        """ List the patients of one attending physician
+
+        :returns: a list of patient dictionaries, in the order they were
+        added (the order of a patient moved from another physician may
+        differ between backends)
+        """
+        raise NotImplementedError
+
+    def patient_ids(self):
+        """ List the patient_id of every patient
+
+        :returns: a list of integers
+        """
+        raise NotImplementedError
+
+    def all_attendings(self):
+        """ List every attending physician
+
+        :returns: a list of attending physician dictionaries
+        """
+        raise NotImplementedError
+
+    def remove_patients(self, patient_ids):
+        """ Remove patients together with their readings
+
+        Patients that do not exist are ignored.
+
+        :param patient_ids: a list of patient_id integers
+        """
+        raise NotImplementedError
+
+    def add_readings(self, patient_id, heart_rates, timestamp):
+        """ Add heart rate readings taken at the same time to a patient
+
+        :param patient_id: the patient_id as an integer
+        :param heart_rates: a list of heart rates as integers
+        :param timestamp: the time of the readings as a datetime
+
+        :returns: True, or False if there is no such patient
+        """
+        raise NotImplementedError
+
+    def readings(self, patient_id):
+        """ List every reading of a patient
+
+        :returns: a list of heart rates and a list of timestamps
+        """
+        raise NotImplementedError
+
+    def last_reading(self, patient_id):
+        """ Find the latest reading of a patient
+
+        :returns: a tuple of the heart rate and the timestamp, or None if
+        the patient has no readings
+        """
+        raise NotImplementedError
+
+    def reading_stats(self, patient_id):
+        """ Summary statistics of a patient's heart rates
+
+        :returns: a dictionary as returned by summarize, or None if the
+        patient has no readings
+        """
+        raise NotImplementedError
+
+    def sum_after(self, patient_id, epoch):
+        """ Count and sum the heart rates of a patient after a given time
+
+        :param patient_id: the patient_id as an integer
+        :param epoch: the start of the window in seconds since 1970-01-01.
+        Readings taken exactly at this time are not included.
+
+        :returns: a tuple of the number of readings and their sum
+        """
+        raise NotImplementedError
+
+    def rollups(self, patient_id, resolution, epoch):
+        """ Per-bucket aggregates of a patient's heart rates
+
+        :param patient_id: the patient_id as an integer
+        :param resolution: "minute", "hour" or "day"
+        :param epoch: the start of the window in seconds since 1970-01-01
+
+        :returns: a list of (start, count, total, minimum, maximum) tuples,
+        one for each bucket that ends after the start of the window, in time
+        order; start is the epoch seconds at which the bucket begins
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """ Remove every patient, attending physician and reading
+        """
+        raise NotImplementedError
+
+    def log_position(self):
+        """ The end of the change log on disk, for a standby server to
+        compare its own with (see replication.py)
+
+        :returns: a tuple of the log segment's generation and its length
+        """
+        raise NotImplementedError("Only the memory storage ships its log")
+
+    def shipped_log(self, generation, offset, wait=0):
+        """ Read the change log written after a position, for a standby
+        server to apply
+
+        :param generation: the generation of the log segment to read from
+        :param offset: the number of bytes of that segment already read
+        :param wait: seconds to wait for more changes when there are none
+
+        :returns: a tuple of the bytes read, True if they end the segment,
+        and the number of bytes logged after them
+
+        :raises LookupError: if the standby has to load a snapshot instead
+        :raises ValueError: if the position is past the end of the log
+        """
+        raise NotImplementedError("Only the memory storage ships its log")
+
+    def snapshot_file(self):
+        """ Find the latest snapshot of the data, for a standby server to
+        start from
+
+        :returns: the absolute path of the snapshot file
+        """
+        raise NotImplementedError("Only the memory storage ships its log")
+
+
+class MemoryStorage(Storage):
+    """ Keeps everything in memory, logged to disk by a WriteAheadLog
+
+    Patients are kept in a Registry grouped by attending physician, and each
+    patient's readings in a HeartRateSeries, so lookups are dictionary
+    lookups and every statistic and interval average comes from running
+    aggregates or a binary search. Patients and attending physicians are
+    stored as PatientRecord and AttendingRecord objects (see records.py),
+    readings are added to the patient's series in place, and dictionaries
+    are only built for the values returned.
+    Readings are added while holding the patient's stripe of a
+    LockStripes, so requests for different patients run in parallel and
+    requests for the same patient one at a time. Adding patients or
+    attending physicians, clearing and taking a snapshot hold every stripe.
+    Readings are read from the immutable snapshot that the patient's series
+    publishes after every change (see SeriesSnapshot and RingSnapshot),
+    without taking a lock, so a long read never holds up the readings being
+    added meanwhile and always sees the readings as they were at one
+    moment.
+    With a directory, only the latest hot_readings readings of each patient
+    stay in memory; older ones are moved to memory-mapped files in the
+    "cold" subfolder (see cold_tier.py) and read from there by the same
+    queries.
+    The readings of a patient with a retention are kept in a RingSeries
+    instead (see ring_series.py), which is never moved to the cold tier.
+    A storage can also be kept as a standby copy of another server's by
+    applying the log that server ships (see receive_log and replication.py)
+    instead of making changes of its own.
+    """
+
+    def __init__(self, directory=None, snapshot_every=500000,
+                 hot_readings=4096, retention_readings=None,
+                 retention_seconds=None, stripes=STRIPES):
+        """ Create an empty in-memory storage
+
+        :param directory: the folder for the write-ahead log and snapshots,
+        or None to keep nothing on disk
+        :param snapshot_every: the number of logged changes between two
+        snapshots
+        :param hot_readings: the number of latest readings of each patient
+        kept in memory, or None to keep every reading in memory
+        :param retention_readings: the default number of latest readings
+        kept for each patient, or None to keep them all
+        :param retention_seconds: by default drop the readings taken more
+        than this many seconds before a patient's latest reading, or None
+        :param stripes: the number of locks shared out between the patients
+        """
+        self.directory = directory
+        self.retention_readings = retention_readings
+        self.retention_seconds = retention_seconds
+        self.patients = Registry("patient_id", group_by="attending_username",
+                                 record_type=PatientRecord)
+        self.attendings = Registry("attending_username",
+                                   record_type=AttendingRecord)
+        self.cold = None
+        if directory is not None and hot_readings is not None:
+            self.cold = ColdTier(os.path.join(directory, "cold"),
+                                 hot_readings)
+        self.stripes = LockStripes(stripes)
+        self.wal = WriteAheadLog(directory, self.patients, self.attendings,
+                                 snapshot_every=snapshot_every,
+                                 new_series=self._new_series,
+                                 lock=self.stripes)
+        self._local = threading.local()
+
+    def _new_series(self, patient):
+        max_readings = patient.get("retention_readings",
+                                   self.retention_readings)
+        max_age = patient.get("retention_seconds", self.retention_seconds)
+        if max_readings is not None or max_age is not None:
+            return RingSeries(max_readings, max_age)
+        if self.cold is None:
+            return HeartRateSeries()
+        return HeartRateSeries(self.cold.history(patient["patient_id"]))
+
+    def open(self):
+        if self.directory is None:
+            return 0
+        if self.cold is not None:
+            self.cold.open()
+        return self.wal.open()
+
+    def close(self):
+        self.wal.close()
+
+    @contextmanager
+    def transaction(self):
+        # Changes are applied straight away; the outermost transaction of
+        # each thread waits for the log to reach the disk once at the end
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                self.wal.commit()
+
+    def add_patients(self, patients):
+        records = [PatientRecord.from_dict(patient) for patient in patients]
+        added = {}
+        existing = []
+        with self.transaction(), self.wal.lock:
+            for record in records:
+                patient_id = record["patient_id"]
+                if patient_id in self.patients or patient_id in added:
+                    existing.append(patient_id)
+                    continue
+                self.wal.log_patient(record)
+                added[patient_id] = record
+            self.patients.extend(added.values())
+        return existing
+
+    def add_attendings(self, attendings):
+        records = [AttendingRecord.from_dict(attending)
+                   for attending in attendings]
+        with self.transaction(), self.wal.lock:
+            for record in records:
+                self.wal.log_attending(record)
+            self.attendings.extend(records)
+
+    def get_patient(self, patient_id):
+        patient = self.patients.get(patient_id)
+        if patient is None:
+            return None
+        return patient.to_dict()
+
+    def get_attending(self, attending_username):
+        attending = self.attendings.get(attending_username)
+        if attending is None:
+            return None
+        return attending.to_dict()
+
+    def patients_of(self, attending_username):
+        return [patient.to_dict()
+                for patient in self.patients.group(attending_username)]
+
+    def patient_ids(self):
+        return self.patients.keys()
+
+    def all_attendings(self):
+        return [attending.to_dict() for attending in self.attendings.values()]
+
+    def remove_patients(self, patient_ids):
+        with self.transaction(), self.wal.lock:
+            for patient_id in patient_ids:
+                self.wal.log_removal(patient_id)
+                self._retire(self.patients.remove(patient_id))
+                if self.cold is not None:
+                    self.cold.remove(patient_id)
+
+    def add_readings(self, patient_id, heart_rates, timestamp):
+        with self.transaction(), self.stripes.stripe(patient_id):
+            patient = self.patients.get(patient_id)
+            if patient is None:
+                return False
+            series = patient.series
+            if series is None:
+                series = patient.series = self._new_series(patient)
+            # Applied before it is logged, so readings the series refuses
+            # never reach the log, where they would stop it being replayed
+            series.extend(heart_rates, timestamp)
+            self.wal.log_readings(patient_id, heart_rates, timestamp)
+        return True
+
+    def _retire(self, patient):
+        # A patient that is removed or cleared gets a new series, whose
+        # cold file replaces the old one, so snapshots of the old series
+        # must stop reading it
+        if patient is not None and patient.series is not None and \
+                patient.series.cold is not None:
+            patient.series.cold.retire()
+
+    def _series(self, patient_id):
+        patient = self.patients.get(patient_id)
+        if patient is None:
+            return None
+        return patient.series
+
+    def _snapshot(self, patient_id):
+        series = self._series(patient_id)
+        if series is None:
+            return None
+        return series.snapshot
+
+    def _read(self, patient_id, read, default):
+        # Calls read with the patient's latest snapshot until it does not
+        # return None. Only a few tries are made without a lock; holding the
+        # stripe keeps the snapshot from being overwritten
+        for _ in range(SNAPSHOT_ATTEMPTS):
+            snapshot = self._snapshot(patient_id)
+            if snapshot is None:
+                return default
+            result = read(snapshot)
+            if result is not None:
+                return result
+        with self.stripes.stripe(patient_id):
+            snapshot = self._snapshot(patient_id)
+            if snapshot is None:
+                return default
+            return read(snapshot)
+
+    def readings(self, patient_id):
+        heart_rates, epochs = self._read(
+            patient_id, lambda snapshot: snapshot.readings(), ([], []))
+        return heart_rates, list(map(format_epoch, epochs))
+
+    def last_reading(self, patient_id):
+        snapshot = self._snapshot(patient_id)
+        latest = None if snapshot is None else snapshot.latest()
+        if latest is None:
+            return None
+        return latest[0], format_epoch(latest[1])
+
+    def reading_stats(self, patient_id):
+        snapshot = self._snapshot(patient_id)
+        if snapshot is None:
+            return None
+        return summarize(len(snapshot), snapshot.total(), snapshot.minimum,
+                         snapshot.maximum, snapshot.sum_squares)
+
+    def sum_after(self, patient_id, epoch):
+        return self._read(patient_id,
+                          lambda snapshot: snapshot.sum_after(epoch), (0, 0))
+
+    def rollups(self, patient_id, resolution, epoch):
+        # The rollups are updated in place as readings are added, so they are
+        # read under the stripe; each resolution keeps a bounded number of
+        # buckets
+        with self.stripes.stripe(patient_id):
+            series = self._series(patient_id)
+            if series is None:
+                return []
+            return series.get_rollups().after(resolution, epoch)
+
+    def clear(self):
+        with self.wal.lock:
+            for patient in self.patients:
+                self._retire(patient)
+            self.patients.clear()
+            self.attendings.clear()
+            if self.cold is not None:
+                self.cold.clear()
+
+    def log_position(self):
+        return self.wal.position()
+
+    def shipped_log(self, generation, offset, wait=0):
+        return self.wal.shipped(generation, offset, wait=wait)
+
+    def snapshot_file(self):
+        return self.wal.shipped_snapshot()
+
+    def receive_log(self, generation, data):
+        """ Apply changes shipped from the log of a primary server
+
+        :param generation: the generation of the primary's log segment
+        :param data: the bytes of the segment that follow the ones received
+        before
+
+        :returns: the number of changes applied
+        """
+        return self.wal.receive(generation, data)
+
+    def restore_snapshot(self, snapshot):
+        """ Replace everything with a snapshot shipped by a primary server
+
+        :param snapshot: a binary file object holding the snapshot
+        """
+        with self.wal.lock:
+            self.clear()
+            self.wal.restore(snapshot)
+
+    def end_replication(self):
+        """ Stop applying a primary's changes and start making changes
+        """
+        self.wal.end_replication()
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS attendings (
+    attending_username TEXT PRIMARY KEY,
+    attending_email TEXT,
+    attending_phone TEXT
+);
+CREATE TABLE IF NOT EXISTS patients (
+    id INTEGER PRIMARY KEY,
+    patient_id INTEGER NOT NULL UNIQUE,
+    attending_username TEXT,
+    patient_age INTEGER,
+    retention_readings INTEGER,
+    retention_seconds INTEGER
+);
+CREATE INDEX IF NOT EXISTS patients_attending
+    ON patients (attending_username);
+CREATE TABLE IF NOT EXISTS readings (
+    patient_id INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    heart_rate INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS readings_patient_time
+    ON readings (patient_id, timestamp);
+CREATE TABLE IF NOT EXISTS reading_partitions (
+    patient_id INTEGER NOT NULL,
+    partition_number INTEGER NOT NULL,
+    first_timestamp INTEGER NOT NULL,
+    last_timestamp INTEGER NOT NULL,
+    reading_count INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    minimum INTEGER NOT NULL,
+    maximum INTEGER NOT NULL,
+    sum_squares INTEGER NOT NULL,
+    PRIMARY KEY (patient_id, partition_number)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS reading_rollups (
+    patient_id INTEGER NOT NULL,
+    seconds INTEGER NOT NULL,
+    bucket_start INTEGER NOT NULL,
+    reading_count INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    minimum INTEGER NOT NULL,
+    maximum INTEGER NOT NULL,
+    PRIMARY KEY (patient_id, seconds, bucket_start)
+) WITHOUT ROWID;
+"""
+
+# The SQL text of each statement is a constant, so sqlite3's per-connection
+# statement cache prepares it once and reuses it for every later call
+UPSERT_ATTENDING = """
+INSERT INTO attendings (attending_username, attending_email, attending_phone)
+VALUES (?, ?, ?)
+ON CONFLICT (attending_username) DO UPDATE SET
+    attending_email = excluded.attending_email,
+    attending_phone = excluded.attending_phone
+"""
+INSERT_PATIENT = """
+INSERT INTO patients (patient_id, attending_username, patient_age,
+    retention_readings, retention_seconds)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (patient_id) DO NOTHING
+"""
+DELETE_READINGS = "DELETE FROM readings WHERE patient_id = ?"
+DELETE_PARTITIONS = "DELETE FROM reading_partitions WHERE patient_id = ?"
+DELETE_ROLLUPS = "DELETE FROM reading_rollups WHERE patient_id = ?"
+SELECT_PATIENT = """
+SELECT patient_id, attending_username, patient_age, retention_readings,
+       retention_seconds
+FROM patients WHERE patient_id = ?
+"""
+SELECT_ATTENDING = """
+SELECT attending_username, attending_email, attending_phone FROM attendings
+WHERE attending_username = ?
+"""
+SELECT_PATIENT_IDS = "SELECT patient_id FROM patients ORDER BY id"
+SELECT_ATTENDINGS = """
+SELECT attending_username, attending_email, attending_phone FROM attendings
+"""
+DELETE_PATIENT = "DELETE FROM patients WHERE patient_id = ?"
+SELECT_PATIENTS_OF = """
+SELECT patient_id, attending_username, patient_age, retention_readings,
+       retention_seconds
+FROM patients WHERE attending_username = ? ORDER BY id
+"""
+INSERT_READING = """
+INSERT INTO readings (patient_id, timestamp, heart_rate) VALUES (?, ?, ?)
+"""
+SELECT_READINGS = """
+SELECT heart_rate, timestamp FROM readings WHERE patient_id = ?
+ORDER BY timestamp, rowid
+"""
+SELECT_LAST_READING = """
+SELECT heart_rate, timestamp FROM readings WHERE patient_id = ?
+ORDER BY timestamp DESC, rowid DESC LIMIT 1
+"""
+UPSERT_PARTITION = """
+INSERT INTO reading_partitions (patient_id, partition_number,
+    first_timestamp, last_timestamp, reading_count, total, minimum, maximum,
+    sum_squares)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (patient_id, partition_number) DO UPDATE SET
+    first_timestamp = MIN(first_timestamp, excluded.first_timestamp),
+    last_timestamp = MAX(last_timestamp, excluded.last_timestamp),
+    reading_count = reading_count + excluded.reading_count,
+    total = total + excluded.total,
+    minimum = MIN(minimum, excluded.minimum),
+    maximum = MAX(maximum, excluded.maximum),
+    sum_squares = sum_squares + excluded.sum_squares
+"""
+# Builds the partitions of a database created before they existed. SQLite
+# divides towards zero, so timestamps before 1970 are moved down by one to
+# round towards minus infinity like Python's //
+FILL_PARTITIONS = """
+INSERT INTO reading_partitions
+SELECT patient_id, timestamp / {seconds} - (timestamp % {seconds} < 0),
+       MIN(timestamp), MAX(timestamp), COUNT(*), SUM(heart_rate),
+       MIN(heart_rate), MAX(heart_rate), SUM(heart_rate * heart_rate)
+FROM readings GROUP BY 1, 2
+""".format(seconds=PARTITION_SECONDS)
+UPSERT_ROLLUP = """
+INSERT INTO reading_rollups (patient_id, seconds, bucket_start,
+    reading_count, total, minimum, maximum)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (patient_id, seconds, bucket_start) DO UPDATE SET
+    reading_count = reading_count + excluded.reading_count,
+    total = total + excluded.total,
+    minimum = MIN(minimum, excluded.minimum),
+    maximum = MAX(maximum, excluded.maximum)
+"""
+# Builds one resolution of the rollups of a database created before they
+# existed; like FILL_PARTITIONS, rounds timestamps before 1970 down
+FILL_ROLLUPS = """
+INSERT INTO reading_rollups
+SELECT patient_id, {seconds},
+       timestamp - ((timestamp % {seconds}) + {seconds}) % {seconds},
+       COUNT(*), SUM(heart_rate), MIN(heart_rate), MAX(heart_rate)
+FROM readings GROUP BY 1, 3
+"""
+SELECT_ROLLUPS = """
+SELECT bucket_start, reading_count, total, minimum, maximum
+FROM reading_rollups
+WHERE patient_id = ? AND seconds = ? AND bucket_start > ?
+ORDER BY bucket_start
+"""
+SELECT_STATS = """
+SELECT SUM(reading_count), SUM(total), MIN(minimum), MAX(maximum),
+       SUM(sum_squares)
+FROM reading_partitions WHERE patient_id = ?
+"""
+SELECT_COUNT = """
+SELECT TOTAL(reading_count) FROM reading_partitions WHERE patient_id = ?
+"""
+SELECT_NEWEST = "SELECT MAX(timestamp) FROM readings WHERE patient_id = ?"
+# Expired readings are deleted through the (patient_id, timestamp) index,
+# and returned so the partitions and rollups can be updated without scanning
+# the readings they still hold
+DELETE_BEFORE = """
+DELETE FROM readings WHERE patient_id = ? AND timestamp < ?
+RETURNING timestamp, heart_rate
+"""
+DELETE_OLDEST = """
+DELETE FROM readings WHERE rowid IN (
+    SELECT rowid FROM readings WHERE patient_id = ?
+    ORDER BY timestamp, rowid LIMIT ?)
+RETURNING timestamp, heart_rate
+"""
+# The first timestamp of a partition is looked up in the index again; the
+# minimum and maximum are only worked out again by RECOUNT_PARTITION when an
+# expired reading was one of them
+EXPIRE_PARTITION = """
+UPDATE reading_partitions SET
+    reading_count = reading_count - ?3,
+    total = total - ?4,
+    sum_squares = sum_squares - ?5,
+    first_timestamp = COALESCE((
+        SELECT MIN(timestamp) FROM readings
+        WHERE patient_id = ?1 AND timestamp >= ?2 * {seconds}
+            AND timestamp < (?2 + 1) * {seconds}),
+        first_timestamp)
+WHERE patient_id = ?1 AND partition_number = ?2
+RETURNING reading_count, minimum, maximum
+""".format(seconds=PARTITION_SECONDS)
+RECOUNT_PARTITION = """
+UPDATE reading_partitions SET (minimum, maximum) = (
+    SELECT MIN(heart_rate), MAX(heart_rate) FROM readings
+    WHERE patient_id = ?1 AND timestamp >= ?2 * {seconds}
+        AND timestamp < (?2 + 1) * {seconds})
+WHERE patient_id = ?1 AND partition_number = ?2
+""".format(seconds=PARTITION_SECONDS)
+DELETE_PARTITION = """
+DELETE FROM reading_partitions WHERE patient_id = ? AND partition_number = ?
+"""
+EXPIRE_ROLLUP = """
+UPDATE reading_rollups SET
+    reading_count = reading_count - ?4,
+    total = total - ?5
+WHERE patient_id = ?1 AND seconds = ?2 AND bucket_start = ?3
+RETURNING reading_count, minimum, maximum
+"""
+RECOUNT_ROLLUP = """
+UPDATE reading_rollups SET (minimum, maximum) = (
+    SELECT MIN(heart_rate), MAX(heart_rate) FROM readings
+    WHERE patient_id = ?1 AND timestamp >= ?3 AND timestamp < ?3 + ?2)
+WHERE patient_id = ?1 AND seconds = ?2 AND bucket_start = ?3
+"""
+DELETE_ROLLUP = """
+DELETE FROM reading_rollups
+WHERE patient_id = ? AND seconds = ? AND bucket_start = ?
+"""
+# Partitions after the one holding the start of the window are added up from
+# their aggregates; only the readings of that one partition are scanned
+SELECT_SUM_AFTER = """
+SELECT SUM(reading_count), SUM(total) FROM (
+    SELECT reading_count, total FROM reading_partitions
+    WHERE patient_id = ? AND partition_number > ?
+    UNION ALL
+    SELECT COUNT(*), TOTAL(heart_rate) FROM readings
+    WHERE patient_id = ? AND timestamp > ? AND timestamp < ?
+)
+"""
+
+
+def group_expired(expired, seconds):
+    """ Aggregate expired readings by the time bucket they were in
+
+    :param expired: a list of (epoch, heart_rate) tuples
+    :param seconds: the length of the buckets in seconds
+
+    :returns: a dictionary from the bucket number (the start of the bucket
+    divided by seconds) to a list of the count, sum, sum of squares,
+    minimum and maximum of the expired heart rates in the bucket
+    """
+    groups = {}
+    for epoch, heart_rate in expired:
+        group = groups.get(epoch // seconds)
+        if group is None:
+            group = groups[epoch // seconds] = [0, 0, 0, heart_rate,
+                                                heart_rate]
+        group[0] += 1
+        group[1] += heart_rate
+        group[2] += heart_rate * heart_rate
+        group[3] = min(group[3], heart_rate)
+        group[4] = max(group[4], heart_rate)
+    return groups
+
+
+class SQLiteStorage(Storage):
+    """ Keeps everything in an SQLite database file
+
+    The database runs in WAL journal mode, so requests that read do not
+    block the request that writes. Each thread gets its own connection.
+    Readings are indexed on (patient_id, timestamp), and statistics and
+    interval averages are computed by SQL aggregates rather than by loading
+    the readings into Python.
+    Each patient's readings are also split into daily partitions, whose
+    first and last timestamp, count, sum, minimum, maximum and sum of
+    squares are kept in reading_partitions and updated with every reading.
+    Statistics add up the partitions, and an interval average adds up the
+    partitions inside the window and scans only the readings of the
+    partition where it starts, so neither reads the whole history.
+    Minute, hour and day rollups are kept the same way in reading_rollups.
+    Readings outside a patient's retention are deleted when readings are
+    added, and subtracted from the partitions and rollups they were in.
+    """
+
+    def __init__(self, path, fsync=True, retention_readings=None,
+                 retention_seconds=None):
+        """ Create a storage for an SQLite database file
+
+        :param path: the path of the database file
+        :param fsync: False to let SQLite skip the fsync at the end of each
+        transaction (synchronous=NORMAL), which can lose the latest changes
+        if the machine crashes
+        :param retention_readings: the default number of latest readings
+        kept for each patient, or None to keep them all
+        :param retention_seconds: by default drop the readings taken more
+        than this many seconds before a patient's latest reading, or None
+        """
+        self.path = path
+        self.fsync = fsync
+        self.retention_readings = retention_readings
+        self.retention_seconds = retention_seconds
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = {}".format(
+                "FULL" if self.fsync else "NORMAL"))
+            self._local.connection = connection
+            self._local.depth = 0
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        tables = {name for name, in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")}
+        connection.executescript(SQLITE_SCHEMA)
+        columns = {row[1] for row in connection.execute(
+            "PRAGMA table_info(patients)")}
+        for key in RETENTION_KEYS:
+            if key not in columns:
+                connection.execute(
+                    "ALTER TABLE patients ADD COLUMN {} INTEGER".format(key))
+        if "reading_partitions" not in tables:
+            connection.execute(FILL_PARTITIONS)
+        if "reading_rollups" not in tables:
+            for seconds in RESOLUTIONS.values():
+                connection.execute(FILL_ROLLUPS.format(seconds=seconds))
+        return 0
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    @contextmanager
+    def transaction(self):
+        connection = self._connection()
+        depth = self._local.depth
+        if depth == 0:
+            connection.execute("BEGIN IMMEDIATE")
+        self._local.depth = depth + 1
+        try:
+            yield connection
+        except BaseException:
+            self._local.depth = depth
+            if depth == 0:
+                connection.execute("ROLLBACK")
+            raise
+        self._local.depth = depth
+        if depth == 0:
+            connection.execute("COMMIT")
+
+    def add_patients(self, patients):
+        existing = []
+        with self.transaction() as connection:
+            for patient in patients:
+                row = tuple(patient.get(key)
+                            for key in PATIENT_KEYS + RETENTION_KEYS)
+                if connection.execute(INSERT_PATIENT, row).rowcount == 0:
+                    existing.append(row[0])
+        return existing
+
+    def add_attendings(self, attendings):
+        rows = [tuple(attending[key] for key in ATTENDING_KEYS)
+                for attending in attendings]
+        with self.transaction() as connection:
+            connection.executemany(UPSERT_ATTENDING, rows)
+
+    def get_patient(self, patient_id):
+        row = self._connection().execute(SELECT_PATIENT,
+                                         (patient_id,)).fetchone()
+        if row is None:
+            return None
+        return patient_record(dict(zip(PATIENT_KEYS + RETENTION_KEYS, row)))
+
+    def get_attending(self, attending_username):
+        row = self._connection().execute(SELECT_ATTENDING,
+                                         (attending_username,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(ATTENDING_KEYS, row))
+
+    def patients_of(self, attending_username):
+        rows = self._connection().execute(SELECT_PATIENTS_OF,
+                                          (attending_username,))
+        return [patient_record(dict(zip(PATIENT_KEYS + RETENTION_KEYS, row)))
+                for row in rows]
+
+    def patient_ids(self):
+        return [row[0] for row in
+                self._connection().execute(SELECT_PATIENT_IDS)]
+
+    def all_attendings(self):
+        return [dict(zip(ATTENDING_KEYS, row))
+                for row in self._connection().execute(SELECT_ATTENDINGS)]
+
+    def remove_patients(self, patient_ids):
+        rows = [(patient_id,) for patient_id in patient_ids]
+        with self.transaction() as connection:
+            for statement in (DELETE_READINGS, DELETE_PARTITIONS,
+                              DELETE_ROLLUPS, DELETE_PATIENT):
+                connection.executemany(statement, rows)
+
+    def add_readings(self, patient_id, heart_rates, timestamp):
+        epoch = to_epoch(timestamp)
+        with self.transaction() as connection:
+            patient = connection.execute(SELECT_PATIENT,
+                                         (patient_id,)).fetchone()
+            if patient is None:
+                return False
+            if len(heart_rates) == 0:
+                return True
+            connection.executemany(INSERT_READING,
+                                   [(patient_id, epoch, heart_rate)
+                                    for heart_rate in heart_rates])
+            count = len(heart_rates)
+            total = sum(heart_rates)
+            minimum = min(heart_rates)
+            maximum = max(heart_rates)
+            connection.execute(UPSERT_PARTITION, (
+                patient_id, epoch // PARTITION_SECONDS, epoch, epoch, count,
+                total, minimum, maximum,
+                sum(rate * rate for rate in heart_rates)))
+            connection.executemany(UPSERT_ROLLUP, [
+                (patient_id, seconds, epoch - epoch % seconds, count, total,
+                 minimum, maximum) for seconds in RESOLUTIONS.values()])
+            max_readings, max_age = patient[3:]
+            if max_readings is None:
+                max_readings = self.retention_readings
+            if max_age is None:
+                max_age = self.retention_seconds
+            if max_readings is not None or max_age is not None:
+                self._expire(connection, patient_id, max_readings, max_age)
+        return True
+
+    def _expire(self, connection, patient_id, max_readings, max_age):
+        # Delete the readings outside the patient's retention, then take
+        # them out of the aggregates of their partitions and rollups
+        expired = []
+        if max_age is not None:
+            newest, = connection.execute(SELECT_NEWEST,
+                                         (patient_id,)).fetchone()
+            expired += connection.execute(
+                DELETE_BEFORE, (patient_id, newest - max_age)).fetchall()
+        if max_readings is not None:
+            count, = connection.execute(SELECT_COUNT,
+                                        (patient_id,)).fetchone()
+            excess = int(count) - len(expired) - max_readings
+            if excess > 0:
+                expired += connection.execute(
+                    DELETE_OLDEST, (patient_id, excess)).fetchall()
+        if not expired:
+            return
+        for number, (count, total, squares, low, high) in group_expired(
+                expired, PARTITION_SECONDS).items():
+            key = (patient_id, number)
+            left, minimum, maximum = connection.execute(
+                EXPIRE_PARTITION, key + (count, total, squares)).fetchone()
+            if left == 0:
+                connection.execute(DELETE_PARTITION, key)
+            elif low == minimum or high == maximum:
+                connection.execute(RECOUNT_PARTITION, key)
+        for seconds in RESOLUTIONS.values():
+            for number, (count, total, _, low, high) in group_expired(
+                    expired, seconds).items():
+                key = (patient_id, seconds, number * seconds)
+                left, minimum, maximum = connection.execute(
+                    EXPIRE_ROLLUP, key + (count, total)).fetchone()
+                if left == 0:
+                    connection.execute(DELETE_ROLLUP, key)
+                elif low == minimum or high == maximum:
+                    connection.execute(RECOUNT_ROLLUP, key)
+
+    def readings(self, patient_id):
+        rows = self._connection().execute(SELECT_READINGS,
+                                          (patient_id,)).fetchall()
+        return ([heart_rate for heart_rate, _ in rows],
+                [format_epoch(epoch) for _, epoch in rows])
+
+    def last_reading(self, patient_id):
+        row = self._connection().execute(SELECT_LAST_READING,
+                                         (patient_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0], format_epoch(row[1])
+
+    def reading_stats(self, patient_id):
+        count, total, minimum, maximum, sum_squares = \
+            self._connection().execute(SELECT_STATS,
+                                       (patient_id,)).fetchone()
+        if count is None:
+            return None
+        return summarize(count, total, minimum, maximum, sum_squares)
+
+    def sum_after(self, patient_id, epoch):
+        partition = epoch // PARTITION_SECONDS
+        count, total = self._connection().execute(
+            SELECT_SUM_AFTER,
+            (patient_id, partition, patient_id, epoch,
+             (partition + 1) * PARTITION_SECONDS)).fetchone()
+        return count, int(total)
+
+    def rollups(self, patient_id, resolution, epoch):
+        seconds = RESOLUTIONS[resolution]
+        return self._connection().execute(
+            SELECT_ROLLUPS, (patient_id, seconds, epoch - seconds)).fetchall()
+
+    def clear(self):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM readings")
+            connection.execute("DELETE FROM reading_partitions")
+            connection.execute("DELETE FROM reading_rollups")
+            connection.execute("DELETE FROM patients")
+            connection.execute("DELETE FROM attendings")
+
+
+def make_storage(backend, directory=None, retention_readings=None,
+                 retention_seconds=None):
+    """ Create a storage backend by name
+
+    :param backend: "memory" or "sqlite"
+    :param directory: the folder to keep the data in, or None to keep the
+    "memory" backend in memory only
+    :param retention_readings: the default number of latest readings kept
+    for each patient, or None to keep them all
+    :param retention_seconds: by default drop the readings taken more than
+    this many seconds before a patient's latest reading, or None
+
+    :returns: an unopened Storage
+    """
+    if backend == "memory":
+        return MemoryStorage(directory,
+                             retention_readings=retention_readings,
+                             retention_seconds=retention_seconds)
+    if backend == "sqlite":
+        return SQLiteStorage(os.path.join(directory or ".",
+                                          "heart_rate_sentinel.db"),
+                             retention_readings=retention_readings,
+                             retention_seconds=retention_seconds)
+    raise ValueError("Unknown storage backend {}".format(backend))
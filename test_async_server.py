@@ -0,0 +1,213 @@
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from flask import Flask, request, jsonify
+import pytest
+import requests
+
+echo_app = Flask(__name__)
+
+
+@echo_app.route("/echo", methods=["GET", "POST"])
+def echo():
+    data = request.get_data()
+    return jsonify({"length": len(data), "lines": data.count(b"\n"),
+                    "query": request.args.get("q"),
+                    "path": request.path}), 200
+
+
+@echo_app.route("/big/<int:size>", methods=["GET"])
+def big(size):
+    return "x" * size
+
+
+@echo_app.route("/slow", methods=["GET"])
+def slow():
+    time.sleep(0.5)
+    return "done"
+
+
+@pytest.fixture
+def server():
+    from async_server import AsyncServer
+    server = AsyncServer(echo_app, threads=2)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    started = threading.Event()
+    asyncio.run_coroutine_threadsafe(
+        server.serve("127.0.0.1", 0, started=started), loop)
+    started.wait(5)
+    yield server
+
+    async def stop():
+        tasks = [task for task in asyncio.all_tasks()
+                 if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run_coroutine_threadsafe(stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+    server.executor.shutdown()
+
+
+def url(server, path):
+    return "http://127.0.0.1:{}{}".format(server.address[1], path)
+
+
+def test_async_server_requests(server):
+    session = requests.Session()
+    r = session.get(url(server, "/echo?q=a%20b"))
+    assert r.json() == {"length": 0, "lines": 0, "query": "a b",
+                        "path": "/echo"}
+    assert r.headers["Connection"] == "keep-alive"
+    r = session.post(url(server, "/echo"), data=b"a\nb\n")
+    assert r.json()["length"] == 4
+    # Long and chunked bodies are read as the app reads them
+    long_body = b"0123456789\n" * 20000
+    assert session.post(url(server, "/echo"),
+                        data=long_body).json()["lines"] == 20000
+    assert session.post(url(server, "/echo"), data=iter(
+        [long_body[:100000], long_body[100000:]])).json()["length"] == \
+        len(long_body)
+    # Long responses are written a part at a time
+    assert len(session.get(url(server, "/big/1000000")).text) == 1000000
+    assert session.get(url(server, "/missing")).status_code == 404
+    assert session.head(url(server, "/big/10")).headers[
+        "Content-Length"] == "10"
+    # Every request above went over the one connection
+    assert server.connections == 1
+
+
+def test_async_server_connections(server):
+    with socket.create_connection(("127.0.0.1", server.address[1])) as conn:
+        conn.sendall(b"GET /big/3 HTTP/1.0\r\n\r\n")
+        response = b""
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            response += data
+    assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert b"Connection: close\r\n" in response
+    assert response.endswith(b"\r\n\r\nxxx")
+    with socket.create_connection(("127.0.0.1", server.address[1])) as conn:
+        conn.sendall(b"NONSENSE\r\n\r\n")
+        assert conn.recv(65536).startswith(b"HTTP/1.1 400 Bad Request")
+        assert conn.recv(65536) == b""
+
+
+def test_async_server_refuses_malformed_requests(server):
+    def answer(request):
+        with socket.create_connection(("127.0.0.1",
+                                       server.address[1])) as conn:
+            conn.sendall(request)
+            return conn.recv(65536).split(b"\r\n")[0]
+
+    bad_request = b"HTTP/1.1 400 Bad Request"
+    assert answer(b"GET /echo HTTP/2.0\r\n\r\n") == \
+        b"HTTP/1.1 505 HTTP Version Not Supported"
+    assert answer(b"GET /echo HTTX/1.1\r\n\r\n") == bad_request
+    assert answer(b"GET echo HTTP/1.1\r\n\r\n") == bad_request
+    for length in (b"-1", b"+4", b"4, 5", b"x"):
+        assert answer(b"POST /echo HTTP/1.1\r\nContent-Length: " + length +
+                      b"\r\n\r\nabcd") == bad_request
+    # A body with both a length and chunked encoding could be read
+    # differently by a proxy in front of the server
+    assert answer(b"POST /echo HTTP/1.1\r\nContent-Length: 4\r\n"
+                  b"Transfer-Encoding: chunked\r\n\r\n0\r\n\r\n") == \
+        bad_request
+    assert answer(b"POST /echo HTTP/1.1\r\nTransfer-Encoding: gzip\r\n"
+                  b"\r\n") == bad_request
+    assert answer(b"GET /echo HTTP/1.1\r\nHost : a\r\n\r\n") == bad_request
+    assert answer(b"GET /echo HTTP/1.1\r\nX-A: a\r\n b\r\n\r\n") == \
+        bad_request
+    # Targets in absolute form are served by their path
+    with socket.create_connection(("127.0.0.1", server.address[1])) as conn:
+        conn.sendall(b"GET http://127.0.0.1/echo?q=1 HTTP/1.0\r\n\r\n")
+        response = b""
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            response += data
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert b'"query":"1"' in response
+
+
+def test_async_server_limits(server):
+    server.max_body_size = 1000
+    server.max_header_size = 4096
+    with socket.create_connection(("127.0.0.1", server.address[1])) as conn:
+        # Refused from its Content-Length, before the body is sent
+        conn.sendall(b"POST /echo HTTP/1.1\r\nContent-Length: 1001\r\n"
+                     b"Expect: 100-continue\r\n\r\n")
+        assert conn.recv(65536).startswith(b"HTTP/1.1 413 Content Too Large")
+    with socket.create_connection(("127.0.0.1", server.address[1])) as conn:
+        conn.sendall(b"GET /echo HTTP/1.1\r\n" +
+                     b"X-Padding: " + b"x" * 5000 + b"\r\n\r\n")
+        assert conn.recv(65536).startswith(
+            b"HTTP/1.1 431 Request Header Fields Too Large")
+    assert requests.post(url(server, "/echo"),
+                         data=b"x" * 1000).json()["length"] == 1000
+
+
+def test_async_server_drains_on_stop(server):
+    idle = requests.Session()
+    assert idle.get(url(server, "/echo")).status_code == 200
+    responses = []
+    request = threading.Thread(target=lambda: responses.append(
+        requests.get(url(server, "/slow"))))
+    request.start()
+    while server.requests == 0:
+        time.sleep(0.01)
+    server.stop()
+    request.join()
+    # The request being handled finished, and closed its connection
+    assert responses[0].text == "done"
+    assert responses[0].headers["Connection"] == "close"
+    # New and idle connections are not served any more
+    while server.connections:
+        time.sleep(0.01)
+    with pytest.raises(requests.ConnectionError):
+        requests.get(url(server, "/echo"))
+
+
+def test_run_until_terminated(tmp_path):
+    # async_server.run as the server's --asyncio option calls it, in a
+    # process of its own
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(
+            __file__)), "heart_rate_sentinel.py"), "--asyncio", "--port",
+         str(port)], cwd=str(tmp_path))
+    try:
+        session = requests.Session()
+        for _ in range(100):
+            try:
+                r = session.get("http://127.0.0.1:{}/api".format(port))
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        assert r.status_code == 200
+        assert r.headers["Connection"] == "keep-alive"
+        r = session.post("http://127.0.0.1:{}/api/new_patient".format(port),
+                         json={"patient_id": 1,
+                               "attending_username": "Smith.J",
+                               "patient_age": 50})
+        assert r.status_code == 200
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(10) == 0
+    finally:
+        process.kill()
+        process.wait()
@@ -0,0 +1,9 @@
+from io import BytesIO
+
+
+def test_stream_file():
+    from bulk_import_client import stream_file
+    test_content = b'{"patient_id": 1}\n{"patient_id": 2}\n'
+    answer = list(stream_file(BytesIO(test_content), chunk_size=13))
+    assert b"".join(answer) == test_content
+    assert [len(chunk) for chunk in answer] == [13, 13, 10]
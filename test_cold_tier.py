@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+import os
+import random
+
+
+def make_series(tmp_path, hot_readings):
+    from cold_tier import ColdTier
+    from hr_series import HeartRateSeries
+    tier = ColdTier(str(tmp_path / "cold"), hot_readings)
+    tier.open()
+    return HeartRateSeries(tier.history(1))
+
+
+def test_cold_series_matches_memory_series(tmp_path):
+    from hr_series import HeartRateSeries
+    rng = random.Random(547)
+    tiered = make_series(tmp_path, 4)
+    plain = HeartRateSeries()
+    start = datetime(2018, 3, 9, 11, 0, 0)
+    for minute in range(0, 50, 2):
+        heart_rates = [rng.randint(50, 150) for _ in range(rng.randint(1, 3))]
+        for series in (tiered, plain):
+            series.extend(heart_rates, start + timedelta(minutes=minute))
+    # Readings older than everything in memory go into the cold file
+    for minute in (1, 31, 47):
+        for series in (tiered, plain):
+            series.append(99, start + timedelta(minutes=minute))
+    assert tiered.cold.count > 0
+    assert len(tiered.epochs) < 8
+    assert len(tiered) == len(plain)
+    assert tiered.heart_rate == plain.heart_rate
+    assert tiered.timestamp == plain.timestamp
+    assert tiered.heart_rate[3] == plain.heart_rate[3]
+    assert tiered.timestamp[-1] == plain.timestamp[-1]
+    for minute in range(-1, 52):
+        epoch = plain.epoch_at(0) + 60 * minute
+        assert tiered.sum_after(epoch) == plain.sum_after(epoch)
+    assert tiered.sum_squares == plain.sum_squares
+    assert (tiered.minimum, tiered.maximum) == (plain.minimum, plain.maximum)
+
+
+def test_memory_storage_recovers_cold_readings(tmp_path):
+    from hr_series import to_epoch
+    from storage import MemoryStorage
+    directory = str(tmp_path / "data")
+    storage = MemoryStorage(directory, hot_readings=3)
+    storage.open()
+    storage.add_patients([{"patient_id": 1, "attending_username": "Smith.J",
+                           "patient_age": 50}])
+    start = datetime(2018, 3, 9, 11, 0, 0)
+    for second in range(20):
+        storage.add_readings(1, [60 + second],
+                             start + timedelta(seconds=second))
+    storage.wal.snapshot()
+    storage.add_readings(1, [100, 101], start + timedelta(seconds=30))
+    expected = storage.readings(1)
+    stats = storage.reading_stats(1)
+    storage.close()
+    assert os.path.exists(os.path.join(directory, "cold", "1.hrs"))
+    storage = MemoryStorage(directory, hot_readings=3)
+    assert storage.open() == 1
+    assert storage.readings(1) == expected
+    assert storage.reading_stats(1) == stats
+    since = to_epoch(start + timedelta(seconds=9))
+    assert storage.sum_after(1, since) == (12, sum(range(70, 80)) + 201)
+    storage.close()
+
+
+def test_cold_series_snapshot(tmp_path):
+    series = make_series(tmp_path, 2)
+    for epoch in range(10, 70, 10):
+        series.append_at(epoch, epoch)
+    snapshot = series.snapshot
+    assert snapshot.cold_count == 4
+    expected = ([10, 20, 30, 40, 50, 60], [10, 20, 30, 40, 50, 60])
+    assert snapshot.readings() == expected
+    assert snapshot.sum_after(15) == (5, 200)
+    # Readings moved to the cold file later come after the snapshot's
+    for epoch in range(70, 120, 10):
+        series.append_at(epoch, epoch)
+    assert series.cold.count > snapshot.cold_count
+    assert snapshot.readings() == expected
+    assert snapshot.sum_after(15) == (5, 200)
+    # Rewriting the cold file for an old reading invalidates the snapshot
+    series.append_at(99, 5)
+    assert snapshot.readings() is None
+    assert snapshot.sum_after(15) is None
+    assert series.snapshot.readings()[0][:2] == [99, 10]
+    assert series.snapshot.sum_after(5) == series.sum_after(5)
+    current = series.snapshot
+    series.cold.retire()
+    assert current.readings() is None
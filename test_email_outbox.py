@@ -0,0 +1,326 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+
+def start_stub_relay(fail_first=0):
+    """Start a local e-mail relay that records what it receives
+
+    The first fail_first requests are answered with a 500 error.
+    """
+    received = []
+    connections = set()
+
+    class StubRelay(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            received.append(json.loads(body))
+            connections.add(self.client_address)
+            if len(received) <= fail_first:
+                self.send_response(500)
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubRelay)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/hrss/send_email".format(server.server_port)
+    return server, url, received, connections
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_outbox_put_peek_ack():
+    from email_outbox import Outbox
+    outbox = Outbox(max_size=2)
+    assert outbox.peek(timeout=0) is None
+    assert outbox.put({"to_email": "a@b.com"}) is True
+    assert outbox.put({"to_email": "c@d.com"}) is True
+    assert outbox.put({"to_email": "e@f.com"}) is False
+    assert len(outbox) == 2
+    entry_id, email, queued_at, attempts = outbox.peek()
+    assert email == {"to_email": "a@b.com"}
+    assert queued_at <= time.time()
+    assert attempts == 0
+    outbox.ack(entry_id)
+    assert outbox.peek()[1] == {"to_email": "c@d.com"}
+    assert len(outbox) == 1
+
+
+def test_outbox_survives_restart(tmp_path):
+    from email_outbox import Outbox
+    path = str(tmp_path / "outbox.jsonl")
+    outbox = Outbox(path)
+    outbox.put({"to_email": "a@b.com"})
+    outbox.put({"to_email": "c@d.com"})
+    outbox.ack(outbox.peek()[0])
+    outbox.close()
+    with open(path, "a") as journal:
+        journal.write('{"op": "put", "id": 7, "ema')
+    reopened = Outbox(path)
+    assert len(reopened) == 1
+    assert reopened.peek()[1] == {"to_email": "c@d.com"}
+    reopened.put({"to_email": "e@f.com"})
+    assert reopened.peek()[0] == 1
+    reopened.close()
+
+
+def test_outbox_retry_waits_until_due(tmp_path):
+    from email_outbox import Outbox
+    path = str(tmp_path / "outbox.jsonl")
+    outbox = Outbox(path)
+    outbox.put({"to_email": "a@b.com"})
+    outbox.put({"to_email": "c@d.com"})
+    first = outbox.peek()[0]
+    outbox.retry(first, 1, time.time() + 0.3)
+    assert outbox.peek()[1] == {"to_email": "c@d.com"}
+    outbox.ack(outbox.peek()[0])
+    assert outbox.peek(timeout=0) is None
+    # peek wakes up when the e-mail that was put off becomes due
+    started = time.monotonic()
+    assert outbox.peek(timeout=5)[::3] == (first, 1)
+    assert time.monotonic() - started < 1
+    outbox.retry(first, 2, time.time() + 60)
+    outbox.close()
+    reopened = Outbox(path)
+    assert len(reopened) == 1
+    assert reopened.peek(timeout=0) is None
+    reopened.close()
+
+
+def test_dispatcher_delivers_to_relay():
+    from email_outbox import Outbox, EmailDispatcher
+    server, url, received, connections = start_stub_relay()
+    outbox = Outbox()
+    dispatcher = EmailDispatcher(outbox, url, timeout=1)
+    dispatcher.start()
+    outbox.put({"to_email": "a@b.com", "subject": "Tachycardic!"})
+    assert wait_for(lambda: len(outbox) == 0)
+    dispatcher.stop()
+    server.shutdown()
+    assert received == [{"to_email": "a@b.com", "subject": "Tachycardic!"}]
+
+
+def test_dispatcher_retries_with_backoff():
+    from email_outbox import Outbox, EmailDispatcher
+    server, url, received, connections = start_stub_relay(fail_first=2)
+    outbox = Outbox()
+    dispatcher = EmailDispatcher(outbox, url, timeout=1, base_delay=0.01)
+    dispatcher.start()
+    outbox.put({"to_email": "a@b.com"})
+    assert wait_for(lambda: len(outbox) == 0)
+    dispatcher.stop()
+    server.shutdown()
+    assert len(received) == 3
+
+
+def test_dispatcher_gives_up():
+    from email_outbox import Outbox, EmailDispatcher
+
+    def failing_post(relay_url, email, timeout):
+        calls.append(email)
+        raise ConnectionError("relay down")
+
+    calls = []
+    outbox = Outbox()
+    dispatcher = EmailDispatcher(outbox, "http://relay", max_attempts=3,
+                                 base_delay=0.001, post=failing_post)
+    assert dispatcher.deliver({"to_email": "a@b.com"}) is False
+    outbox.put({"to_email": "a@b.com"})
+    dispatcher.start()
+    assert wait_for(lambda: len(outbox) == 0)
+    dispatcher.stop()
+    assert len(calls) == 4
+    # Given only an age limit, an e-mail is tried until it is that old
+    calls.clear()
+    dispatcher = EmailDispatcher(outbox, "http://relay", max_age=0.2,
+                                 base_delay=0.01, max_delay=0.01,
+                                 post=failing_post)
+    outbox.put({"to_email": "a@b.com"})
+    dispatcher.start()
+    assert wait_for(lambda: len(outbox) == 0)
+    dispatcher.stop()
+    assert len(calls) > 5
+
+
+def test_dispatcher_recovers_after_relay_outage():
+    from email_outbox import Outbox, EmailDispatcher
+
+    def flaky_post(relay_url, email, timeout):
+        if email["to_email"] == "a@b.com" and time.monotonic() < recovers:
+            failures.append(email)
+            raise ConnectionError("relay down")
+        sent.append(email)
+
+    failures = []
+    sent = []
+    recovers = time.monotonic() + 0.5
+    outbox = Outbox()
+    dispatcher = EmailDispatcher(outbox, "http://relay", base_delay=0.05,
+                                 max_delay=0.1, post=flaky_post)
+    dispatcher.start()
+    outbox.put({"to_email": "a@b.com", "subject": "Tachycardic!"})
+    outbox.put({"to_email": "c@d.com", "subject": "Tachycardic!"})
+    # The failing e-mail is put off rather than holding up the one behind
+    # it, and is neither lost nor dead-lettered while the relay is down
+    assert wait_for(lambda: len(sent) == 1, timeout=0.4)
+    assert sent == [{"to_email": "c@d.com", "subject": "Tachycardic!"}]
+    assert len(outbox) == 1
+    assert wait_for(lambda: len(outbox) == 0)
+    dispatcher.stop()
+    assert sent[1] == {"to_email": "a@b.com", "subject": "Tachycardic!"}
+    assert len(failures) > 2
+
+
+def test_dispatcher_keeps_undelivered_as_dead_letters(tmp_path):
+    from email_outbox import Outbox, EmailDispatcher
+
+    def failing_post(relay_url, email, timeout):
+        raise ConnectionError("relay down")
+
+    path = str(tmp_path / "outbox.jsonl")
+    outbox = Outbox(path)
+    dispatcher = EmailDispatcher(outbox, "http://relay", max_attempts=2,
+                                 base_delay=0.001, post=failing_post)
+    outbox.put({"to_email": "a@b.com", "subject": "Tachycardic!"})
+    dispatcher.start()
+    assert wait_for(lambda: len(outbox) == 0)
+    dispatcher.stop()
+    outbox.close()
+    with open(path + ".dead") as dead_letters:
+        entries = [json.loads(line) for line in dead_letters]
+    assert [entry["email"] for entry in entries] == \
+        [{"to_email": "a@b.com", "subject": "Tachycardic!"}]
+    assert entries[0]["failed_at"] >= entries[0]["time"]
+    assert len(Outbox(path)) == 0
+
+
+def test_dispatcher_dead_letters_without_recipient():
+    from email_outbox import Outbox, EmailDispatcher
+
+    def recording_post(relay_url, email, timeout):
+        sent.append(email)
+
+    sent = []
+    outbox = Outbox()
+    dispatcher = EmailDispatcher(outbox, "http://relay", base_delay=10,
+                                 post=recording_post)
+    outbox.put({"to_email": None, "subject": "Tachycardic!"})
+    outbox.put({"to_email": "a@b.com", "subject": "Tachycardic!"})
+    dispatcher.start()
+    # The e-mail without a recipient is not tried, so it does not hold up
+    # the one behind it
+    assert wait_for(lambda: len(outbox) == 0, timeout=1)
+    dispatcher.stop()
+    assert sent == [{"to_email": "a@b.com", "subject": "Tachycardic!"}]
+
+
+def test_make_digest():
+    from email_outbox import make_digest
+    alert1 = {"to_email": "a@b.com", "subject": "Tachycardic!",
+              "content": "Patient 1 has a tachycardic heart rate!"}
+    alert2 = {"to_email": "a@b.com", "subject": "Tachycardic!",
+              "content": "Patient 2 has a tachycardic heart rate!"}
+    expected = {"to_email": "a@b.com", "subject": "Tachycardic! (3 alerts)",
+                "content": "Patient 1 has a tachycardic heart rate! (x2)\n"
+                           "Patient 2 has a tachycardic heart rate!"}
+    assert make_digest([alert1]) == alert1
+    assert make_digest([alert1, alert2, alert1]) == expected
+
+
+def test_dispatcher_coalesces_on_one_connection():
+    from email_outbox import Outbox, EmailDispatcher
+    server, url, received, connections = start_stub_relay()
+    outbox = Outbox()
+    dispatcher = EmailDispatcher(outbox, url, timeout=1,
+                                 coalesce_window=0.2)
+    for patient_id in range(20):
+        outbox.put({"to_email": "a@b.com", "subject": "Tachycardic!",
+                    "content": "Patient {}".format(patient_id % 2)})
+    outbox.put({"to_email": "c@d.com", "subject": "Tachycardic!",
+                "content": "Patient 3"})
+    dispatcher.start()
+    assert wait_for(lambda: len(outbox) == 0)
+    dispatcher.stop()
+    server.shutdown()
+    assert [email["to_email"] for email in received] == ["a@b.com",
+                                                         "c@d.com"]
+    assert received[0]["content"] == "Patient 0 (x10)\nPatient 1 (x10)"
+    assert len(connections) == 1
+
+
+def test_dispatcher_sends_first_alert_at_once():
+    from email_outbox import Outbox, EmailDispatcher
+
+    def recording_post(relay_url, email, timeout):
+        sent.append((time.monotonic(), email))
+
+    sent = []
+    outbox = Outbox()
+    dispatcher = EmailDispatcher(outbox, "http://relay", coalesce_window=0.5,
+                                 post=recording_post)
+    dispatcher.start()
+    queued = time.monotonic()
+    outbox.put({"to_email": "a@b.com", "subject": "Tachycardic!",
+                "content": "Patient 1"})
+    assert wait_for(lambda: len(sent) == 1)
+    assert sent[0][0] - queued < 0.25
+    # The alerts that follow within the window are sent as one digest when
+    # it ends
+    for _ in range(3):
+        outbox.put({"to_email": "a@b.com", "subject": "Tachycardic!",
+                    "content": "Patient 1"})
+    time.sleep(0.2)
+    assert len(sent) == 1
+    assert wait_for(lambda: len(sent) == 2)
+    assert sent[1][0] - sent[0][0] >= 0.45
+    assert sent[1][1]["content"] == "Patient 1 (x3)"
+    # Another address is not held up by the first one's window
+    outbox.put({"to_email": "c@d.com", "subject": "Tachycardic!",
+                "content": "Patient 2"})
+    assert wait_for(lambda: len(sent) == 3)
+    assert sent[2][0] - sent[1][0] < 0.25
+    dispatcher.stop()
+
+
+def test_dispatcher_does_not_hold_other_addresses():
+    from email_outbox import Outbox, EmailDispatcher
+
+    def recording_post(relay_url, email, timeout):
+        sent.append((time.monotonic(), email))
+
+    sent = []
+    outbox = Outbox()
+    dispatcher = EmailDispatcher(outbox, "http://relay", coalesce_window=2,
+                                 post=recording_post)
+    dispatcher.start()
+    outbox.put({"to_email": "a@b.com", "subject": "Tachycardic!",
+                "content": "Patient 1"})
+    assert wait_for(lambda: len(sent) == 1)
+    # A held alert to a@b.com is older than c@d.com's first one, which is
+    # still sent at once
+    outbox.put({"to_email": "a@b.com", "subject": "Tachycardic!",
+                "content": "Patient 1"})
+    queued = time.monotonic()
+    outbox.put({"to_email": "c@d.com", "subject": "Tachycardic!",
+                "content": "Patient 2"})
+    assert wait_for(lambda: len(sent) == 2)
+    assert sent[1][1]["to_email"] == "c@d.com"
+    assert sent[1][0] - queued < 0.25
+    assert wait_for(lambda: len(sent) == 3)
+    assert sent[2][1]["to_email"] == "a@b.com"
+    assert sent[2][0] - sent[0][0] >= 1.95
+    dispatcher.stop()
@@ -0,0 +1,390 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import pytest
+import requests
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "heart_rate_sentinel.py")
+TOKEN = "cluster-secret"
+
+
+def free_port():
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        return listener.getsockname()[1]
+
+
+@pytest.fixture
+def servers(tmp_path):
+    # Four servers, each in its own folder so they keep separate data
+    processes = []
+    urls = []
+    for number in range(4):
+        directory = tmp_path / "server{}".format(number)
+        directory.mkdir()
+        port = free_port()
+        processes.append(subprocess.Popen(
+            [sys.executable, SERVER, "--port", str(port), "--data", "data",
+             "--cluster-token", TOKEN],
+            cwd=str(directory)))
+        urls.append("http://127.0.0.1:{}".format(port))
+    try:
+        for url in urls:
+            for _ in range(100):
+                try:
+                    requests.get(url + "/api")
+                    break
+                except requests.ConnectionError:
+                    time.sleep(0.1)
+        yield urls
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+def held_patients(url):
+    from heart_rate_sentinel import CLUSTER_TOKEN_HEADER
+    return set(requests.get(url + "/api/cluster/patients",
+                            headers={CLUSTER_TOKEN_HEADER: TOKEN}).json())
+
+
+def test_gateway(servers):
+    import gateway
+    gateway.cluster = gateway.Cluster(servers[:3], token=TOKEN)
+    client = gateway.app.test_client()
+    r = client.post("/api/new_attending",
+                    json={"attending_username": "Smith.J",
+                          "attending_email": "smith@hospital.org",
+                          "attending_phone": "919-867-5309"})
+    assert r.status_code == 200
+    for patient_id in range(20):
+        r = client.post("/api/new_patient",
+                        json={"patient_id": str(patient_id),
+                              "attending_username": "Smith.J",
+                              "patient_age": 50})
+        assert r.status_code == 200
+    lines = [json.dumps({"patient_id": patient_id,
+                         "attending_username": "Ann.A", "patient_age": 60})
+             for patient_id in range(20, 30)]
+    lines[3] = json.dumps({"patient_id": 23, "patient_age": 60})
+    lines.append(json.dumps({"attending_username": "Ann.A",
+                             "attending_email": "ann@hospital.org",
+                             "attending_phone": "919-867-5309"}))
+    lines.append("not json")
+    r = client.post("/api/bulk_import", data="\n".join(lines))
+    assert r.status_code == 200
+    summary = r.get_json()
+    servers_summaries = summary.pop("servers")
+    assert [server["node"] for server in servers_summaries] == servers[:3]
+    assert sum(server["patients_added"]
+               for server in servers_summaries) == 9
+    assert all(server["attendings_added"] == 1
+               for server in servers_summaries)
+    assert summary == {
+        "patients_added": 9, "attendings_added": 1, "rejected": 2,
+        "rejects": [
+            {"line": 4,
+             "error": "The key attending_username is missing from input"},
+            {"line": 12, "error": "The input was not a dictionary"}]}
+    for patient_id in range(29):
+        r = client.post("/api/heart_rate",
+                        json={"patient_id": patient_id, "heart_rate": 60})
+        assert r.status_code == (400 if patient_id == 23 else 200)
+    r = client.post("/api/heart_rate/batch", data="\n".join(
+        json.dumps({"patient_id": patient_id, "heart_rate": 70})
+        for patient_id in (5, 31, 12, 5)) + "\n{")
+    assert r.get_json()["added"] == 3
+    assert [result["status"] for result in r.get_json()["results"]] == \
+        [200, 400, 200, 200, 400]
+    assert r.get_json()["results"][1]["message"] == \
+        "Patient ID 31 not found in database"
+    # Every patient is on one server, the one the ring chooses
+    for url in servers[:3]:
+        assert held_patients(url) == {
+            patient_id for patient_id in range(30) if patient_id != 23
+            and gateway.cluster.ring.node_for(str(patient_id)) == url}
+    assert held_patients(servers[3]) == set()
+    r = client.get("/api/patients/Smith.J")
+    assert [patient["patient_id"] for patient in r.get_json()] == \
+        list(range(20))
+    assert client.get("/api/patients/Nobody").status_code == 400
+    histories = {patient_id: client.get(
+        "/api/heart_rate/{}".format(patient_id)).get_json()
+        for patient_id in range(30) if patient_id != 23}
+    assert histories[5] == [60, 70, 70]
+    assert client.get("/api/status/7").get_json()["heart_rate"] == [60]
+    # A server joins and takes over some patients
+    from heart_rate_sentinel import CLUSTER_TOKEN_HEADER
+    headers = {CLUSTER_TOKEN_HEADER: TOKEN}
+    for denied in ({}, {CLUSTER_TOKEN_HEADER: "guess"}):
+        r = client.post("/api/cluster/nodes", json={"node": servers[3]},
+                        headers=denied)
+        assert r.status_code == 403
+        r = client.delete("/api/cluster/nodes", json={"node": servers[0]},
+                          headers=denied)
+        assert r.status_code == 403
+    assert held_patients(servers[3]) == set()
+    assert len(gateway.cluster.ring) == 3
+    r = client.post("/api/cluster/nodes", json={"node": servers[3] + "/"},
+                    headers=headers)
+    assert r.get_json()["moved"] == len(held_patients(servers[3])) > 0
+    assert client.get("/api/cluster/nodes",
+                      headers=headers).get_json() == servers
+    # A server leaves, after handing over its patients
+    r = client.delete("/api/cluster/nodes", json={"node": servers[0]},
+                      headers=headers)
+    assert r.status_code == 200
+    assert held_patients(servers[0]) == set()
+    for url in servers[1:]:
+        assert all(gateway.cluster.ring.node_for(str(patient_id)) == url
+                   for patient_id in held_patients(url))
+    for patient_id, history in histories.items():
+        assert client.get("/api/heart_rate/{}".format(
+            patient_id)).get_json() == history
+    assert client.get("/api/heart_rate/stats/5").get_json()["count"] == 3
+    r = client.get("/api/patients/Ann.A")
+    assert [patient["patient_id"] for patient in r.get_json()] == \
+        [20, 21, 22, 24, 25, 26, 27, 28, 29]
+    r = client.post("/api/new_patient",
+                    json={"patient_id": 40, "attending_username": "Ann.A",
+                          "patient_age": 30})
+    assert r.status_code == 200
+    assert 40 in held_patients(gateway.cluster.ring.node_for("40"))
+    r = client.delete("/api/cluster/nodes", json={"node": servers[0]},
+                      headers=headers)
+    assert r.status_code == 400
+
+
+def test_gateway_without_servers():
+    import gateway
+    gateway.cluster = gateway.Cluster()
+    client = gateway.app.test_client()
+    r = client.post("/api/new_attending",
+                    json={"attending_username": "Smith.J",
+                          "attending_email": "smith@hospital.org",
+                          "attending_phone": "919-867-5309"})
+    assert r.status_code == 503
+    assert r.get_data(as_text=True) == "The cluster has no servers"
+    assert client.get("/api/patients/Smith.J").status_code == 503
+    assert client.post("/api/heart_rate/batch",
+                       data="").status_code == 503
+    assert client.post("/api/bulk_import", data="{}").status_code == 503
+    assert client.post("/api/new_patient",
+                       json={"patient_id": 1}).status_code == 503
+
+
+def test_gateway_moves_patients_back_when_a_server_fails(servers):
+    import gateway
+    from heart_rate_sentinel import CLUSTER_TOKEN_HEADER
+
+    class FailingCluster(gateway.Cluster):
+        imports = 0
+
+        def call(self, method, node, path, **kwargs):
+            if method == "POST" and path == "/api/cluster/patients" and \
+                    node == servers[2]:
+                self.imports += 1
+                if self.imports == 3:
+                    raise requests.ConnectionError("server failed")
+            return super().call(method, node, path, **kwargs)
+
+    gateway.cluster = FailingCluster(servers[:2], token=TOKEN)
+    client = gateway.app.test_client()
+    client.post("/api/new_attending",
+                json={"attending_username": "Smith.J",
+                      "attending_email": "smith@hospital.org",
+                      "attending_phone": "919-867-5309"})
+    for patient_id in range(30):
+        client.post("/api/new_patient",
+                    json={"patient_id": patient_id,
+                          "attending_username": "Smith.J",
+                          "patient_age": 50})
+        client.post("/api/heart_rate",
+                    json={"patient_id": patient_id, "heart_rate": 60})
+    before = {url: held_patients(url) for url in servers[:2]}
+    r = client.post("/api/cluster/nodes", json={"node": servers[2]},
+                    headers={CLUSTER_TOKEN_HEADER: TOKEN})
+    assert r.status_code == 502
+    assert gateway.cluster.imports == 3
+    assert gateway.cluster.ring.nodes == servers[:2]
+    assert held_patients(servers[2]) == set()
+    assert {url: held_patients(url) for url in servers[:2]} == before
+    for patient_id in range(30):
+        assert client.get("/api/heart_rate/{}".format(
+            patient_id)).get_json() == [60]
+
+
+def test_gateway_checks_attendings_of_new_server(servers):
+    import gateway
+    from heart_rate_sentinel import CLUSTER_TOKEN_HEADER
+
+    class RejectingCluster(gateway.Cluster):
+        def call(self, method, node, path, **kwargs):
+            if path == "/api/bulk_import" and node == servers[1]:
+                kwargs["data"] = b"not json\n"
+            return super().call(method, node, path, **kwargs)
+
+    gateway.cluster = RejectingCluster(servers[:1], token=TOKEN)
+    client = gateway.app.test_client()
+    client.post("/api/new_attending",
+                json={"attending_username": "Smith.J",
+                      "attending_email": "smith@hospital.org",
+                      "attending_phone": "919-867-5309"})
+    for patient_id in range(10):
+        client.post("/api/new_patient",
+                    json={"patient_id": patient_id,
+                          "attending_username": "Smith.J",
+                          "patient_age": 50})
+    # The new server rejected the attending physicians, so it is not given
+    # their patients
+    r = client.post("/api/cluster/nodes", json={"node": servers[1]},
+                    headers={CLUSTER_TOKEN_HEADER: TOKEN})
+    assert r.status_code == 502
+    assert gateway.cluster.ring.nodes == servers[:1]
+    assert held_patients(servers[1]) == set()
+    assert held_patients(servers[0]) == set(range(10))
+
+
+def unreachable(call, unreachable_node, unreachable_path):
+    # Wrap a Cluster's call so one server cannot be reached for one route
+    def failing_call(method, node, path, **kwargs):
+        if node == unreachable_node and path == unreachable_path:
+            raise requests.ConnectionError("server failed")
+        return call(method, node, path, **kwargs)
+    return failing_call
+
+
+def test_gateway_reports_servers_that_fail(servers):
+    import gateway
+    gateway.cluster = gateway.Cluster(servers[:2], token=TOKEN)
+    reachable = gateway.cluster.call
+    gateway.cluster.call = unreachable(reachable, servers[1],
+                                       "/api/new_attending")
+    client = gateway.app.test_client()
+    attending = {"attending_username": "Smith.J",
+                 "attending_email": "smith@hospital.org",
+                 "attending_phone": "919-867-5309"}
+    r = client.post("/api/new_attending", json=attending)
+    assert r.status_code == 503
+    assert r.get_json()["failed"] == [
+        {"node": servers[1], "status": 503,
+         "message": "A server of the cluster is not available"}]
+    # Every server rejects a malformed physician the same way
+    r = client.post("/api/new_attending", json={"attending_username": 1})
+    assert r.status_code == 503
+    gateway.cluster.call = reachable
+    assert client.post("/api/new_attending",
+                       json={"attending_username": 1}).status_code == 400
+    # Sending the physician again adds it to the server that failed
+    assert client.post("/api/new_attending",
+                       json=attending).status_code == 200
+    for patient_id in range(10):
+        client.post("/api/new_patient",
+                    json={"patient_id": patient_id,
+                          "attending_username": "Smith.J",
+                          "patient_age": 50})
+    # A batch keeps the readings the reachable server stored
+    gateway.cluster.call = unreachable(reachable, servers[1],
+                                       "/api/heart_rate/batch")
+    r = client.post("/api/heart_rate/batch", data="\n".join(
+        json.dumps({"patient_id": patient_id, "heart_rate": 70})
+        for patient_id in range(10)))
+    assert r.status_code == 200
+    on_first = [gateway.cluster.ring.node_for(str(patient_id)) == servers[0]
+                for patient_id in range(10)]
+    assert [result["status"] for result in r.get_json()["results"]] == \
+        [200 if first else 503 for first in on_first]
+    assert r.get_json()["added"] == sum(on_first)
+    for patient_id in range(10):
+        assert client.get("/api/heart_rate/{}".format(
+            patient_id)).get_json() == ([70] if on_first[patient_id] else [])
+    # A bulk import reports the server that failed, and keeps the patients
+    # the other one added
+    gateway.cluster.call = unreachable(reachable, servers[1],
+                                       "/api/bulk_import")
+    r = client.post("/api/bulk_import", data="\n".join(
+        json.dumps({"patient_id": patient_id,
+                    "attending_username": "Smith.J", "patient_age": 50})
+        for patient_id in range(10, 20)))
+    assert r.status_code == 503
+    on_first = [gateway.cluster.ring.node_for(str(patient_id)) == servers[0]
+                for patient_id in range(10, 20)]
+    assert r.get_json()["patients_added"] == sum(on_first)
+    failed = r.get_json()["servers"][1]
+    assert failed["node"] == servers[1]
+    assert failed["status"] == 503
+    assert failed["message"] == "A server of the cluster is not available"
+    assert r.get_json()["servers"][0]["patients_added"] == sum(on_first)
+    assert held_patients(servers[0]) == {
+        patient_id for patient_id in range(20)
+        if gateway.cluster.ring.node_for(str(patient_id)) == servers[0]}
+
+
+def test_gateway_routes_other_patients_while_one_moves(servers):
+    import threading
+    import gateway
+
+    class SlowCluster(gateway.Cluster):
+        def call(self, method, node, path, **kwargs):
+            if method == "POST" and path == "/api/cluster/patients" and \
+                    not importing.is_set():
+                moving.append(kwargs["json"]["patient"]["patient_id"])
+                importing.set()
+                assert resume.wait(10)
+            return super().call(method, node, path, **kwargs)
+
+    importing = threading.Event()
+    resume = threading.Event()
+    moving = []
+    gateway.cluster = SlowCluster(servers[:2], token=TOKEN)
+    client = gateway.app.test_client()
+    client.post("/api/new_attending",
+                json={"attending_username": "Smith.J",
+                      "attending_email": "smith@hospital.org",
+                      "attending_phone": "919-867-5309"})
+    for patient_id in range(20):
+        client.post("/api/new_patient",
+                    json={"patient_id": patient_id,
+                          "attending_username": "Smith.J",
+                          "patient_age": 50})
+        client.post("/api/heart_rate",
+                    json={"patient_id": patient_id, "heart_rate": 60})
+    adding = threading.Thread(target=gateway.cluster.add_node,
+                              args=(servers[2],))
+    adding.start()
+    assert importing.wait(10)
+    # The other patients, moved or not, are served from where they are
+    started = time.monotonic()
+    for patient_id in range(20):
+        if patient_id != moving[0]:
+            assert client.get("/api/heart_rate/{}".format(
+                patient_id)).get_json() == [60]
+    assert client.post("/api/new_patient",
+                       json={"patient_id": 100,
+                             "attending_username": "Smith.J",
+                             "patient_age": 50}).status_code == 200
+    assert time.monotonic() - started < 5
+    # The patient being moved waits until it is on its new server
+    answers = []
+    waiting = threading.Thread(target=lambda: answers.append(
+        gateway.app.test_client().get("/api/heart_rate/{}".format(
+            moving[0])).get_json()))
+    waiting.start()
+    time.sleep(0.3)
+    assert answers == []
+    resume.set()
+    waiting.join(10)
+    adding.join(10)
+    assert answers == [[60]]
+    assert gateway.cluster.ring.nodes == servers[:3]
+    for patient_id in list(range(20)) + [100]:
+        assert patient_id in held_patients(
+            gateway.cluster.ring.node_for(str(patient_id)))
+    r = client.get("/api/patients/Smith.J")
+    assert [patient["patient_id"] for patient in r.get_json()] == \
+        list(range(20)) + [100]
@@ -0,0 +1,38 @@
+import pytest
+
+
+def test_hash_ring_node_for():
+    from hash_ring import HashRing
+    ring = HashRing(["a", "b", "c"])
+    assert len(ring) == 3
+    assert "b" in ring
+    assert ring.nodes == ["a", "b", "c"]
+    owners = [ring.node_for(str(key)) for key in range(3000)]
+    # The same key always goes to the same node, and the keys are spread
+    assert owners == [ring.node_for(str(key)) for key in range(3000)]
+    for node in ("a", "b", "c"):
+        assert 600 < owners.count(node) < 1400
+    ring.add("a")
+    assert ring.nodes == ["a", "b", "c"]
+    with pytest.raises(LookupError):
+        HashRing().node_for("1")
+
+
+def test_hash_ring_moves_few_keys():
+    from hash_ring import HashRing
+    ring = HashRing(["a", "b", "c"])
+    before = {key: ring.node_for(str(key)) for key in range(3000)}
+    grown = ring.copy()
+    grown.add("d")
+    assert ring.nodes == ["a", "b", "c"]
+    # Only keys taken over by the new node move
+    moved = [key for key in before if grown.node_for(str(key)) != before[key]]
+    assert all(grown.node_for(str(key)) == "d" for key in moved)
+    assert 400 < len(moved) < 1100
+    grown.remove("b")
+    # Only the removed node's keys move
+    for key in before:
+        if before[key] not in ("b", grown.node_for(str(key))):
+            assert grown.node_for(str(key)) == "d"
+    with pytest.raises(KeyError):
+        grown.remove("b")
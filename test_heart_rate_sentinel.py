@@ -1,6 +1,5 @@
 # import pytest
 from datetime import datetime
-from datetime import timedelta
 from testfixtures import LogCapture
 
 
@@ -59,6 +58,21 @@ def test_parse_new_patient():
     assert answer6 == expected6
 
 
+def test_parse_new_patient_retention():
+    from heart_rate_sentinel import parse_new_patient
+    assert parse_new_patient({"patient_id": 1, "patient_age": 50,
+                              "retention_readings": "1000",
+                              "retention_seconds": None}) == \
+        {"patient_id": 1, "patient_age": 50, "retention_readings": 1000,
+         "retention_seconds": None}
+    assert parse_new_patient({"patient_id": 1, "patient_age": 50,
+                              "retention_seconds": "a day"}) == \
+        "retention_seconds is not a number or can't convert to integer"
+    assert parse_new_patient({"patient_id": 1, "patient_age": 50,
+                              "retention_readings": 0}) == \
+        "retention_readings must be at least 1"
+
+
 def test_validate_new_patient():
     from heart_rate_sentinel import validate_new_patient
     test_in_new_patient1 = {"patient_id": 1,
@@ -172,6 +186,51 @@ def test_add_new_attending():
     assert answer == expected
 
 
+def test_import_records():
+    from heart_rate_sentinel import import_records, storage
+    test_lines = ['{"attending_username": "Imp.A", '
+                  '"attending_email": "imp.a@doctor.com", '
+                  '"attending_phone": "000-000-0000"}\n',
+                  '{"patient_id": "9001", "attending_username": "Imp.A", '
+                  '"patient_age": "60"}\n',
+                  '\n',
+                  b'{"patient_id": 9002, "attending_username": "Imp.A", '
+                  b'"patient_age": 70}\n',
+                  '{"patient_id": 9003, "attending_username": "Imp.A"}\n',
+                  '{"patient_id": "9x", "attending_username": "Imp.A", '
+                  '"patient_age": 1}\n',
+                  'not json\n',
+                  '{"patient_id": 9001, "attending_username": "Imp.A", '
+                  '"patient_age": 61}\n']
+    expected = {"patients_added": 2, "attendings_added": 1, "rejected": 4,
+                "rejects": [{"line": 5,
+                             "error": "No such key: patient_age"},
+                            {"line": 6,
+                             "error": "Patient ID is not a number or can't "
+                                      "convert to integer"},
+                            {"line": 7,
+                             "error": "The input was not a dictionary"},
+                            {"line": 8,
+                             "error": "Patient 9001 already exists"}]}
+    answer = import_records(test_lines)
+    assert answer == expected
+    assert storage.get_patient(9001) == {"patient_id": 9001,
+                                         "attending_username": "Imp.A",
+                                         "patient_age": 60}
+    assert storage.get_patient(9002) is not None
+    assert storage.get_attending("Imp.A")["attending_email"] == \
+        "imp.a@doctor.com"
+
+
+def test_read_lines():
+    from heart_rate_sentinel import read_lines
+    from io import BytesIO
+    test_stream = BytesIO(b'{"a": 1}\n{"b": 2}\n\n{"c": 3}')
+    expected = [b'{"a": 1}', b'{"b": 2}', b'', b'{"c": 3}']
+    answer = list(read_lines(test_stream, chunk_size=3))
+    assert answer == expected
+
+
 def test_heart_rate_timestamp():
     pass
 
@@ -204,119 +263,250 @@ def test_validate_heart_rate_timestamp():
     assert answer3 == expected3
     assert answer4 == expected4
     assert answer5 == expected5
-
-
-def test_find_patient():
+    test_in_heart_rate6 = {"patient_id": 1, "heart_rate": [1]}
+    test_in_heart_rate7 = {"patient_id": None, "heart_rate": 100}
+    answer6 = validate_heart_rate_timestamp(test_in_heart_rate6,
+                                            test_expected_keys)
+    answer7 = validate_heart_rate_timestamp(test_in_heart_rate7,
+                                            test_expected_keys)
+    assert answer6 == ("The key heart_rate has the wrong data type", 400)
+    assert answer7 == ("The key patient_id has the wrong data type", 400)
+    test_in_heart_rate8 = {"patient_id": 1, "heart_rate": 2 ** 63}
+    test_in_heart_rate9 = {"patient_id": str(-2 ** 63 - 1), "heart_rate": 1}
+    answer8 = validate_heart_rate_timestamp(test_in_heart_rate8,
+                                            test_expected_keys)
+    answer9 = validate_heart_rate_timestamp(test_in_heart_rate9,
+                                            test_expected_keys)
+    assert answer8 == ("The key heart_rate is out of range", 400)
+    assert answer9 == ("The key patient_id is out of range", 400)
+    for heart_rate in (-1, 601, 2 ** 40):
+        assert validate_heart_rate_timestamp(
+            {"patient_id": 1, "heart_rate": heart_rate},
+            test_expected_keys) == ("The key heart_rate is out of range",
+                                    400)
+    assert validate_heart_rate_timestamp(
+        {"patient_id": 1, "heart_rate": 600}, test_expected_keys) == \
+        (True, 200)
+
+
+def test_heart_rate_batch_reports_bad_items():
+    from heart_rate_sentinel import app, storage
+    client = app.test_client()
+    client.post("/api/new_patient",
+                json={"patient_id": 7501, "attending_username": "Smith.J",
+                      "patient_age": 50})
+    r = client.post("/api/heart_rate/batch", json=[
+        {"patient_id": 7501, "heart_rate": 80},
+        {"patient_id": 7501, "heart_rate": [1]},
+        {"patient_id": None, "heart_rate": 80},
+        {"patient_id": {"id": 7501}, "heart_rate": 80},
+        {"patient_id": 7501, "heart_rate": None},
+        {"patient_id": 7501, "heart_rate": 2 ** 63}])
+    assert r.status_code == 200
+    assert r.get_json()["added"] == 1
+    assert [result["status"] for result in r.get_json()["results"]] == \
+        [200, 400, 400, 400, 400, 400]
+    assert r.get_json()["results"][1]["message"] == \
+        "The key heart_rate has the wrong data type"
+    assert storage.readings(7501)[0] == [80]
+    r = client.post("/api/heart_rate",
+                    json={"patient_id": 7501, "heart_rate": 2 ** 63})
+    assert r.status_code == 400
+    assert storage.readings(7501)[0] == [80]
+
+
+def test_huge_heart_rates_rejected(tmp_path, monkeypatch):
+    import heart_rate_sentinel
+    from storage import make_storage
+    for backend in ("memory", "sqlite"):
+        (tmp_path / backend).mkdir()
+        test_storage = make_storage(backend, str(tmp_path / backend))
+        test_storage.open()
+        monkeypatch.setattr(heart_rate_sentinel, "storage", test_storage)
+        client = heart_rate_sentinel.app.test_client()
+        client.post("/api/new_patient",
+                    json={"patient_id": 1, "attending_username": "Smith.J",
+                          "patient_age": 50})
+        # Either one would overflow the running sums of squares
+        for heart_rate in (2 ** 40, 2 ** 62, 2 ** 62):
+            r = client.post("/api/heart_rate",
+                            json={"patient_id": 1, "heart_rate": heart_rate})
+            assert r.status_code == 400
+        r = client.post("/api/heart_rate/batch",
+                        json=[{"patient_id": 1, "heart_rate": 80},
+                              {"patient_id": 1, "heart_rate": 2 ** 40}])
+        assert [result["status"] for result in r.get_json()["results"]] == \
+            [200, 400]
+        assert client.get("/api/heart_rate/stats/1").status_code == 200
+        assert test_storage.readings(1)[0] == [80]
+        test_storage.close()
+
+
+def test_parse_heart_rate_batch():
+    from heart_rate_sentinel import parse_heart_rate_batch
+    test_list = '[{"patient_id": 1, "heart_rate": 100}, ' \
+                '{"patient_id": 2, "heart_rate": 90}]'
+    test_ndjson = '{"patient_id": 1, "heart_rate": 100}\n' \
+                  '\n' \
+                  '{"patient_id": 2, "heart_rate": 9\n' \
+                  '{"patient_id": 2, "heart_rate": 90}\n'
+    test_single = '{"patient_id": 1, "heart_rate": 100}'
+    expected1 = [{"patient_id": 1, "heart_rate": 100},
+                 {"patient_id": 2, "heart_rate": 90}]
+    expected2 = [{"patient_id": 1, "heart_rate": 100},
+                 None,
+                 {"patient_id": 2, "heart_rate": 90}]
+    expected3 = [{"patient_id": 1, "heart_rate": 100}]
+    assert parse_heart_rate_batch(test_list) == expected1
+    assert parse_heart_rate_batch(test_ndjson) == expected2
+    assert parse_heart_rate_batch(test_single) == expected3
+    assert parse_heart_rate_batch("") == []
+
+
+def test_group_heart_rate_batch():
+    from heart_rate_sentinel import group_heart_rate_batch
+    test_batch = [{"patient_id": 1, "heart_rate": 100},
+                  {"patient_id": "2", "heart_rate": "90"},
+                  None,
+                  {"patient_id": 1},
+                  {"patient_id": 1, "heart_rate": 120}]
+    expected_results = [None,
+                        None,
+                        {"message": "The input was not a dictionary",
+                         "status": 400},
+                        {"message": "The key heart_rate is missing from "
+                                    "input",
+                         "status": 400},
+                        None]
+    expected_groups = {1: [0, 4], 2: [1]}
+    results, groups = group_heart_rate_batch(test_batch)
+    assert results == expected_results
+    assert groups == expected_groups
+
+
+def test_new_patient_refuses_existing_patient():
+    from heart_rate_sentinel import app, storage
+    client = app.test_client()
+    patient = {"patient_id": 7301, "attending_username": "Smith.J",
+               "patient_age": 50}
+    assert client.post("/api/new_patient", json=patient).status_code == 200
+    assert client.post("/api/heart_rate", json={
+        "patient_id": 7301, "heart_rate": 80}).status_code == 200
+    r = client.post("/api/new_patient", json=dict(patient, patient_age=60))
+    assert r.status_code == 400
+    assert r.get_data(as_text=True) == "Patient 7301 already exists"
+    # The patient and its readings are kept
+    assert storage.get_patient(7301)["patient_age"] == 50
+    assert storage.readings(7301)[0] == [80]
+
+
+def test_cluster_routes_need_token():
+    from heart_rate_sentinel import app, storage, CLUSTER_TOKEN_HEADER
+    client = app.test_client()
+    exported = {"patient": {"patient_id": 7401,
+                            "attending_username": "Smith.J",
+                            "patient_age": 50},
+                "heart_rate": [80], "timestamp": ["2018-03-09 11:00:00"]}
+    app.config["CLUSTER_TOKEN"] = None
+    r = client.post("/api/cluster/patients", json=exported,
+                    headers={CLUSTER_TOKEN_HEADER: ""})
+    assert r.status_code == 403
+    app.config["CLUSTER_TOKEN"] = "secret"
+    try:
+        for headers in ({}, {CLUSTER_TOKEN_HEADER: "guess"}):
+            assert client.post("/api/cluster/patients", json=exported,
+                               headers=headers).status_code == 403
+            assert client.delete("/api/cluster/patients/1",
+                                 headers=headers).status_code == 403
+            assert client.get("/api/cluster/patients",
+                              headers=headers).status_code == 403
+        assert storage.get_patient(7401) is None
+        headers = {CLUSTER_TOKEN_HEADER: "secret"}
+        # The imported patient is validated as a new patient is
+        invalid = dict(exported, patient={"patient_id": "74x",
+                                          "attending_username": "Smith.J",
+                                          "patient_age": 50})
+        r = client.post("/api/cluster/patients", json=invalid,
+                        headers=headers)
+        assert r.status_code == 400
+        invalid = dict(exported, patient={"patient_id": 7401,
+                                          "patient_age": 50})
+        r = client.post("/api/cluster/patients", json=invalid,
+                        headers=headers)
+        assert r.status_code == 400
+        assert storage.get_patient(7401) is None
+        r = client.post("/api/cluster/patients", json=exported,
+                        headers=headers)
+        assert r.status_code == 200
+        assert storage.readings(7401)[0] == [80]
+        r = client.delete("/api/cluster/patients/7401", headers=headers)
+        assert r.status_code == 200
+        assert storage.get_patient(7401) is None
+    finally:
+        app.config["CLUSTER_TOKEN"] = None
+
+
+def test_add_heart_rate_group():
+    from heart_rate_sentinel import add_heart_rate_group, add_new_patient
+    from heart_rate_sentinel import storage
+    add_new_patient(547, "Smith.J", 30)
+    timestamp = datetime(2021, 10, 29, 21, 56, 53)
+    answer1 = add_heart_rate_group(547, [80, 90], timestamp)
+    answer2 = add_heart_rate_group(547, [70], timestamp)
+    answer3 = add_heart_rate_group(548, [70], timestamp)
+    assert answer1 == ("Added test to patient id 547", 200)
+    assert answer2 == ("Added test to patient id 547", 200)
+    assert answer3 == ("Patient ID 548 not found in database", 400)
+    heart_rates, timestamps = storage.readings(547)
+    assert heart_rates == [80, 90, 70]
+    assert timestamps[-1] == "2021-10-29 21:56:53"
+
+
+def test_find_patient_storage():
     from heart_rate_sentinel import find_patient
-    test_patients_db = [{"patient_id": 1,
-                         "attending_username": "Smith.J",
-                         "patient_age": 50,
-                         "heart_rate": [],
-                         "timestamp": []},
-                        {"patient_id": 2,
-                         "attending_username": "Ann.A",
-                         "patient_age": 40}]
+    from storage import MemoryStorage
+    test_storage = MemoryStorage()
+    test_storage.add_patients([{"patient_id": 1,
+                                "attending_username": "Smith.J",
+                                "patient_age": 50},
+                               {"patient_id": 2,
+                                "attending_username": "Ann.A",
+                                "patient_age": 40}])
+    test_storage.add_readings(1, [100], datetime(2000, 3, 9, 12, 0, 0))
     expected1 = {"patient_id": 1,
                  "attending_username": "Smith.J",
-                 "patient_age": 50,
-                 "heart_rate": [],
-                 "timestamp": []}, 0, []
+                 "patient_age": 50}, 1, []
     expected2 = {"patient_id": 2,
                  "attending_username": "Ann.A",
-                 "patient_age": 40}, 1, True
-    expected3 = {"patient_id": 2,
-                 "attending_username": "Ann.A",
-                 "patient_age": 40}, 1, False
-    answer1 = find_patient(1, test_patients_db)
-    answer2 = find_patient(2, test_patients_db)
-    answer3 = find_patient(3, test_patients_db)
+                 "patient_age": 40}, 2, True
+    expected3 = None, 3, False
+    answer1 = find_patient(1, test_storage)
+    answer2 = find_patient(2, test_storage)
+    answer3 = find_patient(3, test_storage)
     assert answer1 == expected1
     assert answer2 == expected2
     assert answer3 == expected3
 
 
-def test_add_heart_rate_timestamp_keys():
-    from heart_rate_sentinel import add_heart_rate_timestamp_keys
-    test_id1 = 1
-    test_username = "Smith.J"
-    test_age = 50
-    test_patient = {"patient_id": test_id1,
-                    "attending_username": test_username,
-                    "patient_age": test_age}
-    expected = {"patient_id": test_id1,
-                "attending_username": test_username,
-                "patient_age": test_age,
-                "heart_rate": [],
-                "timestamp": []}
-    answer = add_heart_rate_timestamp_keys(test_patient)
-    assert answer == expected
-
-
-def test_add_heart_rate_timestamp_info():
-    from heart_rate_sentinel import add_heart_rate_timestamp_info
-    test_patient1 = {"patient_id": 1,
-                     "attending_username": "Smith.J",
-                     "patient_age": 50,
-                     "heart_rate": [],
-                     "timestamp": []}
-    test_in_heart_rate = {"patient_id": 1, "heart_rate": 100}
-    expected1 = {"patient_id": 1,
-                 "attending_username": "Smith.J",
-                 "patient_age": 50,
-                 "heart_rate": [100],
-                 "timestamp": [datetime.now()]}
-    answer1 = add_heart_rate_timestamp_info(test_patient1, test_in_heart_rate)
-    assert answer1["patient_id"] == expected1["patient_id"]
-    assert answer1["attending_username"] == expected1["attending_username"]
-    assert answer1["patient_age"] == expected1["patient_age"]
-    assert answer1["heart_rate"] == expected1["heart_rate"]
-    ans_time_dt1 = datetime.strptime(answer1["timestamp"][0],
-                                     "%Y-%m-%d %H:%M:%S")
-    exp_time_dt1 = expected1["timestamp"][0]
-    assert ans_time_dt1 <= exp_time_dt1 + timedelta(minutes=1)
-    test_patient2 = {"patient_id": 1,
-                     "attending_username": "Smith.J",
-                     "patient_age": 50,
-                     "heart_rate": [100],
-                     "timestamp": [datetime.now()]}
-    expected2 = {"patient_id": 1,
-                 "attending_username": "Smith.J",
-                 "patient_age": 50,
-                 "heart_rate": [100, 100],
-                 "timestamp": ["2001-10-10 00:00:00", datetime.now()]}
-    answer2 = add_heart_rate_timestamp_info(test_patient2, test_in_heart_rate)
-    assert answer2["patient_id"] == expected2["patient_id"]
-    assert answer2["attending_username"] == expected2["attending_username"]
-    assert answer2["patient_age"] == expected2["patient_age"]
-    assert answer2["heart_rate"] == expected2["heart_rate"]
-    ans_time_dt2 = datetime.strptime(answer2["timestamp"][-1],
-                                     "%Y-%m-%d %H:%M:%S")
-    exp_time_dt2 = expected2["timestamp"][-1]
-    assert ans_time_dt2 <= exp_time_dt2 + timedelta(minutes=1)
-
-
-def test_find_patient_all():
+def test_find_patient_all_storage():
     from heart_rate_sentinel import find_patient_all
-    test_find_1 = {"patient_id": 1,
-                   "attending_username": "Smith.J",
-                   "patient_age": 50,
-                   "heart_rate": [100]}
-    test_find_2 = {"patient_id": 1,
-                   "attending_username": "Smith.J",
-                   "patient_age": 50,
-                   "heart_rate": [120]}
-    full_test_list = [test_find_1, test_find_2]
-    answer = find_patient_all(1, full_test_list)
+    from storage import MemoryStorage
+    test_storage = MemoryStorage()
+    test_storage.add_patients([{"patient_id": 1,
+                                "attending_username": "Smith.J",
+                                "patient_age": 50},
+                               {"patient_id": 2,
+                                "attending_username": "Smith.J",
+                                "patient_age": 50}])
+    test_storage.add_readings(1, [100], datetime(2000, 3, 9, 12, 0, 0))
     expected = [{"patient_id": 1,
                  "attending_username": "Smith.J",
                  "patient_age": 50,
-                 "heart_rate": [100]},
-                {"patient_id": 1,
-                 "attending_username": "Smith.J",
-                 "patient_age": 50,
-                 "heart_rate": [120]}
-                ]
-    assert answer == expected
+                 "heart_rate": [100],
+                 "timestamp": ["2000-03-09 12:00:00"]}]
+    assert find_patient_all(1, test_storage) == expected
+    assert find_patient_all(2, test_storage) == []
+    assert find_patient_all(3, test_storage) == []
 
 
 def test_is_tachy():
@@ -339,33 +529,6 @@ def test_is_tachy():
     assert answer_2 == expected_2
 
 
-def test_cal_avg_hr():
-    from heart_rate_sentinel import cal_avg_hr
-    test_1 = [{"patient_id": 1,
-               "attending_username": "Smith.J",
-               "patient_age": 50,
-               "heart_rate": [100]},
-              {"patient_id": 1,
-               "attending_username": "Smith.J",
-               "patient_age": 50,
-               "heart_rate": [130]}]
-
-    test_2 = [{"patient_id": 2,
-               "attending_username": "Smith.K",
-               "patient_age": 50,
-               "heart_rate": [120]},
-              {"patient_id": 2,
-               "attending_username": "Smith.K",
-               "patient_age": 50,
-               "heart_rate": [130]}]
-    answer_1 = cal_avg_hr(test_1)
-    answer_2 = cal_avg_hr(test_2)
-    expected_1 = 115.0
-    expected_2 = 125.0
-    assert answer_1 == expected_1
-    assert answer_2 == expected_2
-
-
 def test_interval_average():
     pass
 
@@ -398,133 +561,113 @@ def test_validate_interval_average():
     assert answer5 == expected5
 
 
-def test_get_patient_hr_entries():
-    from heart_rate_sentinel import get_patient_hr_entries
-    test1 = {"patient_id": 1,
-             "attending_username": "Smith.J",
-             "patient_age": 50,
-             "heart_rate": [100, 100, 100, 110, 120],
-             "timestamp": [datetime(2000, 3, 9, 1, 0, 0),
-                           datetime(2000, 3, 9, 2, 0, 0),
-                           datetime(2000, 3, 9, 3, 0, 0),
-                           datetime(2000, 3, 9, 4, 0, 0),
-                           datetime(2000, 3, 9, 12, 0, 0)]}
-    expected = [100, 100, 100, 110, 120]
-    answer = get_patient_hr_entries(test1)
-    assert answer == expected
-
-
-def test_get_patient_timestamp_entries():
-    from heart_rate_sentinel import get_patient_timestamp_entries
-    test1 = {"patient_id": 1,
-             "attending_username": "Smith.J",
-             "patient_age": 50,
-             "heart_rate": [100, 100, 100, 110, 120],
-             "timestamp": [datetime(2000, 3, 9, 1, 0, 0),
-                           datetime(2000, 3, 9, 2, 0, 0),
-                           datetime(2000, 3, 9, 3, 0, 0),
-                           datetime(2000, 3, 9, 4, 0, 0),
-                           datetime(2000, 3, 9, 12, 0, 0)]}
-    expected = [datetime(2000, 3, 9, 1, 0, 0),
-                datetime(2000, 3, 9, 2, 0, 0),
-                datetime(2000, 3, 9, 3, 0, 0),
-                datetime(2000, 3, 9, 4, 0, 0),
-                datetime(2000, 3, 9, 12, 0, 0)]
-    answer = get_patient_timestamp_entries(test1)
-    assert answer == expected
-
-
-def test_calculate_hrs_after():
-    from heart_rate_sentinel import calculate_hrs_after
-    test_hr_entries = [100, 100, 100, 110, 120]
-    test_timestamp_entries = ["2000-03-09 01:00:00",
-                              "2000-03-09 02:00:00",
-                              "2000-03-09 03:00:00",
-                              "2000-03-09 04:00:00",
-                              "2000-03-09 12:00:00"]
-    test_heart_rate_average_since1 = "2000-03-09 00:00:00"
-    test_heart_rate_average_since2 = "2000-03-09 05:00:00"
-    test_heart_rate_average_since3 = "2000-03-09 13:00:00"
-    test_heart_rate_average_since4 = "2000-04-09 00:00:00"
-    expected1 = [100, 100, 100, 110, 120]
-    expected2 = [120]
-    expected3 = []
-    expected4 = []
-    answer1 = calculate_hrs_after(test_hr_entries, test_timestamp_entries,
-                                  test_heart_rate_average_since1)
-    answer2 = calculate_hrs_after(test_hr_entries, test_timestamp_entries,
-                                  test_heart_rate_average_since2)
-    answer3 = calculate_hrs_after(test_hr_entries, test_timestamp_entries,
-                                  test_heart_rate_average_since3)
-    answer4 = calculate_hrs_after(test_hr_entries, test_timestamp_entries,
-                                  test_heart_rate_average_since4)
-    assert answer1 == expected1
-    assert answer2 == expected2
-    assert answer3 == expected3
-    assert answer4 == expected4
-
-
-def test_calculate_average_since():
-    from heart_rate_sentinel import calculate_average_since
-    test_hrs_after_time = [100, 100, 100, 110, 120]
-    expected = 106
-    answer = calculate_average_since(test_hrs_after_time)
-    assert answer == expected
+def test_calculate_interval_average():
+    from heart_rate_sentinel import calculate_interval_average
+    from storage import MemoryStorage
+    test_storage = MemoryStorage()
+    patient = {"patient_id": 1, "attending_username": "Smith.J",
+               "patient_age": 50}
+    test_storage.add_patients([patient])
+    for heart_rate, hour in zip([100, 100, 100, 110, 120], [1, 2, 3, 4, 12]):
+        test_storage.add_readings(1, [heart_rate],
+                                  datetime(2000, 3, 9, hour, 0, 0))
+    assert calculate_interval_average(patient, "2000-03-09 00:00:00",
+                                      test_storage) == 106
+    assert calculate_interval_average(patient, "2000-03-09 03:00:00",
+                                      test_storage) == 115
+    assert calculate_interval_average(patient, "2000-03-09 13:00:00",
+                                      test_storage) is None
+
+
+def test_window_args():
+    from heart_rate_sentinel import window_args
+    from hr_series import to_epoch
+    import pytest
+    since = "2018-03-09 11:00:00"
+    assert window_args({}) == (None, "raw")
+    assert window_args({"since": since, "resolution": "hour"}) == \
+        (to_epoch(since), "hour")
+    assert window_args({"since": since, "resolution": "auto"}) == \
+        (to_epoch(since), "day")
+    with pytest.raises(ValueError):
+        window_args({"since": "yesterday"})
+    with pytest.raises(ValueError):
+        window_args({"resolution": "week"})
+    with pytest.raises(ValueError):
+        window_args({"resolution": "auto"})
+
+
+def test_window_average_and_history():
+    from heart_rate_sentinel import window_average, window_history
+    from hr_series import to_epoch
+    from storage import MemoryStorage
+    storage = MemoryStorage()
+    storage.add_patients([{"patient_id": 1, "attending_username": "Smith.J",
+                           "patient_age": 50}])
+    storage.add_readings(1, [100], datetime(2000, 3, 9, 1, 0, 0))
+    storage.add_readings(1, [100, 110], datetime(2000, 3, 9, 1, 30, 0))
+    storage.add_readings(1, [120], datetime(2000, 3, 9, 2, 15, 0))
+    since = to_epoch("2000-03-09 01:00:00")
+    assert window_average(1, since, "raw", storage) == 110
+    assert window_average(1, since, "hour", storage) == 107.5
+    assert window_average(1, since + 7200, "raw", storage) is None
+    assert window_history(1, since, "raw", storage) == [100, 110, 120]
+    assert window_history(1, None, "hour", storage) == [
+        {"timestamp": "2000-03-09 01:00:00", "count": 3,
+         "average": 310 / 3, "min": 100, "max": 110},
+        {"timestamp": "2000-03-09 02:00:00", "count": 1,
+         "average": 120, "min": 120, "max": 120}]
+    assert window_history(2, None, "day", storage) == []
+
+
+def test_average_route_needs_since_for_resolution():
+    from heart_rate_sentinel import app
+    client = app.test_client()
+    client.post("/api/new_patient",
+                json={"patient_id": 7502, "attending_username": "Smith.J",
+                      "patient_age": 50})
+    client.post("/api/heart_rate", json={"patient_id": 7502,
+                                         "heart_rate": 80})
+    r = client.get("/api/heart_rate/average/7502?resolution=hour")
+    assert r.status_code == 400
+    assert r.get_data(as_text=True) == "resolution needs a since date"
+    r = client.get("/api/heart_rate/average/7502?since=2000-03-09 01:00:00"
+                   "&resolution=hour")
+    assert (r.status_code, r.get_json()) == (200, 80)
 
 
 def test_attending_patients():
     pass
 
 
-def test_find_patients():
+def test_find_patients_storage():
     from heart_rate_sentinel import find_patients
-    test_attending_username1 = "Smith.J"
-    test_attending_username2 = "Ann.A"
-    test_attending_username3 = "Bob.B"
-    test_patients_db = [{"patient_id": 1,
-                         "attending_username": "Smith.J",
-                         "patient_age": 50,
-                         "heart_rate": [100, 100, 100, 110, 120],
-                         "timestamp": ["2000-03-09 01:00:00",
-                                       "2000-03-09 02:00:00",
-                                       "2000-03-09 03:00:00",
-                                       "2000-03-09 04:00:00",
-                                       "2000-03-09 12:00:00"]},
-                        {"patient_id": 2,
-                         "attending_username": "Smith.J",
-                         "patient_age": 50,
-                         "heart_rate": [100, 100, 100, 110, 100],
-                         "timestamp": ["2000-03-09 01:00:00",
-                                       "2000-03-09 02:00:00",
-                                       "2000-03-09 03:00:00",
-                                       "2000-03-09 04:00:00",
-                                       "2000-03-09 12:00:00"]},
-                        {"patient_id": 10,
-                         "attending_username": "Bob.B",
-                         "patient_age": 100}]
+    from storage import MemoryStorage
+    test_storage = MemoryStorage()
+    test_storage.add_patients([{"patient_id": 1,
+                                "attending_username": "Smith.J",
+                                "patient_age": 50},
+                               {"patient_id": 10,
+                                "attending_username": "Bob.B",
+                                "patient_age": 100}])
+    test_storage.add_readings(1, [120], datetime(2000, 3, 9, 12, 0, 0))
     expected1 = [{"patient_id": 1,
                   "last_heart_rate": 120,
                   "last_time": "2000-03-09 12:00:00",
-                  "status": "tachycardic"},
-                 {"patient_id": 2,
-                  "last_heart_rate": 100,
-                  "last_time": "2000-03-09 12:00:00",
                   "status": "tachycardic"}]
     expected2 = []
     expected3 = [{"patient_id": 10,
                   "last_heart_rate": "No entries",
                   "last_time": "No entries",
                   "status": "No entries"}]
-    answer1 = find_patients(test_attending_username1, test_patients_db)
-    answer2 = find_patients(test_attending_username2, test_patients_db)
-    answer3 = find_patients(test_attending_username3, test_patients_db)
-    assert answer1 == expected1
-    assert answer2 == expected2
-    assert answer3 == expected3
+    assert find_patients("Smith.J", test_storage) == expected1
+    assert find_patients("Ann.A", test_storage) == expected2
+    assert find_patients("Bob.B", test_storage) == expected3
 
 
 def test_validate_attendings_patients():
     from heart_rate_sentinel import validate_attendings_patients
+    from storage import MemoryStorage
     test_attending_username1 = 1
     test_attending_username2 = "Smith.J"
     test_attending_username3 = "Bob.B"
@@ -539,14 +682,16 @@ def test_validate_attendings_patients():
     expected2 = True, 200
     expected3 = True, 200
     expected4 = "Attending physician Ann.A not found", 400
+    test_storage = MemoryStorage()
+    test_storage.add_attendings(test_attending_db)
     answer1 = validate_attendings_patients(test_attending_username1,
-                                           test_attending_db)
+                                           test_storage)
     answer2 = validate_attendings_patients(test_attending_username2,
-                                           test_attending_db)
+                                           test_storage)
     answer3 = validate_attendings_patients(test_attending_username3,
-                                           test_attending_db)
+                                           test_storage)
     answer4 = validate_attendings_patients(test_attending_username4,
-                                           test_attending_db)
+                                           test_storage)
     assert answer1 == expected1
     assert answer2 == expected2
     assert answer3 == expected3
@@ -0,0 +1,99 @@
+from io import StringIO
+from flask import Flask, request
+
+load_app = Flask(__name__)
+sent = []
+
+
+@load_app.route("/api/<path:path>", methods=["GET", "POST"])
+def answer(path):
+    sent.append((request.method, path))
+    return "", 400 if path == "missing" else 200
+
+
+def test_simulate():
+    from heart_rate_sentinel_client import simulate
+    traffic = list(simulate(2, 4, 2, reading_rate=1, poll_rate=0.5, seed=1))
+    assert [made["path"] for made in traffic[:6]] == \
+        ["/api/new_attending"] * 2 + ["/api/new_patient"] * 4
+    assert {made["json"]["attending_username"]
+            for made in traffic[2:6]} == {"Attending.1", "Attending.2"}
+    timed = traffic[6:]
+    assert [made["time"] for made in timed] == \
+        sorted(made["time"] for made in timed)
+    assert all(0 <= made["time"] < 2 for made in timed)
+    assert sum(made["path"] == "/api/heart_rate" for made in timed) == 8
+    assert sum(made["route"] == "/api/patients/<attending_username>"
+               for made in timed) == 2
+    # The same seed makes the same traffic
+    assert list(simulate(2, 4, 2, seed=1)) == list(simulate(2, 4, 2, seed=1))
+
+
+def test_traffic_round_trip():
+    from heart_rate_sentinel_client import simulate, read_traffic, \
+        write_traffic
+    out_file = StringIO()
+    traffic = list(write_traffic(simulate(1, 2, 1, seed=2), out_file))
+    assert list(read_traffic(StringIO(out_file.getvalue() + "\n"))) == \
+        traffic
+
+
+def test_run_load():
+    from heart_rate_sentinel_client import run_load, app_sender
+    sent.clear()
+    traffic = [{"method": "POST", "path": "/api/new_patient", "json": {}},
+               {"method": "GET", "path": "/api/missing"}] + \
+        [{"time": count / 100, "method": "POST", "path": "/api/heart_rate",
+          "route": "/api/heart_rate", "json": {"heart_rate": 70}}
+         for count in range(10)] + \
+        [{"time": 0.1, "method": "GET", "path": "/api/missing"}]
+    report = run_load(traffic, app_sender(load_app), threads=4)
+    # The untimed requests are sent first and only counted
+    assert sent[:2] == [("POST", "new_patient"), ("GET", "missing")]
+    assert len(sent) == 13
+    assert (report.setup_requests, report.setup_errors) == (2, 1)
+    missing, heart_rate, every = report.summary()
+    assert heart_rate["route"] == "POST /api/heart_rate"
+    assert (heart_rate["requests"], heart_rate["errors"]) == (10, 0)
+    assert missing["route"] == "GET /api/missing"
+    assert (missing["requests"], missing["errors"]) == (1, 1)
+    assert (every["requests"], every["errors"]) == (11, 1)
+    assert 0 < heart_rate["p50"] <= heart_rate["p95"] <= heart_rate["p99"]
+    # Sent at their times, over about 0.1 s
+    assert report.seconds >= 0.1
+    assert every["throughput"] == 11 / report.seconds
+
+
+def test_run_load_counts_waiting_for_a_thread():
+    import time
+    from heart_rate_sentinel_client import run_load
+
+    def slow_send(made):
+        time.sleep(0.05)
+        return 200
+
+    traffic = [{"time": 0, "method": "GET", "path": "/api"}
+               for _ in range(5)]
+    every = run_load(traffic, slow_send, threads=1).summary()[-1]
+    # All five were due at once, so the last waited for the other four
+    assert every["p99"] >= 0.2
+    # As fast as possible, only the time to answer counts
+    every = run_load(traffic, slow_send, threads=1, speed=0).summary()[-1]
+    assert every["p99"] < 0.15
+
+
+def test_load_report():
+    from heart_rate_sentinel_client import LoadReport
+    report = LoadReport()
+    for count in range(1, 101):
+        report.add("GET /api", count / 1000, False)
+    report.add("GET /api", None, True)
+    report.seconds = 2.0
+    row = report.summary()[0]
+    assert (row["requests"], row["errors"], row["throughput"]) == \
+        (101, 1, 50.5)
+    assert (row["p50"], row["p95"], row["p99"]) == (0.051, 0.096, 0.1)
+    lines = report.format().splitlines()
+    assert lines[0].split()[:4] == ["route", "requests", "errors", "req/s"]
+    assert lines[1].split() == ["GET", "/api", "101", "1", "50.5", "51.0",
+                                "96.0", "100.0"]
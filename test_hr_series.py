@@ -0,0 +1,119 @@
+from datetime import datetime
+
+
+def test_to_epoch_and_format_epoch():
+    from hr_series import to_epoch, format_epoch
+    answer1 = to_epoch(datetime(2018, 3, 9, 11, 0, 36))
+    answer2 = to_epoch("2018-03-09 11:00:36")
+    expected = 1520593236
+    assert answer1 == expected
+    assert answer2 == expected
+    assert format_epoch(expected) == "2018-03-09 11:00:36"
+
+
+def test_heart_rate_series_views():
+    from hr_series import HeartRateSeries
+    series = HeartRateSeries()
+    assert series.heart_rate == []
+    assert series.timestamp == []
+    series.append(100, datetime(2018, 3, 9, 11, 0, 36))
+    series.append(120, datetime(2018, 3, 9, 11, 1, 0))
+    assert len(series) == 2
+    assert series.heart_rate == [100, 120]
+    assert series.heart_rate[-1] == 120
+    assert series.timestamp[-1] == "2018-03-09 11:01:00"
+    assert series.timestamp[:1] == ["2018-03-09 11:00:36"]
+    assert list(series.timestamp) == ["2018-03-09 11:00:36",
+                                      "2018-03-09 11:01:00"]
+
+
+def test_append_reading():
+    from hr_series import append_reading, new_series_keys, get_series
+    series_patient = {"patient_id": 1}
+    series_patient.update(new_series_keys())
+    list_patient = {"patient_id": 2, "heart_rate": [], "timestamp": []}
+    for patient in [series_patient, list_patient]:
+        append_reading(patient, 90, datetime(2021, 10, 29, 21, 56, 53))
+    assert get_series(series_patient) is not None
+    assert get_series(list_patient) is None
+    assert series_patient["heart_rate"] == [90]
+    assert series_patient["timestamp"] == ["2021-10-29 21:56:53"]
+    assert list_patient == {"patient_id": 2, "heart_rate": [90],
+                            "timestamp": ["2021-10-29 21:56:53"]}
+
+
+def test_heart_rate_series_sum_after():
+    from hr_series import HeartRateSeries, to_epoch
+    series = HeartRateSeries()
+    series.append(100, datetime(2000, 3, 9, 1, 0, 0))
+    series.append(100, datetime(2000, 3, 9, 2, 0, 0))
+    series.append(110, datetime(2000, 3, 9, 4, 0, 0))
+    series.append(120, datetime(2000, 3, 9, 12, 0, 0))
+    series.append(90, datetime(2000, 3, 9, 3, 0, 0))
+    assert series.heart_rate == [100, 100, 90, 110, 120]
+    assert series.timestamp[2] == "2000-03-09 03:00:00"
+    assert series.heart_rate[-1] == 120
+    assert series.heart_rate[1:3] == [100, 90]
+    answer1 = series.sum_after(to_epoch("2000-03-09 00:00:00"))
+    answer2 = series.sum_after(to_epoch("2000-03-09 02:00:00"))
+    answer3 = series.sum_after(to_epoch("2000-03-09 13:00:00"))
+    assert answer1 == (5, 520)
+    assert answer2 == (3, 320)
+    assert answer3 == (0, 0)
+
+
+def test_heart_rate_series_aggregates():
+    from hr_series import HeartRateSeries
+    series = HeartRateSeries()
+    assert series.sum_after(0) == (0, 0)
+    series.append(100, datetime(2000, 3, 9, 1, 0, 0))
+    series.append(120, datetime(2000, 3, 9, 2, 0, 0))
+    series.append(110, datetime(2000, 3, 9, 0, 0, 0))
+    assert series.minimum == 100
+    assert series.maximum == 120
+    assert series.sum_after(0) == (3, 330)
+    assert series.sum_squares == 36500
+
+
+def test_heart_rate_series_extend():
+    from hr_series import HeartRateSeries, append_readings
+    series = HeartRateSeries()
+    series.append(100, datetime(2000, 3, 9, 1, 0, 0))
+    series.extend([90, 130, 110], datetime(2000, 3, 9, 2, 0, 0))
+    series.extend([], datetime(2000, 3, 9, 3, 0, 0))
+    series.extend([80], datetime(2000, 3, 9, 0, 0, 0))
+    assert series.heart_rate == [80, 100, 90, 130, 110]
+    assert series.timestamp[-1] == "2000-03-09 02:00:00"
+    assert series.minimum == 80
+    assert series.maximum == 130
+    assert series.sum_after(0) == (5, 510)
+    list_patient = {"heart_rate": [], "timestamp": []}
+    append_readings(list_patient, [90, 100], datetime(2000, 3, 9, 2, 0, 0))
+    assert list_patient == {"heart_rate": [90, 100],
+                            "timestamp": ["2000-03-09 02:00:00",
+                                          "2000-03-09 02:00:00"]}
+
+
+def test_heart_rate_series_snapshot():
+    from hr_series import HeartRateSeries
+    series = HeartRateSeries()
+    empty = series.snapshot
+    assert len(empty) == 0
+    assert empty.latest() is None
+    assert empty.readings() == ([], [])
+    for epoch, heart_rate in ((10, 60), (20, 70), (30, 80)):
+        series.append_at(heart_rate, epoch)
+    snapshot = series.snapshot
+    assert snapshot.version == empty.version + 3
+    # Later readings, in order or not, leave the snapshot as it was
+    series.append_at(90, 40)
+    series.append_at(100, 15)
+    series.extend_at([110, 120], 50)
+    assert snapshot.readings() == ([60, 70, 80], [10, 20, 30])
+    assert snapshot.latest() == (80, 30)
+    assert (snapshot.total(), snapshot.minimum, snapshot.maximum,
+            snapshot.sum_squares) == (210, 60, 80, 60 ** 2 + 70 ** 2 + 80 ** 2)
+    assert snapshot.sum_after(15) == (2, 150)
+    assert series.snapshot.readings() == (list(series.heart_rate),
+                                          list(series.iter_epochs()))
+    assert series.snapshot.sum_after(15) == series.sum_after(15)
@@ -0,0 +1,40 @@
+import threading
+
+
+def test_lock_stripes_serialize_one_key():
+    from lock_stripes import LockStripes
+    stripes = LockStripes(4)
+    assert stripes.lock_for(1) is stripes.lock_for(5)
+    assert stripes.lock_for(1) is not stripes.lock_for(2)
+    counts = {1: 0, 2: 0}
+
+    def add_many(key):
+        for _ in range(10000):
+            with stripes.stripe(key):
+                value = counts[key]
+                counts[key] = value + 1
+
+    threads = [threading.Thread(target=add_many, args=(key,))
+               for key in (1, 1, 2, 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counts == {1: 20000, 2: 20000}
+
+
+def test_lock_stripes_exclusive():
+    from lock_stripes import LockStripes
+    stripes = LockStripes(4)
+    taken = []
+    with stripes:
+        with stripes.stripe(3):
+            pass
+        thread = threading.Thread(
+            target=lambda: taken.append(stripes.lock_for(3).acquire(
+                timeout=0.05)))
+        thread.start()
+        thread.join()
+    assert taken == [False]
+    assert stripes.lock_for(3).acquire(blocking=False)
+    stripes.lock_for(3).release()
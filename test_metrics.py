@@ -0,0 +1,135 @@
+from datetime import datetime
+import pytest
+
+
+def test_histogram_quantile():
+    from metrics import Histogram
+    histogram = Histogram(bounds=(1, 2, 4))
+    assert histogram.quantile(0.5) is None
+    for value in [0.5, 1.5, 1.5, 3]:
+        histogram.observe(value)
+    assert histogram.counts == [1, 2, 1, 0]
+    assert histogram.count == 4
+    assert histogram.total == 6.5
+    assert histogram.quantile(0.25) == 1
+    assert histogram.quantile(0.5) == 1.5
+    assert histogram.quantile(1) == 4
+    histogram.observe(100)
+    assert histogram.quantile(1) == 4
+
+
+def test_record_and_render():
+    from metrics import Metrics
+    registry = Metrics()
+    registry.record_request("/api/status/<patient_id>", "GET", 200, 0.002)
+    registry.record_request("/api/status/<patient_id>", "GET", 400, 0.0004)
+    registry.record_call("find_patient", 0.00001, failed=True)
+    text = registry.render()
+    labels = 'route="/api/status/<patient_id>",method="GET"'
+    assert "# TYPE hrs_requests_total counter" in text
+    assert "hrs_requests_total{%s} 2" % labels in text
+    assert "hrs_request_errors_total{%s} 1" % labels in text
+    assert 'hrs_request_duration_seconds_bucket{%s,le="0.0005"} 1' \
+        % labels in text
+    assert 'hrs_request_duration_seconds_bucket{%s,le="+Inf"} 2' \
+        % labels in text
+    assert "hrs_request_duration_seconds_count{%s} 2" % labels in text
+    assert 'hrs_request_latency_seconds{%s,quantile="0.99"}' % labels in text
+    assert 'hrs_function_calls_total{function="find_patient"} 1' in text
+    assert 'hrs_function_errors_total{function="find_patient"} 1' in text
+    registry.reset()
+    assert "hrs_requests_total{" not in registry.render()
+
+
+def test_gauges():
+    from metrics import Metrics
+    registry = Metrics()
+    lag = [None]
+    registry.set_gauge("replication_lag_seconds", "Lag.", lambda: lag[0])
+    assert "hrs_replication_lag_seconds" not in registry.render()
+    lag[0] = 0.25
+    text = registry.render()
+    assert "# TYPE hrs_replication_lag_seconds gauge" in text
+    assert "hrs_replication_lag_seconds 0.25" in text
+    registry.reset()
+    assert "hrs_replication_lag_seconds" not in registry.render()
+
+
+def test_timed():
+    from metrics import Metrics, timed
+    registry = Metrics()
+
+    @timed("halve", registry)
+    def halve(number):
+        if number % 2:
+            raise ValueError("odd")
+        return number // 2
+
+    assert halve(4) == 2
+    with pytest.raises(ValueError):
+        halve(3)
+    assert halve.__name__ == "halve"
+    assert registry.calls == {"halve": 2}
+    assert registry.call_errors == {"halve": 1}
+    registry.enabled = False
+    halve(2)
+    assert registry.calls == {"halve": 2}
+
+
+def test_instrument_storage():
+    from metrics import Metrics, instrument_storage
+    from storage import MemoryStorage
+    registry = Metrics()
+    storage = instrument_storage(MemoryStorage(), registry=registry)
+    storage.add_patients([{"patient_id": 1, "attending_username": "Smith.J",
+                           "patient_age": 50}])
+    storage.add_readings(1, [80, 90], datetime(2018, 3, 9, 11))
+    assert storage.readings(1)[0] == [80, 90]
+    assert storage.sum_after(1, 0) == (2, 170)
+    assert registry.calls == {"storage.add_readings": 1,
+                              "storage.readings": 1,
+                              "storage.sum_after": 1}
+
+
+def test_instrument_app():
+    from flask import Flask
+    from metrics import Metrics, instrument_app
+    app = Flask(__name__)
+    registry = Metrics()
+    instrument_app(app, registry)
+
+    @app.route("/api/item/<item_id>")
+    def get_item(item_id):
+        return "Item {}".format(item_id), 200 if item_id == "1" else 400
+
+    client = app.test_client()
+    client.get("/api/item/1")
+    client.get("/api/item/2")
+    client.get("/nowhere")
+    assert registry.requests == {("/api/item/<item_id>", "GET"): 2,
+                                 ("unmatched", "GET"): 1}
+    assert registry.request_errors == {("/api/item/<item_id>", "GET"): 1,
+                                       ("unmatched", "GET"): 1}
+
+
+def test_export_and_add():
+    from metrics import Metrics
+    workers = [Metrics(), Metrics()]
+    for registry in workers:
+        registry.record_request("/api/heart_rate", "POST", 200, 0.002)
+        registry.record_call("storage.add_readings", 0.0001)
+    workers[1].record_request("/api/heart_rate", "POST", 400, 0.0003)
+    workers[1].set_gauge("replication_lag_seconds", "Lag.", lambda: 0.5)
+    combined = Metrics()
+    for registry in workers:
+        combined.add(registry.export())
+    labels = 'route="/api/heart_rate",method="POST"'
+    text = combined.render()
+    assert "hrs_requests_total{%s} 3" % labels in text
+    assert "hrs_request_errors_total{%s} 1" % labels in text
+    assert 'hrs_request_duration_seconds_bucket{%s,le="0.0005"} 1' \
+        % labels in text
+    assert "hrs_request_duration_seconds_count{%s} 3" % labels in text
+    assert 'hrs_function_calls_total{function="storage.add_readings"} 2' \
+        in text
+    assert "hrs_replication_lag_seconds 0.5" in text
@@ -0,0 +1,142 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import requests
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "production.py")
+
+
+def start_server(directory, port, *args):
+    process = subprocess.Popen(
+        [sys.executable, SERVER, "--port", str(port)] + list(args),
+        cwd=str(directory))
+    url = "http://127.0.0.1:{}".format(port)
+    for _ in range(100):
+        try:
+            requests.get(url + "/api")
+            break
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    return process, url
+
+
+def test_production_server(tmp_path):
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+    process, url = start_server(tmp_path, port, "--threads", "4",
+                                "--max-body-size", "100000")
+    try:
+        session = requests.Session()
+        r = session.post(url + "/api/new_patient",
+                         json={"patient_id": 1,
+                               "attending_username": "Smith.J",
+                               "patient_age": 50})
+        assert r.status_code == 200
+        assert r.headers["Connection"] == "keep-alive"
+        r = session.post(url + "/api/heart_rate",
+                         json={"patient_id": 1, "heart_rate": 70})
+        assert r.status_code == 200
+        # Chunked bodies are limited by the app
+        r = requests.post(url + "/api/bulk_import",
+                          data=iter([b"x" * 60000, b"x" * 60000]))
+        assert r.status_code == 413
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(10) == 0
+    finally:
+        process.kill()
+        process.wait()
+    # The storage was closed with everything in it
+    process, url = start_server(tmp_path, port)
+    try:
+        assert requests.get(url + "/api/heart_rate/1").json() == [70]
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def test_production_server_drains(tmp_path):
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+    process, url = start_server(tmp_path, port)
+    try:
+        with socket.create_connection(("127.0.0.1", port)) as conn:
+            # A bulk import whose body is still being sent when the server
+            # is asked to stop
+            conn.sendall(b"POST /api/bulk_import HTTP/1.1\r\n"
+                         b"Host: 127.0.0.1\r\n"
+                         b"Transfer-Encoding: chunked\r\n\r\n")
+            line = b'{"patient_id": 1, "attending_username": "Smith.J", ' \
+                b'"patient_age": 50}\n'
+            first = b'{"attending_username": "Smith.J", ' \
+                b'"attending_email": "smith@hospital.org", ' \
+                b'"attending_phone": "919-867-5309"}\n' + line
+            conn.sendall("{:x}\r\n".format(len(first)).encode() + first +
+                         b"\r\n")
+            time.sleep(0.5)
+            process.send_signal(signal.SIGTERM)
+            time.sleep(0.5)
+            # No new connections are accepted meanwhile
+            try:
+                requests.get(url + "/api", timeout=1)
+                assert False, "a connection was accepted while stopping"
+            except requests.ConnectionError:
+                pass
+            line = line.replace(b"1,", b"2,")
+            conn.sendall("{:x}\r\n".format(len(line)).encode() + line +
+                         b"\r\n0\r\n\r\n")
+            response = b""
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                response += data
+        assert response.startswith(b"HTTP/1.1 200 OK")
+        assert b"Connection: close" in response
+        assert b'"patients_added":2' in response.replace(b" ", b"")
+        assert process.wait(10) == 0
+    finally:
+        process.kill()
+        process.wait()
+    process, url = start_server(tmp_path, port)
+    try:
+        assert [patient["patient_id"] for patient in requests.get(
+            url + "/api/patients/Smith.J").json()] == [1, 2]
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def test_production_email_options(tmp_path):
+    import json
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+    outbox = tmp_path / "alerts" / "outbox.jsonl"
+    outbox.parent.mkdir()
+    process, url = start_server(tmp_path, port, "--outbox", str(outbox),
+                                "--email-relay",
+                                "http://127.0.0.1:9/hrss/send_email")
+    try:
+        requests.post(url + "/api/new_attending",
+                      json={"attending_username": "Smith.J",
+                            "attending_email": "smith@hospital.org",
+                            "attending_phone": "919-867-5309"})
+        requests.post(url + "/api/new_patient",
+                      json={"patient_id": 1, "attending_username": "Smith.J",
+                            "patient_age": 50})
+        r = requests.post(url + "/api/heart_rate",
+                          json={"patient_id": 1, "heart_rate": 130})
+        assert r.status_code == 200
+        with open(str(outbox)) as journal:
+            entries = [json.loads(line) for line in journal]
+        assert entries[-1]["email"]["to_email"] == "smith@hospital.org"
+        assert not (tmp_path / "email_outbox.jsonl").exists()
+    finally:
+        process.terminate()
+        process.wait()
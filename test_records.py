@@ -0,0 +1,45 @@
+from datetime import datetime
+import json
+import pytest
+
+
+def test_patient_record():
+    from records import PatientRecord
+    from hr_series import HeartRateSeries, get_series, new_series_keys
+    patient = PatientRecord.from_dict({"patient_id": 1,
+                                       "attending_username": "Smith.J",
+                                       "patient_age": 50,
+                                       "heart_rate": [100]})
+    assert patient.to_dict() == {"patient_id": 1,
+                                 "attending_username": "Smith.J",
+                                 "patient_age": 50}
+    assert patient["patient_id"] == 1
+    assert patient.get("retention_readings", 10) == 10
+    assert "heart_rate" not in patient
+    with pytest.raises(KeyError):
+        patient["heart_rate"]
+    series = HeartRateSeries()
+    patient.update(new_series_keys(series))
+    assert get_series(patient) is series
+    series.append(100, datetime(2018, 3, 9, 11, 0, 0))
+    assert list(patient["heart_rate"]) == [100]
+    assert sorted(patient.keys()) == ["attending_username", "heart_rate",
+                                      "patient_age", "patient_id",
+                                      "timestamp"]
+    patient.retention_readings = 500
+    assert json.loads(json.dumps(patient.to_dict()))["retention_readings"] \
+        == 500
+    assert not hasattr(patient, "__dict__")
+
+
+def test_attending_record():
+    from records import AttendingRecord
+    attending = AttendingRecord.from_dict(
+        {"attending_username": "Smith.J",
+         "attending_email": "smith.j@doctor.com",
+         "attending_phone": "000-000-0000"})
+    assert dict(attending) == attending.to_dict()
+    assert attending == {"attending_username": "Smith.J",
+                         "attending_email": "smith.j@doctor.com",
+                         "attending_phone": "000-000-0000"}
+    assert attending.get("patient_id") is None
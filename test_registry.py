@@ -0,0 +1,94 @@
+def test_registry_append_and_get():
+    from registry import Registry
+    test_registry = Registry("patient_id")
+    patient1 = {"patient_id": 1,
+                "attending_username": "Smith.J",
+                "patient_age": 50}
+    patient2 = {"patient_id": 2,
+                "attending_username": "Ann.A",
+                "patient_age": 40}
+    answer1 = test_registry.append(patient1)
+    test_registry.append(patient2)
+    assert answer1 == patient1
+    assert test_registry.get(1) == patient1
+    assert test_registry[2] == patient2
+    assert test_registry.get(3) is None
+    assert 2 in test_registry
+    assert 3 not in test_registry
+    assert len(test_registry) == 2
+
+
+def test_registry_iterates_like_a_list():
+    from registry import Registry
+    records = [{"patient_id": 5, "patient_age": 50},
+               {"patient_id": 1, "patient_age": 10},
+               {"patient_id": 3, "patient_age": 30}]
+    test_registry = Registry("patient_id", records)
+    assert list(test_registry) == records
+    assert repr(test_registry) == repr(records)
+
+
+def test_registry_replace_keeps_position():
+    from registry import Registry
+    test_registry = Registry("patient_id",
+                             [{"patient_id": 1, "patient_age": 10},
+                              {"patient_id": 2, "patient_age": 20}])
+    test_registry[1] = {"patient_id": 1, "patient_age": 11}
+    test_registry.append({"patient_id": 2, "patient_age": 21})
+    expected = [{"patient_id": 1, "patient_age": 11},
+                {"patient_id": 2, "patient_age": 21}]
+    assert list(test_registry) == expected
+    test_registry.clear()
+    assert len(test_registry) == 0
+
+
+def test_registry_group():
+    from registry import Registry
+    test_registry = Registry("patient_id", group_by="attending_username")
+    patient1 = {"patient_id": 1, "attending_username": "Smith.J"}
+    patient2 = {"patient_id": 2, "attending_username": "Ann.A"}
+    patient3 = {"patient_id": 3, "attending_username": "Smith.J"}
+    for patient in [patient1, patient2, patient3]:
+        test_registry.append(patient)
+    assert test_registry.group("Smith.J") == [patient1, patient3]
+    assert test_registry.group("Ann.A") == [patient2]
+    assert test_registry.group("Bob.B") == []
+    updated1 = {"patient_id": 1, "attending_username": "Smith.J",
+                "heart_rate": [100]}
+    test_registry[1] = updated1
+    assert test_registry.group("Smith.J") == [updated1, patient3]
+    moved3 = {"patient_id": 3, "attending_username": "Ann.A"}
+    test_registry[3] = moved3
+    assert test_registry.group("Smith.J") == [updated1]
+    assert test_registry.group("Ann.A") == [patient2, moved3]
+
+
+def test_registry_record_type():
+    from registry import Registry
+    from records import PatientRecord
+    test_registry = Registry("patient_id", group_by="attending_username",
+                             record_type=PatientRecord)
+    added = test_registry.append({"patient_id": 1,
+                                  "attending_username": "Smith.J",
+                                  "patient_age": 50})
+    assert type(added) is PatientRecord
+    assert test_registry[1] is added
+    assert test_registry.group("Smith.J") == [{"patient_id": 1,
+                                               "attending_username": "Smith.J",
+                                               "patient_age": 50}]
+
+
+def test_registry_remove():
+    from registry import Registry
+    records = [{"patient_id": 5, "attending_username": "Smith.J"},
+               {"patient_id": 1, "attending_username": "Ann.A"},
+               {"patient_id": 3, "attending_username": "Smith.J"}]
+    test_registry = Registry("patient_id", records,
+                             group_by="attending_username")
+    assert test_registry.remove(5) == records[0]
+    assert test_registry.remove(5) is None
+    assert test_registry.keys() == [1, 3]
+    assert test_registry.values() == records[1:]
+    assert test_registry.group("Smith.J") == [records[2]]
+    test_registry.remove(3)
+    assert test_registry.group("Smith.J") == []
@@ -0,0 +1,202 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+import requests
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "heart_rate_sentinel.py")
+TOKEN = "cluster-secret"
+HEADERS = {"X-Cluster-Token": TOKEN}
+
+
+def start_server(directory, *args):
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+    directory.mkdir()
+    process = subprocess.Popen(
+        [sys.executable, SERVER, "--port", str(port),
+         "--cluster-token", TOKEN] + list(args),
+        cwd=str(directory))
+    url = "http://127.0.0.1:{}".format(port)
+    for _ in range(100):
+        try:
+            requests.get(url + "/api")
+            break
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    return process, url
+
+
+def wait_for(condition, seconds=10):
+    deadline = time.monotonic() + seconds
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def test_standby_follows_and_takes_over(tmp_path):
+    primary, primary_url = start_server(tmp_path / "primary")
+    standby, standby_url = start_server(tmp_path / "standby", "--standby-of",
+                                        primary_url, "--promote-after", "1")
+    try:
+        requests.post(primary_url + "/api/new_attending",
+                      json={"attending_username": "Smith.J",
+                            "attending_email": "smith@hospital.org",
+                            "attending_phone": "919-867-5309"})
+        for patient_id in (1, 2):
+            requests.post(primary_url + "/api/new_patient",
+                          json={"patient_id": patient_id,
+                                "attending_username": "Smith.J",
+                                "patient_age": 50})
+        for heart_rate in range(60, 90):
+            requests.post(primary_url + "/api/heart_rate",
+                          json={"patient_id": 1, "heart_rate": heart_rate})
+        wait_for(lambda: requests.get(
+            standby_url + "/api/heart_rate/1").json() == list(range(60, 90)))
+        assert requests.get(standby_url + "/api/patients/Smith.J").json() == \
+            requests.get(primary_url + "/api/patients/Smith.J").json()
+        status = requests.get(standby_url + "/api/replication/status").json()
+        assert status["role"] == "standby"
+        assert status["primary"] == primary_url
+        assert status["lag_bytes"] == 0
+        assert status["error"] is None
+        assert "hrs_replication_lag_seconds " in requests.get(
+            standby_url + "/api/metrics").text
+        # The standby refuses changes while it follows the primary
+        r = requests.post(standby_url + "/api/heart_rate",
+                          json={"patient_id": 1, "heart_rate": 70})
+        assert r.status_code == 503
+        # Once the primary stops, the standby promotes itself
+        primary.terminate()
+        primary.wait()
+        stopped = time.monotonic()
+        wait_for(lambda: requests.get(
+            standby_url + "/api/replication/status").json()["role"] ==
+            "primary")
+        assert time.monotonic() - stopped < 5
+        r = requests.post(standby_url + "/api/heart_rate",
+                          json={"patient_id": 2, "heart_rate": 70})
+        assert r.status_code == 200
+        assert requests.get(standby_url + "/api/heart_rate/stats/1").json()[
+            "count"] == 30
+    finally:
+        for process in (primary, standby):
+            process.terminate()
+            process.wait()
+
+
+def test_standby_promoted_on_request(tmp_path):
+    primary, primary_url = start_server(tmp_path / "primary")
+    try:
+        for patient_id in range(3):
+            requests.post(primary_url + "/api/new_patient",
+                          json={"patient_id": patient_id,
+                                "attending_username": "Smith.J",
+                                "patient_age": 50})
+        # A standby that starts late catches up with what was logged before
+        standby, standby_url = start_server(tmp_path / "standby",
+                                            "--standby-of", primary_url)
+        try:
+            wait_for(lambda: requests.get(
+                standby_url + "/api/cluster/patients",
+                headers=HEADERS).json() == [0, 1, 2])
+            # Only the holders of the cluster token may read the primary's
+            # data or promote the standby
+            for headers in ({}, {"X-Cluster-Token": "guess"}):
+                assert requests.get(
+                    primary_url + "/api/replication/log",
+                    params={"generation": 0, "offset": 0},
+                    headers=headers).status_code == 403
+                assert requests.get(
+                    primary_url + "/api/replication/snapshot",
+                    headers=headers).status_code == 403
+                assert requests.post(
+                    standby_url + "/api/replication/promote",
+                    headers=headers).status_code == 403
+            assert requests.get(standby_url + "/api/replication/status"
+                                ).json()["role"] == "standby"
+            r = requests.post(standby_url + "/api/replication/promote",
+                              headers=HEADERS)
+            assert r.status_code == 200
+            r = requests.post(standby_url + "/api/heart_rate",
+                              json={"patient_id": 0, "heart_rate": 70})
+            assert r.status_code == 200
+            assert requests.post(primary_url + "/api/replication/promote",
+                                 headers=HEADERS).status_code == 400
+        finally:
+            standby.terminate()
+            standby.wait()
+    finally:
+        primary.terminate()
+        primary.wait()
+
+
+def test_standby_survives_a_log_it_cannot_apply(monkeypatch):
+    import replication
+    from metrics import Metrics
+    monkeypatch.setattr(replication, "RETRY_INTERVAL", 0.01)
+    monkeypatch.setattr(replication, "MAX_RETRY_INTERVAL", 0.05)
+
+    class BrokenStorage:
+        calls = 0
+
+        def log_position(self):
+            self.calls += 1
+            raise KeyError("generation")
+
+    storage = BrokenStorage()
+    standby = replication.Standby(storage, "http://127.0.0.1:9",
+                                  promote_after=0, registry=Metrics())
+    standby.start()
+    try:
+        wait_for(lambda: storage.calls >= 3)
+        # The error is kept and retried; it does not promote the standby
+        assert standby.error.startswith("Applying the primary's log failed")
+        assert standby._thread.is_alive()
+        assert not standby.promoted.is_set()
+    finally:
+        standby.stop()
+
+
+def test_standby_not_promoted_by_error_statuses(monkeypatch):
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    import replication
+    from metrics import Metrics
+    from storage import MemoryStorage
+    monkeypatch.setattr(replication, "RETRY_INTERVAL", 0.01)
+    monkeypatch.setattr(replication, "MAX_RETRY_INTERVAL", 0.05)
+    statuses = [403, 503]
+    requested = []
+
+    class Refusing(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            self.send_response(statuses[len(requested) % 2])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    primary = HTTPServer(("127.0.0.1", 0), Refusing)
+    threading.Thread(target=primary.serve_forever, daemon=True).start()
+    standby = replication.Standby(
+        MemoryStorage(), "http://127.0.0.1:{}".format(primary.server_port),
+        promote_after=0.2, registry=Metrics())
+    standby.start()
+    try:
+        wait_for(lambda: len(requested) >= 4)
+        time.sleep(0.3)
+        # The primary is up, so answering errors does not promote the
+        # standby
+        assert standby.error.startswith("Applying the primary's log failed")
+        assert standby._thread.is_alive()
+        assert not standby.promoted.is_set()
+    finally:
+        standby.stop()
+        primary.shutdown()
+        primary.server_close()
@@ -0,0 +1,114 @@
+import random
+import pytest
+
+
+def kept(readings, max_readings, max_age):
+    # The readings a retention policy keeps, worked out from scratch
+    readings = sorted(readings, key=lambda reading: reading[0])
+    if max_age is not None and readings:
+        cutoff = readings[-1][0] - max_age
+        readings = [reading for reading in readings if reading[0] >= cutoff]
+    if max_readings is not None:
+        readings = readings[-max_readings:]
+    return readings
+
+
+@pytest.mark.parametrize("max_readings, max_age", [(5, None), (None, 100),
+                                                   (40, 300), (1, None)])
+def test_ring_series_matches_retention(max_readings, max_age):
+    from ring_series import RingSeries
+    series = RingSeries(max_readings, max_age)
+    series.get_rollups()
+    rng = random.Random(547)
+    readings = []
+    epoch = 1000
+    for _ in range(3000):
+        epoch += rng.randint(0, 9)
+        heart_rate = rng.randint(50, 150)
+        series.append_at(heart_rate, epoch)
+        # Policies are applied in the order readings arrive, so the
+        # reference keeps only what the series kept after each reading
+        readings = kept(readings + [(epoch, heart_rate)], max_readings,
+                        max_age)
+        assert len(series) == len(readings)
+    rates = [heart_rate for _, heart_rate in readings]
+    assert list(series.iter_epochs()) == [epoch for epoch, _ in readings]
+    assert list(series.heart_rate) == rates
+    assert series.rate_at(0) == rates[0]
+    assert series.epoch_at(-1) == readings[-1][0]
+    assert series.minimum == min(rates)
+    assert series.maximum == max(rates)
+    assert series.sum_squares == sum(rate * rate for rate in rates)
+    middle = readings[len(readings) // 2][0]
+    after = [rate for epoch, rate in readings if epoch > middle]
+    assert series.sum_after(middle) == (len(after), sum(after))
+    assert series.sum_after(0) == (len(rates), sum(rates))
+    from rollups import Rollups
+    expected = Rollups.build(series.iter_epochs(), series.iter_rates())
+    for resolution in ("minute", "hour", "day"):
+        assert series.get_rollups().after(resolution, 0) == \
+            expected.after(resolution, 0)
+
+
+def test_ring_series_out_of_order_and_growth():
+    from ring_series import INITIAL_CAPACITY, RingSeries
+    series = RingSeries(max_age=10 * INITIAL_CAPACITY)
+    for epoch in range(0, 30 * INITIAL_CAPACITY, 2):
+        series.append_at(epoch % 100, epoch)
+    assert len(series) == 5 * INITIAL_CAPACITY + 1
+    assert len(series.epochs) == 8 * INITIAL_CAPACITY
+    series.append_at(250, 30 * INITIAL_CAPACITY - 3)
+    assert len(series) == 5 * INITIAL_CAPACITY + 2
+    assert series.maximum == 250
+    assert series.epoch_at(-2) == 30 * INITIAL_CAPACITY - 3
+    series = RingSeries(max_readings=3)
+    for epoch, heart_rate in [(10, 60), (20, 70), (30, 80), (5, 90)]:
+        series.append_at(heart_rate, epoch)
+    assert list(series.heart_rate) == [60, 70, 80]
+    series.append_at(100, 15)
+    assert list(series.heart_rate) == [100, 70, 80]
+    assert (series.minimum, series.maximum) == (70, 100)
+
+
+def test_ring_series_frozen_round_trip():
+    from ring_series import RingSeries
+    series = RingSeries(max_readings=4)
+    series.extend_at([70, 80, 90], 100)
+    series.extend_at([60, 110], 200)
+    cold, epochs, prefix = series.frozen()
+    assert cold is None
+    assert list(epochs) == [100, 100, 200, 200]
+    assert list(prefix) == [0, 80, 170, 230, 340]
+    loaded = RingSeries(max_readings=4)
+    loaded.extend_arrays(epochs[:2], prefix[1:3])
+    loaded.extend_arrays(epochs[2:], prefix[3:])
+    assert list(loaded.heart_rate) == [80, 90, 60, 110]
+    assert loaded.total() == 340
+    with pytest.raises(ValueError):
+        RingSeries()
+
+
+def test_ring_snapshot():
+    from ring_series import RingSeries
+    series = RingSeries(max_readings=4)
+    for epoch in range(1, 4):
+        series.append_at(60 + epoch, epoch)
+    snapshot = series.snapshot
+    assert snapshot.readings() == ([61, 62, 63], [1, 2, 3])
+    assert snapshot.latest() == (63, 3)
+    assert snapshot.sum_after(1) == (2, 125)
+    # The free slot takes one more reading without touching the snapshot
+    series.append_at(64, 4)
+    assert snapshot.readings() == ([61, 62, 63], [1, 2, 3])
+    # The next one overwrites the snapshot's oldest reading
+    series.append_at(65, 5)
+    assert snapshot.readings() is None
+    assert snapshot.sum_after(1) is None
+    assert series.snapshot.readings() == ([62, 63, 64, 65], [2, 3, 4, 5])
+    assert series.snapshot.total() == series.total()
+    # A reading out of order rebuilds the series in new buffers
+    current = series.snapshot
+    series.append_at(70, 3)
+    assert current.readings() is None
+    assert series.snapshot.readings() == ([63, 70, 64, 65], [3, 3, 4, 5])
+    assert series.snapshot.version > current.version
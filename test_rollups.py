@@ -0,0 +1,67 @@
+from array import array
+
+
+def test_choose_resolution():
+    from rollups import choose_resolution
+    assert choose_resolution(30 * 86400) == "hour"
+    assert choose_resolution(100 * 86400) == "day"
+    assert choose_resolution(6000) == "minute"
+    assert choose_resolution(5999) == "raw"
+
+
+def test_rollup_add():
+    from rollups import Rollup
+    rollup = Rollup(60)
+    rollup.add(1, 80, 80, 80, 125)
+    rollup.add(2, 190, 90, 100, 170)
+    rollup.add(1, 70, 70, 70, 300)
+    rollup.add(1, 120, 120, 120, 10)
+    rollup.add(1, 60, 60, 60, 240)
+    assert rollup.after(0) == [(0, 1, 120, 120, 120),
+                               (120, 3, 270, 80, 100),
+                               (240, 1, 60, 60, 60),
+                               (300, 1, 70, 70, 70)]
+    assert rollup.after(179) == rollup.after(0)[1:]
+    assert rollup.after(180) == rollup.after(0)[2:]
+    assert rollup.after(400) == []
+
+
+def test_rollups_build_matches_incremental():
+    from rollups import Rollups
+    epochs = array("q", range(0, 20000, 7))
+    rates = array("q", [50 + epoch % 97 for epoch in epochs])
+    built = Rollups.build(epochs, rates)
+    added = Rollups()
+    for epoch, rate in zip(epochs, rates):
+        added.add(1, rate, rate, rate, epoch)
+    for resolution in ("minute", "hour", "day"):
+        assert built.after(resolution, 0) == added.after(resolution, 0)
+    assert sum(bucket[1] for bucket in built.after("hour", 0)) == len(epochs)
+
+
+def test_rollup_keeps_recent_buckets():
+    from rollups import Rollup
+    rollup = Rollup(60, keep=180)
+    for epoch in (0, 60, 120):
+        rollup.add(1, 80, 80, 80, epoch)
+    assert [bucket[0] for bucket in rollup.after(0)] == [0, 60, 120]
+    rollup.add(1, 80, 80, 80, 185)
+    assert [bucket[0] for bucket in rollup.after(0)] == [60, 120, 180]
+    # A late reading in a bucket no longer kept is not counted
+    rollup.add(1, 90, 90, 90, 30)
+    rollup.add(1, 90, 90, 90, 70)
+    assert rollup.after(0) == [(60, 2, 170, 80, 90), (120, 1, 80, 80, 80),
+                               (180, 1, 80, 80, 80)]
+
+
+def test_rollups_bounded():
+    from rollups import KEEP_SECONDS, RESOLUTIONS, Rollups
+    rollups = Rollups()
+    # A reading every 30 minutes for three years
+    epochs = range(0, 3 * 365 * 86400, 1800)
+    for epoch in epochs:
+        rollups.add(1, 70, 70, 70, epoch)
+    for name, seconds in RESOLUTIONS.items():
+        buckets = rollups.after(name, 0)
+        assert len(buckets) <= KEEP_SECONDS[name] // seconds
+        assert buckets[-1][0] == epochs[-1] // seconds * seconds
@@ -0,0 +1,110 @@
+from datetime import datetime
+import multiprocessing
+import pytest
+
+BACKENDS = ["memory", "sqlite"]
+
+
+def open_test_store(backend, directory):
+    # Runs in the store process
+    from email_outbox import Outbox
+    from shared_store import serve
+    from storage import make_storage
+    storage = make_storage(backend, directory)
+    storage.open()
+    serve(storage, Outbox())
+
+
+def add_from_worker(address, authkey, worker_number):
+    from shared_store import connect_store
+    storage, outbox = connect_store(address, authkey)
+    timestamp = datetime(2018, 3, 9, 11, 0, worker_number)
+    for count in range(50):
+        with storage.transaction():
+            storage.add_readings(count % 2 + 1, [60 + worker_number],
+                                 timestamp)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_shared_store(backend, tmp_path):
+    from shared_store import connect_store, new_authkey, start_store
+    authkey = new_authkey()
+    manager = start_store(authkey, open_test_store,
+                          (backend, str(tmp_path / "data")))
+    try:
+        storage, outbox = connect_store(manager.address, authkey)
+        storage.add_attendings([{"attending_username": "Smith.J",
+                                 "attending_email": "smith@hospital.org",
+                                 "attending_phone": "919-867-5309"}])
+        storage.add_patients([{"patient_id": patient_id,
+                               "attending_username": "Smith.J",
+                               "patient_age": 50} for patient_id in (1, 2)])
+        workers = [multiprocessing.Process(target=add_from_worker,
+                                           args=(manager.address, authkey,
+                                                 number))
+                   for number in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            assert worker.exitcode == 0
+        # Every worker's readings are in the one store
+        assert storage.reading_stats(1)["count"] == 75
+        assert storage.reading_stats(2)["count"] == 75
+        heart_rates, timestamps = storage.readings(1)
+        assert sorted(set(heart_rates)) == [60, 61, 62]
+        assert storage.last_reading(2)[1] == timestamps[-1]
+        assert [patient["patient_id"]
+                for patient in storage.patients_of("Smith.J")] == [1, 2]
+        assert storage.get_attending("Smith.J")["attending_phone"] == \
+            "919-867-5309"
+        assert outbox.put({"to_email": "smith@hospital.org",
+                           "subject": "Tachycardic!"})
+        # A failed transaction ends in the store, and the SQLite backend
+        # rolls it back
+        with pytest.raises(ValueError):
+            with storage.transaction():
+                storage.add_patients([{"patient_id": 3,
+                                       "attending_username": "Smith.J",
+                                       "patient_age": 60}])
+                raise ValueError("cancelled")
+        if backend == "sqlite":
+            assert storage.get_patient(3) is None
+        with storage.transaction():
+            storage.add_readings(1, [100], datetime(2018, 3, 9, 11, 1, 0))
+        assert storage.last_reading(1) == (100, "2018-03-09 11:01:00")
+        storage.shared.close()
+    finally:
+        manager.shutdown()
+
+
+def open_metrics_store(directory):
+    # Runs in the store process, which starts with a copy of the test
+    # process' metrics
+    from metrics import metrics
+    metrics.reset()
+    open_test_store("memory", directory)
+
+
+def test_worker_metrics(tmp_path):
+    from metrics import Metrics
+    from shared_store import connect_metrics, new_authkey, start_store
+    authkey = new_authkey()
+    manager = start_store(authkey, open_metrics_store,
+                          (str(tmp_path / "data"),))
+    try:
+        worker_metrics = connect_metrics(manager.address, authkey)
+        for worker, status_code in ((1, 200), (2, 200), (1, 400)):
+            registry = Metrics()
+            registry.record_request("/api/heart_rate", "POST", status_code,
+                                    0.001)
+            latest = worker_metrics.report(worker, registry.export())
+        # Each worker's latest metrics are kept, with the store's own
+        combined = Metrics()
+        for exported in latest:
+            combined.add(exported)
+        assert len(latest) == 3
+        assert combined.requests == {("/api/heart_rate", "POST"): 2}
+        assert combined.request_errors == {("/api/heart_rate", "POST"): 1}
+    finally:
+        manager.shutdown()
@@ -0,0 +1,424 @@
+from datetime import datetime, timedelta
+import threading
+import pytest
+
+BACKENDS = ["memory", "sqlite"]
+
+
+def open_storage(backend, tmp_path):
+    from storage import make_storage
+    storage = make_storage(backend, str(tmp_path / "data"))
+    storage.open()
+    return storage
+
+
+def fill(storage):
+    storage.add_attendings([{"attending_username": "Smith.J",
+                             "attending_email": "smith.j@doctor.com",
+                             "attending_phone": "000-000-0000"}])
+    storage.add_patients([{"patient_id": 1, "attending_username": "Smith.J",
+                           "patient_age": 50},
+                          {"patient_id": 2, "attending_username": "Ann.A",
+                           "patient_age": 40},
+                          {"patient_id": 3, "attending_username": "Smith.J",
+                           "patient_age": 30}])
+    storage.add_readings(1, [100], datetime(2018, 3, 9, 11, 0, 0))
+    storage.add_readings(1, [120, 90], datetime(2018, 3, 9, 12, 0, 0))
+    storage.add_readings(1, [80], datetime(2018, 3, 9, 11, 30, 0))
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_storage_records(backend, tmp_path):
+    storage = open_storage(backend, tmp_path)
+    fill(storage)
+    assert storage.get_patient(1) == {"patient_id": 1,
+                                      "attending_username": "Smith.J",
+                                      "patient_age": 50}
+    assert storage.get_patient(4) is None
+    assert storage.get_attending("Smith.J")["attending_email"] == \
+        "smith.j@doctor.com"
+    assert storage.get_attending("Ann.A") is None
+    assert [p["patient_id"] for p in storage.patients_of("Smith.J")] == \
+        [1, 3]
+    assert storage.add_readings(4, [100], datetime(2018, 3, 9)) is False
+    storage.close()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_storage_keeps_existing_patients(backend, tmp_path):
+    storage = open_storage(backend, tmp_path)
+    fill(storage)
+    existing = storage.add_patients([{"patient_id": 1,
+                                      "attending_username": "Ann.A",
+                                      "patient_age": 51},
+                                     {"patient_id": 4,
+                                      "attending_username": "Ann.A",
+                                      "patient_age": 20},
+                                     {"patient_id": 4,
+                                      "attending_username": "Smith.J",
+                                      "patient_age": 21}])
+    assert existing == [1, 4]
+    storage.close()
+    storage = open_storage(backend, tmp_path)
+    assert storage.get_patient(1)["attending_username"] == "Smith.J"
+    assert storage.get_patient(4)["patient_age"] == 20
+    assert sorted(p["patient_id"] for p in storage.patients_of("Ann.A")) == \
+        [2, 4]
+    assert storage.readings(1)[0] == [100, 80, 120, 90]
+    storage.close()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_storage_readings(backend, tmp_path):
+    from hr_series import to_epoch
+    storage = open_storage(backend, tmp_path)
+    fill(storage)
+    assert storage.readings(1) == ([100, 80, 120, 90],
+                                   ["2018-03-09 11:00:00",
+                                    "2018-03-09 11:30:00",
+                                    "2018-03-09 12:00:00",
+                                    "2018-03-09 12:00:00"])
+    assert storage.readings(2) == ([], [])
+    assert storage.last_reading(1) == (90, "2018-03-09 12:00:00")
+    assert storage.last_reading(2) is None
+    stats = storage.reading_stats(1)
+    assert stats["count"] == 4
+    assert stats["average"] == 97.5
+    assert (stats["min"], stats["max"]) == (80, 120)
+    assert abs(stats["stddev"] - 14.790199) < 1e-6
+    assert storage.reading_stats(2) is None
+    since = to_epoch(datetime(2018, 3, 9, 11, 0, 0))
+    assert storage.sum_after(1, since) == (3, 290)
+    assert storage.sum_after(1, since + 7200) == (0, 0)
+    assert storage.sum_after(2, since) == (0, 0)
+    storage.close()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_storage_survives_restart(backend, tmp_path):
+    storage = open_storage(backend, tmp_path)
+    with storage.transaction():
+        fill(storage)
+    storage.close()
+    storage = open_storage(backend, tmp_path)
+    assert storage.readings(1)[0] == [100, 80, 120, 90]
+    assert storage.get_attending("Smith.J") is not None
+    storage.clear()
+    assert storage.get_patient(1) is None
+    storage.close()
+
+
+def test_memory_storage_restarts_after_a_refused_write(tmp_path):
+    storage = open_storage("memory", tmp_path)
+    fill(storage)
+    storage.add_readings(2, [2 ** 62], datetime(2018, 3, 9, 11, 0, 0))
+    # The running sum of the two overflows, so the second is refused
+    with pytest.raises(OverflowError):
+        storage.add_readings(2, [2 ** 62], datetime(2018, 3, 9, 12, 0, 0))
+    storage.close()
+    storage = open_storage("memory", tmp_path)
+    assert storage.readings(1)[0] == [100, 80, 120, 90]
+    assert storage.readings(2)[0] == [2 ** 62]
+    storage.close()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_storage_threads(backend, tmp_path):
+    storage = open_storage(backend, tmp_path)
+    storage.add_patients([{"patient_id": patient_id,
+                           "attending_username": "Smith.J",
+                           "patient_age": 50} for patient_id in range(4)])
+
+    def add_many(patient_id):
+        for minute in range(50):
+            storage.add_readings(patient_id, [60 + minute],
+                                 datetime(2018, 3, 9, 11, minute, 0))
+
+    threads = [threading.Thread(target=add_many, args=(patient_id,))
+               for patient_id in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for patient_id in range(4):
+        assert storage.reading_stats(patient_id)["count"] == 50
+    storage.close()
+
+
+def test_sqlite_transaction_rollback(tmp_path):
+    storage = open_storage("sqlite", tmp_path)
+    with pytest.raises(ValueError):
+        with storage.transaction():
+            fill(storage)
+            raise ValueError("import failed")
+    assert storage.get_patient(1) is None
+    storage.close()
+
+
+def test_sqlite_partitions_match_memory(tmp_path):
+    from datetime import timedelta
+    from hr_series import to_epoch
+    from storage import MemoryStorage
+    import random
+    rng = random.Random(547)
+    sqlite = open_storage("sqlite", tmp_path)
+    memory = MemoryStorage()
+    start = datetime(2018, 3, 9, 11, 0, 0)
+    for storage in (sqlite, memory):
+        storage.add_patients([{"patient_id": 1,
+                               "attending_username": "Smith.J",
+                               "patient_age": 50}])
+    for hour in range(0, 24 * 5, 5):
+        heart_rates = [rng.randint(50, 150) for _ in range(rng.randint(1, 3))]
+        for storage in (sqlite, memory):
+            storage.add_readings(1, heart_rates,
+                                 start + timedelta(hours=hour))
+    assert sqlite.reading_stats(1) == memory.reading_stats(1)
+    for hour in range(-30, 24 * 5 + 1, 3):
+        since = to_epoch(start + timedelta(hours=hour))
+        assert sqlite.sum_after(1, since) == memory.sum_after(1, since)
+    sqlite.close()
+
+
+def test_sqlite_fills_missing_partitions(tmp_path):
+    import sqlite3
+    storage = open_storage("sqlite", tmp_path)
+    fill(storage)
+    stats = storage.reading_stats(1)
+    storage.close()
+    connection = sqlite3.connect(str(tmp_path / "data" /
+                                     "heart_rate_sentinel.db"))
+    connection.execute("DROP TABLE reading_partitions")
+    connection.commit()
+    connection.close()
+    storage = open_storage("sqlite", tmp_path)
+    assert storage.reading_stats(1) == stats
+    storage.close()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_storage_rollups(backend, tmp_path):
+    from hr_series import to_epoch
+    storage = open_storage(backend, tmp_path)
+    fill(storage)
+    storage.add_readings(1, [70], datetime(2018, 3, 9, 12, 0, 30))
+    hour = to_epoch(datetime(2018, 3, 9, 12, 0, 0))
+    assert storage.rollups(1, "hour", 0) == [(hour - 3600, 2, 180, 80, 100),
+                                             (hour, 3, 280, 70, 120)]
+    assert storage.rollups(1, "minute", hour) == [(hour, 3, 280, 70, 120)]
+    assert storage.rollups(1, "day", hour)[0][1:] == (5, 460, 70, 120)
+    assert storage.rollups(2, "day", 0) == []
+    storage.close()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_storage_retention(backend, tmp_path):
+    from datetime import timedelta
+    from storage import make_storage, summarize
+    storage = make_storage(backend, str(tmp_path / "data"),
+                           retention_seconds=2 * 86400)
+    storage.open()
+    storage.add_patients([{"patient_id": 1, "attending_username": "Smith.J",
+                           "patient_age": 50, "retention_readings": 500},
+                          {"patient_id": 2, "attending_username": "Smith.J",
+                           "patient_age": 40}])
+    assert storage.get_patient(1)["retention_readings"] == 500
+    assert "retention_readings" not in storage.get_patient(2)
+    start = datetime(2018, 3, 9, 11, 0, 0)
+    readings = {1: [], 2: []}
+    with storage.transaction():
+        for count in range(3000):
+            heart_rate = 50 + count * 37 % 101
+            timestamp = start + timedelta(seconds=97 * count)
+            for patient_id in (1, 2):
+                storage.add_readings(patient_id, [heart_rate], timestamp)
+                readings[patient_id].append(heart_rate)
+    # 3000 readings 97 s apart span more than three days
+    expected = {1: readings[1][-500:],
+                2: readings[2][-(2 * 86400 // 97 + 1):]}
+    for restarted in (False, True):
+        if restarted:
+            storage.close()
+            storage = make_storage(backend, str(tmp_path / "data"),
+                                   retention_seconds=2 * 86400)
+            storage.open()
+        for patient_id, rates in expected.items():
+            assert storage.readings(patient_id)[0] == rates
+            stats = storage.reading_stats(patient_id)
+            assert stats == pytest.approx(summarize(
+                len(rates), sum(rates), min(rates), max(rates),
+                sum(rate * rate for rate in rates)))
+            last = start + timedelta(seconds=97 * 2999)
+            assert storage.sum_after(patient_id, 0) == (len(rates),
+                                                        sum(rates))
+            for resolution in ("minute", "hour", "day"):
+                buckets = storage.rollups(patient_id, resolution, 0)
+                assert sum(bucket[1] for bucket in buckets) == len(rates)
+                assert sum(bucket[2] for bucket in buckets) == sum(rates)
+                assert min(bucket[3] for bucket in buckets) == min(rates)
+            day = storage.rollups(patient_id, "day", 0)[-1]
+            assert day[0] == 86400 * (int(last.timestamp()) // 86400)
+    storage.close()
+
+
+def test_memory_storage_threads_with_snapshots(tmp_path):
+    from storage import MemoryStorage
+    storage = MemoryStorage(str(tmp_path / "data"), snapshot_every=200)
+    storage.open()
+    storage.add_patients([{"patient_id": patient_id,
+                           "attending_username": "Smith.J",
+                           "patient_age": 50} for patient_id in range(4)])
+
+    def add_many(patient_id):
+        for second in range(500):
+            storage.add_readings(patient_id, [60],
+                                 datetime(2018, 3, 9, 11, 0, second % 60))
+
+    # Two threads per patient, so readings of the same patient race
+    threads = [threading.Thread(target=add_many, args=(patient_id % 4,))
+               for patient_id in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    storage.close()
+    storage = MemoryStorage(str(tmp_path / "data"))
+    storage.open()
+    for patient_id in range(4):
+        assert storage.reading_stats(patient_id)["count"] == 1000
+    storage.close()
+
+
+def test_memory_storage_reads_without_locks(tmp_path):
+    from hr_series import to_epoch
+    from storage import MemoryStorage
+    storage = MemoryStorage(str(tmp_path / "data"), hot_readings=8)
+    storage.open()
+    storage.add_patients([{"patient_id": 1, "attending_username": "Smith.J",
+                           "patient_age": 50}])
+    start = datetime(2018, 3, 9, 11, 0, 0)
+    for second in range(20):
+        storage.add_readings(1, [60 + second], start + timedelta(
+            seconds=second))
+    results = []
+
+    def read():
+        results.append((storage.readings(1), storage.last_reading(1),
+                        storage.reading_stats(1)["count"],
+                        storage.sum_after(1, to_epoch(start))))
+
+    # A writer holding the patient's stripe does not hold up readers
+    with storage.stripes.stripe(1):
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join(5)
+    assert not reader.is_alive()
+    (heart_rates, timestamps), last, count, after = results[0]
+    assert heart_rates == [60 + second for second in range(20)]
+    assert last == (79, timestamps[-1])
+    assert (count, after) == (20, (19, sum(range(61, 80))))
+
+    # Readers racing a writer always see every reading up to some point
+    def add_many():
+        for second in range(20, 2000):
+            storage.add_readings(1, [60 + second % 40], start + timedelta(
+                seconds=second))
+
+    writer = threading.Thread(target=add_many)
+    writer.start()
+    while writer.is_alive():
+        heart_rates, timestamps = storage.readings(1)
+        assert len(heart_rates) == len(timestamps) >= 20
+        assert heart_rates == [60 + second % 40
+                               for second in range(len(heart_rates))]
+        assert timestamps == sorted(timestamps)
+    writer.join()
+    assert storage.reading_stats(1)["count"] == 2000
+    storage.close()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_storage_remove_patients(backend, tmp_path):
+    storage = open_storage(backend, tmp_path)
+    fill(storage)
+    assert storage.patient_ids() == [1, 2, 3]
+    assert storage.all_attendings() == [
+        {"attending_username": "Smith.J",
+         "attending_email": "smith.j@doctor.com",
+         "attending_phone": "000-000-0000"}]
+    storage.remove_patients([1, 4])
+    assert storage.patient_ids() == [2, 3]
+    assert storage.get_patient(1) is None
+    assert storage.readings(1) == ([], [])
+    assert storage.reading_stats(1) is None
+    assert storage.rollups(1, "hour", 0) == []
+    assert [p["patient_id"] for p in storage.patients_of("Smith.J")] == [3]
+    # A patient added again starts without readings
+    storage.add_patients([{"patient_id": 1, "attending_username": "Smith.J",
+                           "patient_age": 50}])
+    assert storage.readings(1) == ([], [])
+    storage.remove_patients([1])
+    storage.close()
+    storage = open_storage(backend, tmp_path)
+    assert storage.patient_ids() == [2, 3]
+    assert storage.get_patient(1) is None
+    storage.close()
+
+
+def test_memory_storage_ships_log(tmp_path):
+    from storage import MemoryStorage
+    primary = MemoryStorage(str(tmp_path / "primary"))
+    primary.open()
+    standby = MemoryStorage(str(tmp_path / "standby"))
+    standby.open()
+
+    def ship(limit=None):
+        generation, offset = standby.log_position()
+        data, complete, behind = primary.shipped_log(generation, offset)
+        if limit is not None:
+            data = data[:limit]
+        standby.receive_log(generation, data)
+        if complete:
+            standby.receive_log(generation + 1, b"")
+        return behind
+
+    fill(primary)
+    # A record split between two shipments is applied once it is whole
+    ship(limit=primary.log_position()[1] - 5)
+    assert standby.readings(1)[0] == [100, 120, 90]
+    assert ship() == 0
+    assert standby.readings(1) == primary.readings(1)
+    assert standby.log_position() == primary.log_position()
+    # The standby follows the primary to its next log segment
+    primary.wal.snapshot()
+    primary.add_readings(2, [70], datetime(2018, 3, 9, 13, 0, 0))
+    assert ship() > 0
+    assert ship() == 0
+    assert standby.log_position() == primary.log_position()
+    assert standby.last_reading(2) == (70, "2018-03-09 13:00:00")
+    # Once the primary deleted the segment, the standby loads its snapshot
+    primary.add_readings(2, [75], datetime(2018, 3, 9, 13, 1, 0))
+    primary.wal.snapshot()
+    primary.wal.snapshot()
+    with pytest.raises(LookupError):
+        primary.shipped_log(*standby.log_position())
+    with open(primary.snapshot_file(), "rb") as snapshot:
+        standby.restore_snapshot(snapshot)
+    primary.remove_patients([3])
+    assert ship() == 0
+    assert standby.patient_ids() == [1, 2]
+    assert standby.readings(2)[0] == [70, 75]
+    with pytest.raises(ValueError):
+        primary.shipped_log(standby.log_position()[0], 10 ** 6)
+    # A promoted standby logs its own changes after the primary's
+    primary.add_readings(1, [60], datetime(2018, 3, 9, 14, 0, 0))
+    ship(limit=4)
+    standby.end_replication()
+    standby.add_readings(2, [65], datetime(2018, 3, 9, 14, 0, 0))
+    standby.close()
+    primary.close()
+    standby = MemoryStorage(str(tmp_path / "standby"))
+    standby.open()
+    assert standby.readings(1)[0] == [100, 80, 120, 90]
+    assert standby.readings(2)[0] == [70, 75, 65]
+    standby.close()
@@ -0,0 +1,182 @@
+from datetime import datetime
+import os
+import threading
+
+
+def make_databases():
+    from registry import Registry
+    return (Registry("patient_id", group_by="attending_username"),
+            Registry("attending_username"))
+
+
+def add_patient(wal, patients_db, patient_id, attending_username):
+    patient = {"patient_id": patient_id,
+               "attending_username": attending_username,
+               "patient_age": 50}
+    with wal.lock:
+        wal.log_patient(patient)
+        patients_db.append(patient)
+    wal.commit()
+
+
+def add_readings(wal, patients_db, patient_id, heart_rates, timestamp):
+    from hr_series import append_readings, get_series, new_series_keys
+    with wal.lock:
+        patient = patients_db[patient_id]
+        if get_series(patient) is None:
+            patient.update(new_series_keys())
+        wal.log_readings(patient_id, heart_rates, timestamp)
+        append_readings(patient, heart_rates, timestamp)
+    wal.commit()
+
+
+def fill(wal, patients_db, attending_db):
+    doc = {"attending_username": "Smith.J",
+           "attending_email": "dr_user_id@yourdomain.com",
+           "attending_phone": "919-867-5309"}
+    with wal.lock:
+        wal.log_attending(doc)
+        attending_db.append(doc)
+    wal.commit()
+    add_patient(wal, patients_db, 1, "Smith.J")
+    add_patient(wal, patients_db, 2, "Smith.J")
+    add_readings(wal, patients_db, 1, [80], datetime(2018, 3, 9, 11, 0, 36))
+    add_readings(wal, patients_db, 1, [120, 90],
+                 datetime(2018, 3, 9, 11, 5, 0))
+    add_readings(wal, patients_db, 1, [70], datetime(2018, 3, 9, 11, 1, 0))
+    add_readings(wal, patients_db, 2, [101], datetime(2018, 3, 9, 12, 0, 0))
+
+
+def recover(directory):
+    from wal import WriteAheadLog
+    patients_db, attending_db = make_databases()
+    wal = WriteAheadLog(directory, patients_db, attending_db)
+    replayed = wal.open()
+    wal.close()
+    return patients_db, attending_db, replayed
+
+
+def assert_recovered(patients_db, attending_db):
+    from hr_series import get_series, to_epoch
+    assert list(attending_db) == [{"attending_username": "Smith.J",
+                                   "attending_email":
+                                       "dr_user_id@yourdomain.com",
+                                   "attending_phone": "919-867-5309"}]
+    patient = patients_db[1]
+    assert patient["heart_rate"] == [80, 70, 120, 90]
+    assert patient["timestamp"] == ["2018-03-09 11:00:36",
+                                    "2018-03-09 11:01:00",
+                                    "2018-03-09 11:05:00",
+                                    "2018-03-09 11:05:00"]
+    assert get_series(patient).maximum == 120
+    minute = to_epoch(datetime(2018, 3, 9, 11, 0, 0))
+    assert get_series(patient).get_rollups().after("minute", 0) == [
+        (minute, 1, 80, 80, 80), (minute + 60, 1, 70, 70, 70),
+        (minute + 300, 2, 210, 90, 120)]
+    assert patients_db[2]["heart_rate"] == [101]
+    assert [p["patient_id"] for p in patients_db.group("Smith.J")] == [1, 2]
+
+
+def test_wal_not_open_logs_nothing(tmp_path):
+    from wal import WriteAheadLog
+    patients_db, attending_db = make_databases()
+    wal = WriteAheadLog(str(tmp_path / "data"), patients_db, attending_db)
+    add_patient(wal, patients_db, 1, "Smith.J")
+    assert not os.path.exists(str(tmp_path / "data"))
+
+
+def test_wal_replays_log(tmp_path):
+    from wal import WriteAheadLog
+    directory = str(tmp_path / "data")
+    patients_db, attending_db = make_databases()
+    wal = WriteAheadLog(directory, patients_db, attending_db)
+    assert wal.open() == 0
+    fill(wal, patients_db, attending_db)
+    wal.close()
+    patients_db, attending_db, replayed = recover(directory)
+    assert replayed == 7
+    assert_recovered(patients_db, attending_db)
+
+
+def test_wal_snapshot_and_tail(tmp_path, monkeypatch):
+    from rollups import Rollups
+    from wal import WriteAheadLog
+    directory = str(tmp_path / "data")
+    patients_db, attending_db = make_databases()
+    wal = WriteAheadLog(directory, patients_db, attending_db)
+    wal.open()
+    fill(wal, patients_db, attending_db)
+    wal.snapshot()
+    add_patient(wal, patients_db, 3, "Jones.K")
+    wal.close()
+    # The segment before the snapshot is kept for standby servers
+    assert sorted(os.listdir(directory)) == ["snapshot.bin",
+                                             "wal.00000000.log",
+                                             "wal.00000001.log"]
+
+    def build(epochs, rates):
+        raise AssertionError("the rollups were not saved")
+
+    # The rollups are loaded from the snapshot rather than built again
+    monkeypatch.setattr(Rollups, "build", build)
+    patients_db, attending_db, replayed = recover(directory)
+    assert replayed == 1
+    assert patients_db[3]["attending_username"] == "Jones.K"
+    assert_recovered(patients_db, attending_db)
+
+
+def test_wal_snapshots_periodically(tmp_path):
+    from wal import WriteAheadLog
+    directory = str(tmp_path / "data")
+    patients_db, attending_db = make_databases()
+    wal = WriteAheadLog(directory, patients_db, attending_db,
+                        snapshot_every=2)
+    wal.open()
+    fill(wal, patients_db, attending_db)
+    wal.close()
+    assert os.path.exists(os.path.join(directory, "snapshot.bin"))
+    patients_db, attending_db, replayed = recover(directory)
+    assert replayed < 7
+    assert_recovered(patients_db, attending_db)
+
+
+def test_wal_drops_torn_record(tmp_path):
+    from wal import WriteAheadLog
+    directory = str(tmp_path / "data")
+    patients_db, attending_db = make_databases()
+    wal = WriteAheadLog(directory, patients_db, attending_db)
+    wal.open()
+    fill(wal, patients_db, attending_db)
+    wal.close()
+    segment = os.path.join(directory, "wal.00000000.log")
+    size = os.path.getsize(segment)
+    with open(segment, "ab") as log:
+        log.write(b"\x03\x20\x00\x00\x00\x12")
+    patients_db, attending_db, replayed = recover(directory)
+    assert replayed == 7
+    assert os.path.getsize(segment) == size
+    assert_recovered(patients_db, attending_db)
+
+
+def test_wal_group_commit(tmp_path):
+    from wal import WriteAheadLog
+    directory = str(tmp_path / "data")
+    patients_db, attending_db = make_databases()
+    wal = WriteAheadLog(directory, patients_db, attending_db)
+    wal.open()
+
+    def add_many(first):
+        for patient_id in range(first, first + 50):
+            add_patient(wal, patients_db, patient_id, "Smith.J")
+
+    threads = [threading.Thread(target=add_many, args=(first,))
+               for first in range(0, 400, 50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wal.close()
+    patients_db, attending_db, replayed = recover(directory)
+    assert replayed == 400
+    assert sorted(patients_db[i]["patient_id"] for i in range(400)) == \
+        list(range(400))
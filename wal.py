@@ -0,0 +1,606 @@
+from array import array
+import json
+import logging
+import os
+import shutil
+import struct
+import sys
+import threading
+import zlib
+from hr_series import HeartRateSeries, get_series, new_series_keys, to_epoch
+
+# Log record types
+PATIENT = 1
+ATTENDING = 2
+READINGS = 3
+REMOVAL = 4
+
+# Every log record starts with its type, the length of its payload and the
+# CRC-32 of the payload, so a record cut short by a crash is detected
+FRAME = struct.Struct("<BII")
+# A READINGS payload is the patient_id and the epoch seconds of the
+# readings, followed by the heart rates as 64-bit integers
+READINGS_HEADER = struct.Struct("<qq")
+SINGLE_READING = struct.Struct("<qqq")
+# A REMOVAL payload is the patient_id of the removed patient
+REMOVED_PATIENT = struct.Struct("<q")
+
+SNAPSHOT_MAGIC = b"HRSSNAP1"
+SNAPSHOT_FILE = "snapshot.bin"
+SEGMENT_FILE = "wal.{:08d}.log"
+SERIES_KEYS = ("heart_rate", "timestamp")
+# Heart rates are loaded from a snapshot this many readings at a time
+LOAD_CHUNK = 1 << 20
+# At most this many bytes of log are shipped to a standby at a time
+SHIP_LIMIT = 1 << 20
+
+
+class WriteAheadLog:
+    """ Write-ahead log and snapshots that make the databases survive restarts
+
+    Every change to the patient and attending physician databases is
+    appended to a binary log before the request that made it returns: new
+    patients and attending physicians as JSON, heart rate readings and
+    removed patients as packed integers. Changes are collected in memory
+    and written with one write and one fsync for every thread that is
+    waiting at that moment (group commit), so concurrent requests share the
+    cost of the fsync.
+    Once snapshot_every records have been logged, a background thread
+    writes a snapshot of both databases, where each patient's heart rates
+    are stored as the raw arrays of their HeartRateSeries, followed by the
+    buckets of its rollups, and starts a new log segment. Segments older
+    than the newest snapshot are deleted, except the one just before it,
+    which a standby may still be reading.
+    open recovers the databases by loading the snapshot and replaying the
+    log segments written after it.
+    A standby server keeps a copy of the databases by applying the log of
+    its primary: the primary ships the bytes of its segments once they are
+    on disk (see shipped and shipped_snapshot), and the standby writes them
+    to segments of its own and applies their records (see receive and
+    restore), so its folder holds the same log as the primary's.
+    Callers hold lock while they log a change and apply it to the
+    databases, so that a snapshot never sees a change that was logged but
+    not applied yet, and call commit after releasing the lock. When lock is
+    a LockStripes, a caller that changes one patient's readings only holds
+    that patient's stripe.
+    """
+
+    def __init__(self, directory, patients_db, attending_db,
+                 snapshot_every=500000, fsync=True, new_series=None,
+                 lock=None):
+        """ Create a write-ahead log for two databases
+
+        Nothing is logged until open is called.
+
+        :param directory: the folder for the snapshot and log segments
+        :param patients_db: the patient Registry, keyed by patient_id
+        :param attending_db: the attending physician Registry, keyed by
+        attending_username
+        :param snapshot_every: the number of logged records after which a
+        new snapshot is taken
+        :param fsync: False to skip the fsync in commit, which is faster but
+        can lose the latest changes if the machine (not just the server)
+        crashes
+        :param new_series: a function that takes a patient dictionary and
+        returns the empty series (a HeartRateSeries or RingSeries) for its
+        recovered readings; by default a HeartRateSeries that keeps every
+        reading in memory
+        :param lock: the lock held by snapshot and by callers that log and
+        apply a change, or None for a new RLock. A LockStripes can be given
+        so callers hold only one stripe while the snapshot holds them all.
+        """
+        self.directory = directory
+        self.patients_db = patients_db
+        self.attending_db = attending_db
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.new_series = new_series or (lambda patient: HeartRateSeries())
+        self.lock = lock or threading.RLock()
+        self._io = threading.Condition(threading.Lock())
+        self._buffer = bytearray()
+        self._file = None
+        self._generation = 0
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+        self._size = 0
+        self._pending = b""
+        self._since_snapshot = 0
+        self._snapshot_thread = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _segments(self):
+        generations = []
+        for name in os.listdir(self.directory):
+            if name.startswith("wal.") and name.endswith(".log"):
+                generations.append(int(name[4:-4]))
+        return sorted(generations)
+
+    def open(self):
+        """ Recover the databases from disk and start logging changes
+
+        The snapshot is loaded first, then every log record written after it
+        is replayed in order. Records are added to the databases, replacing
+        records with the same key. A record cut short at the end of a log
+        segment by a crash is dropped.
+
+        :returns: the number of log records that were replayed
+        """
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            generation = self._load_snapshot()
+            replayed = 0
+            segments = self._segments()
+            for segment in segments:
+                if segment < generation - 1:
+                    os.remove(self._path(SEGMENT_FILE.format(segment)))
+                elif segment >= generation:
+                    replayed += self._replay(segment)
+            self._generation = max([generation] + segments)
+            self._file = open(self._path(SEGMENT_FILE.format(
+                self._generation)), "ab")
+            self._size = os.path.getsize(self._file.name)
+            self._since_snapshot = replayed
+            return replayed
+
+    def _load_snapshot(self):
+        path = self._path(SNAPSHOT_FILE)
+        if not os.path.exists(path):
+            return 0
+        with open(path, "rb") as snapshot:
+            if snapshot.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise ValueError("{} is not a snapshot".format(path))
+            length, = struct.unpack("<Q", snapshot.read(8))
+            state = json.loads(snapshot.read(length))
+            swap = state["byteorder"] != sys.byteorder
+            self.attending_db.extend(state["attendings"])
+            patients = []
+            for patient in state["patients"]:
+                stored = patient.pop("series", None)
+                if stored is not None:
+                    count, minimum, maximum, sum_squares = stored[:4]
+                    series = self.new_series(patient)
+                    self._load_series(snapshot, series, count, swap)
+                    series.restore_aggregates(minimum, maximum, sum_squares)
+                    # Snapshots written before rollups were saved have no
+                    # bucket counts, and the rollups are built instead
+                    rollups = None
+                    if len(stored) > 4:
+                        rollups = self._load_rollups(snapshot, stored[4],
+                                                     swap)
+                    series.restore_rollups(rollups)
+                    patient.update(new_series_keys(series))
+                patients.append(patient)
+            self.patients_db.extend(patients)
+        return state["generation"]
+
+    def _load_series(self, snapshot, series, count, swap):
+        # The snapshot holds count epochs followed by count + 1 prefix sums,
+        # the first of which is zero; both are read a chunk at a time so a
+        # series that moves readings to a cold tier is never whole in memory
+        start = snapshot.tell()
+        for position in range(0, count, LOAD_CHUNK):
+            size = min(LOAD_CHUNK, count - position)
+            epochs = array("q")
+            snapshot.seek(start + 8 * position)
+            epochs.fromfile(snapshot, size)
+            prefix = array("q")
+            snapshot.seek(start + 8 * (count + 1 + position))
+            prefix.fromfile(snapshot, size)
+            if swap:
+                epochs.byteswap()
+                prefix.byteswap()
+            series.extend_arrays(epochs, prefix)
+        snapshot.seek(start + 8 * (2 * count + 1))
+
+    def _load_rollups(self, snapshot, sizes, swap):
+        # Each resolution's rollups are five columns of its number of
+        # buckets, in the order of Rollups.frozen
+        rollups = []
+        for size in sizes:
+            columns = []
+            for _ in range(5):
+                column = array("q")
+                column.fromfile(snapshot, size)
+                if swap:
+                    column.byteswap()
+                columns.append(column)
+            rollups.append(tuple(columns))
+        return rollups
+
+    def _replay(self, segment):
+        path = self._path(SEGMENT_FILE.format(segment))
+        with open(path, "rb") as log:
+            data = log.read()
+        offset, records = self._apply_log(data)
+        if offset < len(data):
+            logging.warning("Dropped {} bytes of an incomplete record at the "
+                            "end of {}".format(len(data) - offset, path))
+            with open(path, "r+b") as log:
+                log.truncate(offset)
+        return records
+
+    def _apply_log(self, data):
+        # Applies the whole records at the start of data and returns the
+        # length they take up and their number
+        view = memoryview(data)
+        # Most records are single readings, so each patient's series is
+        # looked up once per segment rather than once per record
+        series_by_id = {}
+        offset = 0
+        records = 0
+        while offset + FRAME.size <= len(data):
+            kind, length, crc = FRAME.unpack_from(data, offset)
+            start = offset + FRAME.size
+            payload = view[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            offset = start + length
+            records += 1
+            if kind != READINGS:
+                self._apply(kind, payload)
+                series_by_id.clear()
+                continue
+            if length == SINGLE_READING.size:
+                patient_id, epoch, heart_rate = SINGLE_READING.unpack_from(
+                    payload)
+                heart_rates = None
+            else:
+                patient_id, epoch = READINGS_HEADER.unpack_from(payload)
+                heart_rates = struct.unpack_from(
+                    "<{}q".format((length - READINGS_HEADER.size) // 8),
+                    payload, READINGS_HEADER.size)
+            series = series_by_id.get(patient_id)
+            if series is None:
+                series = series_by_id[patient_id] = self._series(patient_id)
+                if series is None:
+                    continue
+            if heart_rates is None:
+                series.append_at(heart_rate, epoch)
+            else:
+                series.extend_at(heart_rates, epoch)
+        view.release()
+        return offset, records
+
+    def _series(self, patient_id):
+        patient = self.patients_db.get(patient_id)
+        if patient is None:
+            return None
+        if get_series(patient) is None:
+            patient.update(new_series_keys(self.new_series(patient)))
+        return get_series(patient)
+
+    def _apply(self, kind, payload):
+        if kind == PATIENT:
+            # Logs written before patients were kept may add a patient again;
+            # the first one is kept with its readings, as add_patients does
+            patient = json.loads(bytes(payload))
+            if patient["patient_id"] not in self.patients_db:
+                self.patients_db.append(patient)
+        elif kind == ATTENDING:
+            self.attending_db.append(json.loads(bytes(payload)))
+        elif kind == REMOVAL:
+            self.patients_db.remove(REMOVED_PATIENT.unpack(payload)[0])
+
+    def _append(self, kind, payload):
+        if self._file is None:
+            return
+        with self._io:
+            self._buffer += FRAME.pack(kind, len(payload), zlib.crc32(payload))
+            self._buffer += payload
+            self._written += 1
+            self._since_snapshot += 1
+
+    def log_patient(self, patient):
+        """ Log a new patient
+
+        :param patient: the patient dictionary or PatientRecord; its heart
+        rates are not logged, they are logged as readings
+        """
+        record = {key: value for key, value in patient.items()
+                  if key not in SERIES_KEYS}
+        self._append(PATIENT, json.dumps(record).encode())
+
+    def log_attending(self, attending):
+        """ Log a new attending physician
+
+        :param attending: the attending physician dictionary or
+        AttendingRecord
+        """
+        self._append(ATTENDING, json.dumps(dict(attending)).encode())
+
+    def log_removal(self, patient_id):
+        """ Log the removal of a patient and its readings
+
+        :param patient_id: the patient_id as an integer
+        """
+        self._append(REMOVAL, REMOVED_PATIENT.pack(patient_id))
+
+    def log_readings(self, patient_id, heart_rates, timestamp):
+        """ Log heart rate readings taken at the same time for one patient
+
+        :param patient_id: the patient_id as an integer
+        :param heart_rates: a list of heart rates as integers
+        :param timestamp: the time of the readings as a datetime
+        """
+        self._append(READINGS,
+                     READINGS_HEADER.pack(patient_id, to_epoch(timestamp)) +
+                     struct.pack("<{}q".format(len(heart_rates)),
+                                 *heart_rates))
+
+    def commit(self):
+        """ Wait until every change logged so far is on disk
+
+        The first thread to call commit writes and fsyncs everything that
+        has been logged. Threads that call commit meanwhile wait, and are
+        served together by the next write and fsync.
+        """
+        with self._io:
+            target = self._written
+            while self._synced < target:
+                if self._syncing:
+                    self._io.wait()
+                else:
+                    self._flush()
+            start_snapshot = self._since_snapshot >= self.snapshot_every and \
+                (self._snapshot_thread is None or
+                 not self._snapshot_thread.is_alive())
+            if start_snapshot:
+                self._snapshot_thread = threading.Thread(
+                    target=self.snapshot, name="wal-snapshot", daemon=True)
+                self._snapshot_thread.start()
+
+    def _flush(self):
+        # Called with _io held; releases it while writing so that other
+        # threads can keep logging into the next group
+        self._syncing = True
+        data = self._buffer
+        self._buffer = bytearray()
+        written = self._written
+        log = self._file
+        self._io.release()
+        try:
+            log.write(data)
+            log.flush()
+            if self.fsync:
+                os.fsync(log.fileno())
+        finally:
+            self._io.acquire()
+            self._syncing = False
+            self._io.notify_all()
+        self._synced = written
+        self._size += len(data)
+
+    def snapshot(self):
+        """ Write a snapshot of both databases and start a new log segment
+
+        The databases are copied while holding lock, which takes a few
+        milliseconds per million readings; the copy is written to disk after
+        the lock is released. Readings in a cold tier are not copied: their
+        files are opened while holding lock and read afterwards.
+        """
+        with self.lock:
+            if self._file is None:
+                return
+            attendings = [dict(attending) for attending in self.attending_db]
+            patients = []
+            arrays = []
+            for patient in self.patients_db:
+                record = {key: value for key, value in patient.items()
+                          if key not in SERIES_KEYS}
+                series = get_series(patient)
+                if series is not None:
+                    rollups = series.get_rollups().frozen()
+                    record["series"] = [len(series), series.minimum,
+                                        series.maximum, series.sum_squares,
+                                        [len(columns[0])
+                                         for columns in rollups]]
+                    arrays.append(series.frozen() + (rollups,))
+                patients.append(record)
+            with self._io:
+                while self._syncing:
+                    self._io.wait()
+                self._flush()
+                self._file.close()
+                self._generation += 1
+                self._file = open(self._path(SEGMENT_FILE.format(
+                    self._generation)), "ab")
+                self._size = 0
+                self._since_snapshot = 0
+                generation = self._generation
+                self._io.notify_all()
+        state = json.dumps({"generation": generation,
+                            "byteorder": sys.byteorder,
+                            "attendings": attendings,
+                            "patients": patients}).encode()
+        path = self._path(SNAPSHOT_FILE)
+        try:
+            with open(path + ".tmp", "wb") as snapshot:
+                snapshot.write(SNAPSHOT_MAGIC)
+                snapshot.write(struct.pack("<Q", len(state)))
+                snapshot.write(state)
+                for cold, epochs, prefix, rollups in arrays:
+                    if cold is None:
+                        epochs.tofile(snapshot)
+                        prefix.tofile(snapshot)
+                    else:
+                        # The cold records come first, and prefix[0] of the
+                        # readings in memory is the last cold prefix sum
+                        cold.write_column(snapshot, 0)
+                        epochs.tofile(snapshot)
+                        snapshot.write(bytes(8))
+                        cold.write_column(snapshot, 1)
+                        prefix[1:].tofile(snapshot)
+                    for columns in rollups:
+                        for column in columns:
+                            column.tofile(snapshot)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+        finally:
+            for cold, _, _, _ in arrays:
+                if cold is not None:
+                    cold.close()
+        os.replace(path + ".tmp", path)
+        for segment in self._segments():
+            if segment < generation - 1:
+                os.remove(self._path(SEGMENT_FILE.format(segment)))
+
+    def position(self):
+        """ The end of the log on disk
+
+        :returns: a tuple of the generation of the current log segment and
+        the number of bytes in it
+        """
+        with self._io:
+            return self._generation, self._size
+
+    def shipped(self, generation, offset, limit=SHIP_LIMIT, wait=0):
+        """ Read the log written after a position, for a standby to apply
+
+        Only what is already on disk is read, so a standby never applies a
+        change the primary could still lose.
+
+        :param generation: the generation of the log segment to read from
+        :param offset: the number of bytes of that segment already read
+        :param limit: the most bytes to read
+        :param wait: seconds to wait for more of the log to reach the disk
+        when the position is the end of the log
+
+        :returns: a tuple of the bytes read, True if they end the segment so
+        the standby goes on with the next generation, and the number of
+        bytes on disk after them
+
+        :raises LookupError: if the segment was deleted once a snapshot
+        included it; the standby then loads the snapshot
+        :raises ValueError: if the position is past the end of the log,
+        e.g. the standby logged changes of its own
+        """
+        with self._io:
+            if (generation, offset) == (self._generation, self._size):
+                self._io.wait_for(lambda: (self._generation, self._size) !=
+                                  (generation, offset), wait)
+            current, size = self._generation, self._size
+        try:
+            log = open(self._path(SEGMENT_FILE.format(generation)), "rb")
+        except FileNotFoundError:
+            raise LookupError("Log segment {} was deleted".format(generation))
+        with log:
+            end = size if generation == current else \
+                os.fstat(log.fileno()).st_size
+            if generation > current or offset > end:
+                raise ValueError("Position {} of log segment {} is past the "
+                                 "end of the log".format(offset, generation))
+            log.seek(offset)
+            data = log.read(min(limit, end - offset))
+        behind = end - offset - len(data)
+        if generation < current:
+            for later in range(generation + 1, current):
+                path = self._path(SEGMENT_FILE.format(later))
+                if os.path.exists(path):
+                    behind += os.path.getsize(path)
+            behind += size
+        complete = generation < current and offset + len(data) == end
+        return data, complete, behind
+
+    def shipped_snapshot(self):
+        """ Find the latest snapshot for a standby to load, taking one first
+        if there is none yet
+
+        :returns: the absolute path of the snapshot file, which is replaced
+        rather than rewritten by later snapshots
+        """
+        path = self._path(SNAPSHOT_FILE)
+        if not os.path.exists(path):
+            self.snapshot()
+        return os.path.abspath(path)
+
+    def receive(self, generation, data):
+        """ Write log bytes shipped by a primary and apply their records
+
+        Used by a standby instead of logging changes itself. When the
+        primary has moved on to the next generation, the standby takes a
+        snapshot first, which moves it on too. A record split between two
+        shipments is applied once its end arrives.
+
+        :param generation: the generation of the primary's segment the
+        bytes are from
+        :param data: the bytes, which follow the ones received before
+
+        :returns: the number of records applied
+
+        :raises ValueError: if the bytes do not follow the ones received
+        before
+        """
+        if generation == self._generation + 1 and not self._pending:
+            self.snapshot()
+        with self.lock:
+            with self._io:
+                if generation != self._generation:
+                    raise ValueError("Received log segment {} while at "
+                                     "segment {}".format(generation,
+                                                         self._generation))
+                self._file.write(data)
+                self._file.flush()
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+                self._size += len(data)
+                self._io.notify_all()
+            data = self._pending + data
+            offset, records = self._apply_log(data)
+            self._pending = data[offset:]
+            self._since_snapshot += records
+        return records
+
+    def restore(self, snapshot):
+        """ Replace the log with a snapshot shipped by a primary and load it
+
+        The caller holds lock and has emptied the databases. Every log
+        segment is deleted, and the shipped log that follows the snapshot
+        is received into a new segment of the snapshot's generation.
+
+        :param snapshot: a binary file object holding the primary's
+        snapshot
+        """
+        path = self._path(SNAPSHOT_FILE)
+        with open(path + ".tmp", "wb") as copy:
+            shutil.copyfileobj(snapshot, copy)
+            copy.flush()
+            os.fsync(copy.fileno())
+        os.replace(path + ".tmp", path)
+        with self._io:
+            self._file.close()
+            for segment in self._segments():
+                os.remove(self._path(SEGMENT_FILE.format(segment)))
+            self._generation = self._load_snapshot()
+            self._file = open(self._path(SEGMENT_FILE.format(
+                self._generation)), "ab")
+            self._size = 0
+            self._pending = b""
+            self._since_snapshot = 0
+
+    def end_replication(self):
+        """ Get ready to log changes after the ones received from a primary
+
+        The start of a record whose end was never received is dropped from
+        the log, so the records logged next follow the last whole one.
+        """
+        with self.lock, self._io:
+            if self._pending:
+                self._size -= len(self._pending)
+                self._file.truncate(self._size)
+                self._pending = b""
+
+    def close(self):
+        """ Write any pending changes, wait for a running snapshot and stop
+        logging
+        """
+        self.commit()
+        thread = self._snapshot_thread
+        if thread is not None:
+            thread.join()
+        with self.lock, self._io:
+            if self._file is not None:
+                self._file.close()
+                self._file = None